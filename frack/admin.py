@@ -0,0 +1,154 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+"""
+Operational information for administrators, served on its own endpoint.
+"""
+
+import json
+import hashlib
+
+from twisted.python import log
+from twisted.web.resource import Resource, ForbiddenResource
+from twisted.web.server import NOT_DONE_YET
+
+from frack.profiler import FORMATS
+
+
+
+def constantTimeEqual(a, b):
+    """
+    Compare two strings in time which doesn't depend on where they differ,
+    like C{hmac.compare_digest} (which older Pythons don't have).  The
+    strings are hashed first so their lengths don't matter either.
+    """
+    a = hashlib.sha256(a).digest()
+    b = hashlib.sha256(b).digest()
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+
+class JSONResource(Resource):
+    """
+    I serve the result of calling a function as JSON.
+    """
+
+    isLeaf = True
+
+
+    def __init__(self, func):
+        Resource.__init__(self)
+        self.func = func
+
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'application/json')
+        request.setHeader('Cache-Control', 'no-cache')
+        return json.dumps(self.func(), indent=2, sort_keys=True)
+
+
+
+class ProfileResource(Resource):
+    """
+    I profile the server for C{?seconds=} (default 10) and serve the result
+    in C{?format=collapsed} (the default) or C{?format=speedscope}.
+    C{?interval=} sets the seconds between samples.  Any C{?pid=} is passed
+    on to C{profile}.
+    """
+
+    isLeaf = True
+
+
+    def __init__(self, profile):
+        """
+        @param profile: A function like L{frack.profiler.profileFor}.
+        """
+        Resource.__init__(self)
+        self.profile = profile
+
+
+    def _error(self, request, message):
+        request.setResponseCode(400)
+        request.setHeader('Content-Type', 'text/plain')
+        return message + '\n'
+
+
+    def render_GET(self, request):
+        format = request.args.get('format', ['collapsed'])[0]
+        kwargs = {}
+        try:
+            seconds = float(request.args.get('seconds', ['10'])[0])
+            interval = float(request.args.get('interval', ['0.005'])[0])
+            if 'pid' in request.args:
+                kwargs['pid'] = int(request.args['pid'][0])
+            d = self.profile(seconds, format, interval, **kwargs)
+        except ValueError as e:
+            return self._error(request, str(e))
+
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
+        def done(output):
+            if finished:
+                return
+            request.setHeader('Content-Type', FORMATS[format])
+            request.setHeader('Cache-Control', 'no-cache')
+            request.write(output)
+            request.finish()
+        def failed(failure):
+            if finished:
+                return
+            if failure.check(ValueError):
+                request.write(self._error(request, failure.getErrorMessage()))
+            else:
+                log.err(failure, 'Error profiling')
+                request.setResponseCode(500)
+            request.finish()
+        d.addCallbacks(done, failed)
+        return NOT_DONE_YET
+
+
+
+class AdminResource(Resource):
+    """
+    The root of the admin endpoint.  Requests must pass my C{token} in an
+    C{X-Admin-Token} header.  It isn't taken from the query, where it
+    would end up in logs and browser history.
+    """
+
+    def __init__(self, metrics, token, profile=None):
+        """
+        @param metrics: A function returning a dict of metrics, served at
+            C{/metrics}.
+        @param token: The secret requests must give.
+        @param profile: A function like L{frack.profiler.profileFor}, served
+            by a L{ProfileResource} at C{/profile}, or C{None}.
+
+        @raise ValueError: If C{token} is empty.
+        """
+        if not token:
+            raise ValueError('The admin endpoint needs a token')
+        Resource.__init__(self)
+        self.token = token
+        self.putChild('metrics', JSONResource(metrics))
+        if profile is not None:
+            self.putChild('profile', ProfileResource(profile))
+
+
+    def authorized(self, request):
+        given = request.getHeader('x-admin-token') or ''
+        return constantTimeEqual(given, self.token)
+
+
+    def getChildWithDefault(self, path, request):
+        if not self.authorized(request):
+            return ForbiddenResource()
+        return Resource.getChildWithDefault(self, path, request)
+
+
+    def render_GET(self, request):
+        if not self.authorized(request):
+            return ForbiddenResource().render(request)
+        request.setHeader('Content-Type', 'text/plain')
+        return '\n'.join(sorted(self.children)) + '\n'
@@ -0,0 +1,267 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+"""
+Admission control in front of the database.
+
+When the database is busy, requests wait in a bounded queue for a turn
+rather than all piling onto it at once, and those that would wait too long
+are turned away with a 503 so that clients back off instead of timing out
+and retrying.
+"""
+
+import heapq
+import itertools
+import math
+
+from twisted.internet import defer
+
+
+# Priorities; lower goes first.
+WRITE = 0
+AUTH = 1
+READ = 2
+ANONYMOUS_READ = 3
+
+DEFAULT_LIMITS = {
+    'read': 8,
+    'write': 4,
+    'auth': 4,
+}
+
+
+def parseLimits(text):
+    """
+    Parse limits given as C{read=8,write=4,auth=4}.
+
+    @raise ValueError: If they're malformed.
+    """
+    limits = {}
+    for part in text.split(','):
+        if part.strip():
+            kind, value = part.split('=')
+            limits[kind.strip()] = int(value)
+    unknown = set(limits) - set(DEFAULT_LIMITS)
+    if unknown:
+        raise ValueError('Unknown operation classes: %s' % (
+            ', '.join(sorted(unknown)),))
+    return limits
+
+
+
+class Overloaded(Exception):
+    """
+    There's too much to do right now.
+
+    @ivar retryAfter: Seconds the client should wait before trying again.
+    """
+
+    def __init__(self, retryAfter):
+        Exception.__init__(self, 'Overloaded; retry after %s seconds' % (
+            retryAfter,))
+        self.retryAfter = retryAfter
+
+
+
+class _Waiter(object):
+
+    def __init__(self, kind, priority, deferred, timeout):
+        self.kind = kind
+        self.priority = priority
+        self.deferred = deferred
+        self.timeout = timeout
+        self.cancelled = False
+
+
+
+class AdmissionController(object):
+    """
+    I limit how many database operations of each class (C{'read'},
+    C{'write'} and C{'auth'}) run at once, and how many run in all.
+
+    Operations which can't start straight away wait in one queue ordered by
+    priority, so writes go before reads and logged-in readers before
+    anonymous ones.  No more than C{queueSize} operations wait: when the
+    queue is full, a newcomer takes the place of the lowest-priority waiter
+    if it outranks it, and is refused otherwise (ties go to those already
+    waiting).  Nothing waits for longer than C{deadline} seconds.  Refused
+    operations fail with L{Overloaded}.
+    """
+
+    def __init__(self, limits=None, capacity=None, queueSize=100,
+                 deadline=2.0, clock=None):
+        """
+        @param limits: A dict of the number of operations of each class
+            allowed at once.
+        @param capacity: The number of operations allowed at once in all
+            (for instance, the size of the connection pool).  Defaults to
+            the sum of C{limits}.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.limits = dict(DEFAULT_LIMITS)
+        self.limits.update(limits or {})
+        if capacity is None:
+            capacity = sum(self.limits.values())
+        self.capacity = capacity
+        self.queueSize = queueSize
+        self.deadline = deadline
+        self.clock = clock
+        self.active = dict([(k, 0) for k in self.limits])
+        self.rejected = dict([(k, 0) for k in self.limits])
+        self._queue = []
+        self._waiting = 0
+        self._counter = itertools.count()
+        self._starting = False
+        self._again = False
+
+
+    def retryAfter(self):
+        return int(math.ceil(self.deadline)) or 1
+
+
+    def waiting(self):
+        return self._waiting
+
+
+    def _canStart(self, kind):
+        return (self.active[kind] < self.limits[kind]
+                and sum(self.active.values()) < self.capacity)
+
+
+    def acquire(self, kind, priority=READ):
+        """
+        Wait for a turn.
+
+        @return: A Deferred which fires with a function to call when the
+            operation is done, or fails with L{Overloaded}.
+        """
+        d = defer.Deferred()
+        waiter = _Waiter(kind, priority, d, None)
+        heapq.heappush(self._queue, (priority, next(self._counter), waiter))
+        self._waiting += 1
+        self._next()
+        if d.called:
+            return d
+
+        if self._waiting > self.queueSize:
+            # Refuse the lowest-priority waiter (perhaps this one).
+            worst = max([x for x in self._queue if not x[2].cancelled])
+            self._refuse(worst[2])
+        if not waiter.cancelled:
+            waiter.timeout = self.clock.callLater(self.deadline,
+                                                  self._expire, waiter)
+        return d
+
+
+    def _expire(self, waiter):
+        waiter.timeout = None
+        self._refuse(waiter)
+
+
+    def _refuse(self, waiter):
+        waiter.cancelled = True
+        self._waiting -= 1
+        if waiter.timeout is not None and waiter.timeout.active():
+            waiter.timeout.cancel()
+        self.rejected[waiter.kind] += 1
+        waiter.deferred.errback(Overloaded(self.retryAfter()))
+
+
+    def _releaser(self, kind):
+        released = []
+        def release():
+            if released:
+                return
+            released.append(True)
+            self.active[kind] -= 1
+            self._next()
+        return release
+
+
+    def _next(self):
+        """
+        Start the highest-priority waiters that can start.
+        """
+        # Operations may finish (and call this) while it's starting them.
+        if self._starting:
+            self._again = True
+            return
+        self._starting = True
+        try:
+            self._again = True
+            while self._again:
+                self._again = False
+                self._startWaiters()
+        finally:
+            self._starting = False
+
+
+    def _startWaiters(self):
+        skipped = []
+        while self._queue:
+            entry = heapq.heappop(self._queue)
+            waiter = entry[2]
+            if waiter.cancelled:
+                continue
+            if sum(self.active.values()) >= self.capacity:
+                skipped.append(entry)
+                break
+            if not self._canStart(waiter.kind):
+                # Its class is full; let others past.
+                skipped.append(entry)
+                continue
+            self._waiting -= 1
+            if waiter.timeout is not None:
+                waiter.timeout.cancel()
+            self.active[waiter.kind] += 1
+            waiter.deferred.callback(self._releaser(waiter.kind))
+        for entry in skipped:
+            heapq.heappush(self._queue, entry)
+
+
+    def run(self, kind, priority, func, *args, **kwargs):
+        """
+        Call C{func} when there's a turn, and end the turn when the Deferred
+        it returns fires.
+        """
+        def start(release):
+            d = defer.maybeDeferred(func, *args, **kwargs)
+            def done(result):
+                release()
+                return result
+            return d.addBoth(done)
+        return self.acquire(kind, priority).addCallback(start)
+
+
+    def runner(self, runner, kind, priority=None):
+        """
+        Wrap a runner so its operations are admitted by me.
+        """
+        if priority is None:
+            priority = {'write': WRITE, 'auth': AUTH}.get(kind, READ)
+        return AdmittedRunner(runner, self, kind, priority)
+
+
+
+class AdmittedRunner(object):
+    """
+    A runner whose operations each wait for a turn from an
+    L{AdmissionController}.
+    """
+
+    def __init__(self, runner, controller, kind, priority):
+        self.runner = runner
+        self.controller = controller
+        self.kind = kind
+        self.priority = priority
+
+
+    def run(self, op):
+        return self.controller.run(self.kind, self.priority,
+                                   self.runner.run, op)
+
+
+    def runInteraction(self, func, *args, **kwargs):
+        return self.controller.run(self.kind, self.priority,
+                                   self.runner.runInteraction, func, *args,
+                                   **kwargs)
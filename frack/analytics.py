@@ -0,0 +1,233 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+"""
+Tickets opened, closed and reopened over the tracker's whole history, and
+the backlog of open tickets, as time series.
+
+L{History} keeps three NumPy arrays of times: when each ticket was created,
+and when one was closed or reopened (from C{status} rows of
+C{ticket_change}).  It reads only what's been added since it last looked,
+keyed on C{(time, ticket)}, so the first read is the only big one.  Series
+are then binned with C{bincount} and the backlog is a cumulative sum, and
+each series is cached until more history arrives.
+
+NumPy is optional; without it L{available} is C{False}.
+"""
+
+from twisted.internet import defer
+from norm.operation import SQL
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from frack.cache import SingleFlight, LRUCache
+
+
+available = numpy is not None
+
+BINS = {
+    'day': 86400,
+    'week': 7 * 86400,
+    'month': 30 * 86400,
+}
+
+KINDS = ['opened', 'closed', 'reopened']
+
+# The most bins in one series: over 27 years of days.
+MAX_BINS = 10000
+
+CREATED = '''
+    SELECT time, id, NULL, NULL
+    FROM ticket
+    WHERE time IS NOT NULL AND %s
+    ORDER BY time, id
+    LIMIT ?'''
+
+STATUS_CHANGES = '''
+    SELECT time, ticket, oldvalue, newvalue
+    FROM ticket_change
+    WHERE field = 'status' AND %s
+    ORDER BY time, ticket
+    LIMIT ?'''
+
+
+
+def _after(position, column):
+    """
+    A condition on C{time} and C{column} for rows after C{position}, and its
+    arguments.
+    """
+    if position is None:
+        return '1 = 1', ()
+    time, ticket = position
+    return 'time >= ? AND (time > ? OR (time = ? AND %s > ?))' % (column,), (
+        time, time, time, ticket)
+
+
+def transition(old, new):
+    """
+    Which of L{KINDS} a status change from C{old} to C{new} is, or C{None}.
+    """
+    if new == 'closed' and old != 'closed':
+        return 'closed'
+    if old == 'closed' and new != 'closed':
+        return 'reopened'
+    return None
+
+
+
+class TooManyBins(Exception):
+    """
+    A series would have more than L{MAX_BINS} bins.
+    """
+
+
+
+class History(object):
+    """
+    I hold the time of every ticket opened, closed and reopened.
+
+    @ivar times: A dict mapping each of L{KINDS} to a sorted NumPy array of
+        times.
+    @ivar version: The number of times I've learned something new, which
+        changes whenever the series would.
+    """
+
+    def __init__(self, runner, batchSize=10000, freshness=60, clock=None):
+        """
+        @param freshness: Seconds between looks for new history.
+        """
+        if numpy is None:
+            raise RuntimeError('Ticket analytics need numpy.')
+        self.runner = runner
+        self.batchSize = batchSize
+        self.times = dict((kind, numpy.zeros(0, numpy.int64))
+                          for kind in KINDS)
+        self.version = 0
+        self.series = LRUCache(32, clock=clock)
+        self._positions = {'created': None, 'status': None}
+        self._refresh = SingleFlight(lambda key: self.refresh(), freshness,
+                                     clock=clock)
+
+
+    def _read(self, name, sql, column):
+        """
+        Read the next batch of rows of C{sql}, after the last one read.
+        """
+        where, args = _after(self._positions[name], column)
+        return self.runner.run(SQL(sql % (where,),
+                                   args + (self.batchSize,)))
+
+
+    @defer.inlineCallbacks
+    def refresh(self):
+        """
+        Read the history added since I last looked.
+
+        @return: A Deferred which fires with the number of rows read.
+        """
+        total = 0
+        for name, sql, column in [('created', CREATED, 'id'),
+                                  ('status', STATUS_CHANGES, 'ticket')]:
+            while True:
+                rows = yield self._read(name, sql, column)
+                found = dict((kind, []) for kind in KINDS)
+                for time, ticket, old, new in rows:
+                    if name == 'created':
+                        found['opened'].append(time)
+                    else:
+                        kind = transition(old, new)
+                        if kind is not None:
+                            found[kind].append(time)
+                for kind, times in found.items():
+                    if times:
+                        # Rows arrive in time order, so this stays sorted.
+                        self.times[kind] = numpy.concatenate([
+                            self.times[kind], numpy.array(times, numpy.int64)])
+                if rows:
+                    self._positions[name] = tuple(rows[-1][:2])
+                total += len(rows)
+                if len(rows) < self.batchSize:
+                    break
+        if total:
+            self.version += 1
+        defer.returnValue(total)
+
+
+    def fresh(self):
+        """
+        Read the new history, unless I've looked in the last C{freshness}
+        seconds.  Concurrent callers share one read.
+        """
+        return self._refresh.get(None)
+
+
+    def compute(self, binSize, start=None, end=None):
+        """
+        Bin the history.
+
+        @param binSize: Seconds in each bin.
+        @param start: The time of the first bin, or C{None} to start at the
+            first ticket.  Whole bins before the first ticket are skipped.
+        @param end: The time the last bin ends by, or C{None} to go up to
+            the latest event.  It's never later than that.
+
+        @raise TooManyBins: If there'd be more than L{MAX_BINS} bins.
+
+        @return: A dict with C{'start'} and C{'bin'} (the time of the first
+            bin and the seconds in each), a list of counts for each of
+            L{KINDS}, and C{'backlog'}, the number of tickets open at the
+            end of each bin.
+        """
+        everything = numpy.concatenate(self.times.values())
+        first = int(everything.min()) if len(everything) else 0
+        last = int(everything.max()) + 1 if len(everything) else 0
+        if start is None:
+            start = first
+        elif start < first:
+            start += (first - start) // binSize * binSize
+        if end is None or end > last:
+            end = max(last, start)
+        count = max(0, -(-(end - start) // binSize))
+        if count > MAX_BINS:
+            raise TooManyBins(count)
+        result = {'start': start, 'bin': binSize}
+        net = numpy.zeros(count, numpy.int64)
+        # Tickets open at the start.
+        backlog = 0
+        for kind, sign in [('opened', 1), ('closed', -1), ('reopened', 1)]:
+            times = self.times[kind]
+            first, last = numpy.searchsorted(times, [start, end])
+            backlog += sign * int(first)
+            counts = numpy.bincount((times[first:last] - start) // binSize,
+                                    minlength=max(count, 1))[:count]
+            net += sign * counts
+            result[kind] = counts.tolist()
+        result['backlog'] = (backlog + numpy.cumsum(net)).tolist()
+        return result
+
+
+    def get(self, binSize, start=None, end=None):
+        """
+        Get binned history as L{compute} does, caching it until more
+        history arrives.
+        """
+        key = (self.version, binSize, start, end)
+        result = self.series.peek(key)
+        if result is None:
+            result = self.compute(binSize, start, end)
+            self.series.set(key, result, 86400)
+        return result
+
+
+    def stats(self):
+        """
+        The number of times and bytes I hold, for
+        L{frack.cache.CacheRegistry}.
+        """
+        return {
+            'entries': sum(len(x) for x in self.times.values()),
+            'bytes': sum(x.nbytes for x in self.times.values()),
+        }
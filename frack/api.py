@@ -0,0 +1,508 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+"""
+JSON API for tickets and their metadata.
+"""
+
+import json
+import base64
+import hashlib
+
+from klein import Klein
+from twisted.internet import defer
+
+from frack.db import TicketStore, NotFoundError
+from frack.admission import Overloaded, ANONYMOUS_READ
+from frack.web import getUser
+from frack.compression import matchingETag
+from frack.export import ExportResource
+from frack.index import STRING_COLUMNS, TIME_COLUMNS
+from frack.analytics import BINS, MAX_BINS, TooManyBins
+
+
+
+def encode(data):
+    """
+    Encode C{data} as compact JSON.
+    """
+    return json.dumps(data, separators=(',', ':'), sort_keys=True)
+
+
+def fieldList(request):
+    """
+    Get the list of fields asked for with C{?fields=a,b,c}, or C{None} if
+    all of them are wanted.
+    """
+    fields = request.args.get('fields', [''])[0]
+    if not fields:
+        return None
+    return [x.strip() for x in fields.split(',') if x.strip()]
+
+
+def intArg(request, name, default):
+    """
+    Get a non-negative integer query argument.
+
+    @raise ValueError: If it isn't one.
+    """
+    value = int(request.args.get(name, [default])[0])
+    if value < 0:
+        raise ValueError(value)
+    return value
+
+
+def publicTicket(ticket):
+    """
+    Leave out of a ticket's attachments the addresses they were uploaded
+    from, which aren't for everyone to see.
+    """
+    if not ticket.get('attachments'):
+        return ticket
+    return dict(ticket, attachments=publicAttachments(ticket['attachments']))
+
+
+def publicAttachments(attachments):
+    """
+    Leave out of attachments the addresses they were uploaded from.
+    """
+    return [dict((k, v) for k, v in x.items() if k not in ('ip', 'ipnr'))
+            for x in attachments]
+
+
+def jsonResponse(data, request):
+    """
+    Write C{data} as JSON with an ETag, or answer 304 if the client already
+    has it.
+    """
+    body = encode(data)
+    etag = '"%s"' % (hashlib.sha1(body).hexdigest(),)
+    request.setHeader('ETag', etag)
+    request.setHeader('Content-Type', 'application/json')
+    matched = matchingETag(request, etag)
+    if matched is not None:
+        request.setHeader('ETag', matched)
+        request.setResponseCode(304)
+        return ''
+    return body
+
+
+def encodeCursor(position):
+    """
+    Make an opaque cursor from a position from L{TicketStore.fetchChanges}.
+    """
+    return base64.urlsafe_b64encode(encode(list(position))).rstrip('=')
+
+
+def decodeCursor(cursor):
+    """
+    Get the position from a cursor made by L{encodeCursor}.
+
+    @raise ValueError: If it isn't one.
+    """
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        time, ticket, key = json.loads(data)
+    except (TypeError, ValueError):
+        raise ValueError(cursor)
+    if not (isinstance(time, (int, long)) and isinstance(ticket, (int, long))
+            and isinstance(key, basestring)):
+        raise ValueError(cursor)
+    return time, ticket, key
+
+
+def jsonError(request, code, message):
+    request.setResponseCode(code)
+    request.setHeader('Content-Type', 'application/json')
+    return encode({'error': message})
+
+
+
+class TicketAPI(object):
+    """
+    Version 1 of the JSON API.  Everything here reads L{TicketStore} and
+    returns the same dicts it produces, less the addresses attachments were
+    uploaded from.
+    """
+
+    app = Klein()
+
+    # Limit on the ids in one request to /tickets.
+    max_tickets = 100
+
+    # Limit on the comments in one page.
+    max_comments = 200
+
+    # Limits on /changes.
+    max_changes = 1000
+    max_wait = 60
+
+    # Seconds between checks for changes while long-polling, for changes
+    # made by other processes (which aren't published here).
+    poll_interval = 5
+
+    # Limit on /search.
+    max_search = 1000
+
+    # Limit on /similar.
+    max_similar = 50
+
+
+    def __init__(self, runner, admission=None, bus=None, clock=None,
+                 index=None, history=None, snapshots=False, similar=None):
+        """
+        @param admission: An L{frack.admission.AdmissionController} which
+            database work must wait for, or C{None}.
+        @param bus: The L{frack.pubsub.Bus} changes are published on, which
+            wakes up long-polling requests for changes, or C{None}.
+        @param index: The L{frack.index.TicketIndex} which answers
+            C{/search}, or C{None} if there isn't one.
+        @param history: The L{frack.analytics.History} which answers
+            C{/analytics}, or C{None} if there isn't one.
+        @param snapshots: If C{True}, use the snapshots of
+            L{frack.history} for C{/asof} and C{/diff}.
+        @param similar: The L{frack.similar.SimilarTickets} which answers
+            C{/similar}, or C{None} if there isn't one.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.runner = runner
+        self.admission = admission
+        self.bus = bus
+        self.clock = clock
+        self.index = index
+        self.history = history
+        self.snapshots = snapshots
+        self.similar = similar
+
+
+    def resource(self):
+        return self.app.resource()
+
+
+    def store(self, request):
+        user = getUser(request)
+        runner = self.runner
+        if self.admission is not None:
+            runner = self.admission.runner(runner, 'read',
+                                           None if user else ANONYMOUS_READ)
+        return TicketStore(runner, user, snapshots=self.snapshots)
+
+
+    def _respond(self, d, request):
+        d.addCallback(jsonResponse, request)
+        def failed(err):
+            if err.check(Overloaded):
+                request.setHeader('Retry-After', str(err.value.retryAfter))
+                return jsonError(request, 503, 'overloaded')
+            err.trap(NotFoundError)
+            return jsonError(request, 404, 'not found')
+        return d.addErrback(failed)
+
+
+    @app.route('/tickets/<int:ticket_number>', methods=['GET'])
+    def ticket(self, request, ticket_number):
+        d = self.store(request).fetchTicket(ticket_number,
+                                            fields=fieldList(request))
+        d.addCallback(publicTicket)
+        return self._respond(d, request)
+
+
+    @app.route('/tickets', methods=['GET'])
+    def tickets(self, request):
+        """
+        Get up to L{max_tickets} tickets with C{?ids=1,2,3}.
+        """
+        try:
+            ids = [int(x) for x in
+                   request.args.get('ids', [''])[0].split(',') if x]
+        except ValueError:
+            return jsonError(request, 400, 'ids must be integers')
+        if not ids:
+            return jsonError(request, 400, 'ids is required')
+        if len(ids) > self.max_tickets:
+            return jsonError(request, 400, 'at most %d ids at once' % (
+                self.max_tickets,))
+        d = self.store(request).fetchTickets(ids, fields=fieldList(request))
+        d.addCallback(lambda tickets: [publicTicket(x) for x in tickets])
+        return self._respond(d, request)
+
+
+    @app.route('/tickets/<int:ticket_number>/comments', methods=['GET'])
+    def comments(self, request, ticket_number):
+        """
+        Get a page of comments with C{?limit=50}, with at most
+        L{max_comments} in it.  For the next page, pass the C{time} of the
+        last comment as C{?after=}.
+        """
+        try:
+            after = None
+            if 'after' in request.args:
+                after = intArg(request, 'after', 0)
+            limit = min(intArg(request, 'limit', 50), self.max_comments)
+        except ValueError:
+            return jsonError(request, 400, 'after and limit must be '
+                                           'non-negative integers')
+        d = self.store(request).fetchCommentWindow(ticket_number, after,
+                                                   limit)
+        return self._respond(d, request)
+
+
+    @app.route('/tickets/<int:ticket_number>/attachments', methods=['GET'])
+    def attachments(self, request, ticket_number):
+        d = self.store(request).fetchTicket(ticket_number,
+                                            fields=['attachments'])
+        d.addCallback(lambda ticket: publicAttachments(ticket['attachments']))
+        return self._respond(d, request)
+
+
+    @app.route('/tickets/<int:ticket_number>/asof', methods=['GET'])
+    def asOf(self, request, ticket_number):
+        """
+        Get a ticket's fields and attachments as they were at C{?time=}
+        (seconds since the epoch).
+        """
+        try:
+            when = int(request.args['time'][0])
+        except (KeyError, ValueError):
+            return jsonError(request, 400, 'time is required')
+        d = self.store(request).fetchTicketAsOf(ticket_number, when)
+        d.addCallback(publicTicket)
+        return self._respond(d, request)
+
+
+    @app.route('/tickets/<int:ticket_number>/diff', methods=['GET'])
+    def diff(self, request, ticket_number):
+        """
+        Get the fields of a ticket which changed between C{?from=} and
+        C{?to=} (seconds since the epoch; C{to} defaults to now), as
+        C{{field: [old, new]}}, and the attachments added in between.
+        """
+        try:
+            start = int(request.args['from'][0])
+            end = int(request.args.get('to', [self.clock.seconds()])[0])
+        except (KeyError, ValueError):
+            return jsonError(request, 400, 'from is required')
+        d = self.store(request).fetchTicketDiff(ticket_number, start, end)
+        return self._respond(d, request)
+
+
+    @app.route('/export', methods=['GET'])
+    def export(self, request):
+        """
+        Stream every ticket as C{?format=jsonl} (the default) or
+        C{?format=csv}.  As this is a lot of work, only logged-in users may.
+        """
+        if not getUser(request):
+            return jsonError(request, 403, 'log in to export tickets')
+        return ExportResource(self.store(request).runner)
+
+
+    @app.route('/changes', methods=['GET'])
+    def changes(self, request):
+        """
+        Get changes to all tickets, oldest first, with C{?limit=100}.
+
+        Start at the beginning, at a time with C{?since=}, or after the
+        changes already seen with the C{cursor} from the last response.
+        With C{?wait=N}, if there are no changes yet, wait up to N seconds
+        for some.
+
+        The response is C{{"changes": [...], "cursor": ..., "more": bool}},
+        where C{more} means there are more changes to get now.  A change
+        committed after later ones had been got is skipped (see
+        L{TicketStore.fetchChanges}).
+        """
+        try:
+            limit = min(intArg(request, 'limit', 100), self.max_changes)
+            wait = min(intArg(request, 'wait', 0), self.max_wait)
+            if 'cursor' in request.args:
+                position = decodeCursor(request.args['cursor'][0])
+            elif 'since' in request.args:
+                position = (intArg(request, 'since', 0), -1, '')
+            else:
+                position = None
+        except ValueError:
+            return jsonError(request, 400, 'bad limit, wait, since or '
+                                           'cursor')
+        d = self._changes(self.store(request), position, limit or 1, wait)
+        # Stop waiting if the client goes away, rather than answering a
+        # request that's already finished.
+        request.notifyFinish().addErrback(lambda ignored: d.cancel())
+        def gone(err):
+            err.trap(defer.CancelledError)
+        return self._respond(d, request).addErrback(gone)
+
+
+    @defer.inlineCallbacks
+    def _changes(self, store, position, limit, wait):
+        deadline = self.clock.seconds() + wait
+        changes = yield store.fetchChanges(position, limit)
+        while not changes and self.clock.seconds() < deadline:
+            yield self._waitForChange(min(deadline - self.clock.seconds(),
+                                          self.poll_interval))
+            changes = yield store.fetchChanges(position, limit)
+        if changes:
+            position = changes[-1]['position']
+        for change in changes:
+            del change['position']
+        defer.returnValue({
+            'changes': changes,
+            'cursor': encodeCursor(position or (-1, -1, '')),
+            'more': len(changes) == limit,
+        })
+
+
+    def _waitForChange(self, timeout):
+        """
+        @return: A Deferred which fires when a change is published, or after
+            C{timeout} seconds.
+        """
+        d = defer.Deferred()
+        def fire(ignored=None):
+            if not d.called:
+                d.callback(None)
+        unsubscribe = lambda: None
+        if self.bus is not None:
+            unsubscribe = self.bus.subscribe(fire)
+        call = self.clock.callLater(timeout, fire)
+        def done(result):
+            unsubscribe()
+            if call.active():
+                call.cancel()
+            return result
+        return d.addBoth(done)
+
+
+    @app.route('/search', methods=['GET'])
+    def search(self, request):
+        """
+        Find tickets by their status, owner, component, milestone, type or
+        priority (C{?status=new,reopened}), or by when they were created or
+        last changed (C{?changetime_min=...&changetime_max=...}).
+
+        The response is C{{"count": N, "tickets": [...], "facets": {...}}},
+        with the numbers of up to C{?limit=50} matching tickets, most
+        recently changed first, and for each column named by
+        C{?facets=owner,component} a list of C{[value, count]}.
+        """
+        if self.index is None:
+            return jsonError(request, 404, 'search is not enabled')
+        if not self.index.ready:
+            request.setHeader('Retry-After', '5')
+            return jsonError(request, 503, 'the index is loading')
+        criteria = {}
+        for name in STRING_COLUMNS:
+            if name in request.args:
+                criteria[name] = request.args[name][0].split(',')
+        try:
+            limit = min(intArg(request, 'limit', 50), self.max_search)
+            for name in TIME_COLUMNS:
+                low = high = None
+                if name + '_min' in request.args:
+                    low = intArg(request, name + '_min', 0)
+                if name + '_max' in request.args:
+                    high = intArg(request, name + '_max', 0)
+                if (low, high) != (None, None):
+                    criteria[name] = (low, high)
+        except ValueError:
+            return jsonError(request, 400, 'bad limit or time')
+        facets = request.args.get('facets', [''])[0].split(',')
+        try:
+            result = {
+                'count': self.index.count(criteria),
+                'tickets': self.index.search(criteria, limit),
+                'facets': dict((name, self.index.facets(name, criteria))
+                               for name in facets if name),
+            }
+        except ValueError as e:
+            return jsonError(request, 400, str(e))
+        return jsonResponse(result, request)
+
+
+    @app.route('/similar', methods=['GET'])
+    def similarTickets(self, request):
+        """
+        Find the tickets most like a C{?summary=} and C{?description=}, for
+        spotting duplicates.  C{?exclude=N} leaves out ticket C{N}.
+
+        The response is a list of up to C{?limit=10} C{{"id": N, "summary":
+        ..., "status": ..., "resolution": ..., "score": S}}, most similar
+        (highest cosine similarity) first.
+        """
+        if self.similar is None:
+            return jsonError(request, 404, 'similar tickets are not enabled')
+        if not self.similar.ready:
+            request.setHeader('Retry-After', '5')
+            return jsonError(request, 503, 'the index is loading')
+        try:
+            limit = min(intArg(request, 'limit', 10), self.max_similar)
+            exclude = None
+            if 'exclude' in request.args:
+                exclude = intArg(request, 'exclude', 0)
+        except ValueError:
+            return jsonError(request, 400, 'bad limit or exclude')
+        summary = request.args.get('summary', [''])[0].decode('utf-8',
+                                                               'replace')
+        description = request.args.get('description', [''])[0].decode(
+            'utf-8', 'replace')
+        found = self.similar.similar(summary, description, limit, exclude)
+        scores = dict(found)
+        d = self.store(request).fetchTickets(
+            [number for number, score in found],
+            fields=['summary', 'status', 'resolution'])
+        def scored(tickets):
+            for ticket in tickets:
+                ticket['score'] = scores[ticket['id']]
+            return tickets
+        d.addCallback(scored)
+        return self._respond(d, request)
+
+
+    @app.route('/analytics', methods=['GET'])
+    def analytics(self, request):
+        """
+        Get the number of tickets opened, closed and reopened per
+        C{?bin=week} (or C{day} or C{month}), and the backlog of open
+        tickets at the end of each, from C{?start=} to C{?end=} (both
+        optional, in seconds since the epoch, and kept within the
+        tracker's history).  Ranges of more than
+        L{frack.analytics.MAX_BINS} bins are refused.
+        """
+        if self.history is None:
+            return jsonError(request, 404, 'analytics are not enabled')
+        size = request.args.get('bin', ['week'])[0]
+        if size not in BINS:
+            return jsonError(request, 400, 'bin must be one of: %s' % (
+                ', '.join(sorted(BINS)),))
+        try:
+            start = end = None
+            if 'start' in request.args:
+                start = intArg(request, 'start', 0)
+            if 'end' in request.args:
+                end = intArg(request, 'end', 0)
+        except ValueError:
+            return jsonError(request, 400, 'bad start or end')
+        d = self.history.fresh()
+        d.addCallback(lambda _: self.history.get(BINS[size], start, end))
+        def tooMany(err):
+            err.trap(TooManyBins)
+            return jsonError(request, 400, 'more than %d bins; use bigger '
+                                           'ones or a shorter range' % (
+                                               MAX_BINS,))
+        return self._respond(d, request).addErrback(tooMany)
+
+
+    @app.route('/components', methods=['GET'])
+    def components(self, request):
+        return self._respond(self.store(request).fetchComponents(), request)
+
+
+    @app.route('/milestones', methods=['GET'])
+    def milestones(self, request):
+        return self._respond(self.store(request).fetchMilestones(), request)
+
+
+    @app.route('/enums/<enum_type>', methods=['GET'])
+    def enums(self, request, enum_type):
+        d = self.store(request).fetchEnum(enum_type)
+        return self._respond(d, request)
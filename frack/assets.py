@@ -0,0 +1,170 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+"""
+Fingerprinted, precompressed static files.
+
+Run C{python -m frack.assets path/to/media} as a build step.  For every file
+in the media directory it writes a copy whose name contains a hash of its
+contents (C{trac.css} becomes something like C{trac.0123456789ab.css}),
+compressed C{.gz} (and C{.br}, if the C{brotli} module is installed) siblings
+of the text files, and a C{manifest.json} mapping original names to
+fingerprinted ones.  L{Renderer} uses the manifest to link to the
+fingerprinted names, which L{StaticFiles} serves with far-future caching.
+"""
+
+import os
+import sys
+import json
+import gzip
+import hashlib
+
+from twisted.python.filepath import FilePath
+from twisted.web import static
+
+from frack.compression import acceptedEncodings, addVary, brotli
+
+
+MANIFEST = 'manifest.json'
+
+# Only worth compressing text.  Images are already compressed.
+COMPRESSIBLE = ('.css', '.js', '.html', '.txt', '.svg', '.json')
+
+FAR_FUTURE = 'public, max-age=31536000'
+SHORT = 'public, max-age=3600'
+
+
+
+def loadManifest(media_path):
+    """
+    Get the mapping of original to fingerprinted names written by
+    L{build}, or an empty dict if there isn't one.
+    """
+    manifest = FilePath(media_path).child(MANIFEST)
+    if not manifest.exists():
+        return {}
+    return json.loads(manifest.getContent())
+
+
+def fingerprintedName(name, content):
+    """
+    Get the name a file should be given once fingerprinted.
+    """
+    root, ext = os.path.splitext(name)
+    digest = hashlib.md5(content).hexdigest()[:12]
+    return '%s.%s%s' % (root, digest, ext)
+
+
+def _compress(fp):
+    content = fp.getContent()
+    gz = fp.siblingExtension('.gz')
+    f = gzip.GzipFile(gz.path, 'wb', 9)
+    try:
+        f.write(content)
+    finally:
+        f.close()
+    if brotli is not None:
+        fp.siblingExtension('.br').setContent(brotli.compress(content))
+
+
+def build(media_path):
+    """
+    Write fingerprinted copies, compressed siblings and a manifest for the
+    files in C{media_path}.  Files written by an earlier build which are no
+    longer current are removed.
+
+    @return: The new manifest.
+    """
+    root = FilePath(media_path)
+    old = loadManifest(media_path)
+    generated = set(old.values())
+    manifest = {}
+    for fp in sorted(root.children()):
+        name = fp.basename()
+        if (fp.isdir() or name == MANIFEST or name in generated
+                or os.path.splitext(name)[1] in ('.gz', '.br')):
+            continue
+        content = fp.getContent()
+        target = root.child(fingerprintedName(name, content))
+        if not target.exists():
+            target.setContent(content)
+        manifest[name] = target.basename()
+        if os.path.splitext(name)[1].lower() in COMPRESSIBLE:
+            _compress(fp)
+            _compress(target)
+
+    for name in generated - set(manifest.values()):
+        for fp in [root.child(name)] + [root.child(name + x)
+                                        for x in ('.gz', '.br')]:
+            if fp.exists():
+                fp.remove()
+
+    root.child(MANIFEST).setContent(json.dumps(manifest, indent=2,
+                                               sort_keys=True))
+    return manifest
+
+
+
+class StaticFiles(static.File):
+    """
+    I serve a directory built by L{build}: fingerprinted files are cached
+    forever, and precompressed siblings are sent to clients that accept them.
+    """
+
+    contentEncodings = dict(static.File.contentEncodings)
+    contentEncodings['.br'] = 'br'
+
+    fingerprinted = frozenset()
+
+
+    def createSimilarFile(self, path):
+        f = static.File.createSimilarFile(self, path)
+        f.fingerprinted = self.fingerprinted
+        return f
+
+
+    def render_GET(self, request):
+        if self.isdir():
+            return static.File.render_GET(self, request)
+
+        name = self.basename()
+        if name in self.fingerprinted:
+            request.setHeader('Cache-Control', FAR_FUTURE)
+        else:
+            request.setHeader('Cache-Control', SHORT)
+
+        if os.path.splitext(name)[1].lower() in COMPRESSIBLE:
+            addVary(request, 'Accept-Encoding')
+            accepted = acceptedEncodings(request)
+            for ext, coding in [('.br', 'br'), ('.gz', 'gzip')]:
+                sibling = self.siblingExtension(ext)
+                if coding in accepted and sibling.exists():
+                    return static.File.render_GET(
+                        self.createSimilarFile(sibling.path), request)
+        return static.File.render_GET(self, request)
+
+
+
+def staticFiles(media_path):
+    """
+    Make a resource serving C{media_path}, knowing which of its files are
+    fingerprinted.
+    """
+    resource = StaticFiles(media_path)
+    resource.fingerprinted = frozenset(loadManifest(media_path).values())
+    return resource
+
+
+
+def main(args=None):
+    args = args if args is not None else sys.argv[1:]
+    if len(args) != 1:
+        sys.stderr.write('usage: python -m frack.assets MEDIA_DIR\n')
+        return 1
+    manifest = build(args[0])
+    for name, target in sorted(manifest.items()):
+        sys.stdout.write('%s -> %s\n' % (name, target))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
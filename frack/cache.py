@@ -0,0 +1,684 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+"""
+Caching and request coalescing.
+
+Cached values live in a L{CacheBackend}.  L{LRUCache} keeps them in the
+process; L{SQLiteCache} keeps them in a file that every process on the host
+shares, and passes invalidations between them; L{TieredCache} puts the first
+in front of the second.
+
+A L{CacheRegistry} keeps track of the memory used by a process's caches and
+keeps it within a budget.
+"""
+
+import os
+import sys
+import time
+import sqlite3
+import cPickle as pickle
+
+from twisted.internet import defer, threads
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+
+
+
+def estimateSize(value, _depth=0):
+    """
+    Roughly estimate how many bytes C{value} and the things in it take up.
+    Objects shared by several containers are counted more than once.
+    """
+    size = sys.getsizeof(value)
+    if _depth >= 8:
+        return size
+    if isinstance(value, dict):
+        for k, v in value.iteritems():
+            size += estimateSize(k, _depth + 1) + estimateSize(v, _depth + 1)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for item in value:
+            size += estimateSize(item, _depth + 1)
+    return size
+
+
+
+class _LinkedDict(object):
+    """
+    The little of C{collections.OrderedDict} (which Python 2.6 lacks) that
+    L{LRUCache} needs: a dict which remembers the order keys were set in,
+    oldest first.
+    """
+
+    def __init__(self):
+        self._links = {}
+        # A circular list of [previous, next, key, value], starting at root.
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+
+    def __len__(self):
+        return len(self._links)
+
+
+    def __setitem__(self, key, value):
+        self.pop(key)
+        root = self._root
+        last = root[0]
+        last[1] = root[0] = self._links[key] = [last, root, key, value]
+
+
+    def pop(self, key, default=None):
+        link = self._links.pop(key, None)
+        if link is None:
+            return default
+        previous, following = link[0], link[1]
+        previous[1] = following
+        following[0] = previous
+        return link[3]
+
+
+    def iteritems(self):
+        link = self._root[1]
+        while link is not self._root:
+            yield link[2], link[3]
+            link = link[1]
+
+
+    def __iter__(self):
+        for key, value in self.iteritems():
+            yield key
+
+
+
+class SingleFlight(object):
+    """
+    I make concurrent lookups of the same key share one in-flight call, and
+    can remember the answer for a short while afterwards.
+
+    Everyone waiting on a key gets the same result object, so don't mutate
+    it.
+
+    @param func: A function which takes a key and returns a C{Deferred}.
+    @param freshness: Number of seconds a result may be handed out after it
+        arrives.  C{0} means results are only shared by lookups that overlap.
+    @param clock: An C{IReactorTime} provider (defaults to the reactor).
+    """
+
+    def __init__(self, func, freshness=0, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.func = func
+        self.freshness = freshness
+        self.clock = clock
+        self._inflight = {}
+        self._fresh = {}
+
+
+    def get(self, key):
+        """
+        Look up C{key}, joining a lookup already in progress if there is one.
+
+        @return: A C{Deferred} which fires with the result of C{func(key)}.
+        """
+        if key in self._fresh:
+            expires, value = self._fresh[key]
+            if expires > self.clock.seconds():
+                return defer.succeed(value)
+            del self._fresh[key]
+
+        d = defer.Deferred()
+        waiters = self._inflight.get(key)
+        if waiters is not None:
+            waiters.append(d)
+            return d
+        # Join the waiters before calling func, which may answer at once.
+        waiters = self._inflight[key] = [d]
+        result = defer.maybeDeferred(self.func, key)
+        result.addBoth(self._landed, key, waiters)
+        return d
+
+
+    def _landed(self, result, key, waiters):
+        if self._inflight.get(key) is waiters:
+            del self._inflight[key]
+            if self.freshness and not isinstance(result, Failure):
+                self._fresh[key] = (self.clock.seconds() + self.freshness,
+                                    result)
+        for d in waiters:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+
+    def invalidate(self, key):
+        """
+        Forget anything known about C{key}.  Lookups which started before now
+        still get their answer, but it won't be handed to anyone else.
+        """
+        self._fresh.pop(key, None)
+        self._inflight.pop(key, None)
+
+
+
+class CacheBackend(object):
+    """
+    Somewhere to keep cached values.  Keys are strings; values are anything
+    that can be pickled, except C{None}.  Every method returns a
+    C{Deferred}, so backends may be remote.
+    """
+
+    def get(self, key):
+        """
+        @return: A Deferred which fires with the value, or C{None} if it
+            isn't cached (or has expired).
+        """
+        raise NotImplementedError()
+
+
+    def set(self, key, value, ttl, cost=None):
+        """
+        Cache C{value} for C{ttl} seconds.
+
+        @param cost: Seconds it took to compute C{value}, for backends which
+            decide what to evict by it, or C{None} if not known.
+        """
+        raise NotImplementedError()
+
+
+    def delete(self, key):
+        raise NotImplementedError()
+
+
+
+class LRUCache(CacheBackend):
+    """
+    I keep up to C{maxSize} values in memory, throwing away the least
+    recently used ones to make room.
+
+    I keep a rough count of the bytes my keys and values take up, and of
+    what each would cost to compute again, so that a L{CacheRegistry} can
+    choose what to evict when memory is short.
+
+    @ivar bytes: The estimated size of my entries.
+    """
+
+    registry = None
+
+
+    def __init__(self, maxSize=1000, cost=1.0, clock=None):
+        """
+        @param cost: Seconds it takes to recompute an entry whose cost isn't
+            given when it's set.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.maxSize = maxSize
+        self.cost = cost
+        self.clock = clock
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> (expires, value, bytes, cost)
+        self._entries = _LinkedDict()
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def peek(self, key):
+        """
+        Get a value straight away.
+
+        @return: The value, or C{None} if it isn't cached.
+        """
+        entry = self._remove(key)
+        if entry is None or entry[0] <= self.clock.seconds():
+            self.misses += 1
+            return None
+        self._entries[key] = entry
+        self.bytes += entry[2]
+        self.hits += 1
+        return entry[1]
+
+
+    def get(self, key):
+        return defer.succeed(self.peek(key))
+
+
+    def set(self, key, value, ttl, cost=None):
+        self._remove(key)
+        if cost is None:
+            cost = self.cost
+        size = estimateSize(key) + estimateSize(value)
+        self._entries[key] = (self.clock.seconds() + ttl, value, size, cost)
+        self.bytes += size
+        while len(self._entries) > self.maxSize:
+            self.evict(next(iter(self._entries)))
+        if self.registry is not None:
+            self.registry.enforce()
+        return defer.succeed(None)
+
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+        return entry
+
+
+    def delete(self, key):
+        self._remove(key)
+        return defer.succeed(None)
+
+
+    def victim(self):
+        """
+        Get the entry I'd evict first: the least recently used.
+
+        @return: C{(key, bytes, cost)}, or C{None} if I'm empty.
+        """
+        for key, entry in self._entries.iteritems():
+            return key, entry[2], entry[3]
+        return None
+
+
+    def evict(self, key):
+        if self._remove(key) is not None:
+            self.evictions += 1
+
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+
+class SQLiteCache(CacheBackend):
+    """
+    I keep values in an SQLite file shared by every process on a host, and
+    carry invalidations between those processes.
+
+    Opening the file may wait on another process's lock, so I use it from a
+    thread of my own, which my connection never leaves.  Operations asked
+    for before L{start} wait for it.  Only Frack should be able to write to
+    the file, as values are pickled.
+    """
+
+    # Seconds invalidations are kept for processes that haven't seen them.
+    keepInvalidations = 60
+
+
+    def __init__(self, path, clock=None, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        if clock is None:
+            clock = reactor
+        self.path = path
+        self.clock = clock
+        self.reactor = reactor
+        self.db = None
+        # Tells my invalidations from other processes'.
+        self.origin = '%d-%s' % (os.getpid(), os.urandom(4).encode('hex'))
+        self._lastInvalidation = 0
+        self.pool = ThreadPool(1, 1, 'cache')
+        self._inPool(self._open).addErrback(
+            log.err, 'Error opening cache %r' % (path,))
+
+
+    def _inPool(self, func, *args):
+        return threads.deferToThreadPool(self.reactor, self.pool, func, *args)
+
+
+    def _open(self):
+        self.db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS cache_entry (
+                key TEXT PRIMARY KEY,
+                value BLOB,
+                expires REAL)''')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS cache_invalidation (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                key TEXT,
+                origin TEXT,
+                time REAL)''')
+        row = self.db.execute(
+            'SELECT MAX(id) FROM cache_invalidation').fetchone()
+        self._lastInvalidation = row[0] or 0
+
+
+    def start(self):
+        """
+        Start my thread.
+
+        @return: A L{Deferred} firing once the file has been opened.
+        """
+        self.pool.start()
+        return self._inPool(lambda: None)
+
+
+    def get(self, key):
+        return self._inPool(self._get, key, self.clock.seconds())
+
+
+    def _get(self, key, now):
+        row = self.db.execute(
+            'SELECT value, expires FROM cache_entry WHERE key = ?',
+            (key,)).fetchone()
+        if row is None or row[1] <= now:
+            return None
+        return pickle.loads(str(row[0]))
+
+
+    def set(self, key, value, ttl, cost=None):
+        # Pickle here, so that a value changed after it's cached isn't
+        # read by my thread while it changes.
+        return self._inPool(self._set, key, pickle.dumps(value, 2),
+                            self.clock.seconds() + ttl)
+
+
+    def _set(self, key, pickled, expires):
+        self.db.execute(
+            'INSERT OR REPLACE INTO cache_entry (key, value, expires) '
+            'VALUES (?, ?, ?)', (key, sqlite3.Binary(pickled), expires))
+
+
+    def delete(self, key):
+        return self._inPool(self._delete, key)
+
+
+    def _delete(self, key):
+        self.db.execute('DELETE FROM cache_entry WHERE key = ?', (key,))
+
+
+    def invalidate(self, key):
+        """
+        Delete C{key} and tell the other processes to forget it.
+        """
+        return self._inPool(self._invalidate, key, time.time())
+
+
+    def _invalidate(self, key, now):
+        self.db.execute('DELETE FROM cache_entry WHERE key = ?', (key,))
+        self.db.execute(
+            'INSERT INTO cache_invalidation (key, origin, time) '
+            'VALUES (?, ?, ?)', (key, self.origin, now))
+
+
+    def invalidations(self):
+        """
+        Get the keys other processes have invalidated since I last asked.
+
+        @return: A L{Deferred} firing with a list of keys.
+        """
+        return self._inPool(self._invalidations)
+
+
+    def _invalidations(self):
+        rows = self.db.execute(
+            'SELECT id, key, origin FROM cache_invalidation WHERE id > ? '
+            'ORDER BY id', (self._lastInvalidation,)).fetchall()
+        if rows:
+            self._lastInvalidation = rows[-1][0]
+        return [key for ignored, key, origin in rows if origin != self.origin]
+
+
+    def clean(self):
+        """
+        Delete expired values and old invalidations.
+        """
+        return self._inPool(self._clean, self.clock.seconds(),
+                            time.time() - self.keepInvalidations)
+
+
+    def _clean(self, now, before):
+        self.db.execute('DELETE FROM cache_entry WHERE expires <= ?', (now,))
+        self.db.execute('DELETE FROM cache_invalidation WHERE time < ?',
+                        (before,))
+
+
+    def close(self):
+        """
+        Close the file once the operations already asked for are done, and
+        stop my thread.
+        """
+        d = self._inPool(self._close)
+        def stopped(result):
+            self.pool.stop()
+            return result
+        return d.addBoth(stopped)
+
+
+    def _close(self):
+        if self.db is not None:
+            self.db.close()
+
+
+
+class TieredCache(object):
+    """
+    I look values up in a local L{CacheBackend} first, then in a shared
+    one (if there is one).
+
+    Invalidating a key removes it from both tiers and, if the shared tier
+    is an L{SQLiteCache}, from the local tiers of the other processes, which
+    find out within C{pollInterval} seconds.  Functions passed to
+    L{onInvalidate} are called with every invalidated key, from here or
+    elsewhere, so that things cached by other means can be forgotten too.
+    """
+
+    def __init__(self, local, shared=None, pollInterval=0.25, localTTL=60,
+                 clock=None):
+        """
+        @param localTTL: Seconds to keep values found in the shared tier in
+            the local one.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.local = local
+        self.shared = shared
+        self.pollInterval = pollInterval
+        self.localTTL = localTTL
+        self._listeners = []
+        self._polls = 0
+        self._poller = LoopingCall(self.poll)
+        self._poller.clock = clock
+
+
+    def start(self):
+        if isinstance(self.shared, SQLiteCache):
+            self.shared.start()
+            self._poller.start(self.pollInterval, now=False)
+
+
+    def stop(self):
+        """
+        Stop polling, and close the shared tier if I started it.
+        """
+        if self._poller.running:
+            self._poller.stop()
+            return self.shared.close()
+        return defer.succeed(None)
+
+
+    def onInvalidate(self, callback):
+        self._listeners.append(callback)
+
+
+    @defer.inlineCallbacks
+    def get(self, key):
+        value = yield self.local.get(key)
+        if value is None and self.shared is not None:
+            value = yield self.shared.get(key)
+            if value is not None:
+                yield self.local.set(key, value, self.localTTL)
+        defer.returnValue(value)
+
+
+    @defer.inlineCallbacks
+    def set(self, key, value, ttl, cost=None):
+        yield self.local.set(key, value, ttl, cost)
+        if self.shared is not None:
+            yield self.shared.set(key, value, ttl)
+
+
+    @defer.inlineCallbacks
+    def invalidate(self, key):
+        """
+        Forget C{key} here and everywhere else.
+        """
+        yield self.local.delete(key)
+        if isinstance(self.shared, SQLiteCache):
+            yield self.shared.invalidate(key)
+        elif self.shared is not None:
+            yield self.shared.delete(key)
+        self._notify(key)
+
+
+    def _notify(self, key):
+        for callback in self._listeners:
+            try:
+                callback(key)
+            except Exception:
+                log.err(None, 'Error invalidating %r' % (key,))
+
+
+    @defer.inlineCallbacks
+    def poll(self):
+        """
+        Forget keys other processes have invalidated.
+        """
+        try:
+            keys = yield self.shared.invalidations()
+            self._polls += 1
+            if self._polls % 240 == 0:
+                yield self.shared.clean()
+        except sqlite3.Error:
+            log.err(None, 'Error polling for cache invalidations')
+            return
+        for key in keys:
+            self.local.delete(key)
+            self._notify(key)
+
+
+
+class CacheRegistry(object):
+    """
+    I keep track of the memory used by a process's caches, and keep it
+    within C{budget} bytes.
+
+    Caches which can evict entries on my say-so (like L{LRUCache}) have a
+    C{bytes} attribute and C{victim} and C{evict} methods, and I set their
+    C{registry} so that they tell me when they grow.  When the total is
+    over budget, I look at the entry each would evict next and evict the
+    one that is cheapest to recompute for the memory it takes up (the
+    lowest cost per byte), until it isn't.
+
+    Others (like L{frack.session.SessionStore}, which must keep unsaved
+    changes) only report their size, and count against the budget as of
+    the last time L{stats} was called.
+
+    Every cache has a C{stats} method returning a dict of numbers, which
+    includes C{'entries'} and C{'bytes'}.
+    """
+
+    def __init__(self, budget=None):
+        """
+        @param budget: The most bytes the caches may use, or C{None} for no
+            limit.
+        """
+        self.budget = budget
+        self.caches = {}
+        self.evictions = 0
+        self._fixed = {}
+        self._enforcing = False
+
+
+    def register(self, name, cache):
+        self.caches[name] = cache
+        if hasattr(cache, 'victim'):
+            cache.registry = self
+        else:
+            self._fixed[name] = cache.stats()['bytes']
+        self.enforce()
+
+
+    def bytes(self):
+        total = sum(self._fixed.values())
+        for name, cache in self.caches.iteritems():
+            if name not in self._fixed:
+                total += cache.bytes
+        return total
+
+
+    def enforce(self):
+        """
+        Evict entries until the caches are within budget.
+        """
+        if self.budget is None or self._enforcing:
+            return
+        self._enforcing = True
+        try:
+            excess = self.bytes() - self.budget
+            while excess > 0:
+                best = None
+                for name, cache in self.caches.iteritems():
+                    if name in self._fixed:
+                        continue
+                    victim = cache.victim()
+                    if victim is None:
+                        continue
+                    key, size, cost = victim
+                    score = cost / float(max(size, 1))
+                    if best is None or score < best[0]:
+                        best = (score, cache, key, size)
+                if best is None:
+                    break
+                ignored, cache, key, size = best
+                cache.evict(key)
+                self.evictions += 1
+                excess -= size
+        finally:
+            self._enforcing = False
+
+
+    def stats(self):
+        """
+        Get each cache's statistics.
+
+        @return: A dict mapping cache names to their C{stats()}.
+        """
+        stats = {}
+        for name, cache in self.caches.iteritems():
+            stats[name] = cache.stats()
+            if name in self._fixed:
+                self._fixed[name] = stats[name]['bytes']
+        return stats
+
+
+    def metrics(self):
+        """
+        Get my statistics as metrics, named like C{cache_tickets_bytes}.
+        """
+        metrics = {
+            'cache_bytes': 0,
+            'cache_budget_evictions': self.evictions,
+        }
+        if self.budget is not None:
+            metrics['cache_budget'] = self.budget
+        for name, stats in self.stats().iteritems():
+            for stat, value in stats.iteritems():
+                metrics['cache_%s_%s' % (name, stat)] = value
+            metrics['cache_bytes'] += stats['bytes']
+        return metrics
@@ -0,0 +1,189 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+"""
+Compression of dynamic responses.
+"""
+
+import zlib
+
+from twisted.web.resource import _IEncodingResource
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# The content codings responses may be compressed with.
+CODINGS = ('br', 'gzip')
+
+
+
+def acceptedEncodings(request):
+    """
+    Get the set of content codings named in a request's Accept-Encoding
+    header (ignoring any that are explicitly refused with C{q=0}).
+    """
+    accepted = set()
+    for part in (request.getHeader('accept-encoding') or '').split(','):
+        pieces = [x.strip() for x in part.split(';')]
+        if not pieces[0]:
+            continue
+        refused = [x for x in pieces[1:] if x.replace(' ', '') in ('q=0',
+                                                                   'q=0.0')]
+        if not refused:
+            accepted.add(pieces[0].lower())
+    return accepted
+
+
+def addVary(request, name):
+    """
+    Add C{name} to the headers a response's C{Vary} header lists, keeping
+    any already there.
+    """
+    headers = request.responseHeaders
+    names = []
+    for value in headers.getRawHeaders('vary', []):
+        names.extend([x.strip() for x in value.split(',') if x.strip()])
+    if name.lower() not in [x.lower() for x in names]:
+        names.append(name)
+    headers.setRawHeaders('vary', [', '.join(names)])
+
+
+def encodedETag(etag, coding):
+    """
+    Make the ETag of a response compressed with C{coding} from the ETag of
+    the uncompressed one, since the two aren't byte-for-byte the same.
+    """
+    return '%s-%s"' % (etag[:-1], coding)
+
+
+def negotiatedCoding(request):
+    """
+    Get the content coding a response to C{request} is compressed with if
+    it's big enough, or C{None} if it won't be.
+    """
+    accepted = acceptedEncodings(request)
+    if brotli is not None and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return None
+
+
+def matchingETag(request, etag):
+    """
+    Find the ETag in a request's C{If-None-Match} header which is for the
+    current version of a response, whose uncompressed ETag is C{etag}.
+
+    Clients are sent C{etag} itself, or its L{encodedETag} for the coding
+    they negotiated if the response was big enough to compress, so those
+    are the ones which match.  A tag for another coding doesn't: the client
+    has a representation this request wouldn't get.
+
+    @return: The matching tag, to send back with the 304, or C{None}.
+    """
+    current = [etag]
+    coding = negotiatedCoding(request)
+    if coding is not None:
+        current.append(encodedETag(etag, coding))
+    for tag in (request.getHeader('if-none-match') or '').split(','):
+        tag = tag.strip()
+        if tag == '*':
+            return etag
+        if tag in current:
+            return tag
+    return None
+
+
+def useEncoder(request, resource):
+    """
+    Have C{request} compress its response as C{resource} would, if it's an
+    C{EncodingResourceWrapper}.
+
+    C{twisted.web} only does this for the resource found by traversing the
+    resource tree, not for one rendered later (as by a C{DeferredResource}).
+    """
+    if _IEncodingResource.providedBy(resource):
+        encoder = resource.getEncoder(request)
+        if encoder is not None:
+            request._encoder = encoder
+
+
+class _ThresholdEncoder(object):
+    """
+    I compress a response, unless its first chunk is smaller than the
+    threshold, in which case the whole response is sent as is (small bodies
+    aren't worth compressing, and streams which start small are usually
+    event streams that shouldn't be buffered).
+    """
+
+    def __init__(self, request, coding, minimumSize, level):
+        self.request = request
+        self.coding = coding
+        self.minimumSize = minimumSize
+        self.level = level
+        self._compressor = None
+        self._decided = False
+
+
+    def encode(self, data):
+        if not self._decided:
+            self._decided = True
+            if len(data) >= self.minimumSize:
+                self._start()
+        if self._compressor is None:
+            return data
+        if self.coding == 'br':
+            return self._compressor.process(data)
+        return self._compressor.compress(data)
+
+
+    def _start(self):
+        headers = self.request.responseHeaders
+        headers.setRawHeaders('content-encoding', [self.coding])
+        headers.removeHeader('content-length')
+        etag = headers.getRawHeaders('etag')
+        if etag:
+            headers.setRawHeaders('etag', [encodedETag(etag[0],
+                                                       self.coding)])
+        if self.coding == 'br':
+            self._compressor = brotli.Compressor(quality=self.level)
+        else:
+            self._compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                                16 + zlib.MAX_WBITS)
+
+
+    def finish(self):
+        if self._compressor is None:
+            return ''
+        if self.coding == 'br':
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+
+class CompressingEncoderFactory(object):
+    """
+    A request encoder factory for C{twisted.web.resource.EncodingResourceWrapper}
+    which gzips (or, if the C{brotli} module is installed and the client
+    accepts it, brotli-compresses) responses of at least C{minimumSize}
+    bytes.
+    """
+
+    def __init__(self, minimumSize=1024, gzipLevel=6, brotliQuality=5):
+        self.minimumSize = minimumSize
+        self.gzipLevel = gzipLevel
+        self.brotliQuality = brotliQuality
+
+
+    def encoderForRequest(self, request):
+        coding = negotiatedCoding(request)
+        addVary(request, 'Accept-Encoding')
+        if coding == 'br':
+            return _ThresholdEncoder(request, 'br', self.minimumSize,
+                                     self.brotliQuality)
+        if coding == 'gzip':
+            return _ThresholdEncoder(request, 'gzip', self.minimumSize,
+                                     self.gzipLevel)
+        return None
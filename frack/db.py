@@ -1,9 +1,12 @@
 # Copyright (c) Twisted Matrix Laboratories.
 # See LICENSE for details.
-import time, hashlib, os
+import time, hashlib, os, json
 from twisted.internet import defer
+from twisted.python import log
 from norm.operation import Insert, SQL
 
+from frack import stats
+
 class UnauthorizedError(Exception):
     """
     The given key wasn't acceptable for the requested operation.
@@ -50,6 +53,69 @@ def sqlite_connect(path):
 
 
 
+def firstCommentNumber(changes):
+    """
+    Work out the number of the first comment in C{changes} (rows as for
+    L{groupComments}) from the numbers Trac stores with comments.
+    """
+    times = []
+    for when, author, field, oldvalue, newvalue in changes:
+        if not times or times[-1] != when:
+            times.append(when)
+        if field == 'comment' and oldvalue.split('.')[-1].isdigit():
+            return int(oldvalue.split('.')[-1]) - len(times) + 1
+    return 1
+
+
+def groupComments(changes, ticket_number, first=1):
+    """
+    Group a set of changes to a ticket into a list of comments.
+
+    @param changes: C{(time, author, field, oldvalue, newvalue)} rows from
+        C{ticket_change}, ordered by time.
+
+    @param first: The number of the first comment in C{changes}, if they
+        don't start from the beginning.  Replies to comments before it are
+        noted in C{'replyto'} but the original isn't updated.
+    """
+    ret = []
+    by_number = {}
+    comment = {}
+    last = None
+    i = first
+    for time, author, field, oldvalue, newvalue in changes:
+        if time != last:
+            comment = {
+                'time': time,
+                'ticket': ticket_number,
+                'author': author,
+                'comment': '',
+                'replyto': '',
+                'followups': [],
+                'number': str(i),
+                'changes': {}
+            }
+            ret.append(comment)
+            i += 1
+        last = time
+        if field == 'comment':
+            # handle goofy in-reply-to syntax
+            number = oldvalue
+            if '.' in oldvalue:
+                replyto, number = oldvalue.split('.')
+                comment['replyto'] = replyto
+                if replyto in by_number:
+                    by_number[replyto]['followups'].append(number)
+
+            comment['number'] = number
+            by_number[number] = comment
+            comment['comment'] = newvalue
+        else:
+            comment['changes'][field] = (oldvalue, newvalue)
+    return ret
+
+
+
 class TicketStore(object):
     """
     Abstract, authenticated access to Trac's ticket tables.
@@ -60,15 +126,50 @@ class TicketStore(object):
                    'milestone', 'status', 'resolution', 'summary',
                    'description', 'keywords']
 
-    def __init__(self, runner, user):
+    normal_columns = ['id', 'type', 'time', 'changetime', 'component',
+                   'severity', 'priority', 'owner', 'reporter', 'cc',
+                   'version', 'milestone', 'status', 'resolution', 'summary',
+                   'description', 'keywords']
+
+    # Number of comments after a window of them which are looked at for
+    # replies to the ones in it.
+    reply_horizon = 500
+
+    def __init__(self, runner, user, bus=None, stats=False, snapshots=False):
         """
         @param runner: A C{norm.interface.IRunner} (which is how I connect to
             the database).
         @param user: string name of user to use as reporter when creating
             tickets and as author when commenting/updating tickets.
+        @param bus: A L{frack.pubsub.Bus} to tell about changes once they've
+            been committed, or C{None}.
+        @param stats: If C{True}, keep the counts of L{frack.stats} up to
+            date as tickets are created and updated.
+        @param snapshots: If C{True}, use the snapshots of
+            L{frack.history} to work out what tickets used to look like.
         """
         self.runner = runner
         self.user = user
+        self.bus = bus
+        self.stats = stats
+        self.snapshots = snapshots
+
+
+    def _publish(self, result, kind, ticket_number, now, **extra):
+        """
+        Publish an event about a committed change (if I have a bus) and pass
+        C{result} along.
+        """
+        if self.bus is not None:
+            event = {
+                'kind': kind,
+                'ticket': ticket_number,
+                'time': now,
+                'author': self.user,
+            }
+            event.update(extra)
+            self.bus.publish(event)
+        return result
 
 
     def createTicket(self, data):
@@ -105,8 +206,29 @@ class TicketStore(object):
             if custom_fields:
                 d.addCallback(self._addCustomFields, custom_fields, runner)
             return d
-        
-        return self.runner.runInteraction(interaction, insert_data, data)
+
+        changes = dict([(k, (None, v)) for k, v in insert_data + data.items()
+                        if v is not None and k not in ('time', 'changetime')])
+        d = self.runner.runInteraction(interaction, insert_data, data)
+        d.addCallback(self._count, stats.deltas(None, dict(insert_data)))
+        return d.addCallback(lambda ticket_id: self._publish(ticket_id,
+            'create', ticket_id, now, changes=changes))
+
+
+    def _count(self, result, changes):
+        """
+        Adjust the counts of L{frack.stats} by C{changes} in a transaction
+        of their own, if I keep them.  Errors are logged, since the ticket
+        has already changed; C{python -m frack.stats verify} finds counts
+        left wrong.
+
+        @return: A Deferred which fires with C{result}.
+        """
+        if not self.stats or not changes:
+            return result
+        d = self.runner.runInteraction(stats.applyDeltas, changes)
+        d.addErrback(log.err, 'Error counting tickets')
+        return d.addCallback(lambda ignored: result)
 
 
     def _addCustomFields(self, ticket_id, data, runner):
@@ -122,27 +244,121 @@ class TicketStore(object):
         return d.addCallback(lambda _:ticket_id)
 
 
-    def fetchTicket(self, ticket_number):
+    def fetchTicket(self, ticket_number, _runner=None, fields=None):
         """
         Get the normal and custom columns for a ticket and all the comments.
 
+        @param fields: If given, a list of the only fields wanted.  This may
+            include normal and custom columns, C{'comments'} and
+            C{'attachments'}.  Things not asked for aren't fetched.  C{'id'}
+            is always included.
+
         @return: A Deferred which fires back with a dict.
         """
-        return self.runner.runInteraction(self._fetchTicket, ticket_number)
+        if _runner:
+            return self._fetchTicket(_runner, ticket_number, fields)
+        return self.runner.runInteraction(self._fetchTicket, ticket_number,
+                                          fields)
+
+
+    def fetchTickets(self, ticket_numbers, fields=None):
+        """
+        Get several tickets at once.
 
+        @param ticket_numbers: A list of ticket numbers.
+        @param fields: See L{fetchTicket}.
 
-    def _fetchTicket(self, runner, ticket_number):
-        normal = self._fetchNormalColumns(runner, ticket_number)
-        custom = self._fetchCustomColumns(runner, ticket_number)
-        comments = self.fetchComments(ticket_number, _runner=runner)
-        attachments = self._fetchAttachments(runner, ticket_number)
+        @return: A Deferred which fires with a list of ticket dicts in the
+            same order as C{ticket_numbers}, leaving out any tickets which
+            don't exist.
+        """
+        return self.runner.runInteraction(self._fetchTickets, ticket_numbers,
+                                          fields)
+
+
+    def _fetchTickets(self, runner, ticket_numbers, fields):
+        def missing(err):
+            err.trap(NotFoundError)
+            return None
+        dlist = []
+        for ticket_number in ticket_numbers:
+            d = self._fetchTicket(runner, ticket_number, fields)
+            dlist.append(d.addErrback(missing))
+        d = defer.gatherResults(dlist, consumeErrors=True)
+        return d.addCallback(lambda tickets: [x for x in tickets if x])
+
+
+    def fetchTicketWindowed(self, ticket_number, window):
+        """
+        Like L{fetchTicket}, but only get the first and last C{window}
+        comments, so the cost doesn't grow with the length of the ticket.
+
+        @return: A Deferred which fires with a ticket dict whose
+            C{'comments'} are the first and last comments, with these extra
+            keys: C{'comment_total'}, the number of comments on the ticket,
+            and C{'hidden_comments'}, C{None} or an C{(offset, count)} tuple
+            describing the comments left out (see L{fetchCommentWindow}).
+        """
+        return self.runner.runInteraction(self._fetchTicketWindowed,
+                                          ticket_number, window)
+
+
+    @defer.inlineCallbacks
+    def _fetchTicketWindowed(self, runner, ticket_number, window):
+        ticket = yield self._fetchTicket(runner, ticket_number,
+                                         withComments=False)
+        head = yield self._fetchCommentWindow(runner, ticket_number, None,
+                                              window)
+        total = head['total']
+        comments = head['comments']
+        tail_offset = max(window, total - window)
+        if tail_offset < total:
+            tail = yield self._fetchCommentWindow(runner, ticket_number, None,
+                                                  total - tail_offset,
+                                                  newest=True, total=total)
+            comments += tail['comments']
+        ticket['comments'] = comments
+        ticket['comment_total'] = total
+        ticket['hidden_comments'] = None
+        if tail_offset > window:
+            ticket['hidden_comments'] = (window, tail_offset - window)
+        defer.returnValue(ticket)
+
+
+    def _fetchTicket(self, runner, ticket_number, fields=None,
+                     withComments=True):
+        if fields is None:
+            columns = self.normal_columns
+            custom = self._fetchCustomColumns(runner, ticket_number)
+            comments = defer.succeed(None)
+            if withComments:
+                comments = self.fetchComments(ticket_number, _runner=runner)
+            attachments = self._fetchAttachments(runner, ticket_number)
+        else:
+            fields = set(fields)
+            columns = [x for x in self.normal_columns
+                       if x in fields or x == 'id']
+            custom_names = (fields - set(self.normal_columns)
+                            - set(['comments', 'attachments']))
+            custom = defer.succeed({})
+            if custom_names:
+                custom = self._fetchCustomColumns(runner, ticket_number,
+                                                  custom_names)
+            comments = attachments = defer.succeed(None)
+            if 'comments' in fields:
+                comments = self.fetchComments(ticket_number, _runner=runner)
+            if 'attachments' in fields:
+                attachments = self._fetchAttachments(runner, ticket_number)
+        normal = self._fetchNormalColumns(runner, ticket_number, columns)
         d = defer.gatherResults([normal, custom, comments, attachments],
                                 consumeErrors=True)
         def combine(results):
             normal, custom, comments, attachments = results
             normal.update(custom)
-            normal['comments'] = comments
-            normal['attachments'] = attachments
+            if comments is not None:
+                normal['comments'] = comments
+            if attachments is not None:
+                normal['attachments'] = attachments
             return normal
         def notfound(errors):
             errors.value.subFailure.trap(NotFoundError)
@@ -151,11 +367,141 @@ class TicketStore(object):
         
 
 
-    def _fetchNormalColumns(self, runner, ticket_number):
-        columns = ['id', 'type', 'time', 'changetime', 'component', 'severity',
-                   'priority', 'owner', 'reporter', 'cc', 'version',
-                   'milestone', 'status', 'resolution', 'summary',
-                   'description', 'keywords']
+    def fetchTicketVersion(self, ticket_number):
+        """
+        Get just enough about a ticket to tell whether it has changed: its
+        C{changetime} and a summary of its attachments, in one query.
+
+        @return: A Deferred which fires with a dict with the keys
+            C{'changetime'}, C{'attachment_count'} and C{'attachment_time'}
+            (the time of the newest attachment or C{None}), or errbacks with
+            L{NotFoundError}.
+        """
+        op = SQL('''
+            SELECT
+                changetime,
+                (SELECT COUNT(*) FROM attachment
+                    WHERE type = 'ticket' AND id = ?),
+                (SELECT MAX(time) FROM attachment
+                    WHERE type = 'ticket' AND id = ?)
+            FROM ticket
+            WHERE id = ?''', (str(ticket_number), str(ticket_number),
+                              ticket_number))
+        def firstOne(rows):
+            if not rows:
+                raise NotFoundError(ticket_number)
+            return dict(zip(['changetime', 'attachment_count',
+                             'attachment_time'], rows[0]))
+        return self.runner.run(op).addCallback(firstOne)
+
+
+    def fetchTicketAsOf(self, ticket_number, when):
+        """
+        Get a ticket's normal and custom columns as they were at a moment,
+        worked out from the C{oldvalue}s and C{newvalue}s in
+        C{ticket_change}.
+
+        With C{snapshots}, the changes are replayed forward from the latest
+        snapshot before C{when} (see L{frack.history}).  Otherwise they're
+        undone backward from the ticket as it is now.
+
+        @param when: Seconds since the epoch.  Changes made at exactly this
+            time are included.
+
+        @return: A Deferred which fires with a ticket dict like those from
+            L{fetchTicket}, whose C{'attachments'} are the ones added by
+            then and without C{'comments'}, or errbacks with
+            L{NotFoundError} if the ticket didn't exist yet.
+        """
+        return self.runner.runInteraction(self._fetchTicketAsOf,
+                                          ticket_number, when)
+
+
+    @defer.inlineCallbacks
+    def _fetchTicketAsOf(self, runner, ticket_number, when):
+        ticket = yield self._fetchTicket(runner, ticket_number,
+                                         withComments=False)
+        if ticket['time'] is not None and ticket['time'] > when:
+            raise NotFoundError(ticket_number)
+        attachments = [x for x in ticket.pop('attachments')
+                       if x['time'] is None or x['time'] <= when]
+
+        snapshot = None
+        if self.snapshots:
+            rows = yield runner.run(SQL('''
+                SELECT time, fields
+                FROM frack_ticket_snapshot
+                WHERE ticket = ? AND time <= ?
+                ORDER BY time DESC
+                LIMIT 1''', (ticket_number, when)))
+            if rows:
+                snapshot = rows[0]
+        if snapshot is not None:
+            ticket.update(json.loads(snapshot[1]))
+            changes = yield runner.run(SQL('''
+                SELECT field, newvalue
+                FROM ticket_change
+                WHERE ticket = ? AND time > ? AND time <= ?
+                    AND field != 'comment'
+                ORDER BY time''', (ticket_number, snapshot[0], when)))
+        else:
+            changes = yield runner.run(SQL('''
+                SELECT field, oldvalue
+                FROM ticket_change
+                WHERE ticket = ? AND time > ?
+                    AND field != 'comment'
+                ORDER BY time DESC''', (ticket_number, when)))
+        for field, value in changes:
+            # Fields starting with _ are edits of comments.
+            if not field.startswith('_'):
+                ticket[field] = value
+
+        rows = yield runner.run(SQL('''
+            SELECT MAX(time)
+            FROM ticket_change
+            WHERE ticket = ? AND time <= ?''', (ticket_number, when)))
+        ticket['changetime'] = rows[0][0] or ticket['time']
+        ticket['attachments'] = attachments
+        defer.returnValue(ticket)
+
+
+    def fetchTicketDiff(self, ticket_number, start, end):
+        """
+        Compare a ticket at two moments (see L{fetchTicketAsOf}).
+
+        @return: A Deferred which fires with a dict of
+            C{field: (value at start, value at end)} for each normal or
+            custom column which differs, and C{'attachments'}: a list of the
+            names of the attachments added in between.
+        """
+        return self.runner.runInteraction(self._fetchTicketDiff,
+                                          ticket_number, start, end)
+
+
+    @defer.inlineCallbacks
+    def _fetchTicketDiff(self, runner, ticket_number, start, end):
+        after = yield self._fetchTicketAsOf(runner, ticket_number, end)
+        try:
+            before = yield self._fetchTicketAsOf(runner, ticket_number, start)
+        except NotFoundError:
+            # Created in between.
+            before = {'attachments': []}
+        old_attachments = set(x['filename'] for x in before.pop('attachments'))
+        new_attachments = after.pop('attachments')
+        diff = {}
+        for field in sorted(set(before) | set(after)):
+            if field in ('id', 'changetime'):
+                continue
+            old, new = before.get(field), after.get(field)
+            if old != new:
+                diff[field] = (old, new)
+        diff['attachments'] = [x['filename'] for x in new_attachments
+                               if x['filename'] not in old_attachments]
+        defer.returnValue(diff)
+
+
+    def _fetchNormalColumns(self, runner, ticket_number, columns=None):
+        columns = columns or self.normal_columns
         sql = '''
             SELECT %(columns)s
             FROM ticket
@@ -171,12 +517,17 @@ class TicketStore(object):
         return runner.run(select).addCallback(firstOne)
 
 
-    def _fetchCustomColumns(self, runner, ticket_number):
-        op = SQL('''
+    def _fetchCustomColumns(self, runner, ticket_number, names=None):
+        sql = '''
             SELECT name, value
             FROM ticket_custom
-            WHERE ticket = ?''', (ticket_number,))
-        return runner.run(op).addCallback(dict)
+            WHERE ticket = ?'''
+        args = (ticket_number,)
+        if names:
+            names = sorted(names)
+            sql += ' AND name IN (%s)' % (','.join(['?'] * len(names)),)
+            args += tuple(names)
+        return runner.run(SQL(sql, args)).addCallback(dict)
 
 
     def fetchComments(self, ticket_number, _runner=None):
@@ -189,47 +540,164 @@ class TicketStore(object):
             SELECT time, author, field, oldvalue, newvalue
             FROM ticket_change
             WHERE ticket = ?''', (ticket_number,))
-        return runner.run(op).addCallback(self._groupComments, ticket_number)
-
-
-    def _groupComments(self, changes, ticket_number):
-        """
-        Group a set of changes into a list of comments.
-        """
-        ret = []
-        comment = {}
-        last = None
-        i = 1
-        for time, author, field, oldvalue, newvalue in changes:
-            if time != last:
-                comment = {
-                    'time': time,
-                    'ticket': ticket_number,
-                    'author': author,
-                    'comment': '',
-                    'replyto': '',
-                    'followups': [],
-                    'number': str(i),
-                    'changes': {}
-                }
-                ret.append(comment)
-                i += 1
-            last = time
-            if field == 'comment':
-                # handle goofy in-reply-to syntax
-                number = oldvalue
-                if '.' in oldvalue:
-                    replyto, number = oldvalue.split('.')
-                    comment['replyto'] = replyto
-                    original = ret[int(replyto)-1]
-                    original['followups'].append(number)
-
-
-                comment['number'] = number
-                comment['comment'] = newvalue
-            else:
-                comment['changes'][field] = (oldvalue, newvalue)
-        return ret
+        return runner.run(op).addCallback(groupComments, ticket_number)
+
+
+    def fetchCommentWindow(self, ticket_number, after, limit, _runner=None):
+        """
+        Get some of the comments of a ticket without loading the rest.
+
+        Comments are found by the time they were made, so the cost depends
+        on the size of the window, not on how many comments there are.
+
+        @param after: The time of the comment before the ones wanted, or
+            C{None} to start at the first.
+        @param limit: Maximum number of comments wanted.
+
+        @return: A Deferred which fires with a dict with the keys
+            C{'total'} (number of comments on the ticket) and C{'comments'}
+            (a list like the one from L{fetchComments}, whose C{'followups'}
+            include replies made in the L{reply_horizon} comments after the
+            window), or fails with L{NotFoundError}.
+        """
+        if _runner:
+            return self._fetchCommentWindow(_runner, ticket_number, after,
+                                            limit)
+        return self.runner.runInteraction(self._fetchCommentWindow,
+                                          ticket_number, after, limit)
+
+
+    def fetchComment(self, ticket_number, number, _runner=None):
+        """
+        Get one comment of a ticket by its number.
+
+        @param number: The comment's number, as a string.
+
+        @return: A Deferred which fires with a dict like those from
+            L{fetchComments}, or fails with L{NotFoundError}.
+        """
+        runner = _runner or self.runner
+        op = SQL('''
+            SELECT time
+            FROM ticket_change
+            WHERE ticket = ?
+                AND field = 'comment'
+                AND (oldvalue = ? OR oldvalue LIKE ?)''',
+            (ticket_number, number, '%.' + number))
+        def found(rows):
+            if not rows:
+                raise NotFoundError(ticket_number, number)
+            return runner.run(SQL('''
+                SELECT time, author, field, oldvalue, newvalue
+                FROM ticket_change
+                WHERE ticket = ?
+                    AND time = ?''', (ticket_number, rows[0][0])))
+        d = runner.run(op).addCallback(found)
+        d.addCallback(groupComments, ticket_number, int(number))
+        return d.addCallback(lambda comments: comments[0])
+
+
+    @defer.inlineCallbacks
+    def _countComments(self, runner, ticket_number):
+        """
+        Count a ticket's comments from the number Trac gave the latest one,
+        rather than by counting them all.
+
+        @raise NotFoundError: If there's no such ticket.
+        """
+        rows = yield runner.run(SQL('''
+            SELECT id
+            FROM ticket
+            WHERE id = ?''', (ticket_number,)))
+        if not rows:
+            raise NotFoundError(ticket_number)
+        rows = yield runner.run(SQL('''
+            SELECT time, oldvalue
+            FROM ticket_change
+            WHERE ticket = ?
+                AND field = 'comment'
+            ORDER BY time DESC
+            LIMIT 1''', (ticket_number,)))
+        since, total = -1, 0
+        if rows and rows[0][1].split('.')[-1].isdigit():
+            since, total = rows[0][0], int(rows[0][1].split('.')[-1])
+        # Changes made without a comment row still count as comments.
+        rows = yield runner.run(SQL('''
+            SELECT COUNT(DISTINCT time)
+            FROM ticket_change
+            WHERE ticket = ?
+                AND time > ?''', (ticket_number, since)))
+        defer.returnValue(total + rows[0][0])
+
+
+    @defer.inlineCallbacks
+    def _fetchCommentWindow(self, runner, ticket_number, after, limit,
+                            newest=False, total=None):
+        """
+        @param newest: If C{True}, ignore C{after} and get the last C{limit}
+            comments.
+        @param total: The number of comments, if already counted.
+        """
+        if total is None:
+            total = yield self._countComments(runner, ticket_number)
+        ret = {'total': total, 'comments': []}
+        if not limit:
+            defer.returnValue(ret)
+
+        # A comment is all the changes made at one time.
+        if newest:
+            rows = yield runner.run(SQL('''
+                SELECT DISTINCT time
+                FROM ticket_change
+                WHERE ticket = ?
+                ORDER BY time DESC
+                LIMIT ?''', (ticket_number, limit)))
+            rows.reverse()
+        else:
+            rows = yield runner.run(SQL('''
+                SELECT DISTINCT time
+                FROM ticket_change
+                WHERE ticket = ?
+                    AND time > ?
+                ORDER BY time
+                LIMIT ?''', (ticket_number,
+                              -1 if after is None else after, limit)))
+        if not rows:
+            defer.returnValue(ret)
+        first, last = rows[0][0], rows[-1][0]
+        changes = yield runner.run(SQL('''
+            SELECT time, author, field, oldvalue, newvalue
+            FROM ticket_change
+            WHERE ticket = ?
+                AND time >= ?
+                AND time <= ?
+            ORDER BY time''', (ticket_number, first, last)))
+        if newest:
+            number = total - len(rows) + 1
+        elif after is None:
+            number = 1
+        else:
+            number = firstCommentNumber(changes)
+        comments = groupComments(changes, ticket_number, number)
+
+        # replies to these comments made soon after the window
+        replies = yield runner.run(SQL('''
+            SELECT oldvalue
+            FROM ticket_change
+            WHERE ticket = ?
+                AND time > ?
+                AND field = 'comment'
+            ORDER BY time
+            LIMIT ?''', (ticket_number, last, self.reply_horizon)))
+        by_number = dict([(x['number'], x) for x in comments])
+        for (oldvalue,) in replies:
+            if '.' in oldvalue:
+                replyto, number = oldvalue.split('.')
+                if replyto in by_number:
+                    by_number[replyto]['followups'].append(number)
+
+        ret['comments'] = comments
+        defer.returnValue(ret)
 
 
     def updateTicket(self, ticket_number, data, comment=None, replyto=None):
@@ -246,14 +714,22 @@ class TicketStore(object):
         """
         if not self.user:
             return defer.fail(UnauthorizedError())
-        return self.runner.runInteraction(self._updateTicket, ticket_number,
-                                          data, comment or '', replyto)
-
-    def _updateTicket(self, runner, ticket_number, data, comment, replyto):
         now = int(time.time())
+        changes = {}
+        counts = []
+        d = self.runner.runInteraction(self._updateTicket, ticket_number,
+                                       data, comment or '', replyto, now,
+                                       changes, counts)
+        d.addCallback(self._count, counts)
+        return d.addCallback(self._publish, 'update', ticket_number, now,
+                             changes=changes, comment=comment or '')
+
+    def _updateTicket(self, runner, ticket_number, data, comment, replyto,
+                      now=None, changes=None, counts=None):
+        now = now or int(time.time())
         ticket = self._fetchTicket(runner, ticket_number)
         fields = ticket.addCallback(self._updateFields, runner, ticket_number,
-                                    data, now)
+                                    data, now, changes, counts)
         comment = self._addComment(runner, ticket_number, comment, replyto, now)
         d = defer.gatherResults([fields, comment], consumeErrors=True)
         def notfound(errors):
@@ -262,7 +738,21 @@ class TicketStore(object):
         return d.addErrback(notfound)
 
 
-    def _updateFields(self, old_ticket, runner, ticket_number, data, now):
+    def _updateFields(self, old_ticket, runner, ticket_number, data, now,
+                      changes=None, counts=None):
+        """
+        Update a ticket's normal and custom fields, logging what changed.
+
+        @param changes: A dict which, if given, is filled in with
+            C{field: (oldvalue, newvalue)} for every field that changed.
+        @param counts: A list which, if given, is filled in with how the
+            counts of L{frack.stats} change, as from L{stats.deltas}.
+        """
+        if changes is None:
+            changes = {}
+        counted = {}
+        for field in stats.FIELDS:
+            counted[field] = data.get(field, old_ticket[field])
         # normal fields
         dlist = []
         set_parts = []
@@ -276,6 +766,7 @@ class TicketStore(object):
             args.append(newvalue)
 
             if newvalue != oldvalue:
+                changes[column] = (oldvalue, newvalue)
                 op = SQL('''
                     INSERT INTO ticket_change
                     (ticket, time, author, field, oldvalue, newvalue)
@@ -306,12 +797,16 @@ class TicketStore(object):
                     and ticket = ?''', (newvalue, name, ticket_number))
             dlist.append(runner.run(op))
             if oldvalue != newvalue:
+                changes[name] = (oldvalue, newvalue)
                 op = SQL('''
                     INSERT INTO ticket_change
                     (ticket, time, author, field, oldvalue, newvalue)
                     VALUES (?, ?, ?, ?, ?, ?)
                     ''', (ticket_number, now, self.user, name, oldvalue, newvalue))
                 dlist.append(runner.run(op))
+
+        if counts is not None:
+            counts.extend(stats.deltas(old_ticket, counted))
         return defer.gatherResults(dlist)
 
 
@@ -357,41 +852,44 @@ class TicketStore(object):
         return [dict(zip(columns, x)) for x in rows]
 
 
-    def fetchComponents(self):
+    def fetchComponents(self, _runner=None):
         """
         Get a list of dicts for all the available components.
         """
+        runner = _runner or self.runner
         op = SQL('''
             SELECT name, owner, description
             FROM component
             ORDER BY name
             ''')
-        return self.runner.run(op).addCallback(self.makeDict, ['name', 'owner', 'description'])
+        return runner.run(op).addCallback(self.makeDict, ['name', 'owner', 'description'])
 
 
-    def fetchMilestones(self):
+    def fetchMilestones(self, _runner=None):
         """
         Get a list of dicts for all the milestones.
         """
+        runner = _runner or self.runner
         columns = ['name', 'due', 'completed', 'description']
         op = SQL('''
             SELECT %s
             FROM milestone
             ''' % (','.join(columns)))
-        return self.runner.run(op).addCallback(self.makeDict, columns)
+        return runner.run(op).addCallback(self.makeDict, columns)
 
 
-    def fetchEnum(self, enum_type):
+    def fetchEnum(self, enum_type, _runner=None):
         """
         Get a list of dicts of all the enum key-value pairs for a given type.
         """
+        runner = _runner or self.runner
         columns = ['name', 'value']
         op = SQL('''
             SELECT %s
             FROM "enum"
             WHERE type = ?
             ''' % (','.join(columns),), (enum_type,))
-        return self.runner.run(op).addCallback(self.makeDict, columns)
+        return runner.run(op).addCallback(self.makeDict, columns)
 
 
     def _fetchAttachments(self, runner, ticket_number):
@@ -434,7 +932,82 @@ class TicketStore(object):
             VALUES ('ticket', ?, ?, ?, ?, ?, ?, ?)
             ''', (ticket_number, data['filename'], data['size'], now,
                   data['description'], self.user, data['ip']))
-        return self.runner.run(op)
+        d = self.runner.run(op)
+        return d.addCallback(self._publish, 'attachment', ticket_number, now,
+                             filename=data['filename'])
+
+
+    def fetchChanges(self, after=None, limit=100):
+        """
+        Get changes to all tickets in the order they were made: tickets
+        being created, fields and comments being changed and files being
+        attached.
+
+        Changes are ordered by C{(time, ticket, key)}, where C{key} tells
+        apart changes made to one ticket at once.  Pass the position of the
+        last change seen as C{after} to get the ones after it.
+
+        Positions are only strictly increasing in the order changes were
+        committed if they were committed in the order of their times.  A
+        change stamped with a time before C{after} but committed after the
+        changes up to C{after} were read (because two requests were writing
+        at once, say) is never returned.  Readers which can't miss a change
+        should ask for the changes after a position a little earlier than
+        the last one seen, and ignore the positions they've already had.
+
+        @param after: A C{(time, ticket, key)} tuple, or C{None} to start at
+            the beginning.
+        @param limit: The most changes to get.
+
+        @return: A Deferred which fires with a list of dicts with the keys
+            C{'kind'} (C{'create'}, C{'change'} or C{'attachment'}),
+            C{'time'}, C{'ticket'}, C{'author'}, C{'field'} (C{None} for
+            creations, the filename for attachments), C{'old'}, C{'new'}
+            (the summary for creations, the description for attachments)
+            and C{'position'}, the change's C{(time, ticket, key)}.
+        """
+        if after is None:
+            after = (-1, -1, '')
+        time_after, ticket_after, key_after = after
+        # The time condition is repeated in each part so that each can use
+        # its time index.
+        op = SQL('''
+            SELECT time, ticket, k, kind, author, field, oldvalue, newvalue
+            FROM (
+                SELECT time, ticket, '1:' || field AS k, 'change' AS kind,
+                    author, field, oldvalue, newvalue
+                FROM ticket_change
+                WHERE time >= ?
+                UNION ALL
+                SELECT time, id, '0', 'create', reporter, NULL, NULL, summary
+                FROM ticket
+                WHERE time >= ?
+                UNION ALL
+                SELECT time, CASE WHEN type = 'ticket'
+                    THEN CAST(id AS INTEGER) END,
+                    '2:' || filename, 'attachment', author, filename, NULL,
+                    description
+                FROM attachment
+                WHERE type = 'ticket' AND time >= ?
+            ) AS changes
+            WHERE time > ?
+                OR (time = ? AND (ticket > ?
+                                  OR (ticket = ? AND k > ?)))
+            ORDER BY time, ticket, k
+            LIMIT ?''', (time_after, time_after, time_after, time_after,
+                          time_after, ticket_after, ticket_after, key_after,
+                          limit))
+        columns = ['time', 'ticket', 'key', 'kind', 'author', 'field', 'old',
+                   'new']
+        def parseRows(rows):
+            changes = []
+            for row in rows:
+                change = dict(zip(columns, row))
+                change['position'] = (change['time'], change['ticket'],
+                                      change.pop('key'))
+                changes.append(change)
+            return changes
+        return self.runner.run(op).addCallback(parseRows)
 
 
     def userList(self):
@@ -0,0 +1,462 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+"""
+Exporting every ticket as JSON Lines or CSV.
+
+Tickets are put together by L{assembleTickets}, which merge-joins four
+streams of rows ordered by ticket number (tickets, custom fields, changes
+and attachments), so only one ticket is held in memory at a time however
+many there are.  The C{python -m frack.export} command feeds it
+server-side cursors with psycopg2, and a batch of tickets at a time with
+other drivers, which read every row of a query at once.  L{ExportResource}
+feeds it a batch at a time through a runner, writing no faster than the
+client reads.
+
+Attachments are exported without the addresses they were uploaded from.
+"""
+
+import sys
+import csv
+import json
+from cStringIO import StringIO
+
+from zope.interface import implementer
+from twisted.internet import defer
+from twisted.internet.interfaces import IPushProducer
+from twisted.python import log, usage
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+from norm.operation import SQL
+
+from frack.db import TicketStore, groupComments
+
+
+TICKET_COLUMNS = TicketStore.normal_columns
+ATTACHMENT_COLUMNS = ['filename', 'size', 'time', 'description', 'author']
+
+CUSTOM_NAMES = 'SELECT DISTINCT name FROM ticket_custom ORDER BY name'
+
+# Each of these is ordered by ticket number, which comes first, and takes a
+# condition on the ticket number.
+TICKETS = '''
+    SELECT %s
+    FROM ticket
+    WHERE %%s
+    ORDER BY id''' % (','.join(TICKET_COLUMNS),)
+
+CUSTOM = '''
+    SELECT ticket, name, value
+    FROM ticket_custom
+    WHERE %s
+    ORDER BY ticket, name'''
+
+CHANGES = '''
+    SELECT ticket, time, author, field, oldvalue, newvalue
+    FROM ticket_change
+    WHERE %s
+    ORDER BY ticket, time, field'''
+
+# attachment.id is text, and only a number for tickets' attachments.  CASE
+# makes sure no other kind is cast.
+ATTACHMENT_TICKET = "CASE WHEN type = 'ticket' THEN CAST(id AS INTEGER) END"
+
+ATTACHMENTS = '''
+    SELECT %(ticket)s, %(columns)s
+    FROM attachment
+    WHERE type = 'ticket' AND %%s
+    ORDER BY %(ticket)s, time''' % {
+        'ticket': ATTACHMENT_TICKET,
+        'columns': ','.join(ATTACHMENT_COLUMNS),
+    }
+
+# The queries for a batch of tickets numbered above one, and the rest of
+# their rows.
+BATCH_TICKETS = TICKETS % ('id > ?',) + ' LIMIT ?'
+BATCH_CUSTOM = CUSTOM % ('ticket > ? AND ticket <= ?',)
+BATCH_CHANGES = CHANGES % ('ticket > ? AND ticket <= ?',)
+BATCH_ATTACHMENTS = ATTACHMENTS % (
+    '%s > ? AND %s <= ?' % (ATTACHMENT_TICKET, ATTACHMENT_TICKET),)
+
+
+
+class _Rows(object):
+    """
+    A stream of rows ordered by the ticket number in their first column.
+    """
+
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._next = next(self._rows, None)
+
+
+    def take(self, ticket_number):
+        """
+        Get the rows for a ticket (without the ticket number), skipping any
+        for earlier tickets that weren't asked for.
+        """
+        taken = []
+        while self._next is not None and self._next[0] <= ticket_number:
+            if self._next[0] == ticket_number:
+                taken.append(self._next[1:])
+            self._next = next(self._rows, None)
+        return taken
+
+
+
+def assembleTickets(tickets, custom, changes, attachments):
+    """
+    Put tickets together from rows of the L{TICKETS}, L{CUSTOM}, L{CHANGES}
+    and L{ATTACHMENTS} queries.
+
+    @return: An iterator of ticket dicts like those from
+        L{TicketStore.fetchTicket}.
+    """
+    custom = _Rows(custom)
+    changes = _Rows(changes)
+    attachments = _Rows(attachments)
+    for row in tickets:
+        ticket = dict(zip(TICKET_COLUMNS, row))
+        number = ticket['id']
+        ticket.update(custom.take(number))
+        ticket['comments'] = groupComments(changes.take(number), number)
+        ticket['attachments'] = [dict(zip(ATTACHMENT_COLUMNS, x))
+                                 for x in attachments.take(number)]
+        yield ticket
+
+
+
+class JSONLines(object):
+    """
+    One JSON object per ticket, per line.
+    """
+
+    contentType = 'application/x-ndjson'
+    extension = 'jsonl'
+
+    def __init__(self, customNames):
+        pass
+
+
+    def header(self):
+        return ''
+
+
+    def line(self, ticket):
+        return json.dumps(ticket, sort_keys=True) + '\n'
+
+
+
+class CSVFormat(object):
+    """
+    One row per ticket, with a column for each custom field.  Comments and
+    attachments are JSON in a column each.
+    """
+
+    contentType = 'text/csv; charset=utf-8'
+    extension = 'csv'
+
+    def __init__(self, customNames):
+        self.columns = TICKET_COLUMNS + list(customNames)
+        self._buffer = StringIO()
+        self._writer = csv.writer(self._buffer)
+
+
+    def _row(self, values):
+        self._writer.writerow([_csvValue(x) for x in values])
+        row = self._buffer.getvalue()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return row
+
+
+    def header(self):
+        return self._row(self.columns + ['comments', 'attachments'])
+
+
+    def line(self, ticket):
+        values = [ticket.get(x) for x in self.columns]
+        values.append(json.dumps(ticket['comments'], sort_keys=True))
+        values.append(json.dumps(ticket['attachments'], sort_keys=True))
+        return self._row(values)
+
+
+
+def _csvValue(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+FORMATS = {
+    'jsonl': JSONLines,
+    'csv': CSVFormat,
+}
+
+
+@defer.inlineCallbacks
+def fetchBatch(runner, after, size):
+    """
+    Fetch the rows for up to C{size} tickets numbered above C{after}.
+
+    @return: A Deferred which fires with the rows for L{assembleTickets}, or
+        with C{None} if there are no more tickets.
+    """
+    tickets = yield runner.run(SQL(BATCH_TICKETS, (after, size)))
+    if not tickets:
+        defer.returnValue(None)
+    between = (after, tickets[-1][0])
+    custom = yield runner.run(SQL(BATCH_CUSTOM, between))
+    changes = yield runner.run(SQL(BATCH_CHANGES, between))
+    attachments = yield runner.run(SQL(BATCH_ATTACHMENTS, between))
+    defer.returnValue((tickets, custom, changes, attachments))
+
+
+
+@implementer(IPushProducer)
+class TicketExporter(object):
+    """
+    I write every ticket to a consumer, fetching C{batchSize} at a time.
+    While the consumer has me paused, I don't fetch the next batch.
+
+    @ivar count: The number of tickets written so far.
+    """
+
+    def __init__(self, runner, format, batchSize=200):
+        """
+        @param format: A key of L{FORMATS}.
+        """
+        self.runner = runner
+        self.format = format
+        self.batchSize = batchSize
+        self.count = 0
+        self._paused = None
+        self._stopped = False
+
+
+    def exportTo(self, consumer):
+        """
+        @return: A Deferred which fires with the number of tickets written.
+        """
+        consumer.registerProducer(self, True)
+        def done(result):
+            consumer.unregisterProducer()
+            return result
+        return self._export(consumer).addBoth(done)
+
+
+    @defer.inlineCallbacks
+    def _export(self, consumer):
+        rows = yield self.runner.run(SQL(CUSTOM_NAMES))
+        format = FORMATS[self.format]([x[0] for x in rows])
+        header = format.header()
+        if header:
+            consumer.write(header)
+        last = 0
+        while not self._stopped:
+            batch = yield self.runner.runInteraction(fetchBatch, last,
+                                                     self.batchSize)
+            if batch is None:
+                break
+            for ticket in assembleTickets(*batch):
+                consumer.write(format.line(ticket))
+                self.count += 1
+            last = batch[0][-1][0]
+            if self._paused is not None:
+                yield self._paused
+        defer.returnValue(self.count)
+
+
+    def pauseProducing(self):
+        if self._paused is None:
+            self._paused = defer.Deferred()
+
+
+    def resumeProducing(self):
+        paused, self._paused = self._paused, None
+        if paused is not None:
+            paused.callback(None)
+
+
+    def stopProducing(self):
+        self._stopped = True
+        self.resumeProducing()
+
+
+
+class ExportResource(Resource):
+    """
+    I stream every ticket in the format named by C{?format=} (C{jsonl}, the
+    default, or C{csv}).
+    """
+
+    isLeaf = True
+
+    def __init__(self, runner):
+        Resource.__init__(self)
+        self.runner = runner
+
+
+    def render_GET(self, request):
+        format = request.args.get('format', ['jsonl'])[0]
+        if format not in FORMATS:
+            request.setResponseCode(400)
+            request.setHeader('Content-Type', 'text/plain')
+            return 'format must be one of: %s\n' % (
+                ', '.join(sorted(FORMATS)),)
+        request.setHeader('Content-Type', FORMATS[format].contentType)
+        request.setHeader('Content-Disposition',
+                          'attachment; filename="tickets.%s"' % (
+                              FORMATS[format].extension,))
+
+        exporter = TicketExporter(self.runner, format)
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
+        def done(result):
+            if not finished:
+                request.finish()
+        def failed(err):
+            log.err(err, 'Error exporting tickets')
+            if not finished:
+                # The status has been sent, so all that can be done is to
+                # stop without finishing the response properly.
+                request.transport.loseConnection()
+        exporter.exportTo(request).addCallbacks(done, failed)
+        return NOT_DONE_YET
+
+
+
+def _fetchRows(cursor, size):
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        for row in rows:
+            yield row
+
+
+def _serverSideTickets(connection, batchSize):
+    """
+    Get every ticket through psycopg2 server-side cursors, which fetch
+    C{batchSize} rows at a time.
+    """
+    streams = []
+    for i, sql in enumerate([TICKETS, CUSTOM, CHANGES, ATTACHMENTS]):
+        cursor = connection.cursor('frack_export_%d' % (i,))
+        cursor.itersize = batchSize
+        cursor.execute(sql % ('1 = 1',))
+        streams.append(_fetchRows(cursor, batchSize))
+    return assembleTickets(*streams)
+
+
+
+def _batchedTickets(module, connection, batchSize):
+    """
+    Get every ticket, querying for C{batchSize} at a time by ticket number.
+    """
+    placeholder = '?' if module.paramstyle == 'qmark' else '%s'
+    cursor = connection.cursor()
+    def fetch(sql, args):
+        cursor.execute(sql.replace('?', placeholder), args)
+        return cursor.fetchall()
+    after = 0
+    while True:
+        tickets = fetch(BATCH_TICKETS, (after, batchSize))
+        if not tickets:
+            return
+        between = (after, tickets[-1][0])
+        for ticket in assembleTickets(tickets,
+                                      fetch(BATCH_CUSTOM, between),
+                                      fetch(BATCH_CHANGES, between),
+                                      fetch(BATCH_ATTACHMENTS, between)):
+            yield ticket
+        after = tickets[-1][0]
+
+
+
+def exportConnection(module, connection, out, format, batchSize=1000):
+    """
+    Write every ticket in a database to a file.
+
+    @param module: The DB-API module C{connection} is from.  With psycopg2,
+        rows are read through server-side cursors; with other drivers,
+        C{batchSize} tickets are queried for at a time.
+    @param format: A key of L{FORMATS}.
+
+    @return: The number of tickets written.
+    """
+    cursor = connection.cursor()
+    cursor.execute(CUSTOM_NAMES)
+    format = FORMATS[format]([x[0] for x in cursor.fetchall()])
+    cursor.close()
+
+    if module.__name__ == 'psycopg2':
+        tickets = _serverSideTickets(connection, batchSize)
+    else:
+        tickets = _batchedTickets(module, connection, batchSize)
+
+    out.write(format.header())
+    count = 0
+    for ticket in tickets:
+        out.write(format.line(ticket))
+        count += 1
+    return count
+
+
+
+class Options(usage.Options):
+    synopsis = '[options]'
+
+    optParameters = [
+        ['postgres_db', None, None, 'Name of Postgres database to export.'],
+        ['postgres_user', 'u', None, 'Username for connecting to Postgres.'],
+        ['sqlite_db', None, None, 'Path to SQLite database to export.'],
+        ['format', 'f', 'jsonl', 'jsonl or csv.'],
+        ['output', 'o', '-', 'File to write to; - means standard output.'],
+    ]
+
+    longdesc = """Write every ticket (with custom fields, comments and
+    attachment metadata) as JSON Lines or CSV."""
+
+    def postOptions(self):
+        if bool(self['postgres_db']) == bool(self['sqlite_db']):
+            raise usage.UsageError('Give one of --postgres_db and '
+                                   '--sqlite_db.')
+        if self['format'] not in FORMATS:
+            raise usage.UsageError('--format must be one of: %s' % (
+                ', '.join(sorted(FORMATS)),))
+
+
+
+def main(argv=None):
+    from frack.db import sqlite_connect, postgres_probably_connect
+
+    config = Options()
+    try:
+        config.parseOptions(sys.argv[1:] if argv is None else argv)
+    except usage.UsageError as e:
+        raise SystemExit('%s\n%s' % (config, e))
+
+    if config['sqlite_db']:
+        module, connection = sqlite_connect(config['sqlite_db'])
+    else:
+        import getpass
+        module, connection = postgres_probably_connect(
+            config['postgres_db'],
+            config['postgres_user'] or getpass.getuser())
+
+    out = sys.stdout
+    if config['output'] != '-':
+        out = open(config['output'], 'wb')
+    try:
+        count = exportConnection(module, connection, out, config['format'])
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        connection.close()
+    sys.stderr.write('Exported %d tickets\n' % (count,))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+"""
+Snapshots of tickets with long histories, so that
+L{frack.db.TicketStore.fetchTicketAsOf} only replays the changes since the
+nearest one.
+
+A snapshot is a ticket's normal and custom columns, as JSON, at the time
+of one of its changes.  C{python -m frack.history snapshot} takes one every
+C{--every} changes for each ticket, carrying on from the last snapshot of
+each, so it can be run from cron to keep up with new changes.
+"""
+
+import sys
+import json
+
+from twisted.internet import defer
+from twisted.python import usage
+from twisted.python.failure import Failure
+from norm.operation import SQL
+
+from frack.db import TicketStore
+
+
+CREATE = '''
+    CREATE TABLE IF NOT EXISTS frack_ticket_snapshot (
+        ticket integer not null,
+        time integer not null,
+        fields text not null,
+        primary key (ticket, time))'''
+
+# Changes made at once count as one.
+CHANGE_TIMES = '''
+    SELECT DISTINCT time
+    FROM ticket_change
+    WHERE ticket = ? AND time > ? AND field != 'comment'
+    ORDER BY time'''
+
+
+
+@defer.inlineCallbacks
+def snapshotTicket(runner, ticket_number, every):
+    """
+    Take the snapshots a ticket is due, as part of an interaction.
+
+    @param every: The number of changes between snapshots.
+
+    @return: A Deferred which fires with the number of snapshots taken.
+    """
+    store = TicketStore(runner, None, snapshots=True)
+    rows = yield runner.run(SQL('''
+        SELECT MAX(time)
+        FROM frack_ticket_snapshot
+        WHERE ticket = ?''', (ticket_number,)))
+    latest = rows[0][0]
+    if latest is None:
+        latest = -1
+    times = yield runner.run(SQL(CHANGE_TIMES, (ticket_number, latest)))
+    taken = 0
+    for (when,) in times[every - 1::every]:
+        ticket = yield store._fetchTicketAsOf(runner, ticket_number, when)
+        del ticket['attachments']
+        yield runner.run(SQL('''
+            INSERT INTO frack_ticket_snapshot (ticket, time, fields)
+            VALUES (?, ?, ?)''', (ticket_number, when,
+                                  json.dumps(ticket, sort_keys=True))))
+        taken += 1
+    defer.returnValue(taken)
+
+
+@defer.inlineCallbacks
+def snapshotAll(runner, every=50):
+    """
+    Take the snapshots every ticket is due, committing after each ticket.
+
+    @return: A Deferred which fires with the number of snapshots taken.
+    """
+    yield runner.run(SQL(CREATE))
+    rows = yield runner.run(SQL('''
+        SELECT ticket
+        FROM ticket_change
+        WHERE field != 'comment'
+        GROUP BY ticket
+        HAVING COUNT(DISTINCT time) >= ?
+        ORDER BY ticket''', (every,)))
+    total = 0
+    for (ticket_number,) in rows:
+        taken = yield runner.runInteraction(snapshotTicket, ticket_number,
+                                            every)
+        total += taken
+    defer.returnValue(total)
+
+
+
+class Options(usage.Options):
+    synopsis = '[options] snapshot'
+
+    optParameters = [
+        ['postgres_db', None, None, 'Name of Postgres database.'],
+        ['postgres_user', 'u', None, 'Username for connecting to Postgres.'],
+        ['sqlite_db', None, None, 'Path to SQLite database.'],
+        ['every', 'e', 50, 'Number of changes between snapshots.', int],
+    ]
+
+    longdesc = """Snapshot tickets with long histories, for the history
+    view and the diff API (run Frack with --ticket_snapshots to use them)."""
+
+    def parseArgs(self, command):
+        if command != 'snapshot':
+            raise usage.UsageError('Unknown command: %s' % (command,))
+        self['command'] = command
+
+
+    def postOptions(self):
+        if bool(self['postgres_db']) == bool(self['sqlite_db']):
+            raise usage.UsageError('Give one of --postgres_db and '
+                                   '--sqlite_db.')
+        if self['every'] < 1:
+            raise usage.UsageError('--every must be at least 1.')
+
+
+
+def main(argv=None):
+    from norm.common import BlockingRunner
+    from frack.db import sqlite_connect, postgres_probably_connect
+
+    config = Options()
+    try:
+        config.parseOptions(sys.argv[1:] if argv is None else argv)
+    except usage.UsageError as e:
+        raise SystemExit('%s\n%s' % (config, e))
+
+    if config['sqlite_db']:
+        from norm.sqlite import SqliteTranslator
+        module, connection = sqlite_connect(config['sqlite_db'])
+        translator = SqliteTranslator()
+    else:
+        import getpass
+        from norm.postgres import PostgresTranslator
+        module, connection = postgres_probably_connect(
+            config['postgres_db'],
+            config['postgres_user'] or getpass.getuser())
+        translator = PostgresTranslator()
+    runner = BlockingRunner(connection, translator)
+
+    results = []
+    try:
+        snapshotAll(runner, config['every']).addBoth(results.append)
+    finally:
+        connection.close()
+    [result] = results
+    if isinstance(result, Failure):
+        result.raiseException()
+    sys.stdout.write('Took %d snapshots\n' % (result,))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,311 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+"""
+Importing tickets in bulk from JSON Lines, as written by L{frack.export}.
+
+Each line is a ticket dict like those from L{TicketStore.fetchTicket}.
+Keys other than Trac's normal columns, C{comments} and C{attachments} are
+custom fields.  Tickets without an C{id} are numbered after the highest
+one already in the database.  Comments are stored the way
+L{frack.db.groupComments} reads them back: one row per changed field and a
+C{comment} row whose old value is the comment's number, or
+C{replyto.number} for a reply.  Comments without a number are numbered in
+order from 1.
+
+Rows are inserted with C{executemany} (or C{COPY} with psycopg2) a chunk of
+tickets at a time, and each chunk is committed on its own.  Tickets are
+inserted with their numbers, so with Postgres (whichever driver is used)
+C{ticket_id_seq} is moved past the highest one after each chunk, for
+tickets made afterwards.
+"""
+
+import sys
+import csv
+import json
+import time
+from cStringIO import StringIO
+
+from twisted.python import usage
+
+from frack.db import TicketStore
+
+
+TICKET_COLUMNS = TicketStore.normal_columns
+CUSTOM_COLUMNS = ['ticket', 'name', 'value']
+CHANGE_COLUMNS = ['ticket', 'time', 'author', 'field', 'oldvalue',
+                  'newvalue']
+ATTACHMENT_COLUMNS = ['type', 'id', 'filename', 'size', 'time',
+                      'description', 'author', 'ipnr']
+
+# The packages of the DB-API modules frack.db connects to Postgres with.
+POSTGRES_PACKAGES = set(['psycopg2', 'pgdb', 'pg8000'])
+
+# Keys which are neither columns nor custom fields.
+NOT_CUSTOM = set(['comments', 'attachments', 'comment_total',
+                  'hidden_comments'])
+
+TABLES = [
+    ('ticket', TICKET_COLUMNS),
+    ('ticket_custom', CUSTOM_COLUMNS),
+    ('ticket_change', CHANGE_COLUMNS),
+    ('attachment', ATTACHMENT_COLUMNS),
+]
+
+
+
+class InvalidTicket(Exception):
+    """
+    A line of input isn't a ticket.
+    """
+
+
+
+def ticketRows(ticket, number, now=None):
+    """
+    Turn a ticket dict into rows.
+
+    @param number: The ticket's number.
+    @param now: The time to use for tickets which don't have one.
+
+    @return: A dict mapping each table name in L{TABLES} to a list of rows.
+    """
+    if now is None:
+        now = int(time.time())
+    comments = ticket.get('comments') or []
+    row = dict((x, ticket.get(x)) for x in TICKET_COLUMNS)
+    row['id'] = number
+    if row['time'] is None:
+        row['time'] = now
+    if row['changetime'] is None:
+        row['changetime'] = max([row['time']] +
+                                [x['time'] for x in comments])
+    if row['status'] is None:
+        row['status'] = 'new'
+
+    custom = []
+    for name, value in sorted(ticket.items()):
+        if name in TICKET_COLUMNS or name in NOT_CUSTOM:
+            continue
+        if value is not None and not isinstance(value, basestring):
+            value = str(value)
+        custom.append((number, name, value))
+
+    changes = []
+    for i, comment in enumerate(comments):
+        when = comment['time']
+        author = comment.get('author')
+        for field, (old, new) in sorted(comment.get('changes', {}).items()):
+            changes.append((number, when, author, field, old, new))
+        comment_number = str(comment.get('number') or i + 1)
+        if comment.get('replyto'):
+            comment_number = '%s.%s' % (comment['replyto'], comment_number)
+        changes.append((number, when, author, 'comment', comment_number,
+                        comment.get('comment') or ''))
+
+    attachments = []
+    for attachment in ticket.get('attachments') or []:
+        attachments.append(('ticket', str(number), attachment['filename'],
+                            attachment.get('size'),
+                            attachment.get('time', row['time']),
+                            attachment.get('description'),
+                            attachment.get('author'),
+                            attachment.get('ipnr', attachment.get('ip'))))
+
+    return {
+        'ticket': [tuple(row[x] for x in TICKET_COLUMNS)],
+        'ticket_custom': custom,
+        'ticket_change': changes,
+        'attachment': attachments,
+    }
+
+
+
+class Importer(object):
+    """
+    I import tickets through a DB-API connection, committing every
+    C{chunkSize} tickets.
+
+    @ivar count: The number of tickets imported and committed.
+    """
+
+    def __init__(self, module, connection, chunkSize=1000, out=None):
+        """
+        @param module: The DB-API module C{connection} is from.
+        @param out: A file to report progress to, or C{None}.
+        """
+        self.module = module
+        self.connection = connection
+        self.chunkSize = chunkSize
+        self.out = out
+        self.count = 0
+        self.useCopy = module.__name__ == 'psycopg2'
+        self.postgres = module.__name__.split('.')[0] in POSTGRES_PACKAGES
+        self.placeholder = '?' if module.paramstyle == 'qmark' else '%s'
+        self._started = time.time()
+        self._pending = dict((name, []) for name, columns in TABLES)
+        self._pendingTickets = 0
+        cursor = connection.cursor()
+        cursor.execute('SELECT MAX(id) FROM ticket')
+        self._nextNumber = (cursor.fetchone()[0] or 0) + 1
+        cursor.close()
+
+
+    def add(self, ticket):
+        """
+        Queue a ticket dict to be imported, importing the queue if it's full.
+
+        @raise InvalidTicket: If it's missing something or malformed.
+
+        @return: The ticket's number.
+        """
+        number = ticket.get('id')
+        if number is None:
+            number = self._nextNumber
+        try:
+            tables = ticketRows(ticket, int(number))
+        except (KeyError, TypeError, ValueError) as e:
+            raise InvalidTicket('Ticket %s: %r' % (number, e))
+        self._nextNumber = max(self._nextNumber, int(number) + 1)
+        for name, rows in tables.items():
+            self._pending[name].extend(rows)
+        self._pendingTickets += 1
+        if self._pendingTickets >= self.chunkSize:
+            self.flush()
+        return number
+
+
+    def flush(self):
+        """
+        Insert and commit the queued tickets.
+        """
+        if not self._pendingTickets:
+            return
+        cursor = self.connection.cursor()
+        try:
+            for name, columns in TABLES:
+                rows = self._pending[name]
+                if rows:
+                    self._insert(cursor, name, columns, rows)
+            if self.postgres:
+                cursor.execute("SELECT setval('ticket_id_seq', "
+                               "(SELECT MAX(id) FROM ticket))")
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+        finally:
+            cursor.close()
+        self.count += self._pendingTickets
+        self._pending = dict((name, []) for name, columns in TABLES)
+        self._pendingTickets = 0
+        if self.out is not None:
+            elapsed = time.time() - self._started
+            self.out.write('%d tickets (%.0f/s)\n' % (
+                self.count, self.count / max(elapsed, 0.001)))
+
+
+    def _insert(self, cursor, table, columns, rows):
+        if self.useCopy:
+            data = StringIO()
+            writer = csv.writer(data)
+            for row in rows:
+                writer.writerow([_copyValue(x) for x in row])
+            data.seek(0)
+            cursor.copy_expert(
+                "COPY %s (%s) FROM STDIN WITH CSV NULL '\\N'" % (
+                    table, ','.join(columns)), data)
+        else:
+            cursor.executemany('INSERT INTO %s (%s) VALUES (%s)' % (
+                table, ','.join(columns),
+                ','.join([self.placeholder] * len(columns))), rows)
+
+
+    def importLines(self, lines):
+        """
+        Import a ticket from each line of JSON.
+
+        @raise InvalidTicket: If a line isn't a ticket.  Chunks before it
+            stay imported.
+
+        @return: The number of tickets imported.
+        """
+        for i, line in enumerate(lines):
+            if not line.strip():
+                continue
+            try:
+                ticket = json.loads(line)
+                if not isinstance(ticket, dict):
+                    raise ValueError('not an object')
+                self.add(ticket)
+            except (ValueError, InvalidTicket) as e:
+                raise InvalidTicket('Line %d: %s' % (i + 1, e))
+        self.flush()
+        return self.count
+
+
+
+def _copyValue(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+
+class Options(usage.Options):
+    synopsis = '[options] <file.jsonl>'
+
+    optParameters = [
+        ['postgres_db', None, None, 'Name of Postgres database to import to.'],
+        ['postgres_user', 'u', None, 'Username for connecting to Postgres.'],
+        ['sqlite_db', None, None, 'Path to SQLite database to import to.'],
+        ['chunk', 'c', 1000, 'Number of tickets to commit at a time.', int],
+    ]
+
+    longdesc = """Import tickets from JSON Lines (as written by
+    frack.export).  - reads standard input."""
+
+    def parseArgs(self, path):
+        self['path'] = path
+
+
+    def postOptions(self):
+        if bool(self['postgres_db']) == bool(self['sqlite_db']):
+            raise usage.UsageError('Give one of --postgres_db and '
+                                   '--sqlite_db.')
+
+
+
+def main(argv=None):
+    from frack.db import sqlite_connect, postgres_probably_connect
+
+    config = Options()
+    try:
+        config.parseOptions(sys.argv[1:] if argv is None else argv)
+    except usage.UsageError as e:
+        raise SystemExit('%s\n%s' % (config, e))
+
+    if config['sqlite_db']:
+        module, connection = sqlite_connect(config['sqlite_db'])
+    else:
+        import getpass
+        module, connection = postgres_probably_connect(
+            config['postgres_db'],
+            config['postgres_user'] or getpass.getuser())
+
+    source = sys.stdin
+    if config['path'] != '-':
+        source = open(config['path'], 'rb')
+    importer = Importer(module, connection, config['chunk'], sys.stderr)
+    try:
+        importer.importLines(source)
+    except (InvalidTicket, module.Error) as e:
+        raise SystemExit('%s (%d tickets were imported before it)' % (
+            e, importer.count))
+    finally:
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+"""
+An in-memory, column-oriented index of the small ticket columns, for
+filtering, counting and faceting without asking the database.
+
+Each column is a NumPy array with a row per ticket.  Strings are
+dictionary-encoded: a column holds a small integer code per ticket, and
+the distinct values are kept once.  A filter is then a handful of
+vectorized comparisons over arrays of integers, and a facet is a
+C{bincount}.
+
+The index is loaded from C{ticket} when it starts and follows the
+L{frack.pubsub.Bus} events published by L{frack.db.TicketStore.createTicket}
+and L{frack.db.TicketStore.updateTicket} as they happen.  Changes made by
+other processes aren't published here, so it also re-reads tickets whose
+C{changetime} has moved on every C{interval} seconds.  Only those re-reads
+move on the C{changetime} it reads from, since a change published here
+says nothing about what other processes have done by then, and each starts
+C{overlap} seconds early, for changes that committed late.
+
+NumPy is optional; without it L{available} is C{False} and there is no
+index.
+"""
+
+from twisted.internet import defer, task
+from twisted.python import log
+from norm.operation import SQL
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from frack.cache import estimateSize
+
+
+available = numpy is not None
+
+STRING_COLUMNS = ['status', 'owner', 'component', 'milestone', 'type',
+                  'priority']
+TIME_COLUMNS = ['time', 'changetime']
+COLUMNS = STRING_COLUMNS + TIME_COLUMNS
+
+
+
+class _Strings(object):
+    """
+    A dictionary encoding: each distinct value (including C{None}) gets the
+    next integer code.
+    """
+
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+
+    def encode(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+
+class TicketIndex(object):
+    """
+    I hold the L{COLUMNS} of every ticket in NumPy arrays.
+
+    Criteria for L{search}, L{count} and L{facets} are a dict mapping column
+    names to what's wanted: a list of values for a string column, or a
+    C{(low, high)} tuple for a time column, meaning at least C{low} and
+    before C{high} (either may be C{None}).
+
+    @ivar size: The number of tickets in the index.
+    @ivar latest: The latest C{changetime} read from the database, or
+        C{None}.
+    @ivar ready: Whether the index has been loaded.
+    """
+
+    def __init__(self, capacity=1024, overlap=60, clock=None):
+        """
+        @param overlap: Seconds before L{latest} that refreshes read from.
+        """
+        if numpy is None:
+            raise RuntimeError('The ticket index needs numpy.')
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.overlap = overlap
+        self.size = 0
+        self.latest = None
+        self.ready = False
+        self.ids = numpy.zeros(capacity, numpy.int64)
+        self.columns = {}
+        self.strings = {}
+        for name in STRING_COLUMNS:
+            self.columns[name] = numpy.zeros(capacity, numpy.int32)
+            self.strings[name] = _Strings()
+        for name in TIME_COLUMNS:
+            self.columns[name] = numpy.zeros(capacity, numpy.int64)
+        self._rows = {}
+        self._loop = None
+
+
+    def _grow(self, needed):
+        capacity = len(self.ids)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        def grown(array):
+            bigger = numpy.zeros(capacity, array.dtype)
+            bigger[:self.size] = array[:self.size]
+            return bigger
+        self.ids = grown(self.ids)
+        for name in COLUMNS:
+            self.columns[name] = grown(self.columns[name])
+
+
+    def _encode(self, name, value):
+        if name in TIME_COLUMNS:
+            return value or 0
+        return self.strings[name].encode(value)
+
+
+    def update(self, ticket_number, values):
+        """
+        Set some of a ticket's columns, adding it if it's new.
+
+        @param values: A dict of new values for some of L{COLUMNS}.  Other
+            keys are ignored.
+        """
+        row = self._rows.get(ticket_number)
+        if row is None:
+            self._grow(self.size + 1)
+            row = self._rows[ticket_number] = self.size
+            self.ids[row] = ticket_number
+            self.size += 1
+            values = dict(dict.fromkeys(COLUMNS), **values)
+        for name, value in values.iteritems():
+            if name in self.columns:
+                self.columns[name][row] = self._encode(name, value)
+
+
+    def _addRows(self, rows):
+        """
+        Add or replace whole tickets from C{(id,) + COLUMNS} rows, putting
+        the new ones in with one assignment per column.
+        """
+        new = []
+        for row in rows:
+            if row[0] in self._rows:
+                self.update(row[0], dict(zip(COLUMNS, row[1:])))
+            else:
+                new.append(row)
+        if not new:
+            return
+        start = self.size
+        end = start + len(new)
+        self._grow(end)
+        self.ids[start:end] = [row[0] for row in new]
+        for i, name in enumerate(COLUMNS):
+            self.columns[name][start:end] = [self._encode(name, row[i + 1])
+                                             for row in new]
+        for offset, row in enumerate(new):
+            self._rows[row[0]] = start + offset
+        self.size = end
+
+
+    @defer.inlineCallbacks
+    def refresh(self, runner):
+        """
+        Load the tickets changed since C{overlap} seconds before L{latest},
+        or every ticket the first time.
+
+        @return: A Deferred which fires with the number of tickets read.
+        """
+        where, args = '1 = 1', ()
+        if self.latest is not None:
+            where, args = 'changetime >= ?', (self.latest - self.overlap,)
+        rows = yield runner.run(SQL('SELECT id, %s FROM ticket WHERE %s' % (
+            ','.join(COLUMNS), where), args))
+        self._addRows(rows)
+        changetimes = [row[COLUMNS.index('changetime') + 1] for row in rows]
+        changetimes = [x for x in changetimes if x is not None]
+        if changetimes and (self.latest is None or
+                            max(changetimes) > self.latest):
+            self.latest = max(changetimes)
+        self.ready = True
+        defer.returnValue(len(rows))
+
+
+    def start(self, runner, interval=30):
+        """
+        Load the index, and refresh it every C{interval} seconds.
+        """
+        def refresh():
+            d = self.refresh(runner)
+            d.addErrback(log.err, 'Error refreshing the ticket index')
+            return d
+        self._loop = task.LoopingCall(refresh)
+        self._loop.clock = self.clock
+        self._loop.start(interval)
+
+
+    def stop(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+
+
+    def subscribe(self, bus):
+        """
+        Follow the ticket changes published on C{bus}.
+
+        @return: A function which stops following them.
+        """
+        return bus.subscribe(self._ticketChanged)
+
+
+    def _ticketChanged(self, event):
+        if event['kind'] not in ('create', 'update'):
+            return
+        if event['kind'] == 'update' and event['ticket'] not in self._rows:
+            # Not loaded yet; the next refresh will get it.
+            return
+        values = dict((name, new) for name, (old, new)
+                      in event.get('changes', {}).iteritems())
+        if event['kind'] == 'create':
+            values['time'] = event['time']
+        values['changetime'] = event['time']
+        self.update(event['ticket'], values)
+
+
+    def _mask(self, criteria):
+        mask = numpy.ones(self.size, bool)
+        for name, wanted in criteria.iteritems():
+            if name not in self.columns:
+                raise ValueError('Not an indexed column: %r' % (name,))
+            column = self.columns[name][:self.size]
+            if name in TIME_COLUMNS:
+                low, high = wanted
+                if low is not None:
+                    mask &= column >= low
+                if high is not None:
+                    mask &= column < high
+            else:
+                codes = self.strings[name].codes
+                wanted = [codes[x] for x in wanted if x in codes]
+                if len(wanted) == 1:
+                    mask &= column == wanted[0]
+                else:
+                    mask &= numpy.in1d(column, wanted)
+        return mask
+
+
+    def count(self, criteria):
+        """
+        The number of tickets matching C{criteria}.
+        """
+        return int(numpy.count_nonzero(self._mask(criteria)))
+
+
+    def search(self, criteria, limit=None):
+        """
+        The numbers of the tickets matching C{criteria}, most recently
+        changed first.
+        """
+        rows = numpy.flatnonzero(self._mask(criteria))
+        order = numpy.argsort(self.columns['changetime'][rows],
+                              kind='mergesort')[::-1]
+        if limit is not None:
+            order = order[:limit]
+        return self.ids[rows[order]].tolist()
+
+
+    def facets(self, name, criteria=None):
+        """
+        Count the tickets matching C{criteria} by their value of the string
+        column C{name}.
+
+        @return: A list of C{(value, count)}, biggest count first.
+        """
+        if name not in self.strings:
+            raise ValueError('Not an indexed string column: %r' % (name,))
+        codes = self.columns[name][:self.size]
+        if criteria:
+            codes = codes[self._mask(criteria)]
+        values = self.strings[name].values
+        counts = numpy.bincount(codes, minlength=len(values))
+        return sorted([(values[code], int(n))
+                       for code, n in enumerate(counts) if n],
+                      key=lambda x: (-x[1], x[0]))
+
+
+    def stats(self):
+        """
+        The number of tickets and bytes I hold, for
+        L{frack.cache.CacheRegistry}.
+        """
+        size = self.ids.nbytes + sum(x.nbytes for x in self.columns.values())
+        for strings in self.strings.values():
+            size += estimateSize(strings.values) * 2
+        return {'entries': self.size, 'bytes': size}
@@ -0,0 +1,86 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+"""
+Request-scoped batching of database lookups.
+"""
+
+from twisted.internet import defer
+
+
+
+class PageLoader(object):
+    """
+    I collect the lookups issued while building a page and then run them all
+    in a single interaction.
+
+    Lookups are identified by the function and its arguments, so asking twice
+    for the same thing (even through different L{TicketStore} instances) only
+    runs it once.  Only use me for reads.
+
+    @param runner: A C{norm.interface.IRunner}.
+    """
+
+    def __init__(self, runner):
+        self.runner = runner
+        self._pending = {}
+        self._order = []
+
+
+    def load(self, func, *args):
+        """
+        Schedule a lookup.
+
+        @param func: A function (like L{TicketStore.fetchComponents}) which
+            accepts a C{_runner} keyword argument naming the runner to use.
+        @param args: Positional arguments for C{func}.
+
+        @return: A C{Deferred} which fires with the result of C{func} once
+            L{dispatch} has been called and the lookup is done.
+        """
+        # Bound methods of different stores share the underlying function.
+        key = (getattr(func, '__func__', func), args)
+        if key not in self._pending:
+            self._pending[key] = (func, args, [])
+            self._order.append(key)
+        d = defer.Deferred()
+        self._pending[key][2].append(d)
+        return d
+
+
+    def dispatch(self):
+        """
+        Run every lookup scheduled so far in one interaction.
+
+        @return: A C{Deferred} which fires when all the lookups are done.
+        """
+        order, self._order = self._order, []
+        pending, self._pending = self._pending, {}
+        if not order:
+            return defer.succeed(None)
+        batch = [pending[key] for key in order]
+        d = self.runner.runInteraction(self._interaction, batch)
+        d.addCallbacks(self._resolve, self._failAll,
+                       callbackArgs=(batch,), errbackArgs=(batch,))
+        return d
+
+
+    def _interaction(self, runner, batch):
+        dlist = []
+        for func, args, waiters in batch:
+            dlist.append(defer.maybeDeferred(func, *args, _runner=runner))
+        return defer.DeferredList(dlist, consumeErrors=True)
+
+
+    def _resolve(self, results, batch):
+        for (success, result), (func, args, waiters) in zip(results, batch):
+            for d in waiters:
+                if success:
+                    d.callback(result)
+                else:
+                    d.errback(result)
+
+
+    def _failAll(self, err, batch):
+        for func, args, waiters in batch:
+            for d in waiters:
+                d.errback(err)
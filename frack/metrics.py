@@ -0,0 +1,101 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+"""
+Counting what a Frack process is doing.
+"""
+
+import os
+import resource
+
+from twisted.web.server import Site
+
+
+
+class Metrics(object):
+    """
+    I hold a process's counters (which only go up) and gauges (functions
+    called to get a current value).
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.sources = []
+        self.gauge('pid', os.getpid)
+        self.gauge('cpu_seconds', cpuSeconds)
+        self.gauge('max_rss_kb', maxRSS)
+
+
+    def increment(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+
+    def gauge(self, name, func):
+        """
+        Report the result of calling C{func} as C{name}.
+        """
+        self.gauges[name] = func
+
+
+    def source(self, func):
+        """
+        Report everything in the dict returned by calling C{func}, for
+        metrics whose names aren't known in advance.
+        """
+        self.sources.append(func)
+
+
+    def snapshot(self):
+        """
+        Get the current values of everything as a dict.
+        """
+        data = dict(self.counters)
+        for func in self.sources:
+            data.update(func())
+        for name, func in self.gauges.items():
+            data[name] = func()
+        return data
+
+
+
+def cpuSeconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def maxRSS():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def aggregate(snapshots):
+    """
+    Combine the snapshots of several processes by adding up their numbers.
+
+    @return: A dict of totals, with the snapshots themselves under
+        C{'workers'}.
+    """
+    totals = {}
+    for snapshot in snapshots:
+        for name, value in snapshot.items():
+            if name == 'pid' or not isinstance(value, (int, long, float)):
+                continue
+            totals[name] = totals.get(name, 0) + value
+    totals['workers'] = sorted(snapshots, key=lambda x: x.get('pid'))
+    return totals
+
+
+
+class MetricsSite(Site):
+    """
+    A site which counts requests and responses in a L{Metrics}.
+    """
+
+    def __init__(self, resource, metrics, *args, **kwargs):
+        Site.__init__(self, resource, *args, **kwargs)
+        self.metrics = metrics
+
+
+    def log(self, request):
+        Site.log(self, request)
+        self.metrics.increment('requests')
+        self.metrics.increment('responses_%dxx' % (request.code // 100,))
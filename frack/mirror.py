@@ -0,0 +1,506 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+"""
+Serving from a local, read-only SQLite copy of an upstream Trac database.
+
+A L{Mirror} pulls new rows from upstream (Postgres or SQLite) in batches,
+keyed on time so each pull starts where the last one stopped:
+
+    - C{ticket} rows by C{(changetime, id)}, with their C{ticket_custom}
+      rows refreshed along with them;
+    - C{ticket_change} rows by C{(time, ticket, field)};
+    - ticket C{attachment} rows by C{(time, id, filename)}.
+
+A row's time is set before its transaction commits, so a row committed
+late can sort before ones already pulled.  Each pull therefore starts
+C{overlap} seconds before where the last one stopped, and rows the mirror
+already has are left alone: only new and changed ones are written,
+counted and published.  Each batch is written in one local transaction
+together with the position it reached, so a restarted mirror carries on
+where it was.  Components,
+milestones and enums are small, and are copied whole every so often.  Once
+the mirror has caught up, what it pulls is published on a
+L{frack.pubsub.Bus} like changes made locally, so cached tickets are
+refreshed and watchers hear about them.
+
+Deleted attachments stay in the mirror, and custom fields are only
+refreshed when their ticket's C{changetime} moves on.
+
+L{ReadOnlyResource} turns away anything but C{GET} and C{HEAD}, since
+changes have to be made on the primary.
+"""
+
+import json
+
+from twisted.internet import defer, task
+from twisted.python import log
+from twisted.web.resource import Resource
+from norm.operation import SQL
+
+from frack.db import TicketStore
+
+
+TICKET_COLUMNS = TicketStore.normal_columns
+CUSTOM_COLUMNS = ['ticket', 'name', 'value']
+CHANGE_COLUMNS = ['ticket', 'time', 'author', 'field', 'oldvalue',
+                  'newvalue']
+ATTACHMENT_COLUMNS = ['type', 'id', 'filename', 'size', 'time',
+                      'description', 'author', 'ipnr']
+
+# Tables copied whole, and their columns.
+REFERENCE_TABLES = [
+    ('component', ['name', 'owner', 'description']),
+    ('milestone', ['name', 'due', 'completed', 'description']),
+    ('enum', ['type', 'name', 'value']),
+]
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS ticket (
+        id integer not null primary key, type text, time int,
+        changetime int, component text, severity text, priority text,
+        owner text, reporter text, cc text, version text, milestone text,
+        status text, resolution text, summary text, description text,
+        keywords text)''',
+    '''CREATE TABLE IF NOT EXISTS ticket_change (
+        ticket int not null, time int not null, author text,
+        field text not null, oldvalue text, newvalue text,
+        primary key (ticket, time, field))''',
+    '''CREATE TABLE IF NOT EXISTS ticket_custom (
+        ticket int not null, name text not null, value text,
+        primary key (ticket, name))''',
+    '''CREATE TABLE IF NOT EXISTS attachment (
+        type text not null, id text not null, filename text not null,
+        size int, time int, description text, author text, ipnr text,
+        primary key (type, id, filename))''',
+    '''CREATE TABLE IF NOT EXISTS component (
+        name text not null, owner text, description text,
+        primary key (name))''',
+    '''CREATE TABLE IF NOT EXISTS milestone (
+        name text not null, due integer, completed integer,
+        description text, primary key (name))''',
+    '''CREATE TABLE IF NOT EXISTS enum (
+        type text not null, name text not null, value text,
+        primary key (type, name))''',
+    # Sessions of the mirror's own (anonymous) visitors.
+    '''CREATE TABLE IF NOT EXISTS session (
+        sid text not null, authenticated integer not null,
+        last_visit integer, primary key (sid, authenticated))''',
+    '''CREATE TABLE IF NOT EXISTS session_attribute (
+        sid text not null, authenticated integer not null,
+        name text not null, value text,
+        primary key (sid, authenticated, name))''',
+    '''CREATE TABLE IF NOT EXISTS auth_cookie (
+        cookie text not null, name text not null, ipnr text not null,
+        time integer, primary key (cookie, ipnr, name))''',
+    'CREATE INDEX IF NOT EXISTS ticket_time_idx ON ticket (time)',
+    'CREATE INDEX IF NOT EXISTS ticket_status_idx ON ticket (status)',
+    'CREATE INDEX IF NOT EXISTS ticket_change_ticket_idx '
+    'ON ticket_change (ticket)',
+    'CREATE INDEX IF NOT EXISTS ticket_change_time_idx '
+    'ON ticket_change (time)',
+    '''CREATE TABLE IF NOT EXISTS frack_mirror (
+        name text not null primary key, position text)''',
+]
+
+
+
+class _Stream(object):
+    """
+    Rows of an upstream table, pulled in the order of C{key}.
+    """
+
+    def __init__(self, name, table, columns, key, where='1 = 1'):
+        self.name = name
+        self.table = table
+        self.columns = columns
+        self.key = key
+        self.where = where
+        self._keyIndexes = [columns.index(x) for x in key]
+
+
+    def query(self, position, limit):
+        """
+        @param position: The key of the last row pulled (or its first
+            columns, to start after every row with them), or C{None} to
+            start from the beginning.
+
+        @return: An L{SQL} for the next C{limit} rows after C{position}.
+        """
+        where = [self.where]
+        args = []
+        if position is not None:
+            # The first condition alone lets the key's leading column's
+            # index be used.
+            where.append('%s >= ?' % (self.key[0],))
+            args.append(position[0])
+            condition, more = _after(self.key[:len(position)], position)
+            where.append(condition)
+            args.extend(more)
+        return SQL('SELECT %s FROM %s WHERE %s ORDER BY %s LIMIT ?' % (
+            ','.join(self.columns), self.table,
+            ' AND '.join(where), ','.join(self.key)),
+            tuple(args) + (limit,))
+
+
+    def position(self, row):
+        """
+        The key of C{row}.
+        """
+        return [row[i] for i in self._keyIndexes]
+
+
+
+def _after(columns, position):
+    """
+    A condition for rows which sort after C{position} on C{columns}.
+
+    @return: The condition and its arguments.
+    """
+    parts = []
+    args = []
+    for i, column in enumerate(columns):
+        equal = ['%s = ?' % (x,) for x in columns[:i]]
+        parts.append('(%s)' % (' AND '.join(equal + ['%s > ?' % (column,)]),))
+        args.extend(position[:i + 1])
+    return '(%s)' % (' OR '.join(parts),), args
+
+
+TICKETS = _Stream('ticket', 'ticket', TICKET_COLUMNS, ['changetime', 'id'],
+                  'changetime IS NOT NULL')
+CHANGES = _Stream('ticket_change', 'ticket_change', CHANGE_COLUMNS,
+                  ['time', 'ticket', 'field'])
+ATTACHMENTS = _Stream('attachment', 'attachment', ATTACHMENT_COLUMNS,
+                      ['time', 'id', 'filename'],
+                      "type = 'ticket' AND time IS NOT NULL")
+
+STREAMS = [TICKETS, CHANGES, ATTACHMENTS]
+
+
+
+def _insert(runner, table, columns, rows):
+    sql = 'INSERT OR REPLACE INTO %s (%s) VALUES (%s)' % (
+        table, ','.join(columns), ','.join(['?'] * len(columns)))
+    return defer.gatherResults([runner.run(SQL(sql, tuple(row)))
+                                for row in rows])
+
+
+
+def _placeholders(values):
+    return ','.join(['?'] * len(values))
+
+
+
+def _comparable(row):
+    """
+    C{row} as a tuple that compares equal to the same row read from another
+    database, whose driver may give byte strings rather than unicode.
+    """
+    return tuple(x.decode('utf-8', 'replace') if isinstance(x, str) else x
+                 for x in row)
+
+
+
+class Mirror(object):
+    """
+    I keep a local SQLite database up to date with an upstream Trac database.
+
+    @ivar positions: A dict of the key of the last row pulled for each name
+        in L{STREAMS}.
+    @ivar caughtUp: Whether a pull has reached the end of every stream.
+    @ivar pulled: The number of new or changed rows pulled since I started.
+    """
+
+    def __init__(self, upstream, local, batchSize=500, interval=5,
+                 referenceInterval=60, overlap=60, bus=None, clock=None):
+        """
+        @param upstream: A runner for the upstream database.
+        @param local: A runner for the local SQLite database.
+        @param interval: Seconds between pulls.
+        @param overlap: Seconds before the last row pulled that each pull
+            starts from, to catch rows committed late.
+        @param referenceInterval: Seconds between copies of components,
+            milestones and enums.
+        @param bus: The L{frack.pubsub.Bus} to publish what's pulled on, or
+            C{None}.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.upstream = upstream
+        self.local = local
+        self.batchSize = batchSize
+        self.interval = interval
+        self.referenceInterval = referenceInterval
+        self.overlap = overlap
+        self.bus = bus
+        self.clock = clock
+        self.positions = {}
+        self.caughtUp = False
+        self.pulled = 0
+        self._referenced = None
+        self._pulling = False
+        self._loop = None
+
+
+    @defer.inlineCallbacks
+    def open(self):
+        """
+        Create the local tables if they're missing, and read where the last
+        pulls got to.
+        """
+        for statement in SCHEMA:
+            yield self.local.run(SQL(statement))
+        rows = yield self.local.run(SQL(
+            'SELECT name, position FROM frack_mirror'))
+        self.positions = dict((name, json.loads(position))
+                              for name, position in rows)
+
+
+    def start(self):
+        """
+        Pull now, and every C{interval} seconds after.
+        """
+        self._loop = task.LoopingCall(self._pullLogged)
+        self._loop.clock = self.clock
+        self._loop.start(self.interval)
+
+
+    def stop(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+
+
+    def _pullLogged(self):
+        # Errors are logged rather than stopping the loop: upstream may be
+        # back by the next pull.
+        d = self.pull()
+        d.addErrback(log.err, 'Error pulling from upstream')
+        return d
+
+
+    def pull(self):
+        """
+        Pull everything new from upstream.  If a pull is already running,
+        do nothing.
+
+        @return: A Deferred which fires with the number of new or changed
+            rows pulled.
+        """
+        if self._pulling:
+            return defer.succeed(0)
+        self._pulling = True
+        def done(result):
+            self._pulling = False
+            return result
+        return self._pull().addBoth(done)
+
+
+    @defer.inlineCallbacks
+    def _pull(self):
+        total = 0
+        for stream in STREAMS:
+            position = self.positions.get(stream.name)
+            if position is not None:
+                position = [position[0] - self.overlap]
+            while True:
+                position, fetched, count = yield self._pullBatch(stream,
+                                                                 position)
+                total += count
+                if fetched < self.batchSize:
+                    break
+        now = self.clock.seconds()
+        if (self._referenced is None or
+                now - self._referenced >= self.referenceInterval):
+            yield self.local.runInteraction(self._copyReference)
+            self._referenced = now
+        self.caughtUp = True
+        self.pulled += total
+        defer.returnValue(total)
+
+
+    @defer.inlineCallbacks
+    def _pullBatch(self, stream, position):
+        """
+        Pull a batch of rows from C{stream} after C{position}.
+
+        @return: A Deferred which fires with the position reached, the
+            number of rows fetched and the number of them that were new or
+            changed.
+        """
+        rows = yield self.upstream.run(stream.query(position,
+                                                    self.batchSize))
+        if not rows:
+            defer.returnValue((position, 0, 0))
+        position = stream.position(rows[-1])
+        custom = []
+        if stream is TICKETS:
+            numbers = [row[0] for row in rows]
+            custom = yield self.upstream.run(SQL(
+                'SELECT %s FROM ticket_custom WHERE ticket IN (%s)' % (
+                    ','.join(CUSTOM_COLUMNS), _placeholders(numbers)),
+                tuple(numbers)))
+        changed, new = yield self.local.runInteraction(
+            self._apply, stream, rows, custom, position)
+        furthest = self.positions.get(stream.name)
+        if furthest is None or position > furthest:
+            self.positions[stream.name] = position
+        if self.caughtUp and self.bus is not None:
+            for event in _events(stream, changed, new):
+                self.bus.publish(event)
+        defer.returnValue((position, len(rows), len(changed)))
+
+
+    @defer.inlineCallbacks
+    def _apply(self, runner, stream, rows, custom, position):
+        """
+        Write the new and changed rows of a batch, and the position it
+        reached if it's further than the one written before.
+
+        @return: A Deferred which fires with the rows that were new or
+            changed, and the set of ticket numbers that weren't in the
+            mirror before.
+        """
+        first = stream.position(rows[0])[0]
+        existing = yield runner.run(SQL(
+            'SELECT %s FROM %s WHERE %s >= ? AND %s <= ?' % (
+                ','.join(stream.columns), stream.table, stream.key[0],
+                stream.key[0]), (first, position[0])))
+        existing = set(_comparable(x) for x in existing)
+        changed = [x for x in rows if _comparable(x) not in existing]
+
+        new = set()
+        if stream is TICKETS and changed:
+            numbers = [row[0] for row in changed]
+            known = yield runner.run(SQL(
+                'SELECT id FROM ticket WHERE id IN (%s)' % (
+                    _placeholders(numbers),), tuple(numbers)))
+            new = set(numbers) - set(x[0] for x in known)
+            yield runner.run(SQL(
+                'DELETE FROM ticket_custom WHERE ticket IN (%s)' % (
+                    _placeholders(numbers),), tuple(numbers)))
+            numbers = set(numbers)
+            yield _insert(runner, 'ticket_custom', CUSTOM_COLUMNS,
+                          [x for x in custom if x[0] in numbers])
+        yield _insert(runner, stream.table, stream.columns, changed)
+
+        saved = yield runner.run(SQL(
+            'SELECT position FROM frack_mirror WHERE name = ?',
+            (stream.name,)))
+        if not saved or position > json.loads(saved[0][0]):
+            yield runner.run(SQL(
+                'INSERT OR REPLACE INTO frack_mirror (name, position) '
+                'VALUES (?, ?)', (stream.name, json.dumps(position))))
+        defer.returnValue((changed, new))
+
+
+    @defer.inlineCallbacks
+    def _copyReference(self, runner):
+        for table, columns in REFERENCE_TABLES:
+            rows = yield self.upstream.run(SQL('SELECT %s FROM %s' % (
+                ','.join(columns), table)))
+            yield runner.run(SQL('DELETE FROM %s' % (table,)))
+            yield _insert(runner, table, columns, rows)
+
+
+
+def _events(stream, rows, new):
+    """
+    The L{frack.pubsub.Bus} events for a batch of rows pulled from
+    C{stream}.
+
+    @param new: The numbers of tickets that are new to the mirror.
+    """
+    if stream is TICKETS:
+        for row in rows:
+            ticket = dict(zip(TICKET_COLUMNS, row))
+            if ticket['id'] in new:
+                yield {
+                    'kind': 'create',
+                    'ticket': ticket['id'],
+                    'time': ticket['time'],
+                    'author': ticket['reporter'],
+                    'changes': dict((k, (None, v))
+                                    for k, v in ticket.items() if k != 'id'),
+                }
+    elif stream is CHANGES:
+        # One update per ticket, time and author, as they were made.
+        updates = {}
+        order = []
+        for row in rows:
+            change = dict(zip(CHANGE_COLUMNS, row))
+            key = (change['ticket'], change['time'], change['author'])
+            if key not in updates:
+                order.append(key)
+                updates[key] = {
+                    'kind': 'update',
+                    'ticket': change['ticket'],
+                    'time': change['time'],
+                    'author': change['author'],
+                    'changes': {},
+                    'comment': None,
+                }
+            if change['field'] == 'comment':
+                updates[key]['comment'] = change['newvalue']
+            else:
+                updates[key]['changes'][change['field']] = (
+                    change['oldvalue'], change['newvalue'])
+        for key in order:
+            yield updates[key]
+    elif stream is ATTACHMENTS:
+        for row in rows:
+            attachment = dict(zip(ATTACHMENT_COLUMNS, row))
+            yield {
+                'kind': 'attachment',
+                'ticket': int(attachment['id']),
+                'time': attachment['time'],
+                'author': attachment['author'],
+                'filename': attachment['filename'],
+            }
+
+
+
+class _Refused(Resource):
+
+    isLeaf = True
+
+    def __init__(self, primaryUrl):
+        Resource.__init__(self)
+        self.primaryUrl = primaryUrl
+
+
+    def render(self, request):
+        request.setResponseCode(403)
+        request.setHeader('Content-Type', 'text/plain')
+        message = 'This is a read-only mirror.'
+        if self.primaryUrl:
+            message += '  Make changes at %s' % (self.primaryUrl,)
+        return message + '\n'
+
+
+
+class ReadOnlyResource(Resource):
+    """
+    I pass C{GET} and C{HEAD} requests on to another resource, and turn away
+    the rest.
+    """
+
+    def __init__(self, wrapped, primaryUrl=None):
+        """
+        @param primaryUrl: Where changes can be made, to tell people who try
+            to make them here, or C{None}.
+        """
+        Resource.__init__(self)
+        self.wrapped = wrapped
+        self.primaryUrl = primaryUrl
+
+
+    def getChildWithDefault(self, path, request):
+        if request.method in ('GET', 'HEAD'):
+            return self.wrapped.getChildWithDefault(path, request)
+        return _Refused(self.primaryUrl)
+
+
+    def render(self, request):
+        if request.method in ('GET', 'HEAD'):
+            return self.wrapped.render(request)
+        return _Refused(self.primaryUrl).render(request)
@@ -0,0 +1,149 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+"""
+Verification of Persona assertions.
+"""
+
+import json
+import hashlib
+from urllib import urlencode
+from StringIO import StringIO
+
+from twisted.internet import defer
+from twisted.web.client import (Agent, HTTPConnectionPool, FileBodyProducer,
+                                readBody)
+from twisted.web.http_headers import Headers
+
+from frack.db import UnauthorizedError
+from frack.cache import SingleFlight, LRUCache
+
+
+DEFAULT_VERIFIER = 'https://verifier.login.persona.org/verify'
+
+
+
+class PersonaVerifier(object):
+    """
+    I check Persona assertions with a remote verifier.
+
+    Requests go through one L{Agent} with a persistent connection pool, so
+    logins don't each pay for a new TLS connection, and at most
+    C{maxConcurrent} of them are in progress at once.  Assertions which were
+    verified are remembered until the verifier says they expire, and
+    concurrent checks of the same assertion share one request.
+    """
+
+    def __init__(self, audience, url=DEFAULT_VERIFIER, timeout=10,
+                 maxConcurrent=8, maxCached=10000, reactor=None, agent=None):
+        """
+        @param audience: The site's origin, which assertions must be for.
+        @param url: The URL of the verifier.
+        @param timeout: Seconds to wait for the verifier to connect, and
+            then again for it to respond.
+        @param maxConcurrent: Number of requests to the verifier allowed at
+            once.  Others wait their turn.
+        @param maxCached: Number of verified assertions to remember.
+        @param agent: An C{IAgent} to use instead of making one.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.audience = audience
+        self.url = url
+        self.timeout = timeout
+        self.maxCached = maxCached
+        self.pool = None
+        if agent is None:
+            self.pool = HTTPConnectionPool(reactor, persistent=True)
+            self.pool.maxPersistentPerHost = maxConcurrent
+            agent = Agent(reactor, connectTimeout=timeout, pool=self.pool)
+        self.agent = agent
+        self._semaphore = defer.DeferredSemaphore(maxConcurrent)
+        self._inflight = SingleFlight(self._verify, clock=reactor)
+        # Each costs a request to the verifier to get again.
+        self.verified = LRUCache(maxCached, cost=1.0, clock=reactor)
+
+
+    def verify(self, assertion):
+        """
+        Verify an assertion.
+
+        @return: A Deferred which fires with the verified email address, or
+            fails with L{UnauthorizedError}.
+        """
+        key = hashlib.sha1(assertion).hexdigest()
+        email = self.verified.peek(key)
+        if email is not None:
+            return defer.succeed(email)
+        return self._inflight.get((key, assertion))
+
+
+    def _verify(self, key_and_assertion):
+        key, assertion = key_and_assertion
+        d = self._semaphore.run(self._post, assertion)
+        return d.addCallback(self._checkStatus, key)
+
+
+    def _post(self, assertion):
+        body = urlencode({
+            'assertion': assertion,
+            'audience': self.audience,
+        })
+        headers = Headers({
+            'Content-Type': ['application/x-www-form-urlencoded'],
+        })
+        d = self.agent.request('POST', self.url, headers,
+                               FileBodyProducer(StringIO(body)))
+        d.addCallback(self._readResponse)
+        timeout = self.reactor.callLater(self.timeout, d.cancel)
+        def done(result):
+            if timeout.active():
+                timeout.cancel()
+            return result
+        d.addBoth(done)
+        d.addErrback(self._failed)
+        return d
+
+
+    def _readResponse(self, response):
+        if response.code != 200:
+            # Read and throw away the body so the connection can be reused.
+            d = readBody(response)
+            d.addBoth(lambda ignored: defer.fail(
+                UnauthorizedError('Verification failed')))
+            return d
+        return readBody(response).addCallback(json.loads)
+
+
+    def _failed(self, err):
+        if err.check(UnauthorizedError):
+            return err
+        raise UnauthorizedError('Verification failed: %s' % (
+            err.getErrorMessage(),))
+
+
+    def _checkStatus(self, data, key):
+        if not isinstance(data, dict) or data.get('status') != 'okay':
+            raise UnauthorizedError('Verification failed')
+        email = data.get('email')
+        if not email:
+            raise UnauthorizedError('Verification failed')
+        if 'expires' in data:
+            # Persona gives the expiry in milliseconds.
+            self._remember(key, email, data['expires'] / 1000.0)
+        return email
+
+
+    def _remember(self, key, email, expires):
+        ttl = expires - self.reactor.seconds()
+        if ttl > 0:
+            self.verified.set(key, email, ttl)
+
+
+    def close(self):
+        """
+        Close pooled connections.
+        """
+        if self.pool is None:
+            return defer.succeed(None)
+        return self.pool.closeCachedConnections()
@@ -0,0 +1,473 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+"""
+A norm-style runner that talks to Postgres through psycopg2's asynchronous
+mode, driven directly by the reactor instead of a thread pool.
+"""
+
+from collections import deque
+
+from zope.interface import implements
+
+from twisted.internet import defer
+from twisted.internet.error import ConnectionLost
+from twisted.python import log, failure
+
+from norm.interface import IRunner
+from norm.operation import Insert, SQL
+
+try:
+    from psycopg2.extensions import POLL_OK, POLL_READ, POLL_WRITE
+except ImportError:
+    # Same values as psycopg2.extensions, so that this module can be imported
+    # (and tested) without the driver installed.
+    POLL_OK, POLL_READ, POLL_WRITE = 0, 1, 2
+
+
+
+def translate(operation):
+    """
+    Turn a norm operation into Postgres SQL and arguments.
+
+    @param operation: A C{norm.operation.SQL} or C{norm.operation.Insert}.
+
+    @return: A tuple of C{(sql, args, lastrowid)} where C{lastrowid} is
+        C{True} if the first column of the first row is the result.
+    """
+    if isinstance(operation, Insert):
+        columns = [x[0] for x in operation.columns]
+        args = tuple([x[1] for x in operation.columns])
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            operation.table,
+            ','.join(columns),
+            ','.join(['%s'] * len(columns)))
+        if operation.lastrowid:
+            sql += ' RETURNING id'
+        return sql, args, operation.lastrowid
+    elif isinstance(operation, SQL):
+        sql = operation.sql.replace('%', '%%').replace('?', '%s')
+        return sql, tuple(operation.args or ()), False
+    raise TypeError("Don't know how to run %r" % (operation,))
+
+
+
+class _PollingConnection(object):
+    """
+    I wrap one asynchronous psycopg2 connection and run the queries queued on
+    it one after another, polling from the reactor between steps.
+
+    @ivar pending: A deque of C{(sql, args, lastrowid, deferred)} waiting to
+        be sent on this connection.
+    @ivar onLost: Called with me and my unsent queries if the connection to
+        the server breaks.
+    """
+
+    def __init__(self, reactor, connection):
+        self.reactor = reactor
+        self.connection = connection
+        self.pending = deque()
+        self.pinned = False
+        self.onIdle = None
+        self.onLost = None
+        self.lost = False
+        self._cursor = None
+        self._current = None
+        self._polled = None
+
+
+    def fileno(self):
+        return self.connection.fileno()
+
+
+    def logPrefix(self):
+        return 'pgasync'
+
+
+    def connectionLost(self, reason):
+        self._stopPolling()
+        if self._polled is not None:
+            d, self._polled = self._polled, None
+            d.errback(reason)
+
+
+    def doRead(self):
+        self._poll()
+
+
+    def doWrite(self):
+        self._poll()
+
+
+    def _stopPolling(self):
+        self.reactor.removeReader(self)
+        self.reactor.removeWriter(self)
+
+
+    def _poll(self):
+        try:
+            state = self.connection.poll()
+        except Exception:
+            self._stopPolling()
+            d, self._polled = self._polled, None
+            d.errback()
+            return
+        if state == POLL_OK:
+            self._stopPolling()
+            d, self._polled = self._polled, None
+            d.callback(None)
+        elif state == POLL_READ:
+            self.reactor.removeWriter(self)
+            self.reactor.addReader(self)
+        elif state == POLL_WRITE:
+            self.reactor.removeReader(self)
+            self.reactor.addWriter(self)
+
+
+    def poll(self):
+        """
+        Poll until the connection has finished whatever it's doing.
+
+        @return: A C{Deferred} which fires when the connection is idle.
+        """
+        self._polled = defer.Deferred()
+        d = self._polled
+        self._poll()
+        return d
+
+
+    def depth(self):
+        """
+        The number of queries queued or running on this connection.
+        """
+        return len(self.pending) + (self._current is not None)
+
+
+    def execute(self, sql, args, lastrowid=False):
+        """
+        Queue a query to be sent on this connection.
+
+        @return: A C{Deferred} firing with the rows (or the new row's id
+            if C{lastrowid}).
+        """
+        if self.lost:
+            return defer.fail(ConnectionLost('Postgres connection lost'))
+        d = defer.Deferred()
+        self.pending.append((sql, args, lastrowid, d))
+        if self._current is None:
+            self._next()
+        return d
+
+
+    def _next(self):
+        if not self.pending:
+            self._current = None
+            if self.onIdle is not None:
+                self.onIdle(self)
+            return
+        self._current = sql, args, lastrowid, d = self.pending.popleft()
+        if self._cursor is None:
+            self._cursor = self.connection.cursor()
+        try:
+            self._cursor.execute(sql, args)
+        except Exception:
+            self._failed(failure.Failure())
+            return
+        self.poll().addCallbacks(self._done, self._failed)
+
+
+    def _done(self, ignored):
+        sql, args, lastrowid, d = self._current
+        self._current = None
+        result = None
+        if self._cursor.description is not None:
+            result = self._cursor.fetchall()
+            if lastrowid:
+                result = result[0][0]
+        self._next()
+        d.callback(result)
+
+
+    def _failed(self, err):
+        sql, args, lastrowid, d = self._current
+        self._current = None
+        if self.connection.closed:
+            self._lost()
+        else:
+            self._next()
+        d.errback(err)
+
+
+    def _lost(self):
+        """
+        The server has gone away, or the connection to it has broken.  Stop
+        polling and hand the queries which weren't sent to L{onLost}.
+        """
+        self.lost = True
+        self._stopPolling()
+        pending, self.pending = self.pending, deque()
+        if self.onLost is not None:
+            self.onLost(self, pending)
+
+
+
+class _TransactionRunner(object):
+    """
+    I run operations on a single connection that's been set aside for a
+    transaction (see L{AsyncPostgresRunner.runInteraction}).
+    """
+
+    implements(IRunner)
+
+    def __init__(self, connection):
+        self.connection = connection
+
+
+    def run(self, operation):
+        sql, args, lastrowid = translate(operation)
+        return self.connection.execute(sql, args, lastrowid)
+
+
+    def runInteraction(self, function, *args, **kwargs):
+        # already in a transaction
+        return defer.maybeDeferred(function, self, *args, **kwargs)
+
+
+
+class AsyncPostgresRunner(object):
+    """
+    I run norm operations on a pool of asynchronous psycopg2 connections
+    without using any threads.
+
+    Queries issued with L{run} are pipelined: each goes onto the queue of the
+    least busy connection rather than waiting for an idle one.  Interactions
+    get a connection to themselves for the length of the transaction.
+
+    A connection which breaks (because the server restarted, say) fails the
+    query it was running, and the interaction it was pinned to if any.  It's
+    dropped from the pool, its unsent queries go to the other connections,
+    and a new one is opened in its place after a delay which starts at
+    L{initialDelay} and grows by L{factor} up to L{maxDelay} while
+    connecting keeps failing.
+
+    @param connect: A function which returns a new asynchronous psycopg2
+        connection (see L{postgres_async_connect}).
+    @param size: Number of connections in the pool.
+    """
+
+    implements(IRunner)
+
+    initialDelay = 1.0
+    factor = 2.0
+    maxDelay = 60.0
+
+    def __init__(self, connect, size=4, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.connect = connect
+        self.size = size
+        self.connections = []
+        self._started = False
+        self._starting = []
+        self._waiting = deque()
+        self._reconnects = []
+
+
+    def start(self):
+        """
+        Open all the connections in the pool (if they aren't already open).
+
+        @return: A C{Deferred} which fires once every connection is ready.
+        """
+        if self._started:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._starting.append(d)
+        if len(self._starting) == 1:
+            dlist = [self._open() for i in range(self.size)]
+            opened = defer.gatherResults(dlist, consumeErrors=True)
+            opened.addCallbacks(self._opened, self._openFailed)
+        return d
+
+
+    def _open(self):
+        """
+        Open a new connection.
+
+        @return: A C{Deferred} firing with the L{_PollingConnection} once
+            it's ready.
+        """
+        try:
+            conn = _PollingConnection(self.reactor, self.connect())
+        except Exception:
+            return defer.fail()
+        conn.onIdle = self._released
+        conn.onLost = self._lost
+        return conn.poll().addCallback(lambda _: conn)
+
+
+    def _opened(self, connections):
+        self.connections.extend(connections)
+        self._started = True
+        starting, self._starting = self._starting, []
+        for d in starting:
+            d.callback(None)
+
+
+    def _openFailed(self, err):
+        starting, self._starting = self._starting, []
+        for d in starting:
+            d.errback(err.value.subFailure)
+
+
+    def close(self):
+        """
+        Close all the connections.
+        """
+        for call in self._reconnects:
+            call.cancel()
+        self._reconnects = []
+        for conn in self.connections:
+            conn._stopPolling()
+            conn.connection.close()
+        self.connections = []
+        self._started = False
+
+
+    def _lost(self, conn, pending):
+        """
+        Drop a broken connection from the pool, pass its unsent queries on
+        and start opening a new one.
+        """
+        log.msg('Lost a Postgres connection; reconnecting')
+        if conn in self.connections:
+            self.connections.remove(conn)
+        for sql, args, lastrowid, d in pending:
+            if conn.pinned:
+                # Part of a transaction which has already failed.
+                d.errback(ConnectionLost('Postgres connection lost'))
+            else:
+                self._run(None, sql, args, lastrowid).chainDeferred(d)
+        self._reconnect(self.initialDelay)
+
+
+    def _reconnect(self, delay):
+        def reconnect():
+            self._reconnects.remove(call)
+            d = self._open()
+            d.addCallbacks(self._reconnected, self._reconnectFailed,
+                           errbackArgs=(delay,))
+        call = self.reactor.callLater(delay, reconnect)
+        self._reconnects.append(call)
+
+
+    def _reconnected(self, conn):
+        self.connections.append(conn)
+        self._released(conn)
+
+
+    def _reconnectFailed(self, err, delay):
+        log.err(err, 'Error reconnecting to Postgres')
+        self._reconnect(min(delay * self.factor, self.maxDelay))
+
+
+    def _leastBusy(self):
+        available = [x for x in self.connections if not x.pinned]
+        if not available:
+            return None
+        return min(available, key=lambda x: x.depth())
+
+
+    def _idle(self):
+        for conn in self.connections:
+            if not conn.pinned and not conn.depth():
+                return conn
+        return None
+
+
+    def run(self, operation):
+        """
+        Run a single operation outside of any explicit transaction.
+        """
+        sql, args, lastrowid = translate(operation)
+        return self.start().addCallback(self._run, sql, args, lastrowid)
+
+
+    def _run(self, ignored, sql, args, lastrowid):
+        conn = self._leastBusy()
+        if conn is None:
+            d = defer.Deferred()
+            self._waiting.append((False, d))
+            return d.addCallback(lambda conn: conn.execute(sql, args,
+                                                           lastrowid))
+        return conn.execute(sql, args, lastrowid)
+
+
+    def runInteraction(self, function, *args, **kwargs):
+        """
+        Call C{function} with a runner bound to one connection inside a
+        transaction, committing if it succeeds and rolling back otherwise.
+        """
+        d = self.start().addCallback(lambda _: self._pin())
+        return d.addCallback(self._interact, function, args, kwargs)
+
+
+    def _pin(self):
+        conn = self._idle()
+        if conn is None:
+            d = defer.Deferred()
+            self._waiting.append((True, d))
+            return d
+        conn.pinned = True
+        return conn
+
+
+    def _interact(self, conn, function, args, kwargs):
+        d = conn.execute('BEGIN', ())
+        d.addCallback(lambda _: function(_TransactionRunner(conn), *args,
+                                         **kwargs))
+        def commit(result):
+            return conn.execute('COMMIT', ()).addCallback(lambda _: result)
+        def rollback(err):
+            d = conn.execute('ROLLBACK', ())
+            d.addErrback(log.err)
+            return d.addCallback(lambda _: err)
+        d.addCallbacks(commit, rollback)
+        return d.addBoth(self._unpin, conn)
+
+
+    def _unpin(self, result, conn):
+        conn.pinned = False
+        self._released(conn)
+        return result
+
+
+    def _released(self, conn):
+        """
+        Hand C{conn} to whoever has been waiting longest for a connection, now
+        that it's idle or unpinned.
+        """
+        if conn not in self.connections:
+            return
+        while self._waiting and not conn.pinned:
+            pin, d = self._waiting[0]
+            if pin:
+                if conn.depth():
+                    break
+                conn.pinned = True
+            self._waiting.popleft()
+            d.callback(conn)
+
+
+
+def postgres_async_connect(name, username, host='/var/run/postgresql'):
+    """
+    Return a function which makes new asynchronous psycopg2 connections, for
+    use with L{AsyncPostgresRunner}.
+    """
+    import psycopg2
+    def connect():
+        # async is a reserved word in newer Pythons
+        return psycopg2.connect(host=host, database=name, user=username,
+                                **{'async': 1})
+    return connect
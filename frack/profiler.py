@@ -0,0 +1,233 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+"""
+A sampling profiler which can be switched on in a running process.
+
+While it runs, a background thread looks at the stack of every other thread
+every C{interval} seconds.  Samples taken while the reactor is handling a
+web request are tagged with the request's route (its path with numbers
+replaced by C{<int>}).  Nothing is done when it isn't running, so it costs
+nothing to keep around.
+"""
+
+import os
+import re
+import sys
+import json
+import threading
+
+from twisted.internet import defer
+
+
+SPEEDSCOPE_SCHEMA = 'https://www.speedscope.app/file-format-schema.json'
+
+FORMATS = {
+    'collapsed': 'text/plain',
+    'speedscope': 'application/json',
+}
+
+# The longest a profile may run for.
+MAX_SECONDS = 60
+
+
+
+def routeName(path):
+    """
+    Get the route a path belongs to, like C{/tickets/ticket/<int>}.
+    """
+    path = path.split('?', 1)[0]
+    return re.sub(r'/\d+(?=/|$)', '/<int>', path)
+
+
+def frameName(code):
+    filename = '/'.join(code.co_filename.split('/')[-2:])
+    return '%s (%s:%d)' % (code.co_name, filename, code.co_firstlineno)
+
+
+def _requestRoute(frame):
+    """
+    Find the route of the web request a stack is handling, if it is.
+    """
+    while frame is not None:
+        code = frame.f_code
+        if (code.co_name == 'process'
+                and code.co_filename.endswith(('web/server.py',
+                                               'web/server.pyc'))):
+            request = frame.f_locals.get('self')
+            path = getattr(request, 'path', None)
+            if path:
+                return routeName(path)
+        frame = frame.f_back
+    return None
+
+
+
+class Profile(object):
+    """
+    The samples taken by a L{SamplingProfiler}.
+
+    @ivar counts: A dict mapping C{(thread name, route, stack)} to the
+        number of times it was seen, where C{stack} is a tuple of frame
+        names from the outermost in.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.counts = {}
+        self.samples = 0
+
+
+    def add(self, thread, route, stack):
+        key = (thread, route or '-', stack)
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+
+    def collapsed(self):
+        """
+        Format as collapsed stacks, as read by C{flamegraph.pl}.
+        """
+        lines = []
+        for (thread, route, stack), count in sorted(self.counts.items()):
+            names = [thread, route] + list(stack)
+            lines.append('%s %d' % (';'.join(x.replace(';', ':')
+                                             for x in names), count))
+        return '\n'.join(lines) + '\n'
+
+
+    def speedscope(self):
+        """
+        Format as a speedscope file, with a profile for each thread.
+        """
+        frames = []
+        index = {}
+        def frameIndex(name):
+            if name not in index:
+                index[name] = len(frames)
+                frames.append({'name': name})
+            return index[name]
+
+        profiles = {}
+        for (thread, route, stack), count in sorted(self.counts.items()):
+            profile = profiles.setdefault(thread, {
+                'type': 'sampled',
+                'name': thread,
+                'unit': 'seconds',
+                'startValue': 0,
+                'endValue': 0,
+                'samples': [],
+                'weights': [],
+            })
+            names = ['route: ' + route] + list(stack)
+            profile['samples'].append([frameIndex(x) for x in names])
+            profile['weights'].append(count * self.interval)
+            profile['endValue'] += count * self.interval
+
+        return json.dumps({
+            '$schema': SPEEDSCOPE_SCHEMA,
+            'shared': {'frames': frames},
+            'profiles': [profiles[x] for x in sorted(profiles)],
+            'exporter': 'frack',
+        })
+
+
+    def format(self, name):
+        if name == 'speedscope':
+            return self.speedscope()
+        return self.collapsed()
+
+
+
+class SamplingProfiler(object):
+    """
+    I sample the stacks of all threads from a background thread.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.profile = None
+        self._thread = None
+        self._stopping = threading.Event()
+
+
+    def start(self):
+        self.profile = Profile(self.interval)
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='frack-profiler')
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def stop(self):
+        """
+        Stop sampling.
+
+        @return: The L{Profile}.
+        """
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+        return self.profile
+
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self.sample()
+            self._stopping.wait(self.interval)
+
+
+    def sample(self):
+        """
+        Record the stack of every thread but my own.
+        """
+        me = threading.current_thread().ident
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            route = _requestRoute(frame)
+            stack = []
+            while frame is not None:
+                stack.append(frameName(frame.f_code))
+                frame = frame.f_back
+            stack.reverse()
+            self.profile.add(names.get(ident, str(ident)), route,
+                             tuple(stack))
+        self.profile.samples += 1
+
+
+_running = []
+
+
+def profileFor(seconds, format='collapsed', interval=0.005, pid=None,
+               clock=None):
+    """
+    Profile this process for a while.
+
+    @param pid: If given, it must be this process's ID.
+
+    @return: A Deferred which fires with the profile in C{format} (one of
+        L{FORMATS}).
+
+    @raise ValueError: If a profile is already running, or the arguments
+        are unreasonable.
+    """
+    if clock is None:
+        from twisted.internet import reactor as clock
+    if pid is not None and pid != os.getpid():
+        raise ValueError('No such process')
+    if format not in FORMATS:
+        raise ValueError('Unknown format %r' % (format,))
+    if not 0 < seconds <= MAX_SECONDS or not 0.0005 <= interval <= 1:
+        raise ValueError('Bad duration or interval')
+    if _running:
+        raise ValueError('A profile is already running')
+    profiler = SamplingProfiler(interval)
+    _running.append(profiler)
+    profiler.start()
+    d = defer.Deferred()
+    def finish():
+        _running.remove(profiler)
+        d.callback(profiler.stop().format(format))
+    clock.callLater(seconds, finish)
+    return d
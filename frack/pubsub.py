@@ -0,0 +1,72 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+"""
+In-process publish/subscribe of ticket changes.
+"""
+
+from twisted.python import log
+
+
+
+class Bus(object):
+    """
+    I pass ticket events from the code that makes changes (L{TicketStore})
+    to whoever wants to know about them.
+
+    Events are dicts with at least these keys:
+
+        - C{'kind'}: C{'create'}, C{'update'} or C{'attachment'}
+        - C{'ticket'}: the ticket number
+        - C{'time'}: when it happened (seconds since the epoch)
+        - C{'author'}: who did it
+
+    C{'create'} and C{'update'} events also have C{'changes'}, a dict of
+    C{field: (oldvalue, newvalue)} (the old value is C{None} for new
+    tickets), and C{'update'} events have C{'comment'}.  C{'attachment'}
+    events have C{'filename'}.
+
+    Subscribers are called synchronously, so they should be quick.
+    """
+
+    def __init__(self):
+        self._all = []
+        self._byTicket = {}
+
+
+    def subscribe(self, callback, ticket=None):
+        """
+        Call C{callback} with every event, or only those for one ticket.
+
+        @param ticket: A ticket number, or C{None} for all tickets.
+
+        @return: A function which undoes the subscription.
+        """
+        if ticket is None:
+            subscribers = self._all
+        else:
+            subscribers = self._byTicket.setdefault(ticket, [])
+        subscribers.append(callback)
+        def unsubscribe():
+            if callback in subscribers:
+                subscribers.remove(callback)
+            if ticket is not None and not subscribers:
+                if self._byTicket.get(ticket) is subscribers:
+                    del self._byTicket[ticket]
+        return unsubscribe
+
+
+    def subscriberCount(self):
+        return len(self._all) + sum(map(len, self._byTicket.values()))
+
+
+    def publish(self, event):
+        """
+        Tell the subscribers about C{event}.  Errors in subscribers are
+        logged, not raised.
+        """
+        subscribers = self._all + self._byTicket.get(event['ticket'], [])
+        for callback in subscribers:
+            try:
+                callback(event)
+            except Exception:
+                log.err(None, 'Error delivering %r' % (event,))
@@ -1,10 +1,23 @@
 # Copyright (c) Twisted Matrix Laboratories.
 # See LICENSE for details.
-import os, pwd, socket
-from twisted.python import usage
+import os, pwd, socket, tempfile
+from twisted.python import usage, log
 from twisted.application.service import Service
 from frack.db import sqlite_connect, postgres_probably_connect
+from frack.pgasync import AsyncPostgresRunner, postgres_async_connect
 from frack.wiring import WebService
+from frack.persona import PersonaVerifier, DEFAULT_VERIFIER
+from frack.workers import Supervisor, workerArguments, parseTCP
+from frack.admin import AdminResource
+from frack.cache import TieredCache, LRUCache, SQLiteCache
+from frack.admission import AdmissionController, parseLimits
+from frack.profiler import profileFor
+from frack.mirror import Mirror
+from frack import index, similar
+
+from twisted.internet import reactor
+from twisted.internet.endpoints import serverFromString
+from twisted.web.server import Site
 
 from norm.common import BlockingRunner
 from norm.sqlite import SqliteTranslator
@@ -14,21 +27,91 @@ from norm.postgres import PostgresTranslator
 class FrackService(Service):
 
     def __init__(self, dbRunner, webPort, mediaPath, baseUrl, templateRoot,
-                 fileRoot, secureCookies):
+                 fileRoot, secureCookies, ticketFreshness=0, verifier=None,
+                 admin=None, adminToken=None, cache=None, admission=None,
+                 cacheBudget=None, upstream=None, primaryUrl=None,
+                 ticketIndex=False, ticketStats=False, snapshots=False,
+                 similarTickets=False, spamThreshold=None, spamThreads=2):
+        """
+        @param upstream: A runner for the database to mirror into
+            C{dbRunner}, which is then served read-only, or C{None}.
+        @param primaryUrl: Where changes to a mirror can be made.
+        """
         self.dbRunner = dbRunner
+        self.admin = admin
+        self.adminToken = adminToken
         self.mediaPath = mediaPath
         self.templateRoot = templateRoot
         self.web = WebService(webPort, mediaPath, self.dbRunner, templateRoot,
-                              fileRoot, baseUrl, secureCookies)
+                              fileRoot, baseUrl, secureCookies,
+                              ticketFreshness=ticketFreshness,
+                              verifier=verifier,
+                              cache=cache,
+                              admission=admission,
+                              cacheBudget=cacheBudget,
+                              readOnly=upstream is not None,
+                              primaryUrl=primaryUrl,
+                              ticketIndex=ticketIndex,
+                              ticketStats=ticketStats,
+                              snapshots=snapshots,
+                              similarTickets=similarTickets,
+                              spamThreshold=spamThreshold,
+                              spamThreads=spamThreads)
+        self.mirror = None
+        if upstream is not None:
+            self.mirror = Mirror(upstream, dbRunner, bus=self.web.bus)
 
     def startService(self):
+        """
+        Start serving, once the mirror's tables are ready if there's a
+        mirror.
+        """
+        if self.mirror is None:
+            self._serve()
+            return
+        d = self.mirror.open()
+        d.addCallback(lambda ignored: self.mirror.start())
+        d.addCallback(lambda ignored: self._serve())
+        d.addErrback(log.err, 'Error opening the mirror')
+
+
+    def _serve(self):
         self.web.startService()
+        if self.admin:
+            resource = AdminResource(self.web.metrics.snapshot,
+                                     self.adminToken, profileFor)
+            serverFromString(reactor, self.admin).listen(Site(resource))
+
+
+    def stopService(self):
+        if self.mirror is not None:
+            self.mirror.stop()
+        return self.web.stopService()
 
 
 
 class Options(usage.Options):
     synopsis = '[frack options]'
 
+    optFlags = [['postgres_async', None,
+                 'Talk to Postgres asynchronously from the reactor '
+                 '(requires psycopg2).'],
+                ['ticket_index', None,
+                 'Keep an index of ticket statuses, owners and so on in '
+                 'memory, for /api/v1/search (requires numpy).'],
+                ['ticket_stats', None,
+                 'Keep ticket counts per milestone, component and owner up '
+                 'to date, and show them at /tickets/stats.  Run '
+                 '"python -m frack.stats rebuild" first.'],
+                ['ticket_snapshots', None,
+                 'Use the snapshots taken by "python -m frack.history '
+                 'snapshot" to show tickets\' history.'],
+                ['similar_tickets', None,
+                 'Keep an index of ticket summaries and descriptions in '
+                 'memory, to suggest duplicates of new tickets '
+                 '(requires numpy).'],
+    ]
+
     optParameters = [['postgres_db', None, None,
                       'Name of Postgres database to connect to.'],
 
@@ -54,6 +137,59 @@ class Options(usage.Options):
                       'Location of jinja2 template files.'],
                      ['uploads', None, '/tmp/frackuploads',
                       'Location where attachments are stored'],
+                     ['postgres_pool', None, 4,
+                      'Number of connections used by --postgres_async.', int],
+                     ['ticket_freshness', None, 0,
+                      'Seconds a fetched ticket may be reused for other '
+                      'viewers.', float],
+                     ['persona_verifier', None, DEFAULT_VERIFIER,
+                      'URL of the Persona verifier used for logging in.'],
+                     ['persona_timeout', None, 10,
+                      'Seconds to wait for the Persona verifier.', float],
+                     ['persona_concurrency', None, 8,
+                      'Number of requests to the Persona verifier allowed '
+                      'at once.', int],
+                     ['workers', None, 1,
+                      'Number of processes to serve with.  More than one '
+                      'needs a tcp: endpoint for --web.', int],
+                     ['admin', None, None,
+                      'Endpoint description for the admin resource (which '
+                      'serves metrics and profiles).  Keep it private.'],
+                     ['admin_token', None, None,
+                      'Token required by the admin resource, in an '
+                      'X-Admin-Token header.  Needed with --admin.'],
+                     ['cache_size', None, 1000,
+                      'Number of tickets each process keeps in memory.', int],
+                     ['cache_budget', None, 256,
+                      'Megabytes of memory each process may use for '
+                      'caches.  0 means no limit.', float],
+                     ['cache_path', None, None,
+                      'Path of an SQLite file in which processes on this '
+                      'host share cached tickets.  --workers uses a '
+                      'temporary one if this is not given.'],
+                     ['db_limits', None, 'read=8,write=4,auth=4',
+                      'Number of database operations of each class allowed '
+                      'at once with --postgres_async.'],
+                     ['db_queue', None, 100,
+                      'Number of database operations allowed to wait for a '
+                      'turn.  More are refused with 503.', int],
+                     ['db_deadline', None, 2.0,
+                      'Seconds a database operation may wait for a turn '
+                      'before being refused with 503.', float],
+                     ['mirror', None, None,
+                      'Path to an SQLite database to keep as a read-only '
+                      'mirror of the database given by --postgres_db or '
+                      '--sqlite_db, and serve from.'],
+                     ['primary_url', None, None,
+                      'With --mirror, where changes can be made.'],
+                     ['spam_threshold', None, None,
+                      'Check new tickets and comments against the word '
+                      'counts of Trac\'s spam filter, holding any scoring '
+                      'at least this (from 0 to 1, say 0.9) for moderators '
+                      'at /tickets/spam.', float],
+                     ['spam_threads', None, 2,
+                      'Number of threads scoring submissions for spam.',
+                      int],
     ]
 
     longdesc = """A post, postmodern deconstruction of the Python web-based issue tracker."""
@@ -62,20 +198,83 @@ class Options(usage.Options):
 
 def makeService(config):
 
+    try:
+        limits = parseLimits(config['db_limits'])
+    except ValueError as e:
+        raise usage.UsageError('Bad --db_limits: %s' % (e,))
+
+    if config['admin'] and not config['admin_token']:
+        raise usage.UsageError('--admin needs --admin_token.')
+    if config['ticket_index'] and not index.available:
+        raise usage.UsageError('--ticket_index needs numpy.')
+    if config['similar_tickets'] and not similar.available:
+        raise usage.UsageError('--similar_tickets needs numpy.')
+    if (config['spam_threshold'] is not None
+            and not 0 < config['spam_threshold'] <= 1):
+        raise usage.UsageError('--spam_threshold must be between 0 and 1.')
+
+    if config['mirror'] and config['workers'] > 1:
+        raise usage.UsageError('--mirror can only be used with one worker.')
+
+    if config['workers'] > 1:
+        try:
+            parseTCP(config['web'])
+        except ValueError as e:
+            raise usage.UsageError(str(e))
+        tempDirectory = None
+        if not config['cache_path']:
+            # Cached values are pickled, so the file must be somewhere only
+            # we can write to.  mkdtemp makes the directory mode 0700.
+            tempDirectory = tempfile.mkdtemp(prefix='frack-cache-')
+            config['cache_path'] = os.path.join(tempDirectory,
+                                                'cache.sqlite')
+        return Supervisor(config['workers'], config['web'],
+                          workerArguments(config), admin=config['admin'],
+                          adminToken=config['admin_token'],
+                          tempDirectory=tempDirectory)
+
     if config['postgres_db'] and config['sqlite_db']:
         raise usage.UsageError("Only one of 'sqlite_db' and 'postgres_db' can be specified.")
     if not config['postgres_db'] and not config['sqlite_db']:
         config['postgres_db'] = 'trac'
 
-    if config['postgres_db']:
-        connection = postgres_probably_connect(config['postgres_db'], config['postgres_user'])
-        translator = PostgresTranslator()
-    elif config['sqlite_db']:
-        connection = sqlite_connect(config['sqlite_db'])
-        translator = SqliteTranslator()
-    runner = BlockingRunner(connection[1], translator)
+    if config['postgres_db'] and config['postgres_async']:
+        connect = postgres_async_connect(config['postgres_db'],
+                                         config['postgres_user'])
+        runner = AsyncPostgresRunner(connect, config['postgres_pool'])
+        # Only this runner does more than one thing at once, and no more
+        # than it has connections.
+        admission = AdmissionController(limits,
+                                        capacity=config['postgres_pool'],
+                                        queueSize=config['db_queue'],
+                                        deadline=config['db_deadline'])
+    else:
+        admission = None
+        if config['postgres_db']:
+            connection = postgres_probably_connect(config['postgres_db'], config['postgres_user'])
+            translator = PostgresTranslator()
+        elif config['sqlite_db']:
+            connection = sqlite_connect(config['sqlite_db'])
+            translator = SqliteTranslator()
+        runner = BlockingRunner(connection[1], translator)
+
+    upstream = None
+    if config['mirror']:
+        upstream = runner
+        runner = BlockingRunner(sqlite_connect(config['mirror'])[1],
+                                SqliteTranslator())
+        admission = None
 
     secureCookies = config['baseUrl'].startswith('https')
+    shared = None
+    if config['cache_path']:
+        shared = SQLiteCache(config['cache_path'])
+    cache = TieredCache(LRUCache(config['cache_size']), shared)
+    budget = int(config['cache_budget'] * 1024 * 1024) or None
+    verifier = PersonaVerifier(config['baseUrl'],
+                               url=config['persona_verifier'],
+                               timeout=config['persona_timeout'],
+                               maxConcurrent=config['persona_concurrency'])
 
     return FrackService(dbRunner=runner,
                         webPort=config['web'],
@@ -83,4 +282,19 @@ def makeService(config):
                         baseUrl=config['baseUrl'],
                         templateRoot=config['templates'],
                         fileRoot=config['uploads'],
-                        secureCookies=secureCookies)
+                        secureCookies=secureCookies,
+                        ticketFreshness=config['ticket_freshness'],
+                        verifier=verifier,
+                        admin=config['admin'],
+                        adminToken=config['admin_token'],
+                        cache=cache,
+                        admission=admission,
+                        cacheBudget=budget,
+                        upstream=upstream,
+                        primaryUrl=config['primary_url'],
+                        ticketIndex=config['ticket_index'],
+                        ticketStats=config['ticket_stats'],
+                        snapshots=config['ticket_snapshots'],
+                        similarTickets=config['similar_tickets'],
+                        spamThreshold=config['spam_threshold'],
+                        spamThreads=config['spam_threads'])
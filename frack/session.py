@@ -0,0 +1,349 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+"""
+Sessions for visitors, kept in Trac's C{session} and C{session_attribute}
+tables so that any Frack process can serve any request.
+"""
+
+import os
+import hashlib
+
+from twisted.internet import defer
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+from norm.operation import SQL
+
+from frack.cache import estimateSize
+
+
+COOKIE_NAME = 'frack_session'
+
+# Trac uses authenticated = 0 for anonymous sessions.  It's an integer
+# column in Postgres, so don't pass a bool.
+ANONYMOUS = 0
+
+
+
+class Session(object):
+    """
+    One visitor's session attributes.
+
+    @ivar sid: The session id, or C{None} if nothing has been stored yet (in
+        which case there's no cookie either).
+    """
+
+    def __init__(self, store, request, sid, attributes):
+        self.store = store
+        self.request = request
+        self.sid = sid
+        self.attributes = attributes
+
+
+    def get(self, name, default=None):
+        return self.attributes.get(name, default)
+
+
+    def set(self, name, value):
+        """
+        Set an attribute (or remove it if C{value} is C{None}).  It's written
+        to the database later; see L{save}.
+        """
+        if self.sid is None:
+            if value is None:
+                return
+            self.sid = self.store.create()
+            self._setCookie()
+        if value is None:
+            self.attributes.pop(name, None)
+        else:
+            self.attributes[name] = value
+        self.store.set(self.sid, name, value)
+
+
+    def rotate(self):
+        """
+        Move the session to a new id (and cookie), keeping its attributes,
+        and delete the old one.  Do this when the visitor logs in or out, so
+        that an id someone else knew before can't be used to act as them.
+        """
+        if self.sid is None:
+            return
+        old, self.sid = self.sid, self.store.create()
+        self._setCookie()
+        for name, value in self.attributes.items():
+            self.store.set(self.sid, name, value)
+        self.store.delete(old)
+
+
+    def _setCookie(self):
+        self.request.addCookie(COOKIE_NAME, self.sid, path='/',
+                               max_age=str(int(self.store.lifetime)),
+                               secure=self.store.secureCookies,
+                               httpOnly=True)
+
+
+    def save(self):
+        """
+        Write unsaved changes now, rather than waiting for the next flush.
+        Do this when another process may be asked for the session before
+        then.
+
+        @return: A Deferred which fires when it's written.
+        """
+        return self.store.flush()
+
+
+
+class SessionStore(object):
+    """
+    I keep anonymous sessions in Trac's session tables, with a write-behind
+    cache in front of them.
+
+    Attributes which have been read are cached for C{cacheTime} seconds.
+    Changes and the time of each visit are kept in memory and written in one
+    transaction every C{flushInterval} seconds, so a page view doesn't cost a
+    write.  Another process may see the old values until then (and until its
+    own cached copy is older than C{cacheTime}).  Every C{sweepInterval}
+    seconds, sessions which haven't been used for C{lifetime} seconds are
+    deleted.
+    """
+
+    secureCookies = True
+
+
+    def __init__(self, runner, lifetime=90 * 86400, cacheTime=5,
+                 flushInterval=2, sweepInterval=3600, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.runner = runner
+        self.lifetime = lifetime
+        self.cacheTime = cacheTime
+        self.flushInterval = flushInterval
+        self.sweepInterval = sweepInterval
+        self.clock = clock
+
+        # sid -> (time loaded, attributes)
+        self._cache = {}
+        # sid -> {name: value}; value None means delete
+        self._dirty = {}
+        # sid -> last visit
+        self._visited = {}
+        self._new = set()
+        self._deleted = set()
+
+        self._flusher = LoopingCall(self.flush)
+        self._flusher.clock = clock
+        self._sweeper = LoopingCall(self.expire)
+        self._sweeper.clock = clock
+
+
+    def start(self):
+        self._flusher.start(self.flushInterval, now=False)
+        self._sweeper.start(self.sweepInterval, now=False)
+
+
+    def stop(self):
+        """
+        Stop the timers and write anything unsaved.
+        """
+        for call in (self._flusher, self._sweeper):
+            if call.running:
+                call.stop()
+        return self.flush()
+
+
+    def forRequest(self, request):
+        """
+        Get the session for a request (from its cookie).
+
+        @return: A Deferred which fires with a L{Session}.  If the request
+            had no valid session, the session is empty and will be created
+            when something is stored in it.
+        """
+        sid = request.getCookie(COOKIE_NAME)
+        if not sid:
+            return defer.succeed(Session(self, request, None, {}))
+        def loaded(attributes):
+            if attributes is None:
+                return Session(self, request, None, {})
+            return Session(self, request, sid, attributes)
+        return self.load(sid).addCallback(loaded)
+
+
+    def load(self, sid):
+        """
+        Load a session's attributes.
+
+        @return: A Deferred which fires with a dict, or with C{None} if there
+            is no such session or it has expired.
+        """
+        now = self.clock.seconds()
+        if sid in self._deleted:
+            return defer.succeed(None)
+        cached = self._cache.get(sid)
+        if cached is not None and (sid in self._dirty or sid in self._new
+                                   or cached[0] + self.cacheTime > now):
+            self._visited[sid] = int(now)
+            return defer.succeed(cached[1])
+
+        op = SQL('''
+            SELECT s.last_visit, a.name, a.value
+            FROM session s
+            LEFT JOIN session_attribute a
+                ON a.sid = s.sid AND a.authenticated = s.authenticated
+            WHERE s.sid = ? AND s.authenticated = ?''', (sid, ANONYMOUS))
+        def gotRows(rows):
+            if (not rows or (rows[0][0] or 0) < now - self.lifetime
+                    or sid in self._deleted):
+                return None
+            # Only a session which exists counts as visited.
+            self._visited[sid] = int(now)
+            attributes = dict([(name, value) for ignored, name, value in rows
+                               if name is not None])
+            # Don't lose changes made while this was loading.
+            attributes.update(self._dirty.get(sid, {}))
+            self._cache[sid] = (now, attributes)
+            return attributes
+        return self.runner.run(op).addCallback(gotRows)
+
+
+    def create(self):
+        """
+        Make a new session.
+
+        @return: The new session id.
+        """
+        sid = hashlib.sha1(os.urandom(16)).hexdigest()
+        self._new.add(sid)
+        self._visited[sid] = int(self.clock.seconds())
+        self._cache[sid] = (self.clock.seconds(), {})
+        return sid
+
+
+    def delete(self, sid):
+        """
+        Delete a session, at the next flush.
+        """
+        self._cache.pop(sid, None)
+        self._dirty.pop(sid, None)
+        self._visited.pop(sid, None)
+        if sid in self._new:
+            # Never written, so there's nothing to delete.
+            self._new.discard(sid)
+        else:
+            self._deleted.add(sid)
+
+
+    def stats(self):
+        """
+        Get the number of cached sessions and a rough count of the bytes
+        they take up, for a L{frack.cache.CacheRegistry}.
+        """
+        return {
+            'entries': len(self._cache),
+            'bytes': estimateSize(self._cache),
+            'unsaved': len(self._dirty),
+        }
+
+
+    def set(self, sid, name, value):
+        """
+        Set (or, if C{value} is C{None}, remove) a session attribute.
+        """
+        cached = self._cache.get(sid)
+        if cached is not None:
+            if value is None:
+                cached[1].pop(name, None)
+            else:
+                cached[1][name] = value
+        self._dirty.setdefault(sid, {})[name] = value
+
+
+    def flush(self):
+        """
+        Write unsaved changes and visit times, and forget cached sessions
+        which are too old to be trusted.
+
+        @return: A Deferred which fires when they're written.
+        """
+        now = self.clock.seconds()
+        for sid, (loaded, ignored) in self._cache.items():
+            if (loaded + self.cacheTime <= now and sid not in self._dirty
+                    and sid not in self._new):
+                del self._cache[sid]
+
+        if not (self._dirty or self._visited or self._new or self._deleted):
+            return defer.succeed(None)
+        dirty, self._dirty = self._dirty, {}
+        visited, self._visited = self._visited, {}
+        new, self._new = self._new, set()
+        deleted, self._deleted = self._deleted, set()
+
+        def failed(err):
+            log.err(err, 'Error saving sessions')
+            # Try again next time, keeping anything newer.
+            for sid, changes in dirty.items():
+                changes.update(self._dirty.get(sid, {}))
+                self._dirty[sid] = changes
+            for sid, when in visited.items():
+                self._visited.setdefault(sid, when)
+            self._new.update(new)
+            self._deleted.update(deleted)
+        d = self.runner.runInteraction(self._write, dirty, visited, new,
+                                       deleted)
+        return d.addErrback(failed)
+
+
+    @defer.inlineCallbacks
+    def _write(self, runner, dirty, visited, new, deleted=()):
+        for sid in deleted:
+            yield runner.run(SQL('''
+                DELETE FROM session_attribute
+                WHERE sid = ? AND authenticated = ?''', (sid, ANONYMOUS)))
+            yield runner.run(SQL('''
+                DELETE FROM session
+                WHERE sid = ? AND authenticated = ?''', (sid, ANONYMOUS)))
+        for sid in new:
+            yield runner.run(SQL('''
+                INSERT INTO session (sid, authenticated, last_visit)
+                VALUES (?, ?, ?)''', (sid, ANONYMOUS, visited.get(sid))))
+        for sid, when in visited.items():
+            if sid not in new:
+                yield runner.run(SQL('''
+                    UPDATE session SET last_visit = ?
+                    WHERE sid = ? AND authenticated = ?''',
+                    (when, sid, ANONYMOUS)))
+        for sid, changes in dirty.items():
+            for name, value in changes.items():
+                yield runner.run(SQL('''
+                    DELETE FROM session_attribute
+                    WHERE sid = ? AND authenticated = ? AND name = ?''',
+                    (sid, ANONYMOUS, name)))
+                if value is not None:
+                    yield runner.run(SQL('''
+                        INSERT INTO session_attribute
+                        (sid, authenticated, name, value)
+                        VALUES (?, ?, ?, ?)''', (sid, ANONYMOUS, name, value)))
+
+
+    def expire(self):
+        """
+        Delete sessions which haven't been used for C{lifetime} seconds.
+
+        @return: A Deferred which fires when they're gone.
+        """
+        cutoff = int(self.clock.seconds() - self.lifetime)
+        def interaction(runner):
+            d = runner.run(SQL('''
+                DELETE FROM session_attribute
+                WHERE authenticated = ? AND sid IN (
+                    SELECT sid FROM session
+                    WHERE authenticated = ? AND last_visit < ?)''',
+                (ANONYMOUS, ANONYMOUS, cutoff)))
+            d.addCallback(lambda ignored: runner.run(SQL('''
+                DELETE FROM session
+                WHERE authenticated = ? AND last_visit < ?''',
+                (ANONYMOUS, cutoff))))
+            return d
+        d = self.runner.runInteraction(interaction)
+        return d.addErrback(log.err, 'Error expiring sessions')
@@ -0,0 +1,298 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+"""
+Tickets whose summaries and descriptions read like some text, for pointing
+out likely duplicates while a ticket is being written.
+
+L{SimilarTickets} is a TF-IDF index kept in memory.  A ticket is a vector
+of the words in its summary (counted twice) and description, each weighted
+C{1 + log(count)} and the whole normalized, but without inverse document
+frequencies, so adding a ticket never changes the others.  The frequencies
+are applied to the text being looked up instead (the usual C{lnc.ltc}
+scheme).  Each word has a postings list of the rows it's in and its weight
+in each, kept in C{array}s which NumPy reads without copying; a lookup adds
+up the postings of its few words into a score per row and takes the best
+with C{argpartition}.
+
+A ticket whose text changes gets a new row and its old one is masked out.
+The old rows still count towards how common their words are, which matters
+little because summaries and descriptions are rarely edited.
+
+The index is loaded from C{ticket} when it starts and follows the
+L{frack.pubsub.Bus} events published by L{frack.db.TicketStore}.  Changes
+made by other processes aren't published here, so it also re-reads tickets
+whose C{changetime} has moved on every C{interval} seconds.
+
+NumPy is optional; without it L{available} is C{False} and there is no
+index.
+"""
+
+import re
+import math
+import zlib
+from array import array
+
+from twisted.internet import defer, task
+from twisted.python import log
+from norm.operation import SQL
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from frack.cache import estimateSize
+
+
+available = numpy is not None
+
+WORD = re.compile(r'[a-z0-9_]{2,}')
+
+STOPWORDS = frozenset('''
+    an and are as at be but by can do does for from has have if in into is
+    it its not of on or so that the then there this to was we when which
+    will with would you
+'''.split())
+
+
+
+def words(text):
+    """
+    The words of C{text} worth comparing, lowercased, in order.
+    """
+    return [x for x in WORD.findall((text or u'').lower())
+            if x not in STOPWORDS]
+
+
+def termCounts(summary, description):
+    """
+    Count the words of a summary and description, counting the summary's
+    twice.
+    """
+    counts = {}
+    for word in words(summary) * 2 + words(description):
+        counts[word] = counts.get(word, 0) + 1
+    return counts
+
+
+def termWeights(counts, idf=None):
+    """
+    Weight word counts as C{1 + log(count)}, times C{idf[word]} if given,
+    and normalize them.
+
+    @return: A dict mapping words to weights, empty if there are no words.
+    """
+    weights = {}
+    for word, count in counts.iteritems():
+        weight = 1 + math.log(count)
+        if idf is not None:
+            weight *= idf.get(word, 0)
+        if weight:
+            weights[word] = weight
+    norm = math.sqrt(sum(x * x for x in weights.itervalues()))
+    return dict((word, x / norm) for word, x in weights.iteritems())
+
+
+def _digest(summary, description):
+    parts = []
+    for text in (summary, description):
+        text = text or u''
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        parts.append(text)
+    return zlib.crc32('\0'.join(parts))
+
+
+
+class SimilarTickets(object):
+    """
+    I find the tickets most like some text.
+
+    @ivar postings: A dict mapping each word to a tuple of an C{array} of
+        the rows it's in and an C{array} of its weight in each.
+    @ivar ids: The ticket number of each row.
+    @ivar alive: 1 for each row which is its ticket's current text, else 0.
+    @ivar latest: The latest C{changetime} seen, or C{None}.
+    @ivar ready: Whether the index has been loaded.
+    """
+
+    def __init__(self, runner, clock=None):
+        """
+        @param runner: The C{norm.interface.IRunner} tickets are read from.
+        """
+        if numpy is None:
+            raise RuntimeError('Similar tickets need numpy.')
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.runner = runner
+        self.clock = clock
+        self.postings = {}
+        self.ids = array('i')
+        self.alive = array('B')
+        self.latest = None
+        self.ready = False
+        self._rows = {}
+        self._digests = {}
+        self._live = 0
+        self._loop = None
+
+
+    def update(self, ticket_number, summary, description):
+        """
+        Set the text of a ticket, adding it if it's new.
+
+        @return: C{True} if the text changed, else C{False}.
+        """
+        digest = _digest(summary, description)
+        if self._digests.get(ticket_number) == digest:
+            return False
+        old = self._rows.get(ticket_number)
+        if old is None:
+            self._live += 1
+        else:
+            self.alive[old] = 0
+        row = len(self.ids)
+        self.ids.append(ticket_number)
+        self.alive.append(1)
+        weights = termWeights(termCounts(summary, description))
+        for word, weight in weights.iteritems():
+            postings = self.postings.get(word)
+            if postings is None:
+                postings = self.postings[word] = (array('i'), array('f'))
+            postings[0].append(row)
+            postings[1].append(weight)
+        self._rows[ticket_number] = row
+        self._digests[ticket_number] = digest
+        return True
+
+
+    def similar(self, summary, description=None, limit=10, exclude=None,
+                minimum=0.05):
+        """
+        Find the tickets most like a summary and description.
+
+        @param exclude: A ticket number to leave out (the ticket being
+            looked at, say), or C{None}.
+        @param minimum: The least cosine similarity worth reporting, from 0
+            to 1.
+
+        @return: A list of up to C{limit} C{(ticket number, similarity)},
+            most similar first.
+        """
+        if not self._live or limit < 1:
+            return []
+        idf = {}
+        for word in termCounts(summary, description):
+            postings = self.postings.get(word)
+            if postings is not None:
+                idf[word] = math.log(float(len(self.ids)) /
+                                     len(postings[0])) + 1
+        query = termWeights(termCounts(summary, description), idf)
+        if not query:
+            return []
+        scores = numpy.zeros(len(self.ids), numpy.float32)
+        for word, weight in query.iteritems():
+            rows, weights = self.postings[word]
+            # A word is in each row at most once, so this is safe.
+            scores[numpy.frombuffer(rows, numpy.int32)] += (
+                weight * numpy.frombuffer(weights, numpy.float32))
+        scores *= numpy.frombuffer(self.alive, numpy.uint8)
+        if exclude in self._rows:
+            scores[self._rows[exclude]] = 0
+        limit = min(limit, len(scores))
+        best = numpy.argpartition(-scores, limit - 1)[:limit]
+        best = best[numpy.argsort(-scores[best], kind='mergesort')]
+        return [(self.ids[row], round(float(scores[row]), 3))
+                for row in best if scores[row] >= minimum]
+
+
+    @defer.inlineCallbacks
+    def refresh(self):
+        """
+        Load the tickets changed since L{latest}, or every ticket the first
+        time.
+
+        @return: A Deferred which fires with the number of tickets whose
+            text changed.
+        """
+        where, args = '1 = 1', ()
+        if self.latest is not None:
+            where, args = 'changetime >= ?', (self.latest,)
+        rows = yield self.runner.run(SQL('''
+            SELECT id, summary, description, changetime
+            FROM ticket
+            WHERE %s''' % (where,), args))
+        changed = 0
+        for ticket_number, summary, description, changetime in rows:
+            if self.update(ticket_number, summary, description):
+                changed += 1
+            if changetime is not None and (self.latest is None or
+                                           changetime > self.latest):
+                self.latest = changetime
+        self.ready = True
+        defer.returnValue(changed)
+
+
+    def start(self, interval=60):
+        """
+        Load the index, and refresh it every C{interval} seconds.
+        """
+        def refresh():
+            d = self.refresh()
+            d.addErrback(log.err, 'Error refreshing similar tickets')
+            return d
+        self._loop = task.LoopingCall(refresh)
+        self._loop.clock = self.clock
+        self._loop.start(interval)
+
+
+    def stop(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+
+
+    def subscribe(self, bus):
+        """
+        Follow the ticket changes published on C{bus}.
+
+        @return: A function which stops following them.
+        """
+        return bus.subscribe(self._ticketChanged)
+
+
+    def _ticketChanged(self, event):
+        changes = event.get('changes', {})
+        if event['kind'] == 'create':
+            self.update(event['ticket'],
+                        changes.get('summary', (None, None))[1],
+                        changes.get('description', (None, None))[1])
+        elif event['kind'] == 'update' and ('summary' in changes or
+                                            'description' in changes):
+            # Only what changed is published, so read the rest.
+            d = self._reread(event['ticket'])
+            d.addErrback(log.err, 'Error re-reading ticket %d' % (
+                event['ticket'],))
+
+
+    @defer.inlineCallbacks
+    def _reread(self, ticket_number):
+        rows = yield self.runner.run(SQL('''
+            SELECT summary, description
+            FROM ticket
+            WHERE id = ?''', (ticket_number,)))
+        if rows:
+            self.update(ticket_number, rows[0][0], rows[0][1])
+
+
+    def stats(self):
+        """
+        The number of tickets and bytes I hold, for
+        L{frack.cache.CacheRegistry}.
+        """
+        size = sum(rows.itemsize * len(rows) + weights.itemsize * len(weights)
+                   for rows, weights in self.postings.itervalues())
+        size += self.ids.itemsize * len(self.ids) + len(self.alive)
+        size += estimateSize(self._rows) + estimateSize(self._digests)
+        size += sum(estimateSize(word) for word in self.postings)
+        return {'entries': self._live, 'bytes': size}
@@ -0,0 +1,492 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+"""
+Bayesian spam scoring of new tickets and comments, using the word counts
+Trac's spam filter keeps in C{spamfilter_bayes}.
+
+L{Classifier} holds those counts in memory (a slot per word, and the
+counts in two C{array}s) and scores text the way SpamBayes does: each word
+gets a probability of being spam (Robinson's), the 150 words furthest from
+0.5 are combined with Fisher's chi-squared method.  The tokenizer is a
+subset of SpamBayes's (words of 3 to 12 characters, URL pieces and
+C{skip:} tokens for long words), so the counts Trac trained still mean
+something.
+
+L{SpamFilter} scores submissions in its own thread pool, so the reactor
+never waits for a score, and logs every check to C{spamfilter_log}.
+Anything scoring at least C{threshold} is held in C{frack_spam_held} until
+a moderator (a user with C{SPAM_ADMIN} or C{TRAC_ADMIN} in Trac's
+C{permission} table) decides.  Each decision trains the classifier, both
+in memory and in C{spamfilter_bayes}, without reloading it.
+"""
+
+import re
+import math
+import time
+import json
+import threading
+from array import array
+
+from twisted.internet import defer, threads
+from twisted.python import log
+from twisted.python.threadpool import ThreadPool
+from norm.operation import Insert, SQL
+
+from frack.db import NotFoundError
+
+
+# The row of spamfilter_bayes holding how many messages have been trained.
+STATE = 'saved state'
+
+MODERATORS = ('SPAM_ADMIN', 'TRAC_ADMIN')
+
+# Headers carrying credentials, which are left out of spamfilter_log.
+PRIVATE_HEADERS = frozenset(['authorization', 'cookie',
+                             'proxy-authorization', 'x-admin-token'])
+
+CREATE = '''
+    CREATE TABLE IF NOT EXISTS frack_spam_held (
+        log_id integer primary key,
+        time integer not null,
+        kind text not null,
+        ticket integer,
+        author text,
+        data text,
+        comment text,
+        replyto text)'''
+
+# SpamBayes's defaults.
+UNKNOWN_STRENGTH = 0.45
+UNKNOWN_PROBABILITY = 0.5
+MINIMUM_STRENGTH = 0.1
+MAX_DISCRIMINATORS = 150
+
+URL = re.compile(r'(https?|ftp)://([^\s/?#<>"\']+)([^\s<>"\']*)', re.I)
+PUNCTUATION = '.,;:!?()[]{}<>"\''
+
+
+
+def tokenize(text):
+    """
+    Split text into the tokens SpamBayes would find in it.
+
+    @return: A set of tokens.
+    """
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    tokens = set()
+    for match in URL.finditer(text):
+        scheme, host, rest = match.groups()
+        tokens.add('proto:' + scheme.lower())
+        for piece in host.lower().split('.'):
+            if piece:
+                tokens.add('url:' + piece)
+    text = URL.sub(' ', text)
+    for word in text.lower().split():
+        word = word.strip(PUNCTUATION)
+        if 3 <= len(word) <= 12:
+            tokens.add(word)
+        elif len(word) > 12:
+            tokens.add('skip:%s %d' % (word[0], len(word) // 10 * 10))
+    return tokens
+
+
+def chi2Q(x2, v):
+    """
+    The probability that chi-squared with C{v} (even) degrees of freedom
+    is at least C{x2}.
+    """
+    m = x2 / 2.0
+    total = term = math.exp(-m)
+    for i in range(1, v // 2):
+        term *= m / i
+        total += term
+    return min(total, 1.0)
+
+
+
+def formatHeaders(headers):
+    """
+    Format request headers for C{spamfilter_log}, one C{name: value} line
+    each, leaving out L{PRIVATE_HEADERS}.
+
+    @param headers: A dict mapping header names to values.
+    """
+    return ''.join(['%s: %s\n' % (name, value)
+                    for name, value in sorted(headers.items())
+                    if name.lower() not in PRIVATE_HEADERS])
+
+
+
+class Classifier(object):
+    """
+    I hold how many spam and ham messages each word has been in.
+
+    My methods may be called from several threads at once.
+
+    @ivar nspam: The number of spam messages trained.
+    @ivar nham: The number of ham messages trained.
+    """
+
+    def __init__(self):
+        self.nspam = 0
+        self.nham = 0
+        self._slots = {}
+        self._spam = array('l')
+        self._ham = array('l')
+        self._lock = threading.Lock()
+
+
+    def __len__(self):
+        return len(self._slots)
+
+
+    def load(self, rows):
+        """
+        Replace my counts with C{rows} of C{(word, nspam, nham)}, as in
+        C{spamfilter_bayes}.
+        """
+        slots = {}
+        spam = array('l')
+        ham = array('l')
+        nspam = nham = 0
+        for word, wordSpam, wordHam in rows:
+            if word == STATE:
+                nspam, nham = wordSpam or 0, wordHam or 0
+                continue
+            if isinstance(word, unicode):
+                word = word.encode('utf-8')
+            slots[word] = len(spam)
+            spam.append(wordSpam or 0)
+            ham.append(wordHam or 0)
+        with self._lock:
+            self._slots, self._spam, self._ham = slots, spam, ham
+            self.nspam, self.nham = nspam, nham
+
+
+    def probability(self, word):
+        """
+        The probability that a message containing C{word} is spam.
+        """
+        slot = self._slots.get(word)
+        if slot is None:
+            return UNKNOWN_PROBABILITY
+        spam, ham = self._spam[slot], self._ham[slot]
+        spamRatio = spam / float(self.nspam or 1)
+        hamRatio = ham / float(self.nham or 1)
+        if not spamRatio + hamRatio:
+            return UNKNOWN_PROBABILITY
+        probability = spamRatio / (spamRatio + hamRatio)
+        n = spam + ham
+        return ((UNKNOWN_STRENGTH * UNKNOWN_PROBABILITY + n * probability) /
+                (UNKNOWN_STRENGTH + n))
+
+
+    def score(self, text):
+        """
+        Score some text.
+
+        @return: A tuple of the probability that it's spam, from 0 to 1,
+            and a list of the C{(word, probability)} that decided it,
+            strongest first.
+        """
+        with self._lock:
+            clues = [(word, self.probability(word))
+                     for word in tokenize(text)]
+        clues = [x for x in clues
+                 if abs(x[1] - 0.5) >= MINIMUM_STRENGTH]
+        clues.sort(key=lambda x: (-abs(x[1] - 0.5), x[0]))
+        clues = clues[:MAX_DISCRIMINATORS]
+        if not clues:
+            return 0.5, []
+        # Fisher's method, keeping the products from underflowing.
+        S = H = 1.0
+        Sexp = Hexp = 0
+        for word, probability in clues:
+            S *= 1.0 - probability
+            H *= probability
+            if S < 1e-200:
+                S, e = math.frexp(S)
+                Sexp += e
+            if H < 1e-200:
+                H, e = math.frexp(H)
+                Hexp += e
+        S = math.log(S) + Sexp * math.log(2)
+        H = math.log(H) + Hexp * math.log(2)
+        n = 2 * len(clues)
+        S = 1.0 - chi2Q(-2.0 * S, n)
+        H = 1.0 - chi2Q(-2.0 * H, n)
+        return (S - H + 1.0) / 2.0, clues
+
+
+    def train(self, text, spam):
+        """
+        Count the words of C{text} as being in one more spam (if C{spam}) or
+        ham message.
+
+        @return: A sorted list of the words counted.
+        """
+        words = sorted(tokenize(text))
+        self.count(words, spam)
+        return words
+
+
+    def count(self, words, spam):
+        """
+        Count C{words} (from L{tokenize}) as being in one more spam (if
+        C{spam}) or ham message.
+        """
+        with self._lock:
+            counts = self._spam if spam else self._ham
+            for word in words:
+                slot = self._slots.get(word)
+                if slot is None:
+                    slot = self._slots[word] = len(self._spam)
+                    self._spam.append(0)
+                    self._ham.append(0)
+                counts[slot] += 1
+            if spam:
+                self.nspam += 1
+            else:
+                self.nham += 1
+
+
+    def stats(self):
+        """
+        The number of words and bytes I hold, for
+        L{frack.cache.CacheRegistry}.
+        """
+        size = (self._spam.itemsize * len(self._spam) * 2 +
+                sum(len(word) for word in self._slots) +
+                len(self._slots) * 80)
+        return {'entries': len(self._slots), 'bytes': size}
+
+
+
+class SpamFilter(object):
+    """
+    I check submissions for spam, off the reactor thread, and keep the ones
+    which look like it for moderators.
+
+    @ivar classifier: My L{Classifier}.
+    @ivar ready: Whether the word counts have been loaded.  Until they
+        are, checks are logged but nothing is held.
+    """
+
+    def __init__(self, runner, threshold=0.9, threads=2, reactor=None):
+        """
+        @param runner: The C{norm.interface.IRunner} for the spam filter's
+            tables.
+        @param threshold: The score, from 0 to 1, at which submissions are
+            held.
+        @param threads: The most threads scoring at once.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self.runner = runner
+        self.threshold = threshold
+        self.reactor = reactor
+        self.classifier = Classifier()
+        self.pool = ThreadPool(0, threads, 'spam')
+        self.ready = False
+
+
+    def _inPool(self, func, *args):
+        return threads.deferToThreadPool(self.reactor, self.pool, func, *args)
+
+
+    def start(self):
+        """
+        Start scoring, and load the word counts.
+        """
+        self.pool.start()
+        d = self.load()
+        d.addErrback(log.err, 'Error loading spam word counts')
+        return d
+
+
+    def stop(self):
+        self.pool.stop()
+
+
+    @defer.inlineCallbacks
+    def load(self):
+        """
+        Load the word counts from C{spamfilter_bayes}.
+        """
+        yield self.runner.run(SQL(CREATE))
+        rows = yield self.runner.run(SQL('''
+            SELECT word, nspam, nham
+            FROM spamfilter_bayes'''))
+        yield self._inPool(self.classifier.load, rows)
+        self.ready = True
+
+
+    @defer.inlineCallbacks
+    def check(self, path, author, authenticated, ip, headers, content):
+        """
+        Score a submission and log it to C{spamfilter_log}.
+
+        @param headers: The request's headers, as text.
+
+        @return: A Deferred which fires with a dict of the C{'id'} of the log
+            entry, the C{'score'}, and whether to C{'hold'} it.
+        """
+        score, clues = 0.5, []
+        if self.ready:
+            score, clues = yield self._inPool(self.classifier.score, content)
+        hold = score >= self.threshold
+        # Trac's karma: negative for spam, positive for ham.
+        karma = int(round((0.5 - score) * 10))
+        reasons = 'BayesianFilterStrategy (%d): spam probability %.1f%%' % (
+            karma, score * 100)
+        log_id = yield self.runner.run(Insert('spamfilter_log', [
+            ('time', int(time.time())),
+            ('path', path),
+            ('author', author),
+            ('authenticated', int(bool(authenticated))),
+            ('ipnr', ip),
+            ('headers', headers),
+            ('content', content),
+            ('rejected', int(hold)),
+            ('karma', karma),
+            ('reasons', reasons),
+        ], lastrowid=True))
+        defer.returnValue({'id': log_id, 'score': score, 'hold': hold})
+
+
+    def hold(self, log_id, kind, ticket_number, author, data, comment=None,
+             replyto=None):
+        """
+        Keep a submission for a moderator.
+
+        @param log_id: The C{'id'} from L{check}.
+        @param kind: C{'create'} or C{'update'}.
+        @param data: The ticket fields submitted.
+        """
+        return self.runner.run(Insert('frack_spam_held', [
+            ('log_id', log_id),
+            ('time', int(time.time())),
+            ('kind', kind),
+            ('ticket', ticket_number),
+            ('author', author),
+            ('data', json.dumps(data, sort_keys=True)),
+            ('comment', comment),
+            ('replyto', replyto),
+        ]))
+
+
+    @defer.inlineCallbacks
+    def fetchHeld(self, log_id=None):
+        """
+        Get the submissions waiting for a moderator, oldest first.
+
+        @param log_id: If given, get only the one with this log entry.
+
+        @return: A Deferred which fires with a list of dicts with
+            C{'log_id'}, C{'time'}, C{'kind'}, C{'ticket'}, C{'author'},
+            C{'data'}, C{'comment'}, C{'replyto'}, C{'content'} and
+            C{'karma'}.
+        """
+        where, args = '1 = 1', ()
+        if log_id is not None:
+            where, args = 'h.log_id = ?', (log_id,)
+        rows = yield self.runner.run(SQL('''
+            SELECT h.log_id, h.time, h.kind, h.ticket, h.author, h.data,
+                h.comment, h.replyto, l.content, l.karma
+            FROM frack_spam_held h
+            LEFT JOIN spamfilter_log l ON l.id = h.log_id
+            WHERE %s
+            ORDER BY h.time, h.log_id''' % (where,), args))
+        held = []
+        for row in rows:
+            item = dict(zip(['log_id', 'time', 'kind', 'ticket', 'author',
+                             'data', 'comment', 'replyto', 'content',
+                             'karma'], row))
+            item['data'] = json.loads(item['data'])
+            held.append(item)
+        defer.returnValue(held)
+
+
+    def isModerator(self, user):
+        """
+        Whether C{user} may decide what's spam.
+
+        @return: A Deferred which fires with C{True} or C{False}.
+        """
+        if not user:
+            return defer.succeed(False)
+        d = self.runner.run(SQL('''
+            SELECT 1
+            FROM permission
+            WHERE username = ? AND action IN (?, ?)''',
+            (user,) + MODERATORS))
+        return d.addCallback(bool)
+
+
+    @defer.inlineCallbacks
+    def decide(self, log_id, spam):
+        """
+        Take a moderator's decision on a held submission: train on it, mark
+        its log entry, and stop holding it.
+
+        Only one decision is taken on each submission: the one which stops
+        holding it.  The classifier learns in memory once the decision is
+        committed.
+
+        @param spam: C{True} if it's spam.
+
+        @return: A Deferred which fires with the held submission (as from
+            L{fetchHeld}), for the caller to apply if it isn't spam, or
+            errbacks with L{NotFoundError} if it isn't held.
+        """
+        held = yield self.fetchHeld(log_id)
+        if not held:
+            raise NotFoundError(log_id)
+        item = held[0]
+        words = yield self._inPool(tokenize, item['content'] or '')
+        words = sorted(words)
+        yield self.runner.runInteraction(self._decided, log_id, spam, words)
+        yield self._inPool(self.classifier.count, words, spam)
+        defer.returnValue(item)
+
+
+    @defer.inlineCallbacks
+    def _decided(self, runner, log_id, spam, words):
+        deleted = yield runner.run(SQL('''
+            DELETE FROM frack_spam_held
+            WHERE log_id = ?
+            RETURNING log_id''', (log_id,)))
+        if not deleted:
+            # Someone else decided first.
+            raise NotFoundError(log_id)
+        yield runner.run(SQL('''
+            UPDATE spamfilter_log
+            SET rejected = ?
+            WHERE id = ?''', (int(spam), log_id)))
+        yield self._saveCounts(runner, words, spam)
+
+
+    @defer.inlineCallbacks
+    def train(self, content, spam):
+        """
+        Count the words of C{content} as spam or ham in C{spamfilter_bayes},
+        and then in memory.
+        """
+        words = yield self._inPool(tokenize, content)
+        words = sorted(words)
+        yield self.runner.runInteraction(self._saveCounts, words, spam)
+        yield self._inPool(self.classifier.count, words, spam)
+
+
+    @defer.inlineCallbacks
+    def _saveCounts(self, runner, words, spam):
+        nspam, nham = (1, 0) if spam else (0, 1)
+        for word in words + [STATE]:
+            yield runner.run(SQL('''
+                INSERT INTO spamfilter_bayes (word, nspam, nham)
+                VALUES (?, ?, ?)
+                ON CONFLICT (word)
+                DO UPDATE SET nspam = spamfilter_bayes.nspam + excluded.nspam,
+                    nham = spamfilter_bayes.nham + excluded.nham''',
+                (word.decode('utf-8', 'replace'), nspam, nham)))
@@ -0,0 +1,242 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+"""
+Server-Sent Events streams of ticket changes.
+"""
+
+import os
+import json
+from collections import deque
+
+from zope.interface import implementer
+
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.task import LoopingCall
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+from frack.pubsub import Bus
+
+
+
+def formatEvent(event):
+    """
+    Format a L{frack.pubsub.Bus} event, with the C{'id'} given it by an
+    L{EventStream}, as a Server-Sent Event.
+    """
+    return 'id: %s\nevent: %s\ndata: %s\n\n' % (
+        event['id'], event['kind'],
+        json.dumps(event, separators=(',', ':'), sort_keys=True))
+
+
+# Sent to a watcher who reconnects after missing events which can't be
+# replayed, so that it knows to reload.
+RESET = 'event: reset\ndata: {}\n\n'
+
+
+
+@implementer(IPushProducer)
+class _Subscriber(object):
+    """
+    I write events to one open request.
+
+    While the connection can't keep up I keep up to C{bufferSize} events; if
+    more arrive than that, the connection is dropped.  The browser will
+    reconnect, and it's better to lose one slow watcher than to hold on to
+    memory for it indefinitely.
+    """
+
+    def __init__(self, stream, request, bufferSize):
+        self.stream = stream
+        self.request = request
+        self.bufferSize = bufferSize
+        self.paused = False
+        self.buffered = deque()
+        self.unsubscribe = None
+        self.finished = False
+
+
+    def deliver(self, event):
+        self.send(formatEvent(event))
+
+
+    def send(self, data):
+        if self.finished:
+            return
+        if not self.paused:
+            self.request.write(data)
+        elif len(self.buffered) < self.bufferSize:
+            self.buffered.append(data)
+        else:
+            self.drop()
+
+
+    def drop(self):
+        """
+        Stop listening and close the connection.
+        """
+        self.stopProducing()
+        self.request.unregisterProducer()
+        self.request.finish()
+
+
+    def pauseProducing(self):
+        self.paused = True
+
+
+    def resumeProducing(self):
+        self.paused = False
+        while self.buffered and not self.paused:
+            self.request.write(self.buffered.popleft())
+
+
+    def stopProducing(self):
+        if self.finished:
+            return
+        self.finished = True
+        self.buffered.clear()
+        if self.unsubscribe is not None:
+            self.unsubscribe()
+        self.stream._removed(self)
+
+
+
+class EventStream(object):
+    """
+    I keep track of everyone watching ticket changes.
+
+    An idle watcher costs one open connection and a subscription on an
+    internal L{frack.pubsub.Bus}; a single timer sends every watcher a
+    comment line every C{heartbeat} seconds so that proxies don't close idle
+    connections.
+
+    Each event is given an id made of a token for this stream and a
+    sequence number, and the last C{replaySize} are kept.  A browser which
+    reconnects with the id of the last event it saw in C{Last-Event-ID} is
+    sent the ones it missed, or, if they're no longer kept (or were sent by
+    another process), a C{reset} event.
+
+    @ivar subscribers: The set of open L{_Subscriber}s.
+    """
+
+    def __init__(self, bus, bufferSize=64, heartbeat=15, clock=None,
+                 replaySize=1000):
+        """
+        @param bus: The L{frack.pubsub.Bus} to get events from.
+        @param bufferSize: Number of events to hold for a watcher whose
+            connection isn't keeping up before dropping it.
+        @param replaySize: Number of recent events to keep for watchers
+            who reconnect.
+        """
+        self.bus = bus
+        self.bufferSize = bufferSize
+        self.heartbeat = heartbeat
+        self.subscribers = set()
+        self._heartbeat = LoopingCall(self._beat)
+        if clock is not None:
+            self._heartbeat.clock = clock
+        self._token = os.urandom(4).encode('hex')
+        self._sequence = 0
+        self._recent = deque(maxlen=replaySize)
+        self._watchers = Bus()
+        self.bus.subscribe(self._record)
+
+
+    def _record(self, event):
+        self._sequence += 1
+        event = dict(event, id='%s-%d' % (self._token, self._sequence))
+        self._recent.append((self._sequence, event))
+        self._watchers.publish(event)
+
+
+    def _missed(self, lastEventID, ticket_number):
+        """
+        Get the events after the one with id C{lastEventID}, or C{None} if
+        they can't all be known.
+        """
+        token, _, sequence = lastEventID.partition('-')
+        if token != self._token or not sequence.isdigit():
+            return None
+        sequence = int(sequence)
+        oldest = self._recent[0][0] if self._recent else self._sequence + 1
+        if sequence > self._sequence or sequence < oldest - 1:
+            return None
+        return [event for number, event in self._recent
+                if number > sequence
+                and ticket_number in (None, event['ticket'])]
+
+
+    def resource(self, ticket_number=None):
+        """
+        Get a resource streaming events for one ticket, or for all of them if
+        C{ticket_number} is C{None}.
+        """
+        return _StreamResource(self, ticket_number)
+
+
+    def watch(self, request, ticket_number=None):
+        """
+        Start streaming events to C{request}.
+        """
+        request.setHeader('Content-Type', 'text/event-stream')
+        request.setHeader('Cache-Control', 'no-cache')
+        # Tell nginx not to buffer the stream.
+        request.setHeader('X-Accel-Buffering', 'no')
+
+        subscriber = _Subscriber(self, request, self.bufferSize)
+        subscriber.unsubscribe = self._watchers.subscribe(subscriber.deliver,
+                                                          ticket_number)
+        self.subscribers.add(subscriber)
+        request.registerProducer(subscriber, True)
+        request.notifyFinish().addBoth(lambda ignored:
+                                       subscriber.stopProducing())
+        if not self._heartbeat.running:
+            self._heartbeat.start(self.heartbeat, now=False)
+
+        # Send something straight away so the browser knows it's connected.
+        request.write('retry: 10000\n\n')
+        lastEventID = request.getHeader('last-event-id')
+        if lastEventID:
+            missed = self._missed(lastEventID, ticket_number)
+            if missed is None:
+                subscriber.send(RESET)
+            else:
+                for event in missed:
+                    subscriber.deliver(event)
+        return subscriber
+
+
+    def _removed(self, subscriber):
+        self.subscribers.discard(subscriber)
+        if not self.subscribers and self._heartbeat.running:
+            self._heartbeat.stop()
+
+
+    def _beat(self):
+        for subscriber in list(self.subscribers):
+            subscriber.send(':\n\n')
+
+
+    def close(self):
+        """
+        Close every stream.
+        """
+        for subscriber in list(self.subscribers):
+            subscriber.drop()
+
+
+
+class _StreamResource(Resource):
+
+    isLeaf = True
+
+
+    def __init__(self, stream, ticket_number):
+        Resource.__init__(self)
+        self.stream = stream
+        self.ticket_number = ticket_number
+
+
+    def render_GET(self, request):
+        self.stream.watch(request, self.ticket_number)
+        return NOT_DONE_YET
@@ -0,0 +1,243 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+"""
+Open and closed ticket counts per milestone, component and owner.
+
+The counts are kept in the C{frack_ticket_stats} table, a row per
+dimension (C{milestone}, C{component} or C{owner}), value and state
+(C{open} or C{closed}).  C{python -m frack.stats rebuild} fills it in from
+C{ticket} once; after that L{frack.db.TicketStore} (given C{stats=True})
+adjusts the counts once each ticket it creates or updates is committed,
+from the fields it knows changed.  Showing them is then one read of a small
+table rather than a C{GROUP BY} over every ticket.
+
+The counts are adjusted in a transaction of their own, so that failing to
+count can't lose the change to the ticket, and with C{INSERT ... ON
+CONFLICT} (Postgres 9.5 or SQLite 3.24 and later), so that two adjusting a
+count that isn't there yet don't both try to add it.
+
+C{python -m frack.stats verify} compares the counts with C{ticket}, for
+tickets changed some other way (by Trac, say) or whose counts failed.
+"""
+
+import sys
+
+from twisted.internet import defer
+from twisted.python import usage
+from twisted.python.failure import Failure
+from norm.operation import SQL
+
+
+DIMENSIONS = ['milestone', 'component', 'owner']
+
+# The fields which decide which counts a ticket is in.
+FIELDS = DIMENSIONS + ['status']
+
+CREATE = '''
+    CREATE TABLE IF NOT EXISTS frack_ticket_stats (
+        dimension text not null,
+        value text not null,
+        state text not null,
+        count integer not null,
+        primary key (dimension, value, state))'''
+
+STATE = "CASE WHEN status = 'closed' THEN 'closed' ELSE 'open' END"
+
+# The counts as they are in the ticket table.
+COUNT = ' UNION ALL '.join(['''
+    SELECT '%(dimension)s', COALESCE(%(dimension)s, ''), %(state)s, COUNT(*)
+    FROM ticket
+    GROUP BY COALESCE(%(dimension)s, ''), %(state)s''' % {
+        'dimension': dimension, 'state': STATE}
+    for dimension in DIMENSIONS])
+
+
+
+def state(status):
+    """
+    The state counted for a ticket with C{status}.
+    """
+    if status == 'closed':
+        return 'closed'
+    return 'open'
+
+
+def deltas(old, new):
+    """
+    Work out how the counts change when a ticket does.
+
+    @param old: A dict of the ticket's L{FIELDS} before, or C{None} for a
+        new ticket.
+    @param new: A dict of them after.
+
+    @return: A sorted list of C{(dimension, value, state, delta)}, without
+        those which don't change.
+    """
+    changes = {}
+    for fields, sign in [(old, -1), (new, 1)]:
+        if fields is None:
+            continue
+        for dimension in DIMENSIONS:
+            key = (dimension, fields.get(dimension) or '',
+                   state(fields.get('status')))
+            changes[key] = changes.get(key, 0) + sign
+    return sorted(key + (delta,) for key, delta in changes.items() if delta)
+
+
+@defer.inlineCallbacks
+def applyDeltas(runner, changes):
+    """
+    Adjust the counts by C{changes} (from L{deltas}), as an interaction.
+    """
+    for change in changes:
+        yield runner.run(SQL('''
+            INSERT INTO frack_ticket_stats (dimension, value, state, count)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (dimension, value, state)
+            DO UPDATE SET count = frack_ticket_stats.count + excluded.count''',
+            tuple(change)))
+
+
+@defer.inlineCallbacks
+def rebuild(runner):
+    """
+    Count every ticket again, as an interaction.
+
+    @return: A Deferred which fires with the number of rows of counts.
+    """
+    yield runner.run(SQL(CREATE))
+    yield runner.run(SQL('DELETE FROM frack_ticket_stats'))
+    yield runner.run(SQL('''
+        INSERT INTO frack_ticket_stats (dimension, value, state, count)
+        ''' + COUNT))
+    rows = yield runner.run(SQL('SELECT COUNT(*) FROM frack_ticket_stats'))
+    defer.returnValue(rows[0][0])
+
+
+@defer.inlineCallbacks
+def verify(runner):
+    """
+    Compare the counts with the ticket table.
+
+    @return: A Deferred which fires with a sorted list of
+        C{(dimension, value, state, counted, actual)} for every count
+        that's wrong.
+    """
+    counted = yield runner.run(SQL('''
+        SELECT dimension, value, state, count
+        FROM frack_ticket_stats
+        WHERE count != 0'''))
+    actual = yield runner.run(SQL(COUNT))
+    counted = dict((tuple(x[:3]), x[3]) for x in counted)
+    actual = dict((tuple(x[:3]), x[3]) for x in actual)
+    wrong = []
+    for key in set(counted) | set(actual):
+        if counted.get(key, 0) != actual.get(key, 0):
+            wrong.append(key + (counted.get(key, 0), actual.get(key, 0)))
+    defer.returnValue(sorted(wrong))
+
+
+@defer.inlineCallbacks
+def fetchStats(runner):
+    """
+    Get the counts for display.
+
+    @return: A Deferred which fires with a dict mapping each of
+        L{DIMENSIONS} to a list of dicts with C{'name'}, C{'open'},
+        C{'closed'}, C{'total'} and C{'percent'} (closed, of the total),
+        ordered by name.
+    """
+    rows = yield runner.run(SQL('''
+        SELECT dimension, value, state, count
+        FROM frack_ticket_stats
+        WHERE count > 0'''))
+    found = dict((dimension, {}) for dimension in DIMENSIONS)
+    for dimension, value, state, count in rows:
+        if dimension not in found:
+            continue
+        entry = found[dimension].setdefault(value, {
+            'name': value, 'open': 0, 'closed': 0})
+        entry[state] = count
+    result = {}
+    for dimension, entries in found.items():
+        result[dimension] = []
+        for name in sorted(entries):
+            entry = entries[name]
+            entry['total'] = entry['open'] + entry['closed']
+            entry['percent'] = 100 * entry['closed'] // entry['total']
+            result[dimension].append(entry)
+    defer.returnValue(result)
+
+
+
+class Options(usage.Options):
+    synopsis = '[options] rebuild|verify'
+
+    optParameters = [
+        ['postgres_db', None, None, 'Name of Postgres database.'],
+        ['postgres_user', 'u', None, 'Username for connecting to Postgres.'],
+        ['sqlite_db', None, None, 'Path to SQLite database.'],
+    ]
+
+    longdesc = """Count tickets per milestone, component and owner again
+    (rebuild), or check the counts against the tickets (verify)."""
+
+    def parseArgs(self, command):
+        if command not in ('rebuild', 'verify'):
+            raise usage.UsageError('Unknown command: %s' % (command,))
+        self['command'] = command
+
+
+    def postOptions(self):
+        if bool(self['postgres_db']) == bool(self['sqlite_db']):
+            raise usage.UsageError('Give one of --postgres_db and '
+                                   '--sqlite_db.')
+
+
+
+def main(argv=None):
+    from norm.common import BlockingRunner
+    from frack.db import sqlite_connect, postgres_probably_connect
+
+    config = Options()
+    try:
+        config.parseOptions(sys.argv[1:] if argv is None else argv)
+    except usage.UsageError as e:
+        raise SystemExit('%s\n%s' % (config, e))
+
+    if config['sqlite_db']:
+        from norm.sqlite import SqliteTranslator
+        module, connection = sqlite_connect(config['sqlite_db'])
+        translator = SqliteTranslator()
+    else:
+        import getpass
+        from norm.postgres import PostgresTranslator
+        module, connection = postgres_probably_connect(
+            config['postgres_db'],
+            config['postgres_user'] or getpass.getuser())
+        translator = PostgresTranslator()
+    runner = BlockingRunner(connection, translator)
+
+    command = {'rebuild': rebuild, 'verify': verify}[config['command']]
+    results = []
+    try:
+        runner.runInteraction(command).addBoth(results.append)
+    finally:
+        connection.close()
+    [result] = results
+    if isinstance(result, Failure):
+        result.raiseException()
+
+    if command is rebuild:
+        sys.stdout.write('Rebuilt %d counts\n' % (result,))
+        return
+    for dimension, value, state, counted, actual in result:
+        sys.stdout.write('%s %r %s: counted %d, actually %d\n' % (
+            dimension, value, state, counted, actual))
+    if result:
+        raise SystemExit('%d counts are wrong; run rebuild' % (len(result),))
+    sys.stdout.write('All counts are right\n')
+
+
+if __name__ == '__main__':
+    main()
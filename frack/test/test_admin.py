@@ -0,0 +1,42 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+from twisted.trial.unittest import TestCase
+from twisted.web.test.test_web import DummyRequest
+
+from frack.admin import constantTimeEqual, AdminResource
+
+
+
+class AdminResourceTest(TestCase):
+
+
+    def test_constantTimeEqual(self):
+        self.assertTrue(constantTimeEqual('secret', 'secret'))
+        self.assertFalse(constantTimeEqual('secret', 'secreT'))
+        self.assertFalse(constantTimeEqual('secret', 'secret2'))
+        self.assertFalse(constantTimeEqual('', 'secret'))
+
+
+    def test_authorized(self):
+        """
+        Requests must give the token in a header.  One in the query isn't
+        enough.
+        """
+        resource = AdminResource(dict, token='secret')
+        request = DummyRequest([''])
+        self.assertFalse(resource.authorized(request))
+        request.requestHeaders.setRawHeaders('x-admin-token', ['secret'])
+        self.assertTrue(resource.authorized(request))
+        request.requestHeaders.setRawHeaders('x-admin-token', ['wrong'])
+        self.assertFalse(resource.authorized(request))
+        request = DummyRequest([''])
+        request.args = {'token': ['secret']}
+        self.assertFalse(resource.authorized(request))
+
+
+    def test_noToken(self):
+        """
+        The admin endpoint can't be served without a token.
+        """
+        self.assertRaises(ValueError, AdminResource, dict, None)
+        self.assertRaises(ValueError, AdminResource, dict, '')
@@ -0,0 +1,141 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer
+from twisted.internet.task import Clock
+
+from frack.admission import (AdmissionController, Overloaded, parseLimits,
+                             WRITE, READ, ANONYMOUS_READ)
+
+
+
+class FakeRunner(object):
+
+    def __init__(self):
+        self.calls = []
+
+
+    def run(self, op):
+        d = defer.Deferred()
+        self.calls.append((op, d))
+        return d
+
+
+    def runInteraction(self, func, *args):
+        d = defer.Deferred()
+        self.calls.append((func, d))
+        return d
+
+
+
+class AdmissionControllerTest(TestCase):
+
+
+    def setUp(self):
+        self.clock = Clock()
+        self.controller = AdmissionController({'read': 2, 'write': 1,
+                                               'auth': 1}, capacity=2,
+                                              queueSize=2, deadline=3,
+                                              clock=self.clock)
+
+
+    def test_limit(self):
+        """
+        Operations beyond a class's limit wait until one finishes.
+        """
+        controller = AdmissionController({'read': 1}, clock=self.clock)
+        first = self.successResultOf(controller.acquire('read'))
+        second = controller.acquire('read')
+        self.assertNoResult(second)
+        first()
+        self.successResultOf(second)
+
+
+    def test_capacity(self):
+        """
+        No more than C{capacity} operations run at once in all.
+        """
+        self.controller.acquire('read')
+        self.controller.acquire('write')
+        d = self.controller.acquire('read')
+        self.assertNoResult(d)
+
+
+    def test_priority(self):
+        """
+        Writes waiting go before reads, and logged-in reads before anonymous
+        ones.
+        """
+        releases = [self.successResultOf(self.controller.acquire('read'))
+                    for i in range(2)]
+        started = []
+        anonymous = self.controller.acquire('read', ANONYMOUS_READ)
+        anonymous.addCallback(lambda release: started.append('anonymous'))
+        read = self.controller.acquire('read', READ)
+        read.addCallback(lambda release: started.append('read'))
+        self.controller.queueSize = 3
+        write = self.controller.acquire('write', WRITE)
+        write.addCallback(lambda release: started.append('write'))
+
+        releases[0]()
+        self.assertEqual(started, ['write'])
+        releases[1]()
+        self.assertEqual(started, ['write', 'read'])
+
+
+    def test_deadline(self):
+        """
+        Operations which wait too long are refused.
+        """
+        self.controller.acquire('read')
+        self.controller.acquire('read')
+        d = self.controller.acquire('read')
+        self.clock.advance(3)
+        failure = self.failureResultOf(d, Overloaded)
+        self.assertEqual(failure.value.retryAfter, 3)
+        self.assertEqual(self.controller.waiting(), 0)
+        self.assertEqual(self.controller.rejected['read'], 1)
+
+
+    def test_queueFull(self):
+        """
+        When the queue is full, newcomers are refused unless they outrank
+        someone waiting, who is refused instead.
+        """
+        self.controller.acquire('read')
+        self.controller.acquire('read')
+        waiting = [self.controller.acquire('read', ANONYMOUS_READ),
+                   self.controller.acquire('read', READ)]
+        refused = self.controller.acquire('read', ANONYMOUS_READ)
+        self.failureResultOf(refused, Overloaded)
+
+        write = self.controller.acquire('write', WRITE)
+        self.assertNoResult(write)
+        self.failureResultOf(waiting[0], Overloaded)
+        self.assertNoResult(waiting[1])
+
+
+    def test_runner(self):
+        """
+        Admitted runners wait for a turn and end it when the operation is
+        done.
+        """
+        runner = FakeRunner()
+        admitted = self.controller.runner(runner, 'write')
+        d1 = admitted.run('one')
+        d2 = admitted.runInteraction('two')
+        self.assertEqual([x[0] for x in runner.calls], ['one'])
+
+        runner.calls[0][1].errback(ValueError())
+        self.failureResultOf(d1, ValueError)
+        self.assertEqual([x[0] for x in runner.calls], ['one', 'two'])
+        runner.calls[1][1].callback('result')
+        self.assertEqual(self.successResultOf(d2), 'result')
+        self.assertEqual(self.controller.active['write'], 0)
+
+
+    def test_parseLimits(self):
+        self.assertEqual(parseLimits('read=3, write=1'),
+                         {'read': 3, 'write': 1})
+        self.assertRaises(ValueError, parseLimits, 'reads=3')
+        self.assertRaises(ValueError, parseLimits, 'read')
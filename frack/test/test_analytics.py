@@ -0,0 +1,181 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+import json
+import sqlite3
+
+from twisted.trial.unittest import TestCase
+from twisted.python.util import sibpath
+from twisted.internet.task import Clock
+from twisted.web.test.test_web import DummyRequest
+from norm.sqlite import SqliteTranslator
+from norm.common import BlockingRunner
+
+from frack import analytics
+from frack.analytics import History, TooManyBins, transition, BINS
+from frack.api import TicketAPI
+
+
+
+class TransitionTest(TestCase):
+
+
+    def test_transition(self):
+        self.assertEqual(transition('new', 'closed'), 'closed')
+        self.assertEqual(transition('closed', 'reopened'), 'reopened')
+        self.assertEqual(transition('new', 'assigned'), None)
+        self.assertEqual(transition('closed', 'closed'), None)
+
+
+
+class HistoryTest(TestCase):
+
+    if not analytics.available:
+        skip = 'numpy is not installed'
+
+
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:')
+        self.db.executescript(open(sibpath(__file__, 'trac_test.sql')).read())
+        self.runner = BlockingRunner(self.db, SqliteTranslator())
+        self.clock = Clock()
+        self.history = History(self.runner, batchSize=2, clock=self.clock)
+        self.successResultOf(self.history.refresh())
+
+
+    def test_whole(self):
+        """
+        Over the whole history, every ticket is opened once, and the backlog
+        ends with the tickets still open.
+        """
+        series = self.history.get(BINS['week'])
+        self.assertEqual(sum(series['opened']), 5)
+        self.assertEqual(sum(series['closed']), 6)
+        self.assertEqual(sum(series['reopened']), 2)
+        self.assertEqual(series['backlog'][-1], 1)
+        self.assertEqual(len(series['backlog']), len(series['opened']))
+        self.assertTrue(min(series['backlog']) >= 0)
+
+
+    def test_range(self):
+        """
+        A range that starts late counts the tickets already open at its
+        start in the backlog.
+        """
+        whole = self.history.get(BINS['day'])
+        start = whole['start'] + 100 * BINS['day']
+        part = self.history.get(BINS['day'], start)
+        self.assertEqual(part['backlog'], whole['backlog'][100:])
+        self.assertEqual(part['closed'], whole['closed'][100:])
+
+
+    def test_clamped(self):
+        """
+        A range reaching beyond the history is cut down to it, by whole bins
+        at the start.
+        """
+        whole = self.history.get(BINS['day'])
+        early = whole['start'] - 1000 * BINS['day'] - 5
+        clamped = self.history.get(BINS['day'], early, 2 ** 62)
+        self.assertEqual(clamped['start'], whole['start'] - 5)
+        self.assertEqual(clamped['backlog'][-1], whole['backlog'][-1])
+        self.assertTrue(len(clamped['backlog']) <= len(whole['backlog']) + 1)
+
+
+    def test_tooMany(self):
+        """
+        Series of more than L{MAX_BINS} bins aren't worked out.
+        """
+        self.assertRaises(TooManyBins, self.history.get, 1)
+
+
+    def test_incremental(self):
+        """
+        Refreshing reads only what's new, and the cached series is replaced.
+        """
+        before = self.history.get(BINS['week'])
+        self.assertIdentical(self.history.get(BINS['week']), before)
+        self.assertEqual(self.successResultOf(self.history.refresh()), 0)
+
+        self.db.execute("INSERT INTO ticket_change VALUES "
+                        "(2723, 1400000000, 'x', 'status', 'new', 'closed')")
+        self.assertEqual(self.successResultOf(self.history.refresh()), 1)
+        after = self.history.get(BINS['week'])
+        self.assertEqual(sum(after['closed']), 7)
+        self.assertEqual(after['backlog'][-1], 0)
+
+
+    def test_fresh(self):
+        """
+        L{History.fresh} only looks for new history every so often.
+        """
+        self.db.execute("INSERT INTO ticket_change VALUES "
+                        "(2723, 1400000000, 'x', 'status', 'new', 'closed')")
+        self.successResultOf(self.history.fresh())
+        self.assertEqual(len(self.history.times['closed']), 7)
+        self.db.execute("INSERT INTO ticket_change VALUES "
+                        "(2723, 1400000001, 'x', 'status', 'closed', 'new')")
+        self.successResultOf(self.history.fresh())
+        self.assertEqual(len(self.history.times['reopened']), 2)
+        self.clock.advance(61)
+        self.successResultOf(self.history.fresh())
+        self.assertEqual(len(self.history.times['reopened']), 3)
+
+
+    def test_freshFailure(self):
+        """
+        A failed look for new history is reported to the caller, and the
+        next call looks again.
+        """
+        self.db.execute('ALTER TABLE ticket_change RENAME TO moved')
+        self.failureResultOf(self.history.fresh(), sqlite3.OperationalError)
+        self.db.execute('ALTER TABLE moved RENAME TO ticket_change')
+        self.successResultOf(self.history.fresh())
+        self.assertEqual(len(self.history.times['closed']), 6)
+
+
+
+class AnalyticsAPITest(TestCase):
+
+    if not analytics.available:
+        skip = 'numpy is not installed'
+
+
+    def setUp(self):
+        db = sqlite3.connect(':memory:')
+        db.executescript(open(sibpath(__file__, 'trac_test.sql')).read())
+        runner = BlockingRunner(db, SqliteTranslator())
+        self.api = TicketAPI(runner, history=History(runner, clock=Clock()))
+
+
+    def get(self, args):
+        request = DummyRequest(['analytics'])
+        request.args = dict((k, [v]) for k, v in args.items())
+        return request, self.api.analytics(request)
+
+
+    def test_json(self):
+        request, d = self.get({'bin': 'month'})
+        series = json.loads(self.successResultOf(d))
+        self.assertEqual(series['bin'], BINS['month'])
+        self.assertEqual(sum(series['opened']), 5)
+
+
+    def test_bad(self):
+        request, body = self.get({'bin': 'fortnight'})
+        self.assertEqual(request.responseCode, 400)
+        request, body = self.get({'start': 'then'})
+        self.assertEqual(request.responseCode, 400)
+
+
+    def test_tooMany(self):
+        """
+        Asking for too many bins is a bad request.
+        """
+        request, d = self.get({'bin': 'day', 'start': '0',
+                               'end': str(2 ** 62)})
+        self.successResultOf(d)
+        self.assertEqual(request.responseCode, None)
+        self.patch(analytics, 'MAX_BINS', 10)
+        request, d = self.get({'bin': 'day'})
+        self.successResultOf(d)
+        self.assertEqual(request.responseCode, 400)
@@ -0,0 +1,310 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+import json
+import sqlite3
+
+from twisted.trial.unittest import TestCase
+from twisted.python.util import sibpath
+from twisted.internet.task import Clock
+from twisted.internet.error import ConnectionDone
+from twisted.python.failure import Failure
+from twisted.web.test.test_web import DummyRequest
+from norm.sqlite import SqliteTranslator
+from norm.common import BlockingRunner
+
+from frack.api import TicketAPI, encodeCursor, decodeCursor
+from frack.db import TicketStore
+from frack.pubsub import Bus
+
+
+
+class CursorTest(TestCase):
+
+
+    def test_roundTrip(self):
+        position = (1331151798, 5517, '1:comment')
+        cursor = encodeCursor(position)
+        self.assertNotIn('=', cursor)
+        self.assertEqual(decodeCursor(cursor), position)
+
+
+    def test_bad(self):
+        self.assertRaises(ValueError, decodeCursor, 'nonsense')
+        self.assertRaises(ValueError, decodeCursor,
+                          encodeCursor(('a', 1, 'b')))
+
+
+
+class TicketAPITest(TestCase):
+    """
+    The responses to requests for tickets and metadata.
+    """
+
+    def setUp(self):
+        db = sqlite3.connect(':memory:')
+        db.executescript(open(sibpath(__file__, 'trac_test.sql')).read())
+        self.api = TicketAPI(BlockingRunner(db, SqliteTranslator()))
+
+
+    def get(self, method, pathArgs=(), args=None, headers=None):
+        """
+        Call C{method} of the API as a GET with query C{args}, passing it
+        C{pathArgs} as if from the path.
+
+        @return: The request and the body returned (not JSON-decoded).
+        """
+        request = DummyRequest([''])
+        request.args = dict((k, [v]) for k, v in (args or {}).items())
+        for name, value in (headers or {}).items():
+            request.requestHeaders.setRawHeaders(name, [value])
+        body = getattr(self.api, method)(request, *pathArgs)
+        if not isinstance(body, str):
+            body = self.successResultOf(body)
+        return request, body
+
+
+    def assertJSON(self, request, body, code=200):
+        self.assertEqual(request.responseCode or 200, code)
+        self.assertEqual(request.responseHeaders.getRawHeaders(
+            'content-type'), ['application/json'])
+        return json.loads(body)
+
+
+    def test_ticket(self):
+        request, body = self.get('ticket', (5622,))
+        ticket = self.assertJSON(request, body)
+        self.assertEqual(ticket['id'], 5622)
+        self.assertEqual(len(request.responseHeaders.getRawHeaders('etag')),
+                         1)
+
+
+    def test_ticketFields(self):
+        request, body = self.get('ticket', (5622,),
+                                 {'fields': 'summary,status'})
+        self.assertEqual(sorted(self.assertJSON(request, body)),
+                         ['id', 'status', 'summary'])
+
+
+    def test_ticketNotFound(self):
+        request, body = self.get('ticket', (1,))
+        self.assertEqual(self.assertJSON(request, body, 404),
+                         {'error': 'not found'})
+
+
+    def test_notModified(self):
+        """
+        A client which already has the current response is answered 304,
+        with no body.
+        """
+        request, body = self.get('ticket', (5622,))
+        [etag] = request.responseHeaders.getRawHeaders('etag')
+        request, body = self.get('ticket', (5622,), headers={
+            'if-none-match': '"stale", ' + etag})
+        self.assertEqual(request.responseCode, 304)
+        self.assertEqual(body, '')
+        request, body = self.get('ticket', (5622,), headers={
+            'if-none-match': '"stale"'})
+        self.assertJSON(request, body)
+
+
+    def test_tickets(self):
+        """
+        Tickets come in the order asked for, leaving out ones which don't
+        exist.
+        """
+        request, body = self.get('tickets', args={'ids': '5622,1,2723',
+                                                  'fields': 'summary'})
+        self.assertEqual([x['id'] for x in self.assertJSON(request, body)],
+                         [5622, 2723])
+
+
+    def test_ticketsBad(self):
+        for args in [{}, {'ids': ''}, {'ids': '1,x'}]:
+            request, body = self.get('tickets', args=args)
+            self.assertJSON(request, body, 400)
+
+
+    def test_ticketsTooMany(self):
+        ids = ','.join(str(x) for x in range(self.api.max_tickets + 1))
+        request, body = self.get('tickets', args={'ids': ids})
+        self.assertJSON(request, body, 400)
+        ids = ','.join(str(x) for x in range(self.api.max_tickets))
+        request, body = self.get('tickets', args={'ids': ids})
+        self.assertEqual(self.assertJSON(request, body), [])
+
+
+    def test_comments(self):
+        request, body = self.get('comments', (2723,), {'limit': '2'})
+        window = self.assertJSON(request, body)
+        self.assertEqual([x['number'] for x in window['comments']],
+                         ['1', '2'])
+        request, body = self.get('comments', (2723,), {
+            'after': str(window['comments'][-1]['time']), 'limit': '2'})
+        window = self.assertJSON(request, body)
+        self.assertEqual([x['number'] for x in window['comments']],
+                         ['3', '4'])
+
+
+    def test_commentsNotFound(self):
+        request, body = self.get('comments', (1,))
+        self.assertJSON(request, body, 404)
+
+
+    def test_commentsLimit(self):
+        """
+        Pages of comments are no bigger than C{max_comments}, however many
+        are asked for.
+        """
+        self.api.max_comments = 2
+        request, body = self.get('comments', (2723,), {'limit': '100000'})
+        window = self.assertJSON(request, body)
+        self.assertEqual(len(window['comments']), 2)
+        self.assertTrue(window['total'] > 2)
+
+
+    def test_commentsBad(self):
+        for args in [{'limit': '-1'}, {'after': 'x'}]:
+            request, body = self.get('comments', (2723,), args)
+            self.assertJSON(request, body, 400)
+
+
+    def test_attachments(self):
+        request, body = self.get('attachments', (5622,))
+        self.assertEqual(type(self.assertJSON(request, body)), list)
+        request, body = self.get('attachments', (1,))
+        self.assertJSON(request, body, 404)
+
+
+    def test_uploaderAddress(self):
+        """
+        The addresses attachments were uploaded from are left out.
+        """
+        request, body = self.get('attachments', (5517,))
+        [attachment] = self.assertJSON(request, body)
+        self.assertEqual(attachment['filename'], '5517.diff')
+        responses = [
+            [attachment],
+            self.assertJSON(*self.get('ticket', (5517,)))['attachments'],
+            self.assertJSON(*self.get('tickets', args={'ids': '5517'})
+                            )[0]['attachments'],
+            self.assertJSON(*self.get('asOf', (5517,),
+                                      {'time': '2000000000'})
+                            )['attachments'],
+        ]
+        for attachments in responses:
+            self.assertEqual(len(attachments), 1)
+            self.assertNotIn('ip', attachments[0])
+            self.assertNotIn('ipnr', attachments[0])
+
+
+    def test_components(self):
+        request, body = self.get('components')
+        self.assertEqual([x['name'] for x in self.assertJSON(request, body)],
+                         ['conch', 'core', 'ftp'])
+
+
+    def test_milestones(self):
+        request, body = self.get('milestones')
+        self.assertEqual(len(self.assertJSON(request, body)), 4)
+
+
+    def test_enums(self):
+        request, body = self.get('enums', ('priority',))
+        self.assertEqual([x['name'] for x in self.assertJSON(request, body)],
+                         ['drop everything', 'normal'])
+
+
+    def test_disabled(self):
+        """
+        Search, similar tickets and analytics are 404 unless enabled.
+        """
+        for method in ['search', 'similarTickets', 'analytics']:
+            request, body = self.get(method)
+            self.assertJSON(request, body, 404)
+
+
+    def test_export(self):
+        """
+        Only logged-in users may export.
+        """
+        request, body = self.get('export')
+        self.assertJSON(request, body, 403)
+
+
+
+class ChangesTest(TestCase):
+
+
+    def setUp(self):
+        db = sqlite3.connect(':memory:')
+        db.executescript(open(sibpath(__file__, 'trac_test.sql')).read())
+        self.runner = BlockingRunner(db, SqliteTranslator())
+        self.bus = Bus()
+        self.clock = Clock()
+        self.api = TicketAPI(self.runner, bus=self.bus, clock=self.clock)
+        self.store = TicketStore(self.runner, 'foo', self.bus)
+
+
+    def latest(self):
+        result = self.successResultOf(self.api._changes(self.store, None,
+                                                        10000, 0))
+        self.assertFalse(result['more'])
+        return decodeCursor(result['cursor'])
+
+
+    def test_batches(self):
+        """
+        Changes come in batches with a cursor for the next one.
+        """
+        first = self.successResultOf(self.api._changes(self.store, None, 3,
+                                                       0))
+        self.assertEqual(len(first['changes']), 3)
+        self.assertTrue(first['more'])
+        self.assertNotIn('position', first['changes'][0])
+        second = self.successResultOf(self.api._changes(
+            self.store, decodeCursor(first['cursor']), 3, 0))
+        self.assertNotEqual(first['changes'], second['changes'])
+
+
+    def test_longPoll(self):
+        """
+        With nothing new, a request waits until a change is published.
+        """
+        position = self.latest()
+        d = self.api._changes(self.store, position, 100, 30)
+        self.assertNoResult(d)
+        self.store.updateTicket(5622, {}, 'hello')
+        result = self.successResultOf(d)
+        self.assertEqual([x['new'] for x in result['changes']], ['hello'])
+        self.assertEqual(self.bus.subscriberCount(), 0)
+
+
+    def test_disconnect(self):
+        """
+        A request waiting for changes stops waiting, and writes nothing,
+        when the client goes away.
+        """
+        position = self.latest()
+        request = DummyRequest([''])
+        request.args = {'cursor': [encodeCursor(position)], 'wait': ['30']}
+        d = self.api.changes(request)
+        self.assertEqual(self.bus.subscriberCount(), 1)
+        request.processingFailed(Failure(ConnectionDone()))
+        self.assertEqual(self.successResultOf(d), None)
+        self.assertEqual(self.bus.subscriberCount(), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(request.written, [])
+
+
+    def test_timeout(self):
+        """
+        If nothing changes, the same cursor comes back after the wait.
+        """
+        position = self.latest()
+        d = self.api._changes(self.store, position, 100, 7)
+        self.clock.advance(self.api.poll_interval)
+        self.assertNoResult(d)
+        self.clock.advance(7)
+        result = self.successResultOf(d)
+        self.assertEqual(result['changes'], [])
+        self.assertEqual(decodeCursor(result['cursor']), position)
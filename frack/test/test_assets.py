@@ -0,0 +1,180 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+import gzip
+import zlib
+from StringIO import StringIO
+
+from twisted.trial.unittest import TestCase
+from twisted.python.filepath import FilePath
+from twisted.web.test.test_web import DummyRequest
+
+from frack.assets import build, loadManifest, fingerprintedName
+from frack.compression import (CompressingEncoderFactory, addVary,
+                               matchingETag)
+
+
+
+class buildTest(TestCase):
+
+
+    def mediaDir(self):
+        root = FilePath(self.mktemp())
+        root.makedirs()
+        root.child('trac.css').setContent('body { color: red; }')
+        root.child('logo.png').setContent('\x89PNG not really')
+        return root
+
+
+    def test_fingerprint(self):
+        """
+        Each file gets a copy named after its content, listed in the manifest.
+        """
+        root = self.mediaDir()
+        manifest = build(root.path)
+
+        self.assertEqual(manifest, {
+            'trac.css': fingerprintedName('trac.css', 'body { color: red; }'),
+            'logo.png': fingerprintedName('logo.png', '\x89PNG not really'),
+        })
+        self.assertEqual(loadManifest(root.path), manifest)
+        self.assertEqual(root.child(manifest['trac.css']).getContent(),
+                         'body { color: red; }')
+        self.assertNotEqual(manifest['trac.css'], 'trac.css')
+        self.assertTrue(manifest['trac.css'].startswith('trac.'))
+        self.assertTrue(manifest['trac.css'].endswith('.css'))
+
+
+    def test_compressed(self):
+        """
+        Text files get gzipped siblings; images don't.
+        """
+        root = self.mediaDir()
+        manifest = build(root.path)
+
+        for name in ['trac.css', manifest['trac.css']]:
+            gz = root.child(name + '.gz')
+            content = gzip.GzipFile(fileobj=StringIO(gz.getContent())).read()
+            self.assertEqual(content, 'body { color: red; }')
+        self.assertFalse(root.child('logo.png.gz').exists())
+
+
+    def test_rebuild(self):
+        """
+        Building again replaces the outputs of the last build.
+        """
+        root = self.mediaDir()
+        first = build(root.path)
+        root.child('trac.css').setContent('body { color: blue; }')
+        second = build(root.path)
+
+        self.assertEqual(first['logo.png'], second['logo.png'])
+        self.assertNotEqual(first['trac.css'], second['trac.css'])
+        self.assertFalse(root.child(first['trac.css']).exists())
+        self.assertFalse(root.child(first['trac.css'] + '.gz').exists())
+        self.assertTrue(root.child(second['trac.css']).exists())
+
+
+    def test_noManifest(self):
+        """
+        Without a build, the manifest is empty.
+        """
+        self.assertEqual(loadManifest(self.mediaDir().path), {})
+
+
+
+class CompressingEncoderFactoryTest(TestCase):
+
+
+    def request(self, accept):
+        request = DummyRequest([''])
+        request.requestHeaders.setRawHeaders('accept-encoding', [accept])
+        return request
+
+
+    def test_gzip(self):
+        """
+        Big enough responses are gzipped for clients that accept it.
+        """
+        request = self.request('gzip, deflate')
+        encoder = CompressingEncoderFactory(10).encoderForRequest(request)
+        data = encoder.encode('x' * 100) + encoder.finish()
+        self.assertEqual(zlib.decompress(data, 16 + zlib.MAX_WBITS),
+                         'x' * 100)
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders('content-encoding'),
+            ['gzip'])
+
+
+    def test_small(self):
+        """
+        Responses starting with a chunk below the threshold are left alone.
+        """
+        request = self.request('gzip')
+        encoder = CompressingEncoderFactory(10).encoderForRequest(request)
+        self.assertEqual(encoder.encode('tiny'), 'tiny')
+        self.assertEqual(encoder.encode('x' * 100), 'x' * 100)
+        self.assertEqual(encoder.finish(), '')
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders('content-encoding'), None)
+
+
+    def test_notAccepted(self):
+        """
+        Clients that don't accept gzip don't get it.
+        """
+        request = self.request('identity, gzip;q=0')
+        factory = CompressingEncoderFactory(10)
+        self.assertEqual(factory.encoderForRequest(request), None)
+
+
+    def test_vary(self):
+        """
+        C{Vary: Accept-Encoding} is added to the headers the response
+        already varies by, and they're kept when more are added.
+        """
+        request = self.request('gzip')
+        request.setHeader('Vary', 'Cookie')
+        CompressingEncoderFactory(10).encoderForRequest(request)
+        addVary(request, 'cookie')
+        addVary(request, 'Accept-Language')
+        self.assertEqual(request.responseHeaders.getRawHeaders('vary'),
+                         ['Cookie, Accept-Encoding, Accept-Language'])
+
+
+    def test_etag(self):
+        """
+        Compressed responses get an ETag of their own.
+        """
+        request = self.request('gzip')
+        request.setHeader('ETag', '"abc"')
+        encoder = CompressingEncoderFactory(10).encoderForRequest(request)
+        encoder.encode('x' * 100)
+        self.assertEqual(request.responseHeaders.getRawHeaders('etag'),
+                         ['"abc-gzip"'])
+
+        request = self.request('gzip')
+        request.setHeader('ETag', '"abc"')
+        encoder = CompressingEncoderFactory(10).encoderForRequest(request)
+        encoder.encode('tiny')
+        self.assertEqual(request.responseHeaders.getRawHeaders('etag'),
+                         ['"abc"'])
+
+
+
+    def test_matchingETag(self):
+        """
+        A client's ETag matches if it's the one for the uncompressed
+        response or for the coding the client negotiated, and the one which
+        matched is what to send back.
+        """
+        def match(accept, tags):
+            request = self.request(accept)
+            request.requestHeaders.setRawHeaders('if-none-match', [tags])
+            return matchingETag(request, '"abc"')
+        self.assertEqual(match('gzip', '"def", "abc-gzip"'), '"abc-gzip"')
+        self.assertEqual(match('gzip', '"abc"'), '"abc"')
+        self.assertEqual(match('gzip', '"abc-br"'), None)
+        self.assertEqual(match('identity', '"abc-gzip"'), None)
+        self.assertEqual(match('identity', '"abc"'), '"abc"')
+        self.assertEqual(match('gzip', '"def"'), None)
+        self.assertEqual(match('gzip', '*'), '"abc"')
@@ -0,0 +1,411 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer
+from twisted.internet.task import Clock
+
+from frack.cache import (SingleFlight, LRUCache, SQLiteCache, TieredCache,
+                         CacheRegistry, estimateSize, _LinkedDict)
+
+
+
+class SingleFlightTest(TestCase):
+
+
+    def setUp(self):
+        self.calls = []
+        self.clock = Clock()
+
+
+    def lookup(self, key):
+        d = defer.Deferred()
+        self.calls.append((key, d))
+        return d
+
+
+    def test_coalesce(self):
+        """
+        Concurrent lookups of the same key share one call.
+        """
+        flight = SingleFlight(self.lookup, clock=self.clock)
+        d1 = flight.get(12)
+        d2 = flight.get(12)
+        d3 = flight.get(13)
+        self.assertEqual([x[0] for x in self.calls], [12, 13])
+
+        self.calls[0][1].callback('twelve')
+        self.assertEqual(self.successResultOf(d1), 'twelve')
+        self.assertEqual(self.successResultOf(d2), 'twelve')
+        self.assertNoResult(d3)
+
+
+    def test_synchronous(self):
+        """
+        A function which answers at once still gives the answer, or the
+        failure, to the caller.
+        """
+        flight = SingleFlight(lambda key: key * 2, clock=self.clock)
+        self.assertEqual(self.successResultOf(flight.get(12)), 24)
+        self.assertEqual(self.successResultOf(flight.get(12)), 24)
+        flight = SingleFlight(lambda key: 1 / 0, clock=self.clock)
+        self.failureResultOf(flight.get(12), ZeroDivisionError)
+        self.failureResultOf(flight.get(12), ZeroDivisionError)
+
+
+    def test_noFreshness(self):
+        """
+        Without a freshness window, lookups after the result has arrived make
+        a new call.
+        """
+        flight = SingleFlight(self.lookup, clock=self.clock)
+        flight.get(12)
+        self.calls[0][1].callback('twelve')
+        flight.get(12)
+        self.assertEqual(len(self.calls), 2)
+
+
+    def test_freshness(self):
+        """
+        Results are reused during the freshness window.
+        """
+        flight = SingleFlight(self.lookup, freshness=5, clock=self.clock)
+        flight.get(12)
+        self.calls[0][1].callback('twelve')
+
+        self.clock.advance(4)
+        self.assertEqual(self.successResultOf(flight.get(12)), 'twelve')
+        self.assertEqual(len(self.calls), 1)
+
+        self.clock.advance(1)
+        flight.get(12)
+        self.assertEqual(len(self.calls), 2)
+
+
+    def test_failure(self):
+        """
+        Failures go to every waiter and aren't remembered.
+        """
+        flight = SingleFlight(self.lookup, freshness=5, clock=self.clock)
+        d1 = flight.get(12)
+        d2 = flight.get(12)
+        self.calls[0][1].errback(ValueError('foo'))
+        self.failureResultOf(d1, ValueError)
+        self.failureResultOf(d2, ValueError)
+
+        flight.get(12)
+        self.assertEqual(len(self.calls), 2)
+
+
+    def test_invalidate(self):
+        """
+        After invalidation, new lookups don't join lookups already in
+        progress, and the old result isn't kept.
+        """
+        flight = SingleFlight(self.lookup, freshness=5, clock=self.clock)
+        old = flight.get(12)
+        flight.invalidate(12)
+        new = flight.get(12)
+        self.assertEqual(len(self.calls), 2)
+
+        self.calls[0][1].callback('stale')
+        self.assertEqual(self.successResultOf(old), 'stale')
+        self.assertNoResult(new)
+        self.calls[1][1].callback('fresh')
+        self.assertEqual(self.successResultOf(new), 'fresh')
+        self.assertEqual(self.successResultOf(flight.get(12)), 'fresh')
+
+
+    def test_invalidateFresh(self):
+        """
+        Invalidation throws away remembered results.
+        """
+        flight = SingleFlight(self.lookup, freshness=5, clock=self.clock)
+        flight.get(12)
+        self.calls[0][1].callback('twelve')
+        flight.invalidate(12)
+        flight.get(12)
+        self.assertEqual(len(self.calls), 2)
+
+
+
+class LinkedDictTest(TestCase):
+
+
+    def test_order(self):
+        """
+        Keys come out in the order they were last set.
+        """
+        d = _LinkedDict()
+        for key in 'abcd':
+            d[key] = key.upper()
+        d['b'] = 'B2'
+        self.assertEqual(d.pop('c'), 'C')
+        self.assertEqual(d.pop('c', 'gone'), 'gone')
+        self.assertEqual(list(d.iteritems()),
+                         [('a', 'A'), ('d', 'D'), ('b', 'B2')])
+        self.assertEqual(list(d), ['a', 'd', 'b'])
+        self.assertEqual(len(d), 3)
+        for key in 'adb':
+            d.pop(key)
+        self.assertEqual(list(d), [])
+
+
+
+class LRUCacheTest(TestCase):
+
+
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = LRUCache(2, clock=self.clock)
+
+
+    def test_getSet(self):
+        self.assertEqual(self.successResultOf(self.cache.get('a')), None)
+        self.cache.set('a', 1, 10)
+        self.assertEqual(self.successResultOf(self.cache.get('a')), 1)
+        self.cache.delete('a')
+        self.assertEqual(self.successResultOf(self.cache.get('a')), None)
+
+
+    def test_expiry(self):
+        self.cache.set('a', 1, 10)
+        self.clock.advance(10)
+        self.assertEqual(self.successResultOf(self.cache.get('a')), None)
+
+
+    def test_leastRecentlyUsed(self):
+        """
+        When full, the least recently used value is thrown away.
+        """
+        self.cache.set('a', 1, 10)
+        self.cache.set('b', 2, 10)
+        self.cache.get('a')
+        self.cache.set('c', 3, 10)
+        self.assertEqual(self.successResultOf(self.cache.get('b')), None)
+        self.assertEqual(self.successResultOf(self.cache.get('a')), 1)
+        self.assertEqual(len(self.cache), 2)
+
+
+    def test_stats(self):
+        """
+        I count my entries, their size, hits, misses and evictions.
+        """
+        self.cache.set('a', 'x' * 1000, 10)
+        self.cache.get('a')
+        self.cache.get('b')
+        stats = self.cache.stats()
+        self.assertEqual(stats['entries'], 1)
+        self.assertTrue(stats['bytes'] > 1000)
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.cache.delete('a')
+        self.assertEqual(self.cache.bytes, 0)
+
+
+
+class FixedCache(object):
+    """
+    A cache which can't evict anything.
+    """
+
+    def __init__(self, bytes):
+        self.size = bytes
+
+
+    def stats(self):
+        return {'entries': 1, 'bytes': self.size}
+
+
+
+class CacheRegistryTest(TestCase):
+
+
+    def setUp(self):
+        self.clock = Clock()
+        self.cheap = LRUCache(cost=0.001, clock=self.clock)
+        self.dear = LRUCache(cost=1.0, clock=self.clock)
+
+
+    def test_estimateSize(self):
+        small = estimateSize({'a': [1, 2]})
+        self.assertTrue(estimateSize({'a': [1, 2], 'b': 'x' * 100})
+                        > small + 100)
+
+
+    def test_budget(self):
+        """
+        When over budget, entries which are cheapest to recompute for their
+        size are evicted first.
+        """
+        value = 'x' * 1000
+        size = estimateSize('a') + estimateSize(value)
+        registry = CacheRegistry(budget=size * 3)
+        registry.register('cheap', self.cheap)
+        registry.register('dear', self.dear)
+        self.dear.set('a', value, 10)
+        self.dear.set('b', value, 10)
+        self.cheap.set('c', value, 10)
+        self.cheap.set('d', value, 10)
+
+        self.assertEqual(len(self.cheap), 1)
+        self.assertEqual(len(self.dear), 2)
+        self.assertEqual(registry.evictions, 1)
+        self.assertTrue(registry.bytes() <= registry.budget)
+
+        # Nothing bigger than the budget is kept.
+        self.dear.set('e', value * 100, 10)
+        self.assertEqual(self.successResultOf(self.dear.get('e')), None)
+        self.assertEqual(registry.bytes(), 0)
+
+
+    def test_fixed(self):
+        """
+        Caches which can't evict count against the budget, as of the last
+        time statistics were taken.
+        """
+        fixed = FixedCache(100)
+        registry = CacheRegistry(budget=10000)
+        registry.register('fixed', fixed)
+        registry.register('cheap', self.cheap)
+        self.assertEqual(registry.bytes(), 100)
+        fixed.size = 10000
+        registry.stats()
+        self.cheap.set('a', 'x' * 100, 10)
+        self.assertEqual(len(self.cheap), 0)
+
+
+    def test_metrics(self):
+        registry = CacheRegistry()
+        registry.register('cheap', self.cheap)
+        registry.register('fixed', FixedCache(100))
+        self.cheap.set('a', 1, 10)
+        metrics = registry.metrics()
+        self.assertEqual(metrics['cache_cheap_entries'], 1)
+        self.assertEqual(metrics['cache_fixed_bytes'], 100)
+        self.assertEqual(metrics['cache_bytes'], self.cheap.bytes + 100)
+        self.assertNotIn('cache_budget', metrics)
+
+
+
+class SQLiteCacheTest(TestCase):
+
+
+    def setUp(self):
+        self.clock = Clock()
+        self.path = self.mktemp()
+        # Two instances on one file stand in for two processes.
+        self.one = SQLiteCache(self.path, clock=self.clock)
+        self.two = SQLiteCache(self.path, clock=self.clock)
+        self.addCleanup(self.one.close)
+        self.addCleanup(self.two.close)
+        return defer.gatherResults([self.one.start(), self.two.start()])
+
+
+    @defer.inlineCallbacks
+    def test_shared(self):
+        """
+        Values set by one process can be got by another.
+        """
+        yield self.one.set('a', {'x': (1, 2)}, 10)
+        value = yield self.two.get('a')
+        self.assertEqual(value, {'x': (1, 2)})
+        self.clock.advance(10)
+        value = yield self.two.get('a')
+        self.assertEqual(value, None)
+
+
+    @defer.inlineCallbacks
+    def test_invalidations(self):
+        """
+        Processes find out about keys others have invalidated.
+        """
+        yield self.one.set('a', 1, 10)
+        yield self.one.invalidate('a')
+        value = yield self.two.get('a')
+        self.assertEqual(value, None)
+        keys = yield self.two.invalidations()
+        self.assertEqual(keys, ['a'])
+        keys = yield self.two.invalidations()
+        self.assertEqual(keys, [])
+        keys = yield self.one.invalidations()
+        self.assertEqual(keys, [])
+
+
+    @defer.inlineCallbacks
+    def test_beforeStart(self):
+        """
+        Operations asked for before the cache is started are done once it
+        is, and don't block the reactor in the meantime.
+        """
+        yield self.one.set('a', 1, 10)
+        cache = SQLiteCache(self.path, clock=self.clock)
+        d = cache.get('a')
+        self.assertNoResult(d)
+        cache.start()
+        self.addCleanup(cache.close)
+        value = yield d
+        self.assertEqual(value, 1)
+
+
+
+class TieredCacheTest(TestCase):
+
+
+    def setUp(self):
+        self.clock = Clock()
+        path = self.mktemp()
+        self.shared = [SQLiteCache(path, clock=self.clock) for i in range(2)]
+        for shared in self.shared:
+            self.addCleanup(shared.close)
+        self.one = TieredCache(LRUCache(clock=self.clock), self.shared[0],
+                               clock=self.clock)
+        self.two = TieredCache(LRUCache(clock=self.clock), self.shared[1],
+                               clock=self.clock)
+        return defer.gatherResults([shared.start() for shared in self.shared])
+
+
+    @defer.inlineCallbacks
+    def test_sharedTier(self):
+        """
+        Values set in one process are found in the shared tier by another,
+        and kept locally after that.
+        """
+        yield self.one.set('a', 1, 10)
+        value = yield self.two.get('a')
+        self.assertEqual(value, 1)
+        self.assertEqual(self.successResultOf(self.two.local.get('a')), 1)
+
+
+    @defer.inlineCallbacks
+    def test_invalidate(self):
+        """
+        Invalidating a key removes it from every process's local tier and
+        tells their listeners when they next poll.
+        """
+        heard = []
+        self.two.onInvalidate(heard.append)
+        yield self.one.set('a', 1, 10)
+        yield self.two.get('a')
+
+        yield self.one.invalidate('a')
+        value = yield self.one.get('a')
+        self.assertEqual(value, None)
+        self.assertEqual(self.successResultOf(self.two.local.get('a')), 1)
+
+        yield self.two.poll()
+        value = yield self.two.get('a')
+        self.assertEqual(value, None)
+        self.assertEqual(heard, ['a'])
+
+
+    def test_localOnly(self):
+        """
+        Without a shared tier, values are only kept locally.
+        """
+        cache = TieredCache(LRUCache(clock=self.clock), clock=self.clock)
+        heard = []
+        cache.onInvalidate(heard.append)
+        cache.set('a', 1, 10)
+        self.assertEqual(self.successResultOf(cache.get('a')), 1)
+        cache.invalidate('a')
+        self.assertEqual(self.successResultOf(cache.get('a')), None)
+        self.assertEqual(heard, ['a'])
@@ -5,6 +5,7 @@ from twisted.python.util import sibpath
 from twisted.internet import defer
 from frack.db import (TicketStore, UnauthorizedError, NotFoundError,
                       AuthStore, Collision)
+from frack.pubsub import Bus
 from norm.sqlite import SqliteTranslator
 from norm.common import BlockingRunner
 from norm.operation import SQL
@@ -243,6 +244,78 @@ class TicketStoreTest(TestCase):
         ])
 
 
+    @defer.inlineCallbacks
+    def test_fetchTicket_fields(self):
+        """
+        You can ask for only some fields, and only those are returned.
+        """
+        store = self.populatedStore()
+
+        ticket = yield store.fetchTicket(5622, fields=['status', 'branch'])
+        self.assertEqual(ticket, {
+            'id': 5622,
+            'status': 'closed',
+            'branch': 'branches/tcp-endpoints-tests-refactor-5622',
+        })
+
+        ticket = yield store.fetchTicket(5517, fields=['attachments'])
+        self.assertEqual(sorted(ticket.keys()), ['attachments', 'id'])
+        self.assertEqual(len(ticket['attachments']), 1)
+
+        ticket = yield store.fetchTicket(5622, fields=['comments'])
+        self.assertEqual(len(ticket['comments']), 4)
+
+        self.assertFailure(store.fetchTicket(1, fields=['status']),
+                           NotFoundError)
+
+
+    @defer.inlineCallbacks
+    def test_fetchTickets(self):
+        """
+        You can fetch several tickets at once.  Missing ones are left out.
+        """
+        store = self.populatedStore()
+
+        tickets = yield store.fetchTickets([5622, 1, 5517],
+                                           fields=['summary'])
+        self.assertEqual([x['id'] for x in tickets], [5622, 5517])
+        self.assertEqual(sorted(tickets[0].keys()), ['id', 'summary'])
+
+        tickets = yield store.fetchTickets([5622])
+        self.assertEqual(len(tickets[0]['comments']), 4)
+
+
+    @defer.inlineCallbacks
+    def test_fetchTicketVersion(self):
+        """
+        You can get just the changetime and attachment summary of a ticket.
+        """
+        store = self.populatedStore()
+
+        version = yield store.fetchTicketVersion(5517)
+        self.assertEqual(version, {
+            'changetime': 1331576061,
+            'attachment_count': 1,
+            'attachment_time': 1331531954,
+        })
+
+        version = yield store.fetchTicketVersion(5622)
+        self.assertEqual(version['attachment_count'], 0)
+        self.assertEqual(version['attachment_time'], None)
+
+        yield store.addAttachmentMetadata(5622, {
+            'filename': 'the file',
+            'size': 1234,
+            'description': 'this is a description',
+            'ip': '127.0.0.1',
+        })
+        version = yield store.fetchTicketVersion(5622)
+        self.assertEqual(version['attachment_count'], 1)
+        self.assertTrue(version['attachment_time'])
+
+        self.assertFailure(store.fetchTicketVersion(1), NotFoundError)
+
+
     def test_dne(self):
         """
         Should fail appropriately if the ticket doesn't exist.
@@ -303,6 +376,119 @@ class TicketStoreTest(TestCase):
             self.assertEqual(c['number'], str(i+1))
 
 
+    @defer.inlineCallbacks
+    def test_fetchCommentWindow(self):
+        """
+        A window of comments looks just like that part of the whole list,
+        including followups made after the window, and the next window
+        starts after the time of the last comment in it.
+        """
+        store = self.populatedStore()
+
+        comments = yield store.fetchComments(2723)
+        after = None
+        for offset in range(0, len(comments), 3):
+            window = yield store.fetchCommentWindow(2723, after, 3)
+            self.assertEqual(window['total'], len(comments))
+            self.assertEqual(window['comments'], comments[offset:offset+3])
+            after = window['comments'][-1]['time']
+
+
+    @defer.inlineCallbacks
+    def test_fetchCommentWindow_replies(self):
+        """
+        Replies in a window to comments before it know what they reply to,
+        and comments in a window know about replies after it.
+        """
+        store = self.populatedStore()
+        comments = yield store.fetchComments(2723)
+
+        # look in test/trac_test.sql to see where these come from
+        window = yield store.fetchCommentWindow(2723, comments[7]['time'], 2)
+        self.assertEqual([x['number'] for x in window['comments']],
+                         ['9', '10'])
+        self.assertEqual(window['comments'][0]['followups'], ['11'])
+
+        window = yield store.fetchCommentWindow(2723, comments[9]['time'], 1)
+        self.assertEqual(window['comments'][0]['number'], '11')
+        self.assertEqual(window['comments'][0]['replyto'], '9')
+
+
+    @defer.inlineCallbacks
+    def test_fetchCommentWindow_replyHorizon(self):
+        """
+        Only replies among the next C{reply_horizon} comments are looked
+        for.
+        """
+        store = self.populatedStore()
+        comments = yield store.fetchComments(2723)
+        store.reply_horizon = 1
+
+        window = yield store.fetchCommentWindow(2723, comments[7]['time'], 1)
+        self.assertEqual(window['comments'][0]['followups'], [])
+
+
+    @defer.inlineCallbacks
+    def test_fetchCommentWindow_outside(self):
+        """
+        Windows past the end are empty.
+        """
+        store = self.populatedStore()
+
+        window = yield store.fetchCommentWindow(2723, 2000000000, 5)
+        self.assertEqual(window, {'total': 16, 'comments': []})
+
+
+    def test_fetchCommentWindow_notFound(self):
+        """
+        There are no windows of tickets which don't exist.
+        """
+        store = self.populatedStore()
+        return self.assertFailure(store.fetchCommentWindow(1, None, 5),
+                                  NotFoundError)
+
+
+    @defer.inlineCallbacks
+    def test_fetchComment(self):
+        """
+        A comment can be got by its number, whether or not it's a reply.
+        """
+        store = self.populatedStore()
+        comments = yield store.fetchComments(2723)
+
+        comment = yield store.fetchComment(2723, '10')
+        self.assertEqual(comment['comment'], comments[9]['comment'])
+        comment = yield store.fetchComment(2723, '11')
+        self.assertEqual(comment['comment'], comments[10]['comment'])
+        self.assertEqual(comment['replyto'], '9')
+        yield self.assertFailure(store.fetchComment(2723, '99'),
+                                 NotFoundError)
+
+
+    @defer.inlineCallbacks
+    def test_fetchTicketWindowed(self):
+        """
+        Only the first and last comments are fetched, along with how many
+        were left out.
+        """
+        store = self.populatedStore()
+        full = yield store.fetchTicket(2723)
+
+        ticket = yield store.fetchTicketWindowed(2723, 5)
+        self.assertEqual(ticket['comment_total'], 16)
+        self.assertEqual(ticket['hidden_comments'], (5, 6))
+        self.assertEqual(ticket['comments'],
+                         full['comments'][:5] + full['comments'][-5:])
+        self.assertEqual(ticket['summary'], full['summary'])
+        self.assertEqual(ticket['attachments'], full['attachments'])
+
+        ticket = yield store.fetchTicketWindowed(2723, 10)
+        self.assertEqual(ticket['hidden_comments'], None)
+        self.assertEqual(ticket['comments'], full['comments'])
+
+        self.assertFailure(store.fetchTicketWindowed(1, 5), NotFoundError)
+
+
     @defer.inlineCallbacks
     def test_updateTicket(self):
         """
@@ -440,6 +626,67 @@ class TicketStoreTest(TestCase):
         self.assertEqual(len(changes), 1, "Should only log the component")
 
 
+    @defer.inlineCallbacks
+    def test_updateTicket_publish(self):
+        """
+        Updates are published on the store's bus once they're done.
+        """
+        store = self.populatedStore()
+        store.bus = Bus()
+        events = []
+        store.bus.subscribe(events.append)
+
+        yield store.updateTicket(5622, {'component': 'new component'},
+                                 'a comment')
+        self.assertEqual(len(events), 1)
+        event = events[0]
+        self.assertEqual(event['kind'], 'update')
+        self.assertEqual(event['ticket'], 5622)
+        self.assertEqual(event['author'], 'foo')
+        self.assertEqual(event['comment'], 'a comment')
+        self.assertEqual(event['changes'],
+                         {'component': ('core', 'new component')})
+        ticket = yield store.fetchTicket(5622)
+        self.assertEqual(event['time'], ticket['changetime'])
+
+
+    @defer.inlineCallbacks
+    def test_createTicket_publish(self):
+        """
+        New tickets are published on the store's bus.
+        """
+        store = self.populatedStore()
+        store.bus = Bus()
+        events = []
+        store.bus.subscribe(events.append)
+
+        ticket_id = yield store.createTicket({
+            'summary': 'the summary',
+            'branch': 'foo',
+        })
+        self.assertEqual(len(events), 1)
+        event = events[0]
+        self.assertEqual(event['kind'], 'create')
+        self.assertEqual(event['ticket'], ticket_id)
+        self.assertEqual(event['changes']['summary'], (None, 'the summary'))
+        self.assertEqual(event['changes']['branch'], (None, 'foo'))
+        self.assertEqual(event['changes']['status'], (None, 'new'))
+
+
+    def test_updateTicket_failedNotPublished(self):
+        """
+        Nothing is published when an update fails.
+        """
+        store = self.populatedStore()
+        store.bus = Bus()
+        events = []
+        store.bus.subscribe(events.append)
+
+        store.user = None
+        self.assertFailure(store.updateTicket(5622, {}), UnauthorizedError)
+        self.assertEqual(events, [])
+
+
     @defer.inlineCallbacks
     def test_fetchComponents(self):
         """
@@ -497,6 +744,143 @@ class TicketStoreTest(TestCase):
         self.assertEqual(list(users), ['alice'])
 
 
+    @defer.inlineCallbacks
+    def test_fetchChanges(self):
+        """
+        Changes to all tickets come in order, and can be got a few at a time
+        by passing the position of the last one seen.
+        """
+        store = self.populatedStore()
+
+        changes = yield store.fetchChanges(limit=10000)
+        positions = [x['position'] for x in changes]
+        self.assertEqual(positions, sorted(positions))
+        self.assertEqual(len(set(positions)), len(positions))
+        kinds = set([x['kind'] for x in changes])
+        self.assertEqual(kinds, set(['create', 'change', 'attachment']))
+        created = [x['ticket'] for x in changes if x['kind'] == 'create']
+        self.assertEqual(sorted(created), [2723, 3312, 4712, 5517, 5622])
+
+        paged = []
+        position = None
+        while True:
+            page = yield store.fetchChanges(position, 7)
+            if not page:
+                break
+            paged.extend(page)
+            position = page[-1]['position']
+        self.assertEqual(paged, changes)
+
+
+    @defer.inlineCallbacks
+    def test_fetchChanges_new(self):
+        """
+        Changes made after the position given are got.
+        """
+        store = self.populatedStore()
+        changes = yield store.fetchChanges(limit=10000)
+        yield store.updateTicket(5622, {'priority': 'drop everything'},
+                                 'hello')
+        new = yield store.fetchChanges(changes[-1]['position'])
+        self.assertEqual(sorted([(x['field'], x['new']) for x in new]),
+                         [('comment', 'hello'),
+                          ('priority', 'drop everything')])
+        self.assertEqual(new[0]['author'], 'foo')
+
+
+    @defer.inlineCallbacks
+    def test_fetchTicketAsOf(self):
+        """
+        A ticket can be got as it was at any moment, including the changes
+        made at exactly that moment.
+        """
+        store = self.populatedStore()
+
+        ticket = yield store.fetchTicketAsOf(2723, 1226268968)
+        self.assertEqual(ticket['status'], 'new')
+        self.assertEqual(ticket['owner'], 'glyph')
+        self.assertEqual(ticket['keywords'], '')
+        self.assertEqual(ticket['priority'], 'low')
+        self.assertEqual(ticket['changetime'], 1182815019)
+        self.assertNotIn('comments', ticket)
+
+        ticket = yield store.fetchTicketAsOf(2723, 1226268969)
+        self.assertEqual(ticket['status'], 'assigned')
+        self.assertEqual(ticket['owner'], 'thijs')
+        self.assertEqual(ticket['keywords'], 'fun')
+        self.assertEqual(ticket['cc'], 'thijs')
+        self.assertEqual(ticket['changetime'], 1226268969)
+
+
+    @defer.inlineCallbacks
+    def test_fetchTicketAsOf_now(self):
+        """
+        As of now, a ticket is as it is.
+        """
+        store = self.populatedStore()
+
+        now = yield store.fetchTicket(2723)
+        ticket = yield store.fetchTicketAsOf(2723, 2000000000)
+        del now['comments']
+        self.assertEqual(ticket, now)
+
+
+    @defer.inlineCallbacks
+    def test_fetchTicketAsOf_attachments(self):
+        """
+        Only the attachments added by then are included.
+        """
+        store = self.populatedStore()
+
+        ticket = yield store.fetchTicketAsOf(5517, 1331531953)
+        self.assertEqual(ticket['attachments'], [])
+        ticket = yield store.fetchTicketAsOf(5517, 1331531954)
+        self.assertEqual([x['filename'] for x in ticket['attachments']],
+                         ['5517.diff'])
+
+
+    def test_fetchTicketAsOf_notYet(self):
+        """
+        Before a ticket was created, it isn't found.
+        """
+        store = self.populatedStore()
+        self.assertFailure(store.fetchTicketAsOf(2723, 1182804820),
+                           NotFoundError)
+
+
+    @defer.inlineCallbacks
+    def test_fetchTicketDiff(self):
+        """
+        The fields which differ between two moments are got, with their
+        values at each.
+        """
+        store = self.populatedStore()
+
+        diff = yield store.fetchTicketDiff(2723, 1226268968, 1237748799)
+        self.assertEqual(diff, {
+            'priority': ('low', 'lowest'),
+            'keywords': ('', 'fun, documentation'),
+            'cc': ('', 'thijs'),
+            'launchpad_bug': (None, ''),
+            'branch': (None, ''),
+            'branch_author': (None, ''),
+            'attachments': [],
+        })
+
+
+    @defer.inlineCallbacks
+    def test_fetchTicketDiff_created(self):
+        """
+        A ticket created in between differs in every field it has, and its
+        attachments are all new.
+        """
+        store = self.populatedStore()
+
+        diff = yield store.fetchTicketDiff(5517, 0, 2000000000)
+        self.assertEqual(diff['summary'][0], None)
+        self.assertEqual(diff['attachments'], ['5517.diff'])
+
+
     @defer.inlineCallbacks
     def test_addAttachmentMetadata(self):
         """
@@ -524,6 +908,26 @@ class TicketStoreTest(TestCase):
         self.assertEqual(att['author'], 'foo')
 
 
+    @defer.inlineCallbacks
+    def test_addAttachmentMetadata_publish(self):
+        """
+        New attachments are published on the store's bus.
+        """
+        store = self.populatedStore()
+        store.bus = Bus()
+        events = []
+        store.bus.subscribe(events.append, 5622)
+
+        yield store.addAttachmentMetadata(5622, {
+            'filename': 'the file',
+            'size': 1234,
+            'description': 'this is a description',
+            'ip': '127.0.0.1',
+        })
+        self.assertEqual([(x['kind'], x['filename']) for x in events],
+                         [('attachment', 'the file')])
+
+
     def test_addAttachmentMetadata_noauth(self):
         """
         If you are not authenticated, you can't upload.
@@ -0,0 +1,168 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+import csv
+import json
+import sqlite3
+from StringIO import StringIO
+
+from twisted.trial.unittest import TestCase
+from twisted.python.util import sibpath
+from twisted.internet import defer
+from twisted.test.proto_helpers import StringTransport
+from norm.sqlite import SqliteTranslator
+from norm.common import BlockingRunner
+
+from frack.db import TicketStore
+from frack.api import publicTicket
+from frack.export import (assembleTickets, exportConnection, TicketExporter,
+                          TICKET_COLUMNS)
+
+
+TICKET_NUMBERS = [2723, 3312, 4712, 5517, 5622]
+
+
+
+class FormatCursor(object):
+    """
+    An SQLite cursor taking C{%s} placeholders, like pgdb's and pg8000's.
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+
+    def execute(self, sql, args=()):
+        self.cursor.execute(sql.replace('%s', '?'), args)
+
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+
+class FormatConnection(object):
+    """
+    A connection to SQLite through L{FormatCursor}s, which also stands in
+    for the DB-API module it's from.
+    """
+
+    paramstyle = 'format'
+    __name__ = 'pg8000_dbapi'
+
+    def __init__(self, connection):
+        self.connection = connection
+
+
+    def cursor(self):
+        return FormatCursor(self.connection.cursor())
+
+
+
+class ExportTest(TestCase):
+
+
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:')
+        self.db.executescript(open(sibpath(__file__, 'trac_test.sql')).read())
+        self.runner = BlockingRunner(self.db, SqliteTranslator())
+
+
+    def export(self, format):
+        out = StringIO()
+        count = exportConnection(sqlite3, self.db, out, format, batchSize=2)
+        self.assertEqual(count, len(TICKET_NUMBERS))
+        return out.getvalue()
+
+
+    @defer.inlineCallbacks
+    def test_jsonLines(self):
+        """
+        Each line is a ticket, as L{TicketStore.fetchTicket} gets it and
+        the API serves it, without the addresses attachments were uploaded
+        from.
+        """
+        tickets = [json.loads(x) for x in self.export('jsonl').splitlines()]
+        self.assertEqual([x['id'] for x in tickets], TICKET_NUMBERS)
+
+        store = TicketStore(self.runner, None)
+        for ticket in tickets:
+            expected = yield store.fetchTicket(ticket['id'])
+            self.assertEqual(ticket,
+                             json.loads(json.dumps(publicTicket(expected))))
+        attachments = [x for ticket in tickets for x in ticket['attachments']]
+        self.assertTrue(attachments)
+        for attachment in attachments:
+            self.assertNotIn('ip', attachment)
+            self.assertNotIn('ipnr', attachment)
+
+
+    def test_paramstyle(self):
+        """
+        Drivers which take C{%s} placeholders are queried a batch at a
+        time too.
+        """
+        db = FormatConnection(self.db)
+        out = StringIO()
+        count = exportConnection(db, db, out, 'jsonl', batchSize=2)
+        self.assertEqual(count, len(TICKET_NUMBERS))
+        self.assertEqual(out.getvalue(), self.export('jsonl'))
+
+
+    def test_csv(self):
+        """
+        Each row is a ticket, with a column for each custom field.
+        """
+        rows = list(csv.reader(StringIO(self.export('csv'))))
+        header = rows[0]
+        self.assertEqual(header[:len(TICKET_COLUMNS)], TICKET_COLUMNS)
+        self.assertIn('branch', header)
+        self.assertEqual(header[-2:], ['comments', 'attachments'])
+        self.assertEqual([int(x[0]) for x in rows[1:]], TICKET_NUMBERS)
+        by_id = dict((x[0], dict(zip(header, x))) for x in rows[1:])
+        self.assertEqual(by_id['2723']['branch'],
+                         'branches/relevant-quotes-2723')
+        self.assertTrue(json.loads(by_id['3312']['comments']))
+
+
+    def test_orphans(self):
+        """
+        Rows for tickets which don't exist are skipped.
+        """
+        tickets = list(assembleTickets(
+            [(2,) + (None,) * (len(TICKET_COLUMNS) - 1)],
+            [(1, 'branch', 'x'), (2, 'branch', 'y')],
+            [(1, 10, 'alice', 'comment', '1', 'hi')],
+            []))
+        self.assertEqual(len(tickets), 1)
+        self.assertEqual(tickets[0]['branch'], 'y')
+        self.assertEqual(tickets[0]['comments'], [])
+
+
+    def test_exporter(self):
+        """
+        L{TicketExporter} writes the same thing in batches, and doesn't
+        fetch more while it's paused.
+        """
+        transport = StringTransport()
+        exporter = TicketExporter(self.runner, 'jsonl', batchSize=2)
+        exporter.pauseProducing()
+        d = exporter.exportTo(transport)
+        self.assertEqual(exporter.count, 2)
+        self.assertNoResult(d)
+
+        exporter.resumeProducing()
+        self.assertEqual(self.successResultOf(d), len(TICKET_NUMBERS))
+        self.assertEqual(transport.value(), self.export('jsonl'))
+        self.assertEqual(transport.producer, None)
+
+
+    def test_stopped(self):
+        """
+        When the consumer goes away, the export stops.
+        """
+        transport = StringTransport()
+        exporter = TicketExporter(self.runner, 'csv', batchSize=2)
+        exporter.pauseProducing()
+        d = exporter.exportTo(transport)
+        exporter.stopProducing()
+        self.assertEqual(self.successResultOf(d), 2)
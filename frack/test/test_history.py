@@ -0,0 +1,59 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+import sqlite3
+
+from twisted.trial.unittest import TestCase
+from twisted.python.util import sibpath
+from twisted.internet import defer
+from norm.sqlite import SqliteTranslator
+from norm.common import BlockingRunner
+from norm.operation import SQL
+
+from frack.db import TicketStore
+from frack.history import snapshotAll, CHANGE_TIMES
+
+
+
+class SnapshotTest(TestCase):
+
+
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:')
+        self.db.executescript(open(sibpath(__file__, 'trac_test.sql')).read())
+        self.runner = BlockingRunner(self.db, SqliteTranslator())
+
+
+    def snapshots(self, ticket_number):
+        return [x[0] for x in self.db.execute(
+            'SELECT time FROM frack_ticket_snapshot WHERE ticket = ? '
+            'ORDER BY time', (ticket_number,))]
+
+
+    def test_snapshotAll(self):
+        """
+        Tickets get a snapshot every so many changes, and taking them again
+        only takes the new ones due.
+        """
+        self.assertTrue(self.successResultOf(snapshotAll(self.runner, 3)) > 0)
+        times = [x[0] for x in self.db.execute(CHANGE_TIMES, (2723, -1))]
+        self.assertEqual(self.snapshots(2723), times[2::3])
+        self.assertEqual(self.successResultOf(snapshotAll(self.runner, 3)), 0)
+
+
+    @defer.inlineCallbacks
+    def test_same(self):
+        """
+        Tickets worked out from snapshots are the same as those worked out
+        without them.
+        """
+        yield snapshotAll(self.runner, 2)
+        self.assertNotEqual(self.snapshots(2723), [])
+        plain = TicketStore(self.runner, None)
+        snapped = TicketStore(self.runner, None, snapshots=True)
+        rows = yield self.runner.run(SQL('''
+            SELECT DISTINCT time FROM ticket_change WHERE ticket = 2723'''))
+        for (when,) in rows:
+            for moment in (when - 1, when):
+                expected = yield plain.fetchTicketAsOf(2723, moment)
+                actual = yield snapped.fetchTicketAsOf(2723, moment)
+                self.assertEqual(actual, expected)
@@ -0,0 +1,191 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+import json
+import sqlite3
+from StringIO import StringIO
+
+from twisted.trial.unittest import TestCase
+from twisted.python.util import sibpath
+
+from frack.db import groupComments
+from frack.export import exportConnection
+from frack.importer import Importer, InvalidTicket, ticketRows
+
+
+
+def database(empty=False):
+    db = sqlite3.connect(':memory:')
+    db.executescript(open(sibpath(__file__, 'trac_test.sql')).read())
+    if empty:
+        for table in ['ticket', 'ticket_custom', 'ticket_change',
+                      'attachment']:
+            db.execute('DELETE FROM %s' % (table,))
+        db.commit()
+    return db
+
+
+def export(db):
+    out = StringIO()
+    exportConnection(sqlite3, db, out, 'jsonl')
+    return out.getvalue()
+
+
+
+class TicketRowsTest(TestCase):
+
+
+    def test_comments(self):
+        """
+        Comments are stored so that L{groupComments} reads them back the
+        same, numbered in order unless they have numbers.
+        """
+        rows = ticketRows({
+            'summary': 'hello',
+            'branch': 'foo',
+            'comments': [
+                {'time': 10, 'author': 'alice', 'comment': 'first',
+                 'changes': {'status': ['new', 'assigned']}},
+                {'time': 20, 'author': 'bob', 'comment': 'reply',
+                 'replyto': '1'},
+            ],
+        }, 7, now=5)
+        [ticket] = rows['ticket']
+        self.assertEqual(ticket[:4], (7, None, 5, 20))
+        self.assertEqual(rows['ticket_custom'], [(7, 'branch', 'foo')])
+
+        changes = [x[1:] for x in rows['ticket_change']]
+        self.assertIn((20, 'bob', 'comment', '1.2', 'reply'), changes)
+        comments = groupComments(changes, 7)
+        self.assertEqual([x['number'] for x in comments], ['1', '2'])
+        self.assertEqual(comments[0]['followups'], ['2'])
+        self.assertEqual(comments[0]['changes'],
+                         {'status': ('new', 'assigned')})
+
+
+
+class FakeCursor(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+
+
+    def execute(self, sql, args=()):
+        self.connection.executed.append(sql)
+
+
+    def executemany(self, sql, rows):
+        self.connection.executed.append(sql)
+
+
+    def fetchone(self):
+        return (None,)
+
+
+    def copy_expert(self, sql, data):
+        self.connection.executed.append(sql)
+
+
+    def close(self):
+        pass
+
+
+
+class FakePostgres(object):
+    """
+    Pretends to be psycopg2 and a connection from it, remembering the SQL
+    run.
+    """
+
+    __name__ = 'psycopg2'
+    paramstyle = 'pyformat'
+
+    def __init__(self):
+        self.executed = []
+
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+    def commit(self):
+        self.executed.append('COMMIT')
+
+
+
+class ImporterTest(TestCase):
+
+
+    def test_roundTrip(self):
+        """
+        Importing an export gives back the same tickets.
+        """
+        source = database()
+        exported = export(source)
+        target = database(empty=True)
+        importer = Importer(sqlite3, target, chunkSize=2)
+        count = importer.importLines(StringIO(exported))
+        self.assertEqual(count, 5)
+        self.assertEqual(export(target), exported)
+
+
+    def test_numbering(self):
+        """
+        Tickets without numbers are numbered after the highest one.
+        """
+        db = database()
+        importer = Importer(sqlite3, db)
+        number = importer.add({'summary': 'new one'})
+        self.assertEqual(importer.add({'summary': 'another'}), number + 1)
+        importer.flush()
+        rows = db.execute('SELECT summary, status FROM ticket WHERE id >= ? '
+                          'ORDER BY id', (number,)).fetchall()
+        self.assertEqual(rows, [('new one', 'new'), ('another', 'new')])
+
+
+    def test_chunks(self):
+        """
+        Each chunk is committed on its own, so a bad line leaves the chunks
+        before it imported.
+        """
+        db = database(empty=True)
+        importer = Importer(sqlite3, db, chunkSize=1)
+        lines = [json.dumps({'id': 1, 'summary': 'one'}),
+                 json.dumps({'id': 2, 'comments': [{'author': 'x'}]})]
+        self.assertRaises(InvalidTicket, importer.importLines, lines)
+        self.assertEqual(importer.count, 1)
+        self.assertEqual(db.execute('SELECT id FROM ticket').fetchall(),
+                         [(1,)])
+
+
+    def test_sequence(self):
+        """
+        With Postgres, rows are copied and the ticket number sequence is
+        moved past the imported tickets in each chunk.
+        """
+        db = FakePostgres()
+        importer = Importer(db, db, chunkSize=1)
+        importer.importLines([json.dumps({'id': 7, 'summary': 'seven'}),
+                              json.dumps({'id': 9, 'summary': 'nine'})])
+        setval = ("SELECT setval('ticket_id_seq', "
+                  "(SELECT MAX(id) FROM ticket))")
+        self.assertEqual(db.executed.count(setval), 2)
+        self.assertTrue(db.executed[0].startswith('SELECT MAX(id)'))
+        self.assertTrue(db.executed[1].startswith('COPY ticket '))
+        self.assertEqual(db.executed[-2:], [setval, 'COMMIT'])
+
+
+    def test_sequenceWithoutCopy(self):
+        """
+        With other Postgres drivers, rows are inserted and the sequence is
+        moved all the same.
+        """
+        for name in ['pgdb', 'pg8000.pg8000_dbapi']:
+            db = FakePostgres()
+            db.__name__ = name
+            importer = Importer(db, db)
+            importer.importLines([json.dumps({'id': 7, 'summary': 'seven'})])
+            self.assertTrue(db.executed[1].startswith('INSERT INTO ticket '))
+            self.assertEqual(db.executed[-2:], [
+                "SELECT setval('ticket_id_seq', "
+                "(SELECT MAX(id) FROM ticket))",
+                'COMMIT'])
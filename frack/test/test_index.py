@@ -0,0 +1,173 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+import json
+import sqlite3
+
+from twisted.trial.unittest import TestCase
+from twisted.python.util import sibpath
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.web.test.test_web import DummyRequest
+from norm.sqlite import SqliteTranslator
+from norm.common import BlockingRunner
+
+from frack import index
+from frack.index import TicketIndex
+from frack.db import TicketStore
+from frack.pubsub import Bus
+from frack.api import TicketAPI
+
+
+
+class TicketIndexTest(TestCase):
+
+    if not index.available:
+        skip = 'numpy is not installed'
+
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:')
+        self.db.executescript(open(sibpath(__file__, 'trac_test.sql')).read())
+        self.runner = BlockingRunner(self.db, SqliteTranslator())
+        self.index = TicketIndex(capacity=2, clock=Clock())
+        count = yield self.index.refresh(self.runner)
+        self.assertEqual(count, 5)
+
+
+    def query(self, sql):
+        return [x[0] for x in self.db.execute(sql).fetchall()]
+
+
+    def test_search(self):
+        """
+        L{TicketIndex.search} finds the same tickets as SQL, most recently
+        changed first.
+        """
+        self.assertEqual(self.index.search({}), self.query(
+            'SELECT id FROM ticket ORDER BY changetime DESC'))
+        status = self.query('SELECT status FROM ticket WHERE id = 5622')[0]
+        self.assertEqual(
+            sorted(self.index.search({'status': [status, 'nonesuch']})),
+            self.query("SELECT id FROM ticket WHERE status = '%s' "
+                       "ORDER BY id" % (status,)))
+        self.assertEqual(self.index.search({'status': ['nonesuch']}), [])
+
+
+    def test_timeRange(self):
+        [changetime] = self.query('SELECT changetime FROM ticket '
+                                  'WHERE id = 3312')
+        self.assertEqual(self.index.count({'changetime': (changetime, None)}),
+                         self.query('SELECT COUNT(*) FROM ticket WHERE '
+                                    'changetime >= %d' % (changetime,))[0])
+        self.assertEqual(
+            self.index.count({'changetime': (None, changetime)}),
+            self.query('SELECT COUNT(*) FROM ticket WHERE '
+                       'changetime < %d' % (changetime,))[0])
+
+
+    def test_facets(self):
+        rows = self.db.execute('SELECT component, COUNT(*) FROM ticket '
+                               'GROUP BY component').fetchall()
+        self.assertEqual(sorted(self.index.facets('component')),
+                         sorted(rows))
+        self.assertRaises(ValueError, self.index.facets, 'summary')
+        self.assertRaises(ValueError, self.index.count, {'summary': ['x']})
+
+
+    @defer.inlineCallbacks
+    def test_events(self):
+        """
+        Tickets created and updated through a L{TicketStore} on the bus the
+        index follows are updated in it straight away.
+        """
+        bus = Bus()
+        self.index.subscribe(bus)
+        store = TicketStore(self.runner, 'alice', bus)
+        number = yield store.createTicket({'summary': 'new',
+                                           'component': 'core'})
+        self.assertEqual(self.index.search({'status': ['new'],
+                                            'component': ['core'],
+                                            'owner': [None]}, 1), [number])
+        yield store.updateTicket(number, {'owner': 'bob'})
+        self.assertEqual(self.index.search({'owner': ['bob']}), [number])
+        self.assertEqual(self.index.size, 6)
+
+
+    @defer.inlineCallbacks
+    def test_refresh(self):
+        """
+        Refreshing reads the tickets changed by others.
+        """
+        self.db.execute("UPDATE ticket SET owner = 'carol', "
+                        "changetime = (SELECT MAX(changetime) FROM ticket) "
+                        "+ 1 WHERE id = 4712")
+        yield self.index.refresh(self.runner)
+        self.assertEqual(self.index.search({'owner': ['carol']}), [4712])
+        self.assertEqual(self.index.size, 5)
+
+
+    @defer.inlineCallbacks
+    def test_refreshAfterEvents(self):
+        """
+        Changes published here don't move on where refreshes read from, so
+        changes others made before them are still read, as are changes
+        others committed a little late.
+        """
+        bus = Bus()
+        self.index.subscribe(bus)
+        latest = self.index.latest
+        store = TicketStore(self.runner, 'alice', bus)
+        yield store.updateTicket(2723, {'owner': 'bob'})
+        self.assertEqual(self.index.latest, latest)
+
+        self.db.execute("UPDATE ticket SET owner = 'carol', changetime = ? "
+                        "WHERE id = 4712", (latest - 10,))
+        yield self.index.refresh(self.runner)
+        self.assertEqual(self.index.search({'owner': ['carol']}), [4712])
+        self.assertEqual(self.index.search({'owner': ['bob']}), [2723])
+        self.assertTrue(self.index.latest > latest)
+
+
+
+class SearchAPITest(TestCase):
+
+    if not index.available:
+        skip = 'numpy is not installed'
+
+
+    def setUp(self):
+        db = sqlite3.connect(':memory:')
+        db.executescript(open(sibpath(__file__, 'trac_test.sql')).read())
+        self.runner = BlockingRunner(db, SqliteTranslator())
+        self.index = TicketIndex(clock=Clock())
+        self.api = TicketAPI(self.runner, index=self.index)
+
+
+    def get(self, args):
+        request = DummyRequest(['search'])
+        request.args = dict((k, [v]) for k, v in args.items())
+        return request, self.api.search(request)
+
+
+    def test_loading(self):
+        request, body = self.get({})
+        self.assertEqual(request.responseCode, 503)
+
+
+    def test_search(self):
+        self.index.refresh(self.runner)
+        request, body = self.get({'limit': '2', 'facets': 'status'})
+        result = json.loads(body)
+        self.assertEqual(result['count'], 5)
+        self.assertEqual(len(result['tickets']), 2)
+        self.assertEqual(sum(n for value, n in result['facets']['status']),
+                         5)
+
+
+    def test_bad(self):
+        self.index.refresh(self.runner)
+        request, body = self.get({'facets': 'summary'})
+        self.assertEqual(request.responseCode, 400)
+        request, body = self.get({'time_min': 'yesterday'})
+        self.assertEqual(request.responseCode, 400)
@@ -0,0 +1,138 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+import sqlite3
+from twisted.trial.unittest import TestCase
+from twisted.python.util import sibpath
+from twisted.internet import defer
+
+from norm.sqlite import SqliteTranslator
+from norm.common import BlockingRunner
+
+from frack.db import TicketStore, NotFoundError
+from frack.loader import PageLoader
+
+
+
+class CountingRunner(object):
+    """
+    I count the interactions run through me.
+    """
+
+    def __init__(self, runner):
+        self.runner = runner
+        self.interactions = 0
+
+
+    def run(self, op):
+        return self.runner.run(op)
+
+
+    def runInteraction(self, *args, **kwargs):
+        self.interactions += 1
+        return self.runner.runInteraction(*args, **kwargs)
+
+
+
+class PageLoaderTest(TestCase):
+
+
+    def populatedRunner(self):
+        db = sqlite3.connect(":memory:")
+        db.executescript(open(sibpath(__file__, "trac_test.sql")).read())
+        return CountingRunner(BlockingRunner(db, SqliteTranslator()))
+
+
+    @defer.inlineCallbacks
+    def test_batched(self):
+        """
+        All the lookups are run in one interaction when dispatched.
+        """
+        runner = self.populatedRunner()
+        store = TicketStore(runner, None)
+        loader = PageLoader(runner)
+        ticket = loader.load(store.fetchTicket, 5622)
+        components = loader.load(store.fetchComponents)
+        priorities = loader.load(store.fetchEnum, 'priority')
+        self.assertEqual(runner.interactions, 0)
+
+        yield loader.dispatch()
+        self.assertEqual(runner.interactions, 1)
+
+        ticket = yield ticket
+        self.assertEqual(ticket['id'], 5622)
+        components = yield components
+        self.assertEqual(len(components), 3)
+        priorities = yield priorities
+        self.assertEqual(len(priorities), 2)
+
+
+    @defer.inlineCallbacks
+    def test_dedupe(self):
+        """
+        The same lookup asked for twice, even from different stores, only runs
+        once and both requesters get the result.
+        """
+        runner = self.populatedRunner()
+        calls = []
+        store1 = TicketStore(runner, 'foo')
+        store2 = TicketStore(runner, 'bar')
+        original = TicketStore.fetchEnum
+        def fetchEnum(self, *args, **kwargs):
+            calls.append(args)
+            return original(self, *args, **kwargs)
+        self.patch(TicketStore, 'fetchEnum', fetchEnum)
+
+        loader = PageLoader(runner)
+        d1 = loader.load(store1.fetchEnum, 'priority')
+        d2 = loader.load(store2.fetchEnum, 'priority')
+        d3 = loader.load(store2.fetchEnum, 'severity')
+        yield loader.dispatch()
+
+        self.assertEqual(len(calls), 2)
+        r1 = yield d1
+        r2 = yield d2
+        self.assertEqual(r1, r2)
+        r3 = yield d3
+        self.assertNotEqual(r1, r3)
+
+
+    def test_sameName(self):
+        """
+        Different functions with the same name are different lookups.
+        """
+        runner = self.populatedRunner()
+        def makeLookup(result):
+            def lookup(_runner):
+                return result
+            return lookup
+        loader = PageLoader(runner)
+        d1 = loader.load(makeLookup('one'))
+        d2 = loader.load(makeLookup('two'))
+        loader.dispatch()
+        self.assertEqual(self.successResultOf(d1), 'one')
+        self.assertEqual(self.successResultOf(d2), 'two')
+
+
+    def test_errors(self):
+        """
+        A failing lookup only fails its own Deferred.
+        """
+        runner = self.populatedRunner()
+        store = TicketStore(runner, None)
+        loader = PageLoader(runner)
+        missing = loader.load(store.fetchTicket, 1)
+        components = loader.load(store.fetchComponents)
+        loader.dispatch()
+
+        self.failureResultOf(missing, NotFoundError)
+        self.assertEqual(len(self.successResultOf(components)), 3)
+
+
+    def test_nothing(self):
+        """
+        Dispatching with nothing scheduled doesn't touch the database.
+        """
+        runner = self.populatedRunner()
+        loader = PageLoader(runner)
+        self.successResultOf(loader.dispatch())
+        self.assertEqual(runner.interactions, 0)
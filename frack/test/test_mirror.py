@@ -0,0 +1,201 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+import sqlite3
+from StringIO import StringIO
+
+from twisted.trial.unittest import TestCase
+from twisted.python.util import sibpath
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.web.test.test_web import DummyRequest
+from twisted.web.resource import Resource
+from twisted.web.static import Data
+from norm.sqlite import SqliteTranslator
+from norm.common import BlockingRunner
+
+from frack.db import TicketStore
+from frack.export import exportConnection
+from frack.pubsub import Bus
+from frack.mirror import Mirror, ReadOnlyResource, _after
+
+
+
+def export(db):
+    out = StringIO()
+    exportConnection(sqlite3, db, out, 'jsonl')
+    return out.getvalue()
+
+
+
+class AfterTest(TestCase):
+
+
+    def test_after(self):
+        condition, args = _after(['time', 'id'], [10, 3])
+        self.assertEqual(condition, '((time > ?) OR (time = ? AND id > ?))')
+        self.assertEqual(args, [10, 10, 3])
+
+
+
+class MirrorTest(TestCase):
+
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        upstream = self.mktemp()
+        self.upstreamDB = sqlite3.connect(upstream)
+        self.upstreamDB.executescript(
+            open(sibpath(__file__, 'trac_test.sql')).read())
+        self.upstream = BlockingRunner(self.upstreamDB, SqliteTranslator())
+
+        self.localPath = self.mktemp()
+        self.localDB = sqlite3.connect(self.localPath)
+        self.local = BlockingRunner(self.localDB, SqliteTranslator())
+
+        self.bus = Bus()
+        self.events = []
+        self.bus.subscribe(self.events.append)
+        self.clock = Clock()
+        self.mirror = yield self.openMirror(self.local)
+
+
+    def tearDown(self):
+        self.upstreamDB.close()
+        self.localDB.close()
+
+
+    @defer.inlineCallbacks
+    def openMirror(self, local):
+        mirror = Mirror(self.upstream, local, batchSize=7, bus=self.bus,
+                        clock=self.clock)
+        yield mirror.open()
+        defer.returnValue(mirror)
+
+
+    @defer.inlineCallbacks
+    def test_catchUp(self):
+        """
+        The first pull copies everything, a batch at a time, without
+        publishing any events.
+        """
+        count = yield self.mirror.pull()
+        self.assertTrue(count > 7)
+        self.assertTrue(self.mirror.caughtUp)
+        self.assertEqual(export(self.localDB), export(self.upstreamDB))
+        self.assertEqual(
+            self.localDB.execute('SELECT COUNT(*) FROM milestone').fetchall(),
+            self.upstreamDB.execute(
+                'SELECT COUNT(*) FROM milestone').fetchall())
+        self.assertEqual(self.events, [])
+
+        count = yield self.mirror.pull()
+        self.assertEqual(count, 0)
+
+
+    @defer.inlineCallbacks
+    def test_changes(self):
+        """
+        Later pulls copy new and changed tickets and publish them.
+        """
+        yield self.mirror.pull()
+        store = TicketStore(self.upstream, 'alice')
+        yield store.updateTicket(5622, {'summary': 'mirrored',
+                                        'branch': 'somewhere'}, 'hello')
+        number = yield store.createTicket({'summary': 'new',
+                                           'reporter': 'alice'})
+        yield self.mirror.pull()
+
+        self.assertEqual(export(self.localDB), export(self.upstreamDB))
+        kinds = [(x['kind'], x['ticket']) for x in self.events]
+        self.assertEqual(sorted(kinds), sorted([('create', number),
+                                                ('update', 5622)]))
+        [update] = [x for x in self.events if x['kind'] == 'update']
+        self.assertEqual(update['comment'], 'hello')
+        self.assertEqual(update['changes']['summary'][1], 'mirrored')
+
+
+    @defer.inlineCallbacks
+    def test_late(self):
+        """
+        A row committed after later ones were pulled, with an earlier time,
+        is pulled the next time, and only it is published.
+        """
+        yield self.mirror.pull()
+        latest = self.mirror.positions['ticket_change'][0]
+        self.upstreamDB.execute(
+            'INSERT INTO ticket_change (ticket, time, author, field, '
+            'oldvalue, newvalue) VALUES (?, ?, ?, ?, ?, ?)',
+            (3312, latest - 10, 'bob', 'comment', '', 'late'))
+        self.upstreamDB.commit()
+
+        count = yield self.mirror.pull()
+        self.assertEqual(count, 1)
+        self.assertEqual(export(self.localDB), export(self.upstreamDB))
+        self.assertEqual([(x['ticket'], x['comment']) for x in self.events],
+                         [(3312, 'late')])
+        self.assertEqual(self.mirror.positions['ticket_change'][0], latest)
+
+
+    @defer.inlineCallbacks
+    def test_resume(self):
+        """
+        Positions are kept in the mirror, so a new L{Mirror} on the same file
+        only pulls what's new.
+        """
+        yield self.mirror.pull()
+        store = TicketStore(self.upstream, 'alice')
+        yield store.updateTicket(2723, {}, 'again')
+
+        reopened = sqlite3.connect(self.localPath)
+        self.addCleanup(reopened.close)
+        mirror = yield self.openMirror(
+            BlockingRunner(reopened, SqliteTranslator()))
+        self.assertEqual(mirror.positions, self.mirror.positions)
+        count = yield mirror.pull()
+        # The ticket row and the comment
+        self.assertEqual(count, 2)
+        self.assertEqual(export(reopened), export(self.upstreamDB))
+
+
+    @defer.inlineCallbacks
+    def test_start(self):
+        """
+        Once started, the mirror pulls every C{interval} seconds.
+        """
+        self.mirror.start()
+        self.addCleanup(self.mirror.stop)
+        pulled = self.mirror.pulled
+        self.assertTrue(pulled > 0)
+
+        store = TicketStore(self.upstream, 'alice')
+        yield store.updateTicket(4712, {}, 'later')
+        self.clock.advance(self.mirror.interval)
+        self.assertEqual(self.mirror.pulled, pulled + 2)
+
+
+
+class ReadOnlyResourceTest(TestCase):
+
+
+    def setUp(self):
+        root = Resource()
+        root.putChild('tickets', Data('hello', 'text/plain'))
+        self.resource = ReadOnlyResource(root, 'https://example.com/')
+
+
+    def test_get(self):
+        request = DummyRequest(['tickets'])
+        child = self.resource.getChildWithDefault('tickets', request)
+        self.assertEqual(child.render(request), 'hello')
+
+
+    def test_post(self):
+        """
+        Other methods are refused, pointing to the primary.
+        """
+        request = DummyRequest(['tickets'])
+        request.method = 'POST'
+        child = self.resource.getChildWithDefault('tickets', request)
+        body = child.render(request)
+        self.assertEqual(request.responseCode, 403)
+        self.assertIn('https://example.com/', body)
@@ -0,0 +1,162 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+import json
+from urlparse import parse_qs
+
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseDone
+
+from frack.db import UnauthorizedError
+from frack.persona import PersonaVerifier
+
+
+
+class FakeResponse(object):
+    """
+    Enough of an C{IResponse} for C{readBody}.
+    """
+
+    def __init__(self, code, body):
+        self.code = code
+        self.phrase = 'OK' if code == 200 else 'Error'
+        self.body = body
+        self.length = len(body)
+
+
+    def deliverBody(self, protocol):
+        protocol.dataReceived(self.body)
+        protocol.connectionLost(Failure(ResponseDone()))
+
+
+
+class FakeAgent(object):
+    """
+    An agent which remembers requests, to be answered by the test.
+    """
+
+    def __init__(self):
+        self.requests = []
+
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        d = defer.Deferred()
+        body = bodyProducer._inputFile.read()
+        self.requests.append((method, uri, parse_qs(body), d))
+        return d
+
+
+    def respond(self, index, code, data):
+        d = self.requests[index][3]
+        d.callback(FakeResponse(code, json.dumps(data)))
+
+
+
+class PersonaVerifierTest(TestCase):
+
+
+    def setUp(self):
+        self.clock = Clock()
+        self.clock.advance(1000)
+        self.agent = FakeAgent()
+        self.verifier = PersonaVerifier('http://example.com',
+                                        url='http://verifier/verify',
+                                        timeout=5, maxConcurrent=2,
+                                        reactor=self.clock, agent=self.agent)
+
+
+    def okay(self, email='foo@example.com', expires=1100):
+        return {'status': 'okay', 'email': email,
+                'expires': expires * 1000}
+
+
+    def test_verify(self):
+        """
+        Assertions are posted to the verifier with the audience, and the
+        verified email address is returned.
+        """
+        d = self.verifier.verify('assertion')
+        method, uri, body, ignored = self.agent.requests[0]
+        self.assertEqual(method, 'POST')
+        self.assertEqual(uri, 'http://verifier/verify')
+        self.assertEqual(body, {'assertion': ['assertion'],
+                                'audience': ['http://example.com']})
+        self.agent.respond(0, 200, self.okay())
+        self.assertEqual(self.successResultOf(d), 'foo@example.com')
+
+
+    def test_failure(self):
+        """
+        If the verifier says no, or isn't working, verification fails.
+        """
+        d1 = self.verifier.verify('one')
+        d2 = self.verifier.verify('two')
+        self.agent.respond(0, 200, {'status': 'failure'})
+        self.agent.respond(1, 500, {})
+        self.failureResultOf(d1, UnauthorizedError)
+        self.failureResultOf(d2, UnauthorizedError)
+
+
+    def test_malformed(self):
+        """
+        Verification fails if the verifier answers with something other than
+        an object with an email address.
+        """
+        results = [self.verifier.verify('a%d' % (i,)) for i in range(4)]
+        self.agent.respond(0, 200, ['okay'])
+        self.agent.respond(1, 200, 'okay')
+        self.agent.respond(2, 200, None)
+        self.agent.respond(3, 200, {'status': 'okay'})
+        for d in results:
+            self.failureResultOf(d, UnauthorizedError)
+
+
+    def test_timeout(self):
+        """
+        Verification fails if the verifier takes too long.
+        """
+        d = self.verifier.verify('assertion')
+        self.clock.advance(5)
+        self.failureResultOf(d, UnauthorizedError)
+
+
+    def test_cached(self):
+        """
+        Verified assertions are remembered until they expire.
+        """
+        d = self.verifier.verify('assertion')
+        self.agent.respond(0, 200, self.okay(expires=1100))
+
+        self.clock.advance(99)
+        d = self.verifier.verify('assertion')
+        self.assertEqual(self.successResultOf(d), 'foo@example.com')
+        self.assertEqual(len(self.agent.requests), 1)
+
+        self.clock.advance(1)
+        self.verifier.verify('assertion')
+        self.assertEqual(len(self.agent.requests), 2)
+
+
+    def test_coalesce(self):
+        """
+        Concurrent checks of the same assertion share one request.
+        """
+        d1 = self.verifier.verify('assertion')
+        d2 = self.verifier.verify('assertion')
+        self.assertEqual(len(self.agent.requests), 1)
+        self.agent.respond(0, 200, self.okay())
+        self.assertEqual(self.successResultOf(d1), 'foo@example.com')
+        self.assertEqual(self.successResultOf(d2), 'foo@example.com')
+
+
+    def test_concurrency(self):
+        """
+        No more than C{maxConcurrent} requests are made at once.
+        """
+        results = [self.verifier.verify('a%d' % (i,)) for i in range(3)]
+        self.assertEqual(len(self.agent.requests), 2)
+        self.agent.respond(0, 200, self.okay())
+        self.assertEqual(len(self.agent.requests), 3)
+        self.assertEqual(self.successResultOf(results[0]), 'foo@example.com')
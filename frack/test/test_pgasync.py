@@ -0,0 +1,331 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer
+from twisted.internet.task import Clock
+
+from norm.operation import Insert, SQL
+
+from frack.pgasync import (translate, AsyncPostgresRunner, POLL_OK,
+                           POLL_READ)
+
+
+
+class FakeCursor(object):
+
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = None
+
+
+    def execute(self, sql, args):
+        if self.connection.closed:
+            raise OperationalError('connection already closed')
+        self.connection.executed.append((sql, args))
+        self.connection.busy = True
+        rows = self.connection.results.pop(sql, None)
+        self.description = None if rows is None else [('col',)]
+        self.rows = rows
+
+
+    def fetchall(self):
+        return self.rows
+
+
+
+class FakeConnection(object):
+    """
+    Pretends to be an asynchronous psycopg2 connection.  Queries stay in
+    progress until L{finish} is called.
+    """
+
+    def __init__(self):
+        self.executed = []
+        self.results = {}
+        self.busy = False
+        self.closed = 0
+        self.owner = None
+
+
+    def fileno(self):
+        return -1
+
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+    def poll(self):
+        if self.closed:
+            raise OperationalError('server closed the connection')
+        if self.busy:
+            return POLL_READ
+        return POLL_OK
+
+
+    def finish(self):
+        self.busy = False
+        self.owner.doRead()
+
+
+    def die(self):
+        """
+        Pretend the server went away.  Nobody notices until the connection
+        is next used, unless it's busy.
+        """
+        self.closed = 2
+        if self.busy:
+            self.owner.doRead()
+
+
+
+class OperationalError(Exception):
+    pass
+
+
+
+class FakeReactor(Clock):
+
+
+    def __init__(self):
+        Clock.__init__(self)
+        self.readers = set()
+
+
+    def addReader(self, r):
+        r.connection.owner = r
+        self.readers.add(r)
+
+
+    def removeReader(self, r):
+        self.readers.discard(r)
+
+
+    def addWriter(self, w):
+        pass
+
+
+    def removeWriter(self, w):
+        pass
+
+
+
+class translateTest(TestCase):
+
+
+    def test_sql(self):
+        """
+        Question marks become Postgres placeholders and literal percents are
+        escaped.
+        """
+        sql, args, lastrowid = translate(SQL("select ? where x like '%a'",
+                                             (1,)))
+        self.assertEqual(sql, "select %s where x like '%%a'")
+        self.assertEqual(args, (1,))
+        self.assertEqual(lastrowid, False)
+
+
+    def test_insert(self):
+        """
+        Inserts which want the last row id use RETURNING.
+        """
+        sql, args, lastrowid = translate(Insert('ticket', [('a', 1),
+                                                           ('b', 2)],
+                                                lastrowid=True))
+        self.assertEqual(sql, 'INSERT INTO ticket (a,b) VALUES (%s,%s) '
+                              'RETURNING id')
+        self.assertEqual(args, (1, 2))
+        self.assertEqual(lastrowid, True)
+
+
+
+class AsyncPostgresRunnerTest(TestCase):
+
+
+    def makeRunner(self, size=2):
+        self.conns = []
+        self.down = False
+        def connect():
+            if self.down:
+                raise OperationalError('could not connect to server')
+            c = FakeConnection()
+            self.conns.append(c)
+            return c
+        self.reactor = FakeReactor()
+        return AsyncPostgresRunner(connect, size, self.reactor)
+
+
+    def test_run(self):
+        """
+        run sends the query and fires with the rows once the connection says
+        it's done.
+        """
+        runner = self.makeRunner(1)
+        runner.start()
+        conn = self.conns[0]
+        conn.results['select 1'] = [(1,)]
+
+        d = runner.run(SQL('select 1'))
+        self.assertNoResult(d)
+        self.assertEqual(conn.executed, [('select 1', ())])
+        conn.finish()
+        self.assertEqual(self.successResultOf(d), [(1,)])
+
+
+    def test_pipelined(self):
+        """
+        Queries go to the least busy connection instead of waiting for an
+        idle one.
+        """
+        runner = self.makeRunner(2)
+        runner.run(SQL('one'))
+        runner.run(SQL('two'))
+        runner.run(SQL('three'))
+        self.assertEqual(len(self.conns[0].executed), 1)
+        self.assertEqual(len(self.conns[1].executed), 1)
+
+        self.conns[0].finish()
+        self.assertEqual(self.conns[0].executed[-1], ('three', ()))
+
+
+    def test_runInteraction(self):
+        """
+        Interactions run in a transaction on one connection and commit when
+        they succeed.
+        """
+        runner = self.makeRunner(2)
+        def interaction(r, value):
+            return r.run(SQL('insert ?', (value,))).addCallback(
+                lambda _: value)
+        d = runner.runInteraction(interaction, 'foo')
+        conn = self.conns[0]
+        conn.finish()
+        conn.finish()
+        conn.finish()
+        self.assertEqual(self.successResultOf(d), 'foo')
+        self.assertEqual([x[0] for x in conn.executed],
+                         ['BEGIN', 'insert %s', 'COMMIT'])
+        self.assertEqual(self.conns[1].executed, [])
+
+
+    def test_runInteraction_rollback(self):
+        """
+        A failing interaction is rolled back and the failure passed on.
+        """
+        runner = self.makeRunner(1)
+        def interaction(r):
+            raise ValueError('foo')
+        d = runner.runInteraction(interaction)
+        conn = self.conns[0]
+        conn.finish()
+        conn.finish()
+        self.failureResultOf(d, ValueError)
+        self.assertEqual([x[0] for x in conn.executed],
+                         ['BEGIN', 'ROLLBACK'])
+
+
+    def test_runInteraction_pinned(self):
+        """
+        While a connection is in a transaction, other queries go elsewhere
+        and other interactions wait for it.
+        """
+        runner = self.makeRunner(1)
+        waiting = defer.Deferred()
+        runner.runInteraction(lambda r: waiting)
+        conn = self.conns[0]
+        conn.finish()
+
+        d = runner.run(SQL('other'))
+        self.assertEqual([x[0] for x in conn.executed], ['BEGIN'])
+
+        waiting.callback(None)
+        conn.finish()
+        self.assertEqual([x[0] for x in conn.executed],
+                         ['BEGIN', 'COMMIT', 'other'])
+        conn.finish()
+        self.successResultOf(d)
+
+
+    def test_reconnect(self):
+        """
+        When a connection breaks, the query it was running fails, queries
+        waiting for it go to a new connection once one is opened, and the
+        broken one is never used again.
+        """
+        runner = self.makeRunner(1)
+        runner.start()
+        first = self.conns[0]
+        one = runner.run(SQL('one'))
+        two = runner.run(SQL('two'))
+        first.die()
+        self.failureResultOf(one, OperationalError)
+        self.assertNoResult(two)
+        self.assertEqual(runner.connections, [])
+
+        self.reactor.advance(runner.initialDelay)
+        self.assertEqual(len(self.conns), 2)
+        second = self.conns[1]
+        self.assertEqual(runner.connections[0].connection, second)
+        self.assertEqual(second.executed, [('two', ())])
+        second.finish()
+        self.successResultOf(two)
+        self.assertEqual(first.executed, [('one', ())])
+
+
+    def test_reconnectBackoff(self):
+        """
+        While the server can't be reached, reconnecting is tried less and
+        less often, up to C{maxDelay} apart.
+        """
+        runner = self.makeRunner(1)
+        runner.maxDelay = 5
+        runner.start()
+        d = runner.run(SQL('one'))
+        self.down = True
+        self.conns[0].die()
+        self.failureResultOf(d)
+
+        for delay in [1, 2, 4, 5, 5]:
+            self.reactor.advance(delay - 0.1)
+            self.assertEqual(len(self.flushLoggedErrors(OperationalError)),
+                             0)
+            self.reactor.advance(0.1)
+            self.assertEqual(len(self.flushLoggedErrors(OperationalError)),
+                             1)
+        self.down = False
+        self.reactor.advance(5)
+        self.assertEqual(len(runner.connections), 1)
+        d = runner.run(SQL('two'))
+        self.assertEqual(self.conns[-1].executed, [('two', ())])
+
+
+    def test_reconnectInteraction(self):
+        """
+        An interaction whose connection breaks fails, and doesn't get its
+        connection back into the pool when it's done.
+        """
+        runner = self.makeRunner(1)
+        waiting = defer.Deferred()
+        d = runner.runInteraction(lambda r: waiting)
+        conn = self.conns[0]
+        conn.finish()
+        conn.die()
+        waiting.errback(OperationalError('server closed the connection'))
+        self.failureResultOf(d, OperationalError)
+        self.assertEqual(runner.connections, [])
+        self.assertEqual([x[0] for x in conn.executed], ['BEGIN'])
+        self.flushLoggedErrors()
+
+
+    def test_close(self):
+        """
+        Closing the pool stops it reconnecting.
+        """
+        runner = self.makeRunner(1)
+        d = runner.run(SQL('one'))
+        self.conns[0].die()
+        self.failureResultOf(d)
+        runner.close()
+        self.reactor.advance(runner.initialDelay)
+        self.assertEqual(len(self.conns), 1)
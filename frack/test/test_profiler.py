@@ -0,0 +1,201 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+import os
+import json
+import threading
+
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.web.server import NOT_DONE_YET
+from twisted.web.test.test_web import DummyRequest
+
+from frack import profiler
+from frack.profiler import (Profile, SamplingProfiler, profileFor, routeName,
+                            _requestRoute)
+from frack.admin import AdminResource
+
+
+
+class FakeCode(object):
+
+    def __init__(self, name, filename):
+        self.co_name = name
+        self.co_filename = filename
+        self.co_firstlineno = 1
+
+
+
+class FakeFrame(object):
+
+    def __init__(self, name, filename, back=None, locals=None):
+        self.f_code = FakeCode(name, filename)
+        self.f_back = back
+        self.f_locals = locals or {}
+
+
+
+class FakeRequest(object):
+    path = '/tickets/ticket/3312?format=json'
+
+
+
+class RouteTest(TestCase):
+
+
+    def test_routeName(self):
+        self.assertEqual(routeName('/tickets/ticket/3312'),
+                         '/tickets/ticket/<int>')
+        self.assertEqual(routeName('/tickets/ticket/3312/events?x=1'),
+                         '/tickets/ticket/<int>/events')
+        self.assertEqual(routeName('/tickets/report/1a'),
+                         '/tickets/report/1a')
+
+
+    def test_requestRoute(self):
+        """
+        A stack running inside a web request's C{process} is tagged with
+        the request's route.
+        """
+        process = FakeFrame('process', '/lib/twisted/web/server.py',
+                            locals={'self': FakeRequest()})
+        handler = FakeFrame('showTicket', '/frack/web.py', process)
+        self.assertEqual(_requestRoute(handler), '/tickets/ticket/<int>')
+        self.assertEqual(_requestRoute(FakeFrame('run', '/frack/x.py')), None)
+
+
+
+class ProfileTest(TestCase):
+
+
+    def profile(self):
+        profile = Profile(0.01)
+        profile.add('MainThread', '/tickets', ('run', 'render'))
+        profile.add('MainThread', '/tickets', ('run', 'render'))
+        profile.add('PoolThread-1', None, ('work',))
+        return profile
+
+
+    def test_collapsed(self):
+        self.assertEqual(self.profile().collapsed(),
+                         'MainThread;/tickets;run;render 2\n'
+                         'PoolThread-1;-;work 1\n')
+
+
+    def test_speedscope(self):
+        data = json.loads(self.profile().speedscope())
+        names = [x['name'] for x in data['shared']['frames']]
+        main, pool = data['profiles']
+        self.assertEqual(main['name'], 'MainThread')
+        self.assertEqual([[names[i] for i in x] for x in main['samples']],
+                         [['route: /tickets', 'run', 'render']])
+        self.assertEqual(main['weights'], [0.02])
+        self.assertEqual(pool['endValue'], 0.01)
+
+
+
+def waitingHere(started, event):
+    started.set()
+    event.wait()
+
+
+
+class SamplingProfilerTest(TestCase):
+
+
+    def test_sample(self):
+        """
+        Sampling records the stacks of other threads.
+        """
+        started = threading.Event()
+        event = threading.Event()
+        thread = threading.Thread(target=waitingHere, args=(started, event),
+                                  name='waiter')
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(event.set)
+        # Don't sample until the thread is inside waitingHere.
+        started.wait()
+
+        sampler = SamplingProfiler()
+        sampler.profile = Profile(sampler.interval)
+        sampler.sample()
+        stacks = [stack for (name, route, stack) in sampler.profile.counts
+                  if name == 'waiter']
+        self.assertEqual(len(stacks), 1)
+        self.assertIn('waitingHere', ' '.join(stacks[0]))
+        self.assertEqual(sampler.profile.samples, 1)
+
+
+    def test_profileFor(self):
+        """
+        L{profileFor} samples for the given time and then fires with the
+        formatted profile.
+        """
+        clock = Clock()
+        d = profileFor(1, 'collapsed', clock=clock)
+        self.assertNoResult(d)
+        self.assertRaises(ValueError, profileFor, 1, clock=clock)
+        clock.advance(1)
+        self.assertIsInstance(self.successResultOf(d), str)
+        self.assertEqual(profiler._running, [])
+
+
+    def test_badArguments(self):
+        clock = Clock()
+        self.assertRaises(ValueError, profileFor, 1, 'pstats', clock=clock)
+        self.assertRaises(ValueError, profileFor, 0, clock=clock)
+        self.assertRaises(ValueError, profileFor, 3600, clock=clock)
+        self.assertRaises(ValueError, profileFor, 1, pid=os.getpid() + 1,
+                          clock=clock)
+        self.assertEqual(profiler._running, [])
+
+
+
+class ProfileResourceTest(TestCase):
+
+
+    def setUp(self):
+        self.calls = []
+        self.admin = AdminResource(dict, 'secret', self.profile)
+
+
+    def profile(self, seconds, format, interval, **kwargs):
+        d = defer.Deferred()
+        self.calls.append(((seconds, format, interval, kwargs), d))
+        return d
+
+
+    def get(self, args, token='secret'):
+        request = DummyRequest(['profile'])
+        request.requestHeaders.setRawHeaders('x-admin-token', [token])
+        request.args = dict((k, [v]) for k, v in args.items())
+        resource = self.admin.getChildWithDefault('profile', request)
+        return request, resource.render(request)
+
+
+    def test_profile(self):
+        request, result = self.get({'seconds': '2',
+                                    'format': 'speedscope', 'pid': '12'})
+        self.assertEqual(result, NOT_DONE_YET)
+        [(args, d)] = self.calls
+        self.assertEqual(args, (2.0, 'speedscope', 0.005, {'pid': 12}))
+        d.callback('{}')
+        self.assertEqual(request.written, ['{}'])
+        self.assertEqual(request.finished, 1)
+
+
+    def test_error(self):
+        """
+        Profiling errors are reported as bad requests.
+        """
+        request, result = self.get({})
+        [(args, d)] = self.calls
+        d.errback(ValueError('A profile is already running'))
+        self.assertEqual(request.responseCode, 400)
+        self.assertEqual(request.finished, 1)
+
+
+    def test_unauthorized(self):
+        self.get({}, 'wrong')
+        self.assertEqual(self.calls, [])
@@ -0,0 +1,230 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+import json
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.task import Clock
+from twisted.web.test.test_web import DummyRequest
+
+from frack.pubsub import Bus
+from frack.sse import EventStream, formatEvent, RESET
+
+
+
+def event(ticket, kind='update', time=1000):
+    return {'kind': kind, 'ticket': ticket, 'time': time, 'author': 'foo'}
+
+
+def parseEvents(written):
+    """
+    Get the events in what was written to a stream, as dicts of their
+    fields.
+    """
+    events = []
+    for chunk in written:
+        fields = dict(line.split(': ', 1) for line in chunk.split('\n')
+                      if ': ' in line)
+        if 'data' in fields:
+            fields['data'] = json.loads(fields['data'])
+            events.append(fields)
+    return events
+
+
+
+class BusTest(TestCase):
+
+
+    def test_publish(self):
+        """
+        Subscribers to everything get every event; subscribers to a ticket
+        get only that ticket's events.
+        """
+        bus = Bus()
+        everything = []
+        one = []
+        bus.subscribe(everything.append)
+        bus.subscribe(one.append, 12)
+
+        bus.publish(event(12))
+        bus.publish(event(13))
+        self.assertEqual([x['ticket'] for x in everything], [12, 13])
+        self.assertEqual([x['ticket'] for x in one], [12])
+
+
+    def test_unsubscribe(self):
+        """
+        Subscribing returns a function which undoes it.
+        """
+        bus = Bus()
+        events = []
+        unsubscribe = bus.subscribe(events.append, 12)
+        self.assertEqual(bus.subscriberCount(), 1)
+        unsubscribe()
+        unsubscribe()
+        self.assertEqual(bus.subscriberCount(), 0)
+        bus.publish(event(12))
+        self.assertEqual(events, [])
+
+
+    def test_error(self):
+        """
+        A subscriber raising an exception doesn't stop the others from
+        getting the event.
+        """
+        bus = Bus()
+        events = []
+        bus.subscribe(lambda e: 1 / 0)
+        bus.subscribe(events.append)
+        bus.publish(event(12))
+        self.assertEqual(len(events), 1)
+        self.assertEqual(len(self.flushLoggedErrors(ZeroDivisionError)), 1)
+
+
+
+class StreamingRequest(DummyRequest):
+    """
+    A request which, like a real one, just remembers a push producer.
+    """
+
+    producer = None
+
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+
+class EventStreamTest(TestCase):
+
+
+    def setUp(self):
+        self.bus = Bus()
+        self.clock = Clock()
+        self.stream = EventStream(self.bus, bufferSize=2, heartbeat=10,
+                                  clock=self.clock)
+
+
+    def watch(self, ticket_number=None, lastEventID=None):
+        request = StreamingRequest([])
+        if lastEventID is not None:
+            request.requestHeaders.setRawHeaders('last-event-id',
+                                                 [lastEventID])
+        subscriber = self.stream.watch(request, ticket_number)
+        return request, subscriber
+
+
+    def test_stream(self):
+        """
+        Events for the watched ticket are written to the request.
+        """
+        request, subscriber = self.watch(12)
+        self.assertEqual(request.responseHeaders.getRawHeaders('content-type'),
+                         ['text/event-stream'])
+        self.assertIdentical(request.producer, subscriber)
+        self.bus.publish(event(12))
+        self.bus.publish(event(13))
+        [sent] = parseEvents(request.written)
+        self.assertEqual(sent['event'], 'update')
+        self.assertEqual(sent['data'], dict(event(12), id=sent['id']))
+        self.assertEqual(request.written[1:], [formatEvent(sent['data'])])
+
+
+    def test_ids(self):
+        """
+        Every event sent on a stream has a different id, however many
+        happen at once.
+        """
+        request, subscriber = self.watch()
+        for i in range(3):
+            self.bus.publish(event(12))
+        ids = [x['id'] for x in parseEvents(request.written)]
+        self.assertEqual(len(set(ids)), 3)
+
+
+    def test_replay(self):
+        """
+        A watcher reconnecting with C{Last-Event-ID} is sent the events for
+        its ticket which it missed.
+        """
+        request, subscriber = self.watch(12)
+        self.bus.publish(event(12, time=1))
+        [last] = parseEvents(request.written)
+        request.finish()
+
+        self.bus.publish(event(12, time=2))
+        self.bus.publish(event(13, time=3))
+        self.bus.publish(event(12, time=4))
+        request, subscriber = self.watch(12, last['id'])
+        self.assertEqual([x['data']['time'] for x in
+                          parseEvents(request.written)], [2, 4])
+
+        self.bus.publish(event(12, time=5))
+        self.assertEqual([x['data']['time'] for x in
+                          parseEvents(request.written)], [2, 4, 5])
+
+
+    def test_replayUnknown(self):
+        """
+        A watcher reconnecting after events which are no longer kept, or
+        with an id from another stream, is told to start again.
+        """
+        self.stream = EventStream(self.bus, replaySize=2, clock=self.clock)
+        request, subscriber = self.watch(12)
+        self.bus.publish(event(12, time=1))
+        [last] = parseEvents(request.written)
+        request.finish()
+        for i in range(3):
+            self.bus.publish(event(12, time=2 + i))
+
+        for lastEventID in [last['id'], 'abc-1', 'nonsense']:
+            request, subscriber = self.watch(12, lastEventID)
+            self.assertEqual(request.written[1:], [RESET])
+            request.finish()
+
+
+    def test_heartbeat(self):
+        """
+        Watchers are sent a comment line every so often, and the timer stops
+        when nobody is watching.
+        """
+        request, subscriber = self.watch()
+        self.clock.advance(10)
+        self.assertEqual(request.written[-1], ':\n\n')
+
+        request.finish()
+        self.assertEqual(self.stream.subscribers, set())
+        self.assertEqual(self.stream._watchers.subscriberCount(), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_paused(self):
+        """
+        While a watcher's connection is paused, events are kept and sent
+        when it resumes.
+        """
+        request, subscriber = self.watch(12)
+        subscriber.pauseProducing()
+        self.bus.publish(event(12, time=1))
+        self.bus.publish(event(12, time=2))
+        self.assertEqual(len(request.written), 1)
+
+        subscriber.resumeProducing()
+        self.assertEqual([x['data']['time'] for x in
+                          parseEvents(request.written)], [1, 2])
+
+
+    def test_slowConsumer(self):
+        """
+        A watcher that falls too far behind is dropped.
+        """
+        request, subscriber = self.watch(12)
+        subscriber.pauseProducing()
+        for i in range(3):
+            self.bus.publish(event(12, time=i))
+        self.assertEqual(request.finished, 1)
+        self.assertEqual(self.stream.subscribers, set())
+        self.assertEqual(self.stream._watchers.subscriberCount(), 0)
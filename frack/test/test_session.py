@@ -0,0 +1,237 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+import sqlite3
+
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.python.util import sibpath
+from twisted.web.test.test_web import DummyRequest
+from norm.sqlite import SqliteTranslator
+from norm.common import BlockingRunner
+from norm.operation import SQL
+
+from frack.session import SessionStore, COOKIE_NAME
+
+
+
+class CookieRequest(DummyRequest):
+
+    def __init__(self, sid=None):
+        DummyRequest.__init__(self, [''])
+        self.received = {}
+        if sid is not None:
+            self.received[COOKIE_NAME] = sid
+        self.added = {}
+        self.cookieOptions = {}
+
+
+    def getCookie(self, name):
+        return self.received.get(name)
+
+
+    def addCookie(self, name, value, **kwargs):
+        self.added[name] = value
+        self.cookieOptions[name] = kwargs
+
+
+
+class SessionStoreTest(TestCase):
+
+
+    def setUp(self):
+        db = sqlite3.connect(":memory:")
+        db.executescript(open(sibpath(__file__, "trac_test.sql")).read())
+        self.runner = BlockingRunner(db, SqliteTranslator())
+        self.clock = Clock()
+        self.clock.advance(1000000)
+        self.store = SessionStore(self.runner, lifetime=1000, cacheTime=5,
+                                  clock=self.clock)
+
+
+    def request(self, sid=None):
+        return CookieRequest(sid)
+
+
+    def otherStore(self):
+        """
+        Another store on the same database, like another process would have.
+        """
+        return SessionStore(self.runner, lifetime=1000, cacheTime=5,
+                            clock=self.clock)
+
+
+    @defer.inlineCallbacks
+    def test_new(self):
+        """
+        A request without a cookie gets an empty session, which is only
+        created (with a cookie) when something is stored in it.
+        """
+        request = self.request()
+        session = yield self.store.forRequest(request)
+        self.assertEqual(session.sid, None)
+        self.assertEqual(session.get('email'), None)
+
+        session.set('email', 'foo@example.com')
+        self.assertNotEqual(session.sid, None)
+        self.assertEqual(request.added, {COOKIE_NAME: session.sid})
+        self.assertEqual(session.get('email'), 'foo@example.com')
+        self.assertEqual(request.cookieOptions[COOKIE_NAME]['httpOnly'],
+                         True)
+        self.assertEqual(request.cookieOptions[COOKIE_NAME]['secure'], True)
+
+
+    @defer.inlineCallbacks
+    def test_rotate(self):
+        """
+        Rotating a session moves its attributes to a new id and cookie, and
+        the old id stops working.
+        """
+        session = yield self.store.forRequest(self.request())
+        session.set('color', 'blue')
+        yield session.save()
+        old = session.sid
+
+        request = self.request(old)
+        session = yield self.store.forRequest(request)
+        session.rotate()
+        self.assertNotEqual(session.sid, old)
+        self.assertEqual(request.added, {COOKIE_NAME: session.sid})
+        self.assertEqual(session.get('color'), 'blue')
+
+        again = yield self.store.forRequest(self.request(old))
+        self.assertEqual(again.sid, None)
+        yield session.save()
+        for store in (self.store, self.otherStore()):
+            again = yield store.forRequest(self.request(old))
+            self.assertEqual(again.sid, None)
+            again = yield store.forRequest(self.request(session.sid))
+            self.assertEqual(again.get('color'), 'blue')
+        rows = yield self.runner.run(SQL(
+            "SELECT count(*) FROM session_attribute WHERE sid = ?", (old,)))
+        self.assertEqual(rows[0][0], 0)
+
+
+    @defer.inlineCallbacks
+    def test_writeBehind(self):
+        """
+        Changes are written when the store is flushed, after which other
+        processes can see them.
+        """
+        session = yield self.store.forRequest(self.request())
+        session.set('email', 'foo@example.com')
+
+        other = yield self.otherStore().forRequest(self.request(session.sid))
+        self.assertEqual(other.sid, None, "Shouldn't be written yet")
+
+        yield self.store.flush()
+        other = yield self.otherStore().forRequest(self.request(session.sid))
+        self.assertEqual(other.sid, session.sid)
+        self.assertEqual(other.get('email'), 'foo@example.com')
+
+
+    @defer.inlineCallbacks
+    def test_remove(self):
+        """
+        Setting an attribute to C{None} removes it.
+        """
+        session = yield self.store.forRequest(self.request())
+        session.set('email', 'foo@example.com')
+        yield session.save()
+        session.set('email', None)
+        yield session.save()
+
+        other = yield self.otherStore().forRequest(self.request(session.sid))
+        self.assertEqual(other.get('email'), None)
+
+
+    @defer.inlineCallbacks
+    def test_cached(self):
+        """
+        Loaded sessions are cached for C{cacheTime} seconds.
+        """
+        session = yield self.store.forRequest(self.request())
+        session.set('email', 'foo@example.com')
+        yield session.save()
+
+        self.clock.advance(10)
+        yield self.store.flush()
+        yield self.store.forRequest(self.request(session.sid))
+        yield self.runner.run(SQL("DELETE FROM session_attribute"))
+        again = yield self.store.forRequest(self.request(session.sid))
+        self.assertEqual(again.get('email'), 'foo@example.com')
+
+        self.clock.advance(5)
+        again = yield self.store.forRequest(self.request(session.sid))
+        self.assertEqual(again.get('email'), None)
+
+
+    @defer.inlineCallbacks
+    def test_unknown(self):
+        """
+        A cookie for a session that doesn't exist gets a new, empty session,
+        and isn't counted as a visit.
+        """
+        session = yield self.store.forRequest(self.request('nonsense'))
+        self.assertEqual(session.sid, None)
+        self.assertEqual(self.store._visited, {})
+
+
+    @defer.inlineCallbacks
+    def test_expire(self):
+        """
+        Sessions which haven't been visited for C{lifetime} seconds are
+        deleted, and authenticated sessions are left alone.
+        """
+        old = yield self.store.forRequest(self.request())
+        old.set('email', 'old@example.com')
+        yield self.store.flush()
+
+        self.clock.advance(600)
+        new = yield self.store.forRequest(self.request())
+        new.set('email', 'new@example.com')
+        yield self.store.flush()
+
+        self.clock.advance(500)
+        yield self.store.expire()
+        rows = yield self.runner.run(SQL(
+            "SELECT sid, name FROM session_attribute ORDER BY sid"))
+        self.assertEqual(sorted(rows), sorted([
+            (new.sid, 'email'),
+            ('alice', 'email'),
+        ]))
+        rows = yield self.runner.run(SQL("SELECT sid FROM session"))
+        self.assertEqual(sorted(rows), sorted([(new.sid,), ('alice',)]))
+
+
+    @defer.inlineCallbacks
+    def test_visit(self):
+        """
+        Loading a session counts as a visit, which keeps it from expiring.
+        """
+        session = yield self.store.forRequest(self.request())
+        session.set('email', 'foo@example.com')
+        yield self.store.flush()
+
+        self.clock.advance(900)
+        yield self.store.forRequest(self.request(session.sid))
+        yield self.store.flush()
+
+        self.clock.advance(900)
+        yield self.store.expire()
+        other = yield self.otherStore().forRequest(self.request(session.sid))
+        self.assertEqual(other.get('email'), 'foo@example.com')
+
+
+    def test_timers(self):
+        """
+        Once started, the store flushes every C{flushInterval} seconds.
+        """
+        self.store.flushInterval = 2
+        self.store.start()
+        self.store.create()
+        self.clock.advance(2)
+        rows = self.successResultOf(self.runner.run(SQL(
+            "SELECT count(*) FROM session")))
+        self.assertEqual(rows[0][0], 2)
+        self.successResultOf(self.store.stop())
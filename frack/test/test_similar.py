@@ -0,0 +1,163 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+import json
+import sqlite3
+
+from twisted.trial.unittest import TestCase
+from twisted.python.util import sibpath
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.web.test.test_web import DummyRequest
+from norm.sqlite import SqliteTranslator
+from norm.common import BlockingRunner
+
+from frack import similar
+from frack.similar import SimilarTickets, words, termCounts
+from frack.db import TicketStore
+from frack.pubsub import Bus
+from frack.api import TicketAPI
+
+
+
+class WordsTest(TestCase):
+
+
+    def test_words(self):
+        self.assertEqual(words(u'The reactor CRASHES in a test_case'),
+                         [u'reactor', u'crashes', u'test_case'])
+        self.assertEqual(words(None), [])
+
+
+    def test_termCounts(self):
+        """
+        Words in the summary count twice.
+        """
+        self.assertEqual(termCounts(u'kqueue crash', u'crash again'),
+                         {u'kqueue': 2, u'crash': 3, u'again': 1})
+
+
+
+class SimilarTicketsTest(TestCase):
+
+    if not similar.available:
+        skip = 'numpy is not installed'
+
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:')
+        self.db.executescript(open(sibpath(__file__, 'trac_test.sql')).read())
+        self.runner = BlockingRunner(self.db, SqliteTranslator())
+        self.similar = SimilarTickets(self.runner, clock=Clock())
+        changed = yield self.similar.refresh()
+        self.assertEqual(changed, 5)
+
+
+    def numbers(self, *args, **kwargs):
+        return [x[0] for x in self.similar.similar(*args, **kwargs)]
+
+
+    def test_similar(self):
+        """
+        The ticket sharing the most telling words comes first.
+        """
+        self.assertEqual(self.numbers(u'server crash with kqueue')[0], 3312)
+        self.assertEqual(self.numbers(u'FilePath statinfo')[0], 4712)
+        found = self.similar.similar(u'kqueue')
+        self.assertEqual([x[0] for x in found], [3312])
+        self.assertTrue(0 < found[0][1] <= 1)
+
+
+    def test_nothing(self):
+        self.assertEqual(self.similar.similar(u'the'), [])
+        self.assertEqual(self.similar.similar(u'xyzzy plugh'), [])
+
+
+    def test_exclude(self):
+        self.assertEqual(self.numbers(u'kqueue', exclude=3312), [])
+
+
+    def test_limit(self):
+        self.assertEqual(len(self.similar.similar(
+            u'twisted test', u'the reactor', limit=2, minimum=0)), 2)
+
+
+    @defer.inlineCallbacks
+    def test_refresh(self):
+        """
+        Tickets changed by others are picked up, and ones whose text hasn't
+        changed are left alone.
+        """
+        self.db.execute("UPDATE ticket SET summary = 'kqueue woes', "
+                        "changetime = 2000000000 WHERE id = 4712")
+        changed = yield self.similar.refresh()
+        self.assertEqual(changed, 1)
+        self.assertEqual(sorted(self.numbers(u'kqueue')), [3312, 4712])
+        changed = yield self.similar.refresh()
+        self.assertEqual(changed, 0)
+
+
+    @defer.inlineCallbacks
+    def test_bus(self):
+        """
+        Tickets created and edited through a L{TicketStore} with a bus are
+        indexed as soon as they're committed.
+        """
+        bus = Bus()
+        self.similar.subscribe(bus)
+        store = TicketStore(self.runner, 'alice', bus=bus)
+        number = yield store.createTicket({'summary': 'gopher support',
+                                           'description': 'please'})
+        self.assertEqual(self.numbers(u'gopher'), [number])
+        yield store.updateTicket(number, {'summary': 'finger support'})
+        self.assertEqual(self.numbers(u'gopher'), [])
+        self.assertEqual(self.numbers(u'finger'), [number])
+
+
+    def test_stats(self):
+        stats = self.similar.stats()
+        self.assertEqual(stats['entries'], 5)
+        self.assertTrue(stats['bytes'] > 0)
+
+
+
+class SimilarAPITest(TestCase):
+
+    if not similar.available:
+        skip = 'numpy is not installed'
+
+
+    def setUp(self):
+        db = sqlite3.connect(':memory:')
+        db.executescript(open(sibpath(__file__, 'trac_test.sql')).read())
+        self.runner = BlockingRunner(db, SqliteTranslator())
+        self.similar = SimilarTickets(self.runner, clock=Clock())
+        self.api = TicketAPI(self.runner, similar=self.similar)
+
+
+    def get(self, args):
+        request = DummyRequest(['similar'])
+        request.args = dict((k, [v]) for k, v in args.items())
+        return request, self.api.similarTickets(request)
+
+
+    def test_loading(self):
+        request, body = self.get({'summary': 'kqueue'})
+        self.assertEqual(request.responseCode, 503)
+
+
+    def test_similar(self):
+        self.similar.refresh()
+        request, d = self.get({'summary': 'silent kqueue crash'})
+        [ticket] = json.loads(self.successResultOf(d))
+        self.assertEqual(ticket['id'], 3312)
+        self.assertEqual(ticket['summary'],
+                         'Silent server crash with kqueue.reactor')
+        self.assertEqual(ticket['status'], 'closed')
+        self.assertTrue(ticket['score'] > 0)
+
+
+    def test_bad(self):
+        self.similar.refresh()
+        request, body = self.get({'summary': 'kqueue', 'limit': 'lots'})
+        self.assertEqual(request.responseCode, 400)
@@ -0,0 +1,274 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+import sqlite3
+
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer
+from norm.sqlite import SqliteTranslator
+from norm.common import BlockingRunner
+
+from frack.db import NotFoundError
+from frack.spam import (tokenize, formatHeaders, Classifier, SpamFilter,
+                        STATE)
+
+
+# Trac's spam filter tables (and its permission table), as SQLite.
+SCHEMA = '''
+    CREATE TABLE spamfilter_bayes (
+        word text primary key,
+        nspam integer,
+        nham integer);
+    CREATE TABLE spamfilter_log (
+        id integer primary key,
+        time integer,
+        path text,
+        author text,
+        authenticated integer,
+        ipnr text,
+        headers text,
+        content text,
+        rejected integer,
+        karma integer,
+        reasons text);
+    CREATE TABLE permission (
+        username text not null,
+        action text not null);
+'''
+
+SPAM = 'buy cheap pills now at http://pills.example.com/cheap'
+HAM = 'the reactor crashes when kqueue has many clients'
+
+
+
+class TokenizeTest(TestCase):
+
+
+    def test_tokenize(self):
+        self.assertEqual(sorted(tokenize(
+            u'Visit http://www.Example.com/x now, ok? supercalifragilistic')),
+            ['now', 'proto:http', 'skip:s 20', 'url:com', 'url:example',
+             'url:www', 'visit'])
+
+
+
+class FormatHeadersTest(TestCase):
+
+
+    def test_formatHeaders(self):
+        """
+        Headers are logged one to a line, without the ones carrying
+        credentials.
+        """
+        self.assertEqual(formatHeaders({
+            'host': 'example.com',
+            'user-agent': 'spambot',
+            'cookie': 'TRAC_AUTH=secret',
+            'Authorization': 'Basic c2VjcmV0',
+        }), 'host: example.com\nuser-agent: spambot\n')
+
+
+
+class ClassifierTest(TestCase):
+
+
+    def setUp(self):
+        self.classifier = Classifier()
+        for i in range(10):
+            self.classifier.train(SPAM, True)
+            self.classifier.train(HAM, False)
+
+
+    def test_score(self):
+        spam, clues = self.classifier.score('cheap pills')
+        self.assertTrue(spam > 0.9)
+        self.assertEqual(sorted(word for word, p in clues),
+                         ['cheap', 'pills'])
+        ham, clues = self.classifier.score('kqueue crashes')
+        self.assertTrue(ham < 0.1)
+
+
+    def test_unknown(self):
+        """
+        Text with no words worth knowing is neither.
+        """
+        self.assertEqual(self.classifier.score('hello there'), (0.5, []))
+
+
+    def test_load(self):
+        """
+        Counts load from C{spamfilter_bayes} rows, including the number of
+        messages trained.
+        """
+        classifier = Classifier()
+        classifier.load([(STATE, 3, 5), (u'pills', 3, 0), (u'reactor', 0, 5)])
+        self.assertEqual((classifier.nspam, classifier.nham), (3, 5))
+        self.assertEqual(len(classifier), 2)
+        self.assertTrue(classifier.probability('pills') > 0.5)
+        self.assertTrue(classifier.probability('reactor') < 0.5)
+        self.assertEqual(classifier.probability('nonesuch'), 0.5)
+
+
+    def test_stats(self):
+        stats = self.classifier.stats()
+        self.assertEqual(stats['entries'], len(self.classifier))
+        self.assertTrue(stats['bytes'] > 0)
+
+
+
+class SpamFilterTest(TestCase):
+
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:')
+        self.db.executescript(SCHEMA)
+        classifier = Classifier()
+        for i in range(10):
+            classifier.train(SPAM, True)
+            classifier.train(HAM, False)
+        self.db.executemany('INSERT INTO spamfilter_bayes VALUES (?, ?, ?)',
+            [(word.decode('utf-8'), classifier._spam[slot],
+              classifier._ham[slot])
+             for word, slot in classifier._slots.items()] +
+            [(STATE, classifier.nspam, classifier.nham)])
+        self.runner = BlockingRunner(self.db, SqliteTranslator())
+        self.spam = SpamFilter(self.runner, threshold=0.9)
+        self.addCleanup(self.spam.stop)
+        yield self.spam.start()
+
+
+    def check(self, content):
+        return self.spam.check('/tickets/newticket', 'alice', True,
+                               '127.0.0.1', 'Host: example.com\n', content)
+
+
+    def logged(self):
+        return self.db.execute('SELECT content, rejected, author '
+                               'FROM spamfilter_log ORDER BY id').fetchall()
+
+
+    @defer.inlineCallbacks
+    def test_check(self):
+        """
+        Spam is held, ham isn't, and both are logged.
+        """
+        self.assertTrue(self.spam.ready)
+        result = yield self.check(u'cheap pills')
+        self.assertTrue(result['hold'])
+        self.assertTrue(result['score'] > 0.9)
+        result = yield self.check(u'kqueue crashes')
+        self.assertFalse(result['hold'])
+        self.assertEqual(self.logged(), [(u'cheap pills', 1, u'alice'),
+                                         (u'kqueue crashes', 0, u'alice')])
+
+
+    @defer.inlineCallbacks
+    def test_notReady(self):
+        """
+        Until the counts are loaded, nothing is held.
+        """
+        spam = SpamFilter(self.runner)
+        result = yield spam.check('/', 'alice', True, '127.0.0.1', '',
+                                  u'cheap pills')
+        self.assertEqual((result['score'], result['hold']), (0.5, False))
+
+
+    @defer.inlineCallbacks
+    def test_decideHam(self):
+        """
+        A held submission a moderator says is ham is handed back to be
+        made, the classifier learns from it in memory and in the database,
+        and it's no longer held.
+        """
+        result = yield self.check(u'cheap pills')
+        yield self.spam.hold(result['id'], 'update', 5622, 'alice',
+                             {'priority': 'high'}, u'cheap pills', '')
+        [held] = yield self.spam.fetchHeld()
+        self.assertEqual(held['data'], {'priority': 'high'})
+        self.assertEqual(held['ticket'], 5622)
+
+        before = self.spam.classifier.probability('pills')
+        item = yield self.spam.decide(result['id'], False)
+        self.assertEqual(item['comment'], u'cheap pills')
+        self.assertEqual(self.spam.classifier.nham, 11)
+        self.assertTrue(self.spam.classifier.probability('pills') < before)
+        self.assertEqual(self.db.execute(
+            'SELECT nham FROM spamfilter_bayes WHERE word = ?',
+            (STATE,)).fetchall(), [(11,)])
+        self.assertEqual(self.db.execute(
+            "SELECT nspam, nham FROM spamfilter_bayes WHERE word = 'pills'"
+            ).fetchall(), [(10, 1)])
+        self.assertEqual(self.logged()[0][1], 0)
+        held = yield self.spam.fetchHeld()
+        self.assertEqual(held, [])
+
+
+    @defer.inlineCallbacks
+    def test_decideSpam(self):
+        """
+        Spam a moderator confirms is trained as spam, including words never
+        seen before.
+        """
+        result = yield self.check(u'cheap pills zyzzyva')
+        yield self.spam.hold(result['id'], 'create', None, 'alice',
+                             {'summary': 'cheap pills zyzzyva'})
+        yield self.spam.decide(result['id'], True)
+        self.assertEqual(self.spam.classifier.nspam, 11)
+        self.assertEqual(self.db.execute(
+            "SELECT nspam, nham FROM spamfilter_bayes WHERE word = 'zyzzyva'"
+            ).fetchall(), [(1, 0)])
+        self.assertEqual(self.logged()[0][1], 1)
+
+
+    @defer.inlineCallbacks
+    def test_decideTwice(self):
+        """
+        Of two decisions taken on a submission at once, only the first is
+        taken and trained on; the other fails with L{NotFoundError}.
+        """
+        result = yield self.check(u'cheap pills')
+        yield self.spam.hold(result['id'], 'create', None, 'alice',
+                             {'summary': 'cheap pills'})
+        first = self.spam.decide(result['id'], False)
+        second = self.spam.decide(result['id'], False)
+        yield first
+        yield self.assertFailure(second, NotFoundError)
+        self.assertEqual(self.spam.classifier.nham, 11)
+        self.assertEqual(self.db.execute(
+            "SELECT nspam, nham FROM spamfilter_bayes WHERE word = 'pills'"
+            ).fetchall(), [(10, 1)])
+
+
+    @defer.inlineCallbacks
+    def test_decideFails(self):
+        """
+        If the decision can't be saved, the submission is still held and
+        the classifier hasn't learnt from it.
+        """
+        result = yield self.check(u'cheap pills')
+        yield self.spam.hold(result['id'], 'create', None, 'alice',
+                             {'summary': 'cheap pills'})
+        def broken(runner, words, spam):
+            raise RuntimeError('broken')
+        self.patch(self.spam, '_saveCounts', broken)
+        yield self.assertFailure(self.spam.decide(result['id'], False),
+                                 RuntimeError)
+        self.assertEqual(self.spam.classifier.nham, 10)
+        held = yield self.spam.fetchHeld()
+        self.assertEqual(len(held), 1)
+
+
+    def test_decideNotHeld(self):
+        return self.assertFailure(self.spam.decide(1234, True),
+                                  NotFoundError)
+
+
+    @defer.inlineCallbacks
+    def test_isModerator(self):
+        self.db.execute("INSERT INTO permission VALUES ('bob', 'SPAM_ADMIN')")
+        self.db.execute("INSERT INTO permission VALUES ('carol', "
+                        "'TICKET_VIEW')")
+        for user, expected in [('bob', True), ('carol', False),
+                               ('alice', False), (None, False)]:
+            moderator = yield self.spam.isModerator(user)
+            self.assertEqual(moderator, expected)
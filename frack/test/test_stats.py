@@ -0,0 +1,112 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+import sqlite3
+
+from twisted.trial.unittest import TestCase
+from twisted.python.util import sibpath
+from twisted.internet import defer
+from norm.sqlite import SqliteTranslator
+from norm.common import BlockingRunner
+
+from frack.db import TicketStore
+from frack.stats import deltas, rebuild, verify, fetchStats
+
+
+
+class DeltasTest(TestCase):
+
+
+    def test_new(self):
+        self.assertEqual(deltas(None, {'milestone': 'm', 'component': 'core',
+                                       'owner': None, 'status': 'new'}),
+                         [('component', 'core', 'open', 1),
+                          ('milestone', 'm', 'open', 1),
+                          ('owner', '', 'open', 1)])
+
+
+    def test_closed(self):
+        """
+        Closing a ticket moves it from open to closed in each of its counts,
+        and only the fields that change matter otherwise.
+        """
+        old = {'milestone': 'm', 'component': 'core', 'owner': 'alice',
+               'status': 'assigned'}
+        new = dict(old, status='closed', component='web')
+        self.assertEqual(deltas(old, new),
+                         [('component', 'core', 'open', -1),
+                          ('component', 'web', 'closed', 1),
+                          ('milestone', 'm', 'closed', 1),
+                          ('milestone', 'm', 'open', -1),
+                          ('owner', 'alice', 'closed', 1),
+                          ('owner', 'alice', 'open', -1)])
+        self.assertEqual(deltas(old, dict(old, status='reopened')), [])
+
+
+
+class StatsTest(TestCase):
+
+
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:')
+        self.db.executescript(open(sibpath(__file__, 'trac_test.sql')).read())
+        self.runner = BlockingRunner(self.db, SqliteTranslator())
+        self.successResultOf(self.runner.runInteraction(rebuild))
+
+
+    def verify(self):
+        return self.successResultOf(self.runner.runInteraction(verify))
+
+
+    def test_rebuild(self):
+        self.assertEqual(self.verify(), [])
+        counts = self.successResultOf(fetchStats(self.runner))
+        total = sum(x['total'] for x in counts['component'])
+        self.assertEqual(total, 5)
+        for dimension in ['milestone', 'owner']:
+            self.assertEqual(sum(x['total'] for x in counts[dimension]), total)
+
+
+    @defer.inlineCallbacks
+    def test_writes(self):
+        """
+        Tickets created and updated through a L{TicketStore} with C{stats}
+        keep the counts right.
+        """
+        store = TicketStore(self.runner, 'alice', stats=True)
+        number = yield store.createTicket({'summary': 'new',
+                                           'component': 'newthing',
+                                           'milestone': 'next'})
+        self.assertEqual(self.verify(), [])
+        yield store.updateTicket(number, {'status': 'closed',
+                                          'owner': 'alice'}, 'done')
+        yield store.updateTicket(5622, {'milestone': 'next'})
+        self.assertEqual(self.verify(), [])
+
+        counts = yield fetchStats(self.runner)
+        [next] = [x for x in counts['milestone'] if x['name'] == 'next']
+        self.assertEqual(next['closed'], 2)
+        self.assertEqual(next['percent'], 100)
+
+
+    @defer.inlineCallbacks
+    def test_countingFails(self):
+        """
+        A ticket change is kept even if counting it fails.
+        """
+        self.db.execute('DROP TABLE frack_ticket_stats')
+        store = TicketStore(self.runner, 'alice', stats=True)
+        yield store.updateTicket(5622, {'milestone': 'next'})
+        self.assertEqual(len(self.flushLoggedErrors(sqlite3.Error)), 1)
+        ticket = yield store.fetchTicket(5622)
+        self.assertEqual(ticket['milestone'], 'next')
+
+
+    def test_verify(self):
+        """
+        Changes made without keeping the counts are found.
+        """
+        self.db.execute("UPDATE ticket SET owner = 'zed' WHERE id = 3312")
+        wrong = self.verify()
+        self.assertIn(('owner', 'zed', 'closed', 0, 1), wrong)
+        self.successResultOf(self.runner.runInteraction(rebuild))
+        self.assertEqual(self.verify(), [])
@@ -0,0 +1,251 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+import sqlite3
+
+from twisted.trial.unittest import TestCase
+from twisted.python.util import sibpath
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+from twisted.web.resource import Resource, EncodingResourceWrapper
+from twisted.web.server import Site
+from twisted.web.test.test_web import DummyRequest
+from norm.sqlite import SqliteTranslator
+from norm.common import BlockingRunner
+
+from frack.db import NotFoundError
+from frack.web import (ticketValidators, setValidatorHeaders, TicketApp,
+                       TracAuthWrapper, setEmail, getEmail, setSession)
+from frack.session import SessionStore, COOKIE_NAME
+from frack.test.test_session import CookieRequest
+from frack.cache import TieredCache, LRUCache
+from frack.compression import CompressingEncoderFactory
+from frack.api import jsonResponse
+
+
+VERSION = {
+    'changetime': 1300000000,
+    'attachment_count': 1,
+    'attachment_time': 1200000000,
+}
+
+
+
+class ValidatorsTest(TestCase):
+
+
+    def test_ticketValidators(self):
+        etag, last_modified = ticketValidators(VERSION, None)
+        self.assertTrue(etag.startswith('"') and etag.endswith('"'))
+        self.assertEqual(last_modified, 1300000000)
+        self.assertEqual(ticketValidators(VERSION, None), (etag,
+                                                           last_modified))
+        changed = dict(VERSION, attachment_count=2)
+        self.assertNotEqual(ticketValidators(changed, None)[0], etag)
+
+
+    def test_viewer(self):
+        """
+        Pages rendered for different visitors, whether logged in with a
+        username or only an email address, have different ETags.
+        """
+        etags = set([
+            ticketValidators(VERSION, None)[0],
+            ticketValidators(VERSION, u'alice')[0],
+            ticketValidators(VERSION, u'bob')[0],
+            ticketValidators(VERSION, None, u'alice@example.com')[0],
+            ticketValidators(VERSION, u'alice', u'alice@example.com')[0],
+        ])
+        self.assertEqual(len(etags), 5)
+
+
+    def test_setValidatorHeaders(self):
+        request = DummyRequest([''])
+        setValidatorHeaders(request, '"x"', 1300000000, False)
+        headers = request.responseHeaders
+        self.assertEqual(headers.getRawHeaders('etag'), ['"x"'])
+        self.assertEqual(headers.getRawHeaders('last-modified'),
+                         ['Sun, 13 Mar 2011 07:06:40 GMT'])
+        self.assertEqual(headers.getRawHeaders('cache-control'),
+                         ['no-cache'])
+
+        request = DummyRequest([''])
+        setValidatorHeaders(request, '"x"', 1300000000, True)
+        self.assertEqual(request.responseHeaders.getRawHeaders(
+            'cache-control'), ['private, no-cache'])
+
+
+    def test_vary(self):
+        """
+        Pages vary by cookie as well as by whatever they already varied by.
+        """
+        request = DummyRequest([''])
+        request.setHeader('Vary', 'Accept-Encoding')
+        setValidatorHeaders(request, '"x"', 1300000000, False)
+        self.assertEqual(request.responseHeaders.getRawHeaders('vary'),
+                         ['Accept-Encoding, Cookie'])
+
+
+
+class SetEmailTest(TestCase):
+
+
+    def test_login(self):
+        """
+        Logging in or out moves the visitor's session to a new id.
+        """
+        db = sqlite3.connect(':memory:')
+        db.executescript(open(sibpath(__file__, 'trac_test.sql')).read())
+        store = SessionStore(BlockingRunner(db, SqliteTranslator()),
+                             clock=Clock())
+        request = CookieRequest()
+        setSession(request, self.successResultOf(store.forRequest(request)))
+        setEmail('foo@example.com', request)
+        first = request.added[COOKIE_NAME]
+        self.assertEqual(getEmail(request), 'foo@example.com')
+
+        setEmail(None, request)
+        self.assertNotEqual(request.added[COOKIE_NAME], first)
+        self.assertEqual(getEmail(request), None)
+
+
+    def test_noSession(self):
+        """
+        Logging in without a session to remember it in is an error.
+        """
+        request = DummyRequest([''])
+        self.assertRaises(RuntimeError, setEmail, 'foo@example.com', request)
+        self.assertEqual(setEmail(None, request), None)
+
+
+
+class PausedRunner(object):
+    """
+    A runner whose interactions wait until L{resume} is called.
+    """
+
+    def __init__(self, runner):
+        self.runner = runner
+        self.paused = []
+
+
+    def runInteraction(self, *args, **kwargs):
+        d = defer.Deferred()
+        self.paused.append((d, args, kwargs))
+        return d
+
+
+    def resume(self):
+        paused, self.paused = self.paused, []
+        for d, args, kwargs in paused:
+            self.runner.runInteraction(*args, **kwargs).chainDeferred(d)
+
+
+
+class TicketCacheTest(TestCase):
+
+
+    def setUp(self):
+        db = sqlite3.connect(':memory:')
+        db.executescript(open(sibpath(__file__, 'trac_test.sql')).read())
+        self.runner = PausedRunner(BlockingRunner(db, SqliteTranslator()))
+        clock = Clock()
+        self.cache = TieredCache(LRUCache(10, clock=clock), clock=clock)
+        self.app = TicketApp(self.runner, None, None, None, cache=self.cache)
+
+
+    def test_cached(self):
+        d = self.app.tickets.get(5622)
+        self.runner.resume()
+        ticket = self.successResultOf(d)
+        self.assertEqual(self.successResultOf(self.cache.get('ticket:5622')),
+                         ticket)
+
+
+    def test_changedWhileFetching(self):
+        """
+        A ticket which changes while it's being fetched isn't cached, since
+        what was read may be from before the change.
+        """
+        d = self.app.tickets.get(5622)
+        self.app.bus.publish({'kind': 'update', 'ticket': 5622})
+        self.runner.resume()
+        self.successResultOf(d)
+        self.assertEqual(self.successResultOf(self.cache.get('ticket:5622')),
+                         None)
+
+        d = self.app.tickets.get(5622)
+        self.cache._notify('ticket:5622')
+        self.runner.resume()
+        self.successResultOf(d)
+        self.assertEqual(self.successResultOf(self.cache.get('ticket:5622')),
+                         None)
+
+        d = self.app.tickets.get(5622)
+        self.runner.resume()
+        self.assertEqual(self.successResultOf(self.cache.get('ticket:5622')),
+                         self.successResultOf(d))
+
+
+
+class AnonymousStore(object):
+    """
+    An auth store which knows no one.
+    """
+
+    def usernameFromCookie(self, cookie):
+        return defer.fail(NotFoundError(cookie))
+
+
+
+class JSONResource(Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        return jsonResponse({'data': 'x' * 2000}, request)
+
+
+
+class CompressionTest(TestCase):
+
+
+    def get(self, headers):
+        """
+        Get a response from a site serving L{JSONResource} as it's served
+        by L{frack.wiring}.
+
+        @return: The response's status line and a dict of its headers.
+        """
+        root = Resource()
+        root.putChild('api', TracAuthWrapper(AnonymousStore(),
+            EncodingResourceWrapper(JSONResource(),
+                                    [CompressingEncoderFactory()])))
+        protocol = Site(root, timeout=None).buildProtocol(None)
+        transport = StringTransport()
+        protocol.makeConnection(transport)
+        protocol.dataReceived('GET /api/x HTTP/1.1\r\nHost: example.com\r\n'
+                              + ''.join('%s: %s\r\n' % x for x in headers)
+                              + '\r\n')
+        head = transport.value().split('\r\n\r\n', 1)[0].split('\r\n')
+        return head[0], dict(x.lower().split(': ', 1) for x in head[1:])
+
+
+    def test_compressed(self):
+        """
+        Responses behind a L{TracAuthWrapper} are compressed, and a client
+        revalidating the compressed one is answered 304 with its ETag.
+        """
+        status, headers = self.get([('Accept-Encoding', 'gzip')])
+        self.assertEqual(status, 'HTTP/1.1 200 OK')
+        self.assertEqual(headers['content-encoding'], 'gzip')
+        etag = headers['etag']
+        self.assertTrue(etag.endswith('-gzip"'))
+
+        status, headers = self.get([('Accept-Encoding', 'gzip'),
+                                    ('If-None-Match', etag)])
+        self.assertEqual(status, 'HTTP/1.1 304 Not Modified')
+        self.assertEqual(headers['etag'], etag)
+
+        status, headers = self.get([('If-None-Match', etag)])
+        self.assertEqual(status, 'HTTP/1.1 200 OK')
+        self.assertNotIn('content-encoding', headers)
@@ -0,0 +1,293 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+import os
+import json
+import shutil
+import socket
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.internet.error import ProcessTerminated
+from twisted.test.proto_helpers import StringTransport
+from twisted.python.usage import UsageError
+
+from frack.workers import (parseTCP, workerArguments, Supervisor,
+                           WorkerProtocol, WorkerControl, METRICS_FD)
+from frack.metrics import Metrics, aggregate
+from frack.service import Options, makeService
+
+
+
+class ParseTCPTest(TestCase):
+
+
+    def test_parse(self):
+        self.assertEqual(parseTCP('tcp:1353'), (1353, ''))
+        self.assertEqual(parseTCP('tcp:port=80:interface=127.0.0.1'),
+                         (80, '127.0.0.1'))
+        self.assertEqual(parseTCP('tcp:8080:backlog=50'), (8080, ''))
+
+
+    def test_notTCP(self):
+        self.assertRaises(ValueError, parseTCP, 'unix:/tmp/frack.sock')
+        self.assertRaises(ValueError, parseTCP, 'tcp:interface=::1')
+
+
+
+class WorkerArgumentsTest(TestCase):
+
+
+    def test_arguments(self):
+        """
+        Workers get the supervisor's options except those about the
+        supervisor itself.
+        """
+        config = Options()
+        config.parseOptions(['--sqlite_db=trac.db', '--workers=4',
+                             '--web=tcp:8080', '--postgres_async'])
+        args = workerArguments(config)
+        self.assertIn('--sqlite_db=trac.db', args)
+        self.assertIn('--postgres_async', args)
+        self.assertEqual([x for x in args if x.startswith('--web')
+                          or x.startswith('--workers')], [])
+
+
+
+class FakeTransport(object):
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.signals = []
+        self.written = []
+
+
+    def write(self, data):
+        self.written.append(data)
+
+
+    def signalProcess(self, sig):
+        self.signals.append(sig)
+
+
+
+class FakeSupervisor(Supervisor):
+    """
+    A supervisor which doesn't really start processes.
+    """
+
+    def spawn(self):
+        worker = WorkerProtocol(self)
+        worker.transport = FakeTransport(worker)
+        self.workers.append(worker)
+        worker.ready.addCallback(self._workerReady)
+        self.spawned.append(worker)
+        return worker
+
+
+
+class SupervisorTest(TestCase):
+
+
+    def setUp(self):
+        self.clock = Clock()
+        self.supervisor = FakeSupervisor(2, 'tcp:0', [], reactor=self.clock)
+        self.supervisor.spawned = []
+        for i in range(2):
+            self.supervisor.spawn()
+
+
+    def report(self, worker, **data):
+        worker.childDataReceived(METRICS_FD, json.dumps(data) + '\n')
+
+
+    def die(self, worker):
+        worker.processEnded(Failure(ProcessTerminated(signal=9)))
+
+
+    def test_restart(self):
+        """
+        A worker which dies is replaced.
+        """
+        first = self.supervisor.workers[0]
+        self.report(first, pid=1)
+        self.die(first)
+        self.assertEqual(len(self.supervisor.workers), 1)
+        self.clock.advance(self.supervisor.backoff)
+        self.assertEqual(len(self.supervisor.workers), 2)
+        self.assertEqual(self.supervisor.restarts, 1)
+
+
+    def test_backoff(self):
+        """
+        Workers which die before they're ready are replaced more and more
+        slowly.
+        """
+        self.die(self.supervisor.workers[0])
+        self.clock.advance(1)
+        self.die(self.supervisor.workers[-1])
+        self.clock.advance(1)
+        self.assertEqual(len(self.supervisor.workers), 1)
+        self.clock.advance(1)
+        self.assertEqual(len(self.supervisor.workers), 2)
+
+
+    def test_rollingRestart(self):
+        """
+        Each worker is stopped once its replacement is ready.
+        """
+        old = list(self.supervisor.workers)
+        d = self.supervisor.rollingRestart()
+        new = self.supervisor.spawned[-1]
+        self.assertEqual(old[0].transport.signals, [])
+
+        self.report(new, pid=3)
+        self.assertEqual(old[0].transport.signals, ['TERM'])
+        self.assertEqual(old[1].transport.signals, [])
+        self.die(old[0])
+
+        newer = self.supervisor.spawned[-1]
+        self.report(newer, pid=4)
+        self.die(old[1])
+        self.successResultOf(d)
+        self.assertEqual(self.supervisor.workers, [new, newer])
+        self.assertEqual(self.supervisor.restarts, 0)
+
+
+    def test_metrics(self):
+        """
+        The workers' metrics are added up.
+        """
+        first, second = self.supervisor.workers
+        self.report(first, pid=1, requests=3)
+        self.report(second, pid=2, requests=4)
+        metrics = self.supervisor.metrics()
+        self.assertEqual(metrics['requests'], 7)
+        self.assertEqual(metrics['worker_count'], 2)
+        self.assertEqual([x['pid'] for x in metrics['workers']], [1, 2])
+
+
+    def test_profile(self):
+        """
+        Profiling sends the worker with the given process ID a command, and
+        fires with its reply.
+        """
+        first, second = self.supervisor.workers
+        self.report(first, pid=1)
+        self.report(second, pid=2)
+        d = self.supervisor.profile(5, 'collapsed', 0.01, pid=2)
+        [line] = second.transport.written
+        command = json.loads(line)
+        self.assertEqual(command['command'], 'profile')
+        self.assertEqual(command['seconds'], 5)
+        self.assertNoResult(d)
+
+        second.childDataReceived(METRICS_FD, json.dumps(
+            {'reply': command['id'], 'result': 'a;b 1\n'}) + '\n')
+        self.assertEqual(self.successResultOf(d), 'a;b 1\n')
+        self.assertEqual(second.metrics, {'pid': 2})
+        self.assertRaises(ValueError, self.supervisor.profile, 5, pid=3)
+
+
+    def test_profileError(self):
+        """
+        Errors reported by the worker, or its dying, fail the profile.
+        """
+        first, second = self.supervisor.workers
+        self.report(first, pid=1)
+        d = self.supervisor.profile(5)
+        command = json.loads(first.transport.written[0])
+        first.childDataReceived(METRICS_FD, json.dumps(
+            {'reply': command['id'], 'error': 'busy'}) + '\n')
+        self.failureResultOf(d, ValueError)
+
+        d = self.supervisor.profile(5)
+        self.die(first)
+        self.failureResultOf(d, ProcessTerminated)
+
+
+    def test_tempDirectory(self):
+        """
+        Without a C{--cache_path}, workers share a cache in a new directory
+        only this user can use, which is removed once they've stopped.
+        """
+        config = Options()
+        config.parseOptions(['--sqlite_db=trac.db', '--workers=2',
+                             '--web=tcp:0'])
+        supervisor = makeService(config)
+        path = supervisor.tempDirectory
+        self.addCleanup(shutil.rmtree, path, True)
+        self.assertEqual(os.stat(path).st_mode & 0777, 0700)
+        cache = os.path.join(path, 'cache.sqlite')
+        self.assertIn('--cache_path=%s' % (cache,), supervisor.workerArgs)
+
+        supervisor.socket = socket.socket()
+        self.successResultOf(supervisor.stopService())
+        self.assertFalse(os.path.exists(path))
+
+
+
+class MakeServiceTest(TestCase):
+
+
+    def test_blockingAdmission(self):
+        """
+        Database work isn't queued for a turn when the runner does it one
+        thing at a time anyway.
+        """
+        config = Options()
+        config.parseOptions(['--sqlite_db=%s' % (self.mktemp(),),
+                             '--web=tcp:0'])
+        service = makeService(config)
+        self.assertIdentical(service.web.admission, None)
+        self.assertIdentical(service.web.admitted('read'), service.dbRunner)
+
+
+    def test_adminToken(self):
+        """
+        The admin endpoint isn't served without a token.
+        """
+        config = Options()
+        config.parseOptions(['--sqlite_db=trac.db', '--admin=tcp:0'])
+        self.assertRaises(UsageError, makeService, config)
+
+
+
+class WorkerControlTest(TestCase):
+
+
+    def test_command(self):
+        """
+        Commands from the supervisor are run and answered.
+        """
+        calls = []
+        control = WorkerControl(lambda **kw: calls.append(kw) or 'profile')
+        control.makeConnection(StringTransport())
+        control.dataReceived(json.dumps(
+            {'id': 3, 'command': 'profile', 'seconds': 1}) + '\n')
+        self.assertEqual(calls, [{'seconds': 1}])
+        self.assertEqual(json.loads(control.transport.value()),
+                         {'reply': 3, 'result': 'profile'})
+
+
+
+class MetricsTest(TestCase):
+
+
+    def test_snapshot(self):
+        metrics = Metrics()
+        metrics.increment('requests')
+        metrics.increment('requests', 2)
+        metrics.gauge('answer', lambda: 42)
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['requests'], 3)
+        self.assertEqual(snapshot['answer'], 42)
+        self.assertIn('pid', snapshot)
+
+
+    def test_aggregate(self):
+        totals = aggregate([{'pid': 2, 'requests': 1, 'name': 'x'},
+                            {'pid': 1, 'requests': 2}])
+        self.assertEqual(totals['requests'], 3)
+        self.assertNotIn('pid', totals)
+        self.assertNotIn('name', totals)
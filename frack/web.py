@@ -7,7 +7,7 @@ Klein-based web service
 import time
 import cgi
 import json
-import requests
+import hashlib
 from email import utils
 from datetime import datetime
 from urllib import quote_plus
@@ -16,9 +16,18 @@ from klein import Klein
 
 from twisted.web.resource import NoResource, Resource
 from twisted.web.util import DeferredResource
-from twisted.internet import defer, threads
+from twisted.internet import defer
 
-from frack.db import NotFoundError, TicketStore, AuthStore, UnauthorizedError
+from frack.db import NotFoundError, TicketStore, AuthStore
+from frack.loader import PageLoader
+from frack.cache import SingleFlight, LRUCache
+from frack.pubsub import Bus
+from frack.sse import EventStream
+from frack.persona import PersonaVerifier
+from frack.admission import Overloaded, ANONYMOUS_READ
+from frack.compression import addVary, matchingETag, useEncoder
+from frack.spam import formatHeaders
+from frack import stats
 
 
 #------------------------------------------------------------------------------
@@ -27,14 +36,17 @@ from frack.db import NotFoundError, TicketStore, AuthStore, UnauthorizedError
 class TracAuthWrapper(Resource):
 
 
-    def __init__(self, store, child):
+    def __init__(self, store, child, sessions=None):
         """
         @param store: An AuthStore instance.
         @param child: The resource being wrapped.
+        @param sessions: A L{frack.session.SessionStore} to load visitors'
+            sessions from, or C{None} to do without.
         """
         Resource.__init__(self)
         self.store = store
         self.child = child
+        self.sessions = sessions
 
 
     def render(self, request):
@@ -50,12 +62,16 @@ class TracAuthWrapper(Resource):
 
     @defer.inlineCallbacks
     def _associateUser(self, request):
+        if self.sessions is not None:
+            session = yield self.sessions.forRequest(request)
+            setSession(request, session)
         cookie_value = request.getCookie('trac_auth')
         try:
             username = yield self.store.usernameFromCookie(cookie_value)
             setUser(request, username)
         except NotFoundError:
             setUser(request, None)
+        useEncoder(request, self.child)
         defer.returnValue(self.child)
 
 
@@ -82,14 +98,37 @@ def getUser(request):
     return getattr(request, 'authenticated_user', None)
 
 
+def setSession(request, session):
+    """
+    Associate this request with a visitor's L{frack.session.Session}.
+    """
+    request.frack_session = session
+
+
+def getSession(request):
+    """
+    Get the L{frack.session.Session} for this request, or C{None} if it
+    wasn't loaded.
+    """
+    return getattr(request, 'frack_session', None)
+
+
 def setEmail(email, request):
     """
     Associate an already-authenticated email address with this
-    request's session.
+    request's session, moving the session to a new id as the visitor is
+    now someone else.
+
+    @raise RuntimeError: If the request has no session to keep it in.
     """
-    session = request.getSession()
-    # XXX very bad, do sessions the right way, eh?
-    session.persona_email = email
+    session = getSession(request)
+    if session is None:
+        if email is None:
+            return email
+        raise RuntimeError('No session to keep the email address in; '
+                           'is TracAuthWrapper missing its SessionStore?')
+    session.rotate()
+    session.set('email', email)
     return email
 
 
@@ -98,8 +137,32 @@ def getEmail(request):
     Get the already-authenticated email address associated with this
     request.
     """
-    session = request.getSession()
-    return getattr(session, 'persona_email', None)
+    session = getSession(request)
+    if session is None:
+        return None
+    return session.get('email')
+
+
+def saveSession(result, request):
+    """
+    Write this request's session now, so that other processes see it.
+
+    @return: A Deferred which fires with C{result} once it's written.
+    """
+    session = getSession(request)
+    if session is None:
+        return defer.succeed(result)
+    return session.save().addCallback(lambda ignored: result)
+
+
+def overloadedResponse(request, failure):
+    """
+    Tell the client that an L{Overloaded} request should be tried again
+    later.
+    """
+    request.setResponseCode(503)
+    request.setHeader('Retry-After', str(failure.value.retryAfter))
+    return 'Too busy right now.  Please try again in a moment.'
 
 
 #------------------------------------------------------------------------------
@@ -109,8 +172,13 @@ def getEmail(request):
 class Renderer(object):
 
 
-    def __init__(self, jinja_env):
+    def __init__(self, jinja_env, manifest=None):
+        """
+        @param manifest: A dict mapping static file names to their
+            fingerprinted names (see L{frack.assets.build}).
+        """
         self.jinja_env = jinja_env
+        self.manifest = manifest or {}
         self.jinja_env.globals['static_root'] = '/static'
         self.jinja_env.globals['attachment_root'] = '/files'
         self.jinja_env.globals['raw_attachment_root'] = '/files'
@@ -120,6 +188,16 @@ class Renderer(object):
         self.jinja_env.filters['ago'] = relativeTime
         self.jinja_env.filters['isotime'] = isolikeTime
         self.jinja_env.filters['urlencode'] = quote_plus
+        self.jinja_env.filters['static'] = self.staticURL
+
+
+    def staticURL(self, name):
+        """
+        Get the URL of a static file, using its fingerprinted name if it has
+        one.
+        """
+        return '%s/%s' % (self.jinja_env.globals['static_root'],
+                          self.manifest.get(name, name))
 
 
     def render(self, request, name, params=None):
@@ -129,25 +207,70 @@ class Renderer(object):
             'urlpath': request.URLPath(),
             'logged_in_email': getEmail(request),
         })
+        # only wait on the values that aren't ready yet
+        keys = []
         dlist = []
-        for k,v in list(params.items()):
-            # I'm just making them all deferred so that the list is homogeneous.
-            # If it's slowing things down too much, then fix it.
-            d = defer.maybeDeferred(lambda:v).addCallback(lambda v:(k,v))
-            dlist.append(d)
+        for k,v in params.items():
+            if isinstance(v, defer.Deferred):
+                keys.append(k)
+                dlist.append(v)
+        if not dlist:
+            return defer.maybeDeferred(self._render, params, request, name)
         d = defer.gatherResults(dlist, consumeErrors=True)
 
         # Give me the first error, not a FirstError
         d.addErrback(lambda err: err.value.subFailure)
-        return d.addCallback(self._render, request, name)
+        d.addCallback(lambda values: params.update(zip(keys, values)))
+        return d.addCallback(lambda _: self._render(params, request, name))
 
 
-    def _render(self, items, request, name):
-        params = dict(items)
+    def _render(self, params, request, name):
         template = self.jinja_env.get_template(name)
         return template.render(params).encode('utf-8')
 
 
+#------------------------------------------------------------------------------
+# HTTP caching
+
+def ticketValidators(version, user, email=None):
+    """
+    Compute the validators for a ticket page.  The page shows who it's
+    rendered for, so they're part of the validators.
+
+    @param version: A dict like the one returned by
+        L{TicketStore.fetchTicketVersion}.
+    @param user: The username the page is being rendered for (or C{None}).
+    @param email: The email address the visitor has logged in with (or
+        C{None}).
+
+    @return: A tuple of C{(etag, last_modified)} where C{etag} is a quoted
+        string and C{last_modified} is seconds since the epoch.
+    """
+    key = '%(changetime)s:%(attachment_count)s:%(attachment_time)s' % version
+    key += ':' + (user or '').encode('utf-8')
+    key += ':' + (email or '').encode('utf-8')
+    etag = '"%s"' % (hashlib.sha1(key).hexdigest(),)
+    last_modified = max(version['changetime'], version['attachment_time'])
+    return etag, last_modified
+
+
+def setValidatorHeaders(request, etag, last_modified, private):
+    """
+    Set the headers which let browsers and proxies revalidate a page instead
+    of fetching it again.
+
+    @param private: Whether the page is only for this visitor.
+    """
+    request.setHeader('ETag', etag)
+    request.setHeader('Last-Modified', utils.formatdate(last_modified,
+                                                        usegmt=True))
+    addVary(request, 'Cookie')
+    if private:
+        request.setHeader('Cache-Control', 'private, no-cache')
+    else:
+        request.setHeader('Cache-Control', 'no-cache')
+
+
 #------------------------------------------------------------------------------
 # Jinja filters
 
@@ -247,14 +370,55 @@ class FakeAuthenticatorDontActuallyUseExceptForTesting(Resource):
 class TicketApp(object):
 
     app = Klein()
+    ticket_cache_ttl = 300
+    choices_cache_ttl = 3600
 
 
-    def __init__(self, runner, renderer, file_store, frackRootPath):
+    def __init__(self, runner, renderer, file_store, frackRootPath,
+                 ticket_freshness=0, comment_window=25, bus=None, cache=None,
+                 admission=None, ticket_stats=False, snapshots=False,
+                 spam=None):
+        """
+        @param ticket_freshness: Number of seconds a fetched ticket may be
+            shown to other viewers before it's fetched again.  Concurrent
+            fetches of the same ticket are always shared.
+        @param comment_window: Number of comments shown at the start and at
+            the end of a ticket page.  The ones in between are loaded on
+            demand, this many at a time.
+        @param bus: The L{frack.pubsub.Bus} ticket changes are published on.
+            Cached tickets are forgotten when they change, and watchers of
+            the event streams are told.
+        @param cache: A L{frack.cache.TieredCache} to keep tickets in for
+            C{ticket_cache_ttl} seconds, or C{None}.
+        @param admission: An L{frack.admission.AdmissionController} which
+            database work must wait for, or C{None}.
+        @param ticket_stats: If C{True}, keep the counts of L{frack.stats}
+            up to date and show them at C{/stats}.
+        @param snapshots: If C{True}, use the snapshots of L{frack.history}
+            for ticket history.
+        @param spam: A L{frack.spam.SpamFilter} to check new tickets and
+            comments with, or C{None}.  Moderators decide on the ones it
+            holds at C{/spam}.
+        """
         self.runner = runner
+        self.admission = admission
+        self.ticket_stats = ticket_stats
+        self.snapshots = snapshots
+        self.spam = spam
+        self.bus = bus if bus is not None else Bus()
+        self.events = EventStream(self.bus)
+        self.comment_window = comment_window
         self.file_store = file_store
-        self._cache = {}
-        self._userList = None
-        self._userList_lastModified = None
+        self.tickets = SingleFlight(self._fetchTicket, ticket_freshness)
+        self.bus.subscribe(self._ticketChanged)
+        self.cache = cache
+        if cache is not None:
+            cache.onInvalidate(self._cacheInvalidated)
+        # Ticket number -> number of times it's been invalidated, so that a
+        # fetch which an invalidation overtook isn't cached.
+        self._generations = {}
+        # Components, milestones, enums and the user list.
+        self.choices = LRUCache(100)
         self.renderer = renderer
         self.frackRootPath = frackRootPath
 
@@ -265,30 +429,90 @@ class TicketApp(object):
         Get the list of users and the last time the list was modified returned
         as a deferred tuple.
         """
-        if self._userList is None or self._userList_lastModified:
+        cached = self.choices.peek('users')
+        if cached is None or cached[1]:
             # need to refresh it
-            store = TicketStore(self.runner, getUser(request))
+            store = TicketStore(self.runnerFor(request), getUser(request))
+            started = time.time()
             new_list = yield store.userList()
-            self._userList = list(new_list)
-            self._userList_lastModified = time.time()
+            cached = (list(new_list), time.time())
+            self.choices.set('users', cached, self.choices_cache_ttl,
+                             cached[1] - started)
 
-        defer.returnValue((self._userList, self._userList_lastModified))
+        defer.returnValue(cached)
 
 
     def render(self, *args, **kwargs):
         return self.renderer.render(*args, **kwargs)
 
 
+    def runnerFor(self, request, kind='read'):
+        """
+        Get the runner to use for a request's database work.
+
+        @param kind: The class of work: C{'read'} or C{'write'}.
+        """
+        if self.admission is None:
+            return self.runner
+        priority = None
+        if request is None or (kind == 'read' and not getUser(request)):
+            priority = ANONYMOUS_READ
+        return self.admission.runner(self.runner, kind, priority)
+
+
+    @app.handle_errors(Overloaded)
+    def overloaded(self, request, failure):
+        return overloadedResponse(request, failure)
+
+
+    def _fetchTicket(self, ticket_number):
+        # Tickets look the same to everyone, so no user is needed.
+        store = TicketStore(self.runnerFor(None), None)
+        if self.cache is None:
+            return store.fetchTicketWindowed(ticket_number,
+                                             self.comment_window)
+        key = 'ticket:%d' % (ticket_number,)
+        generation = self._generations.get(ticket_number, 0)
+        def cached(ticket):
+            if ticket is not None:
+                return ticket
+            d = store.fetchTicketWindowed(ticket_number, self.comment_window)
+            return d.addCallback(remember, time.time())
+        def remember(ticket, started):
+            if self._generations.get(ticket_number, 0) != generation:
+                # It changed while we were reading it, so this may be stale.
+                return ticket
+            d = self.cache.set(key, ticket, self.ticket_cache_ttl,
+                               time.time() - started)
+            return d.addCallback(lambda ignored: ticket)
+        return self.cache.get(key).addCallback(cached)
+
+
+    def _invalidated(self, ticket_number):
+        self.tickets.invalidate(ticket_number)
+        self._generations[ticket_number] = (
+            self._generations.get(ticket_number, 0) + 1)
+
+
+    def _ticketChanged(self, event):
+        self._invalidated(event['ticket'])
+        if self.cache is not None:
+            self.cache.invalidate('ticket:%d' % (event['ticket'],))
+
+
+    def _cacheInvalidated(self, key):
+        # Another process changed a ticket.
+        if key.startswith('ticket:'):
+            self._invalidated(int(key[len('ticket:'):]))
+
+
     @app.route('/newticket', methods=['GET'])
-    def create_GET(self, request):        
-        return self.render(request, 'ticket_create.html', {
-            'components': self.getComponents(request),
-            'milestones': self.getMilestones(request),
-            'severities': self.getSeverities(request),
-            'priorities': self.getPriorities(request),
-            'resolutions': self.getResolutions(request),
-            'ticket_types': self.getTicketTypes(request),
-        })
+    def create_GET(self, request):
+        store = TicketStore(self.runnerFor(request), getUser(request))
+        loader = PageLoader(self.runnerFor(request))
+        params = self.getMetadata(store, loader)
+        loader.dispatch()
+        return self.render(request, 'ticket_create.html', params)
 
     @app.route('/newticket', methods=['POST'])
     def create_POST(self, request):
@@ -312,13 +536,20 @@ class TicketApp(object):
             'branch_author': one('field_branch_author'),
             'launchpad_bug': one('field_launchpad_bug'),
         }
-        store = TicketStore(self.runner, getUser(request))
-        d = store.createTicket(data)
-
+        store = TicketStore(self.runnerFor(request, 'write'), getUser(request),
+                            bus=self.bus, stats=self.ticket_stats)
+        d = self._checkSpam(request, 'create', None, data,
+                            data['summary'] + '\n' + data['description'])
+
+        def checked(held):
+            if held:
+                return held
+            d = store.createTicket(data)
+            return d.addCallback(created, request)
         def created(ticket_number, request):
             request.redirect('ticket/%d' % (ticket_number,))
         # XXX return something nice when not authenticated.
-        return d.addCallback(created, request)
+        return d.addCallback(checked)
 
 
     @app.route('/users', methods=['GET', 'HEAD'])
@@ -347,35 +578,224 @@ class TicketApp(object):
         })
 
 
+    @app.route('/stats', methods=['GET'])
+    def stats_GET(self, request):
+        """
+        Show open and closed counts per milestone, component and owner.
+        """
+        if not self.ticket_stats:
+            return NoResource().render(request)
+        d = stats.fetchStats(self.runnerFor(request))
+        return d.addCallback(lambda counts: self.render(request, 'stats.html',
+                                                        {'stats': counts}))
+
+
     @app.route('/ticket/<int:ticket_number>', methods=['GET'])
     def ticket_GET(self, request, ticket_number):
         user = getUser(request)
-        store = TicketStore(self.runner, user)
+        store = TicketStore(self.runnerFor(request), user)
+
+        if (request.getHeader('if-none-match')
+                or request.getHeader('if-modified-since')):
+            # a cheap query is enough to tell if they already have it
+            d = store.fetchTicketVersion(ticket_number)
+            d.addCallback(self._checkNotModified, request, user)
+        else:
+            d = defer.succeed(False)
+        d.addCallback(self._ticketPage, request, store, ticket_number)
+        return d.addErrback(self._notFound, request)
 
+
+    def _checkNotModified(self, version, request, user):
+        """
+        Set the validator headers for a ticket page and answer 304 if the
+        client's copy is current.
+
+        @param version: A dict as returned by L{TicketStore.fetchTicketVersion}.
+
+        @return: C{True} if a 304 was sent.
+        """
+        email = getEmail(request)
+        etag, last_modified = ticketValidators(version, user, email)
+        setValidatorHeaders(request, etag, last_modified, user or email)
+
+        if request.getHeader('if-none-match'):
+            matched = matchingETag(request, etag)
+            not_modified = matched is not None
+            if not_modified:
+                request.setHeader('ETag', matched)
+        else:
+            parsed = utils.parsedate_tz(request.getHeader('if-modified-since'))
+            not_modified = (parsed is not None
+                            and last_modified <= utils.mktime_tz(parsed))
+        if not_modified:
+            request.setResponseCode(304)
+        return not_modified
+
+
+    def _ticketPage(self, not_modified, request, store, ticket_number):
+        if not_modified:
+            return ''
+        user = getUser(request)
+        email = getEmail(request)
+
+        # The ticket itself comes from self.tickets, which is shared with
+        # other requests; everything else the page needs is batched.
+        loader = PageLoader(self.runnerFor(request))
         replyto = request.args.get('replyto', [''])[0]
+        replyto_comment = None
         if replyto:
             replyto = int(replyto)
+            replyto_comment = loader.load(store.fetchComment, ticket_number,
+                                          str(replyto))
+            def noComment(err):
+                err.trap(NotFoundError)
+                return None
+            replyto_comment.addErrback(noComment)
 
         def mergeCommentsAndAttachments(ticket):
-            ticket['commentsAndAttachments'] = sorted(ticket['comments'] + ticket['attachments'], key=lambda x:x['time'])
+            etag, last_modified = ticketValidators({
+                'changetime': ticket['changetime'],
+                'attachment_count': len(ticket['attachments']),
+                'attachment_time': max([x['time'] for x in
+                                        ticket['attachments']] or [None]),
+            }, user, email)
+            setValidatorHeaders(request, etag, last_modified, user or email)
+
+            # the fetched ticket is shared with other viewers
+            ticket = dict(ticket)
+            ticket['commentsAndAttachments'] = self._mergeCommentsAndAttachments(ticket)
             return ticket
 
-        return self.render(request, 'ticket.html', {
-            'ticket': store.fetchTicket(ticket_number).addCallback(mergeCommentsAndAttachments),
+        params = self.getMetadata(store, loader)
+        params.update({
+            'ticket': self.tickets.get(ticket_number).addCallback(mergeCommentsAndAttachments),
             'replyto': replyto,
-            'components': self.getComponents(request),
-            'milestones': self.getMilestones(request),
-            'severities': self.getSeverities(request),
-            'priorities': self.getPriorities(request),
-            'resolutions': self.getResolutions(request),
-            'ticket_types': self.getTicketTypes(request),
-        }).addErrback(self._notFound, request)
+            'replyto_comment': replyto_comment,
+        })
+        loader.dispatch()
+        return self.render(request, 'ticket.html', params)
+
+
+    def _mergeCommentsAndAttachments(self, ticket):
+        """
+        Interleave a windowed ticket's comments and attachments by time, with
+        a placeholder for the comments that were left out.
+        """
+        comments = ticket['comments']
+        attachments = ticket['attachments']
+        if not ticket['hidden_comments']:
+            return sorted(comments + attachments, key=lambda x:x['time'])
+
+        offset, count = ticket['hidden_comments']
+        head, tail = comments[:offset], comments[offset:]
+        after, before = head[-1]['time'], tail[0]['time']
+        head = head + [x for x in attachments if x['time'] <= after]
+        tail = tail + [x for x in attachments if x['time'] >= before]
+        hidden = self._hiddenPlaceholder(offset, count, after, before)
+        return (sorted(head, key=lambda x:x['time']) + [hidden]
+                + sorted(tail, key=lambda x:x['time']))
+
+
+    def _hiddenPlaceholder(self, offset, count, after, before):
+        """
+        Make a placeholder for C{count} comments starting at C{offset}, made
+        between the times C{after} and C{before}.
+        """
+        return {
+            'hidden': True,
+            'offset': offset,
+            'count': count,
+            'after': after,
+            'before': before,
+        }
+
+
+    @app.route('/ticket/<int:ticket_number>/comments', methods=['GET'])
+    def comments_GET(self, request, ticket_number):
+        """
+        Render the next run of comments (and the attachments added between
+        them) left out of a ticket page.  The query arguments come from a
+        placeholder made by L{_hiddenPlaceholder}.
+        """
+        def one(name):
+            return int(request.args.get(name, ['0'])[0])
+        try:
+            offset, count = one('offset'), one('count')
+            after, before = one('after'), one('before')
+        except ValueError:
+            request.setResponseCode(400)
+            return 'bad window'
+        limit = min(count, self.comment_window)
+
+        store = TicketStore(self.runnerFor(request), getUser(request))
+        d = defer.gatherResults([
+            store.fetchCommentWindow(ticket_number, after, limit),
+            store.fetchTicket(ticket_number, fields=['attachments']),
+        ], consumeErrors=True)
+        d.addErrback(lambda err: err.value.subFailure)
+
+        def render(results):
+            window, ticket = results
+            comments = window['comments']
+            rest = count - len(comments)
+            last = before
+            if rest > 0 and comments:
+                last = comments[-1]['time']
+            items = comments + [x for x in ticket['attachments']
+                                if after < x['time'] <= last
+                                and x['time'] < before]
+            items.sort(key=lambda x:x['time'])
+            if rest > 0 and comments:
+                items.append(self._hiddenPlaceholder(offset + len(comments),
+                                                     rest, last, before))
+            ticket['commentsAndAttachments'] = items
+            return self.render(request, 'ticket_comments.html', {
+                'ticket': ticket,
+            })
+        d.addCallback(render)
+        return d.addErrback(self._notFound, request)
+
+
+    @app.route('/ticket/<int:ticket_number>/history', methods=['GET'])
+    def history_GET(self, request, ticket_number):
+        """
+        Show a ticket's fields as they were at C{?time=} (seconds since the
+        epoch; the latest change if not given), with links to each of its
+        changes.
+        """
+        store = TicketStore(self.runnerFor(request), getUser(request),
+                            snapshots=self.snapshots)
+        try:
+            when = int(request.args.get('time', [time.time()])[0])
+        except ValueError:
+            request.setResponseCode(400)
+            return 'bad time'
+        d = defer.gatherResults([
+            store.fetchTicketAsOf(ticket_number, when),
+            store.fetchComments(ticket_number),
+        ], consumeErrors=True)
+        d.addErrback(lambda err: err.value.subFailure)
+
+        def render(results):
+            ticket, comments = results
+            fields = sorted((k, v) for k, v in ticket.items()
+                            if k not in ('id', 'attachments'))
+            return self.render(request, 'ticket_history.html', {
+                'ticket': ticket,
+                'time': when,
+                'fields': fields,
+                'comments': comments,
+            })
+        d.addCallback(render)
+        return d.addErrback(self._notFound, request)
 
 
     @app.route('/ticket/<int:ticket_number>', methods=['POST'])
     def ticket_POST(self, request, ticket_number):
         user = getUser(request)
-        store = TicketStore(self.runner, user)
+        store = TicketStore(self.runnerFor(request, 'write'), user,
+                            bus=self.bus, stats=self.ticket_stats)
 
         def one(name):
             return request.args.get(name, [''])[0]
@@ -422,12 +842,24 @@ class TicketApp(object):
             return 'not a valid action'
 
 
-        d = store.updateTicket(ticket_number, data, comment, replyto)
+        d = defer.succeed(None)
+        if comment:
+            d = self._checkSpam(request, 'update', ticket_number, data,
+                                comment, comment, replyto)
+        def checked(held):
+            if held:
+                return held
+            d = store.updateTicket(ticket_number, data, comment, replyto)
+            return d.addCallback(cb, request, ticket_number)
         def cb(ignore, request, ticket_number):
             request.redirect(str(ticket_number))
             return ''
-        d.addCallback(cb, request, ticket_number)
-        return d.addErrback(lambda err: 'There was an error')
+        d.addCallback(checked)
+        def failed(err):
+            if err.check(Overloaded):
+                return err
+            return 'There was an error'
+        return d.addErrback(failed)
 
 
     @app.route('/ticket/<int:ticket_number>/attachments', methods=['GET'])
@@ -452,7 +884,8 @@ class TicketApp(object):
 
         # XXX we should probably make sure the ticket exists
 
-        store = TicketStore(self.runner, user)
+        store = TicketStore(self.runnerFor(request, 'write'), user,
+                            bus=self.bus)
 
         description = request.args.get('description', [''])[0]
         ip = request.getClientIP()
@@ -492,6 +925,8 @@ class TicketApp(object):
 
 
         def eb(err, request):
+            if err.value.subFailure.check(Overloaded):
+                return err.value.subFailure
             request.setResponseCode(400)
             return ('Error.  Maybe there is already a file by that name on this'
                     ' ticket?')
@@ -500,59 +935,161 @@ class TicketApp(object):
         return d.addCallback(cb, request, ticket_number).addErrback(eb, request)
 
 
-    def _notFound(self, err, request):
-        err.trap(NotFoundError)
-        return NoResource().render(request)
+    @app.route('/ticket/<int:ticket_number>/events', methods=['GET'])
+    def ticket_events(self, request, ticket_number):
+        """
+        Stream changes to one ticket as Server-Sent Events.
+        """
+        return self.events.resource(ticket_number)
 
 
-    def resource(self):
-        return self.app.resource()
+    @app.route('/events', methods=['GET'])
+    def events_GET(self, request):
+        """
+        Stream changes to every ticket as Server-Sent Events.
+        """
+        return self.events.resource()
 
 
-    def _cacheValue(self, value, name):
-        self._cache[name] = value
-        return value
+    @defer.inlineCallbacks
+    def _checkSpam(self, request, kind, ticket_number, data, content,
+                   comment=None, replyto=None):
+        """
+        Check a submission with the spam filter, and hold it if it looks
+        like spam.
+
+        @return: A Deferred which fires with the page to show if it was
+            held, or C{None} if it should go ahead.
+        """
+        user = getUser(request)
+        if self.spam is None or not user:
+            # Nothing's made without a user anyway.
+            defer.returnValue(None)
+        headers = formatHeaders(request.getAllHeaders())
+        result = yield self.spam.check(request.path, user, bool(user),
+                                       request.getClientIP(),
+                                       headers.decode('utf-8', 'replace'),
+                                       content.decode('utf-8', 'replace'))
+        if not result['hold']:
+            defer.returnValue(None)
+        yield self.spam.hold(result['id'], kind, ticket_number, user, data,
+                             comment, replyto)
+        request.setResponseCode(202)
+        defer.returnValue(self.render(request, 'spam_held.html', {
+            'ticket_number': ticket_number,
+        }))
 
 
-    def getCachedValue(self, name, func, *args, **kwargs):
-        if name in self._cache:
-            return defer.succeed(self._cache[name])
-        d = defer.maybeDeferred(func, *args, **kwargs)
-        return d.addCallback(self._cacheValue, name)
+    @defer.inlineCallbacks
+    def _moderator(self, request):
+        if self.spam is None:
+            defer.returnValue(False)
+        allowed = yield self.spam.isModerator(getUser(request))
+        defer.returnValue(allowed)
 
 
-    def getComponents(self, request):
-        store = TicketStore(self.runner, getUser(request))
-        return self.getCachedValue('components', store.fetchComponents)
+    @app.route('/spam', methods=['GET'])
+    def spam_GET(self, request):
+        """
+        Show the submissions held by the spam filter, to a moderator.
+        """
+        def allowed(moderator):
+            if not moderator:
+                request.setResponseCode(403)
+                return 'you must be a moderator'
+            d = self.spam.fetchHeld()
+            return d.addCallback(lambda held: self.render(
+                request, 'spam.html', {'held': held}))
+        return self._moderator(request).addCallback(allowed)
+
+
+    @app.route('/spam/<int:log_id>', methods=['POST'])
+    def spam_POST(self, request, log_id):
+        """
+        Take a moderator's C{decision} (C{spam} or C{ham}) on a held
+        submission, making it if it's ham.
+        """
+        decision = request.args.get('decision', [''])[0]
+        if decision not in ('spam', 'ham'):
+            request.setResponseCode(400)
+            return 'decision must be spam or ham'
+        def allowed(moderator):
+            if not moderator:
+                request.setResponseCode(403)
+                return 'you must be a moderator'
+            d = self.spam.decide(log_id, decision == 'spam')
+            d.addCallback(decided)
+            return d.addErrback(self._notFound, request)
+        def decided(held):
+            if decision == 'spam':
+                return back()
+            # Made as its author, as it would have been.
+            store = TicketStore(self.runnerFor(request, 'write'),
+                                held['author'], bus=self.bus,
+                                stats=self.ticket_stats)
+            if held['kind'] == 'create':
+                d = store.createTicket(held['data'])
+            else:
+                d = store.updateTicket(held['ticket'], held['data'],
+                                       held['comment'], held['replyto'])
+            return d.addCallback(lambda ignored: back())
+        def back():
+            request.redirect('../spam')
+            return ''
+        return self._moderator(request).addCallback(allowed)
 
 
-    def getMilestones(self, request):
-        store = TicketStore(self.runner, getUser(request))
-        return self.getCachedValue('milestones', store.fetchMilestones)
+    def _notFound(self, err, request):
+        err.trap(NotFoundError)
+        return NoResource().render(request)
 
 
-    def getSeverities(self, request):
-        store = TicketStore(self.runner, getUser(request))
-        return self.getCachedValue('severities',
-            store.fetchEnum, 'severity')
+    def resource(self):
+        return self.app.resource()
 
 
-    def getPriorities(self, request):
-        store = TicketStore(self.runner, getUser(request))
-        return self.getCachedValue('priorities',
-            store.fetchEnum, 'priority')
+    def _cacheValue(self, value, name, started):
+        self.choices.set(name, value, self.choices_cache_ttl,
+                         time.time() - started)
+        return value
 
 
-    def getResolutions(self, request):
-        store = TicketStore(self.runner, getUser(request))
-        return self.getCachedValue('resolutions',
-            store.fetchEnum, 'resolution')
+    def getCachedValue(self, name, loader, func, *args):
+        """
+        Get a value from my cache, or have C{loader} look it up with C{func}.
 
+        @return: The cached value, or a C{Deferred} if it had to be looked up.
+        """
+        value = self.choices.peek(name)
+        if value is not None:
+            return value
+        d = loader.load(func, *args)
+        return d.addCallback(self._cacheValue, name, time.time())
 
-    def getTicketTypes(self, request):
-        store = TicketStore(self.runner, getUser(request))
-        return self.getCachedValue('ticket_types',
-            store.fetchEnum, 'ticket_type')
+
+    def getMetadata(self, store, loader):
+        """
+        Get the components, milestones and enums used by the ticket forms.
+
+        @param store: A L{TicketStore}.
+        @param loader: The L{PageLoader} for the page being built.
+
+        @return: A dict of template parameters.
+        """
+        return {
+            'components': self.getCachedValue('components', loader,
+                store.fetchComponents),
+            'milestones': self.getCachedValue('milestones', loader,
+                store.fetchMilestones),
+            'severities': self.getCachedValue('severities', loader,
+                store.fetchEnum, 'severity'),
+            'priorities': self.getCachedValue('priorities', loader,
+                store.fetchEnum, 'priority'),
+            'resolutions': self.getCachedValue('resolutions', loader,
+                store.fetchEnum, 'resolution'),
+            'ticket_types': self.getCachedValue('ticket_types', loader,
+                store.fetchEnum, 'ticket_type'),
+        }
 
 
 
@@ -560,29 +1097,45 @@ class PersonaAuthApp(object):
 
 
     app = Klein()
-    verification_url = 'https://verifier.login.persona.org/verify'
     cookie_name = 'trac_auth'
     secure_cookie = True
 
 
-    def __init__(self, runner, renderer, audience, frackRootPath):
+    def __init__(self, runner, renderer, audience, frackRootPath,
+                 verifier=None, admission=None):
+        """
+        @param verifier: The L{PersonaVerifier} to check assertions with.
+            By default, one which uses the public Persona verifier.
+        @param admission: An L{frack.admission.AdmissionController} which
+            database work must wait for, or C{None}.
+        """
+        if admission is not None:
+            runner = admission.runner(runner, 'auth')
         self.store = AuthStore(runner)
         self.audience = audience
         self.renderer = renderer
         self.frackRootPath = frackRootPath
+        if verifier is None:
+            verifier = PersonaVerifier(audience)
+        self.verifier = verifier
 
 
     def render(self, *args, **kwargs):
         return self.renderer.render(*args, **kwargs)
 
 
+    @app.handle_errors(Overloaded)
+    def overloaded(self, request, failure):
+        return overloadedResponse(request, failure)
+
+
     @app.route('/login')
     def login(self, request):
-        # XXX since I am lame, and want to see this working right now, I'm
-        # going to use requests.  I acknowledge the lameness.
         assertion = request.args['assertion'][0]
-        d = threads.deferToThread(self._getVerifiedEmail, assertion)
+        d = self.verifier.verify(assertion)
         d.addCallback(setEmail, request)
+        # The next request may go to another process.
+        d.addCallback(saveSession, request)
         
         d.addCallbacks(self.store.usernameFromEmail)
         d.addCallbacks(self._logThemIn, self._emailNotInUse,
@@ -590,26 +1143,6 @@ class PersonaAuthApp(object):
         return d
 
 
-    def _getVerifiedEmail(self, assertion):
-        """
-        Verify an assertion with the the provider.
-        """
-        data = {
-            'assertion': assertion,
-            'audience': self.audience,
-        }
-        response = requests.post(self.verification_url, data=data, verify=True)
-
-        if not response.ok:
-            raise UnauthorizedError('Verification failed')
-
-        verification_data = json.loads(response.content)
-
-        if verification_data['status'] == 'okay':
-            return verification_data['email']
-        raise UnauthorizedError('Verification failed')
-
-
     def _emailNotInUse(self, err, request):
         """
         This person has authenticated using an email address that isn't
@@ -628,10 +1161,9 @@ class PersonaAuthApp(object):
 
     def setTracCookie(self, cookie_value, request):
         # XXX what kind of expiration should it have?
-        # XXX add httponly
         request.addCookie(self.cookie_name, cookie_value.encode('utf-8'),
                           path='/',
-                          secure=self.secure_cookie)
+                          secure=self.secure_cookie, httpOnly=True)
 
 
     def jsonUserState(self, ignore, request):
@@ -671,8 +1203,10 @@ class PersonaAuthApp(object):
     def logout(self, request):
         setEmail(None, request)
         setUser(request, None)
-        request.addCookie(self.cookie_name, '', path='/', secure=self.secure_cookie)
-        return 'logged out'
+        request.addCookie(self.cookie_name, '', path='/',
+                          secure=self.secure_cookie, httpOnly=True)
+        d = saveSession(None, request)
+        return d.addCallback(lambda ignored: 'logged out')
 
 
 
@@ -5,18 +5,35 @@
 Components for simple web interface.
 """
 
-from twisted.internet import reactor
+import os
+import socket
+
+from twisted.internet import reactor, defer, task
 from twisted.internet.endpoints import serverFromString
 from twisted.application.service import Service
+from twisted.protocols.policies import WrappingFactory
 from twisted.web import static
-from twisted.web.resource import Resource
-from twisted.web.server import Site
+from twisted.web.resource import Resource, EncodingResourceWrapper
 
 from jinja2 import FileSystemLoader, Environment
 
 from frack.db import AuthStore
 from frack.web import TicketApp, PersonaAuthApp, Renderer, TracAuthWrapper
 from frack.files import DiskFileStore
+from frack.api import TicketAPI
+from frack.assets import staticFiles, loadManifest
+from frack.compression import CompressingEncoderFactory
+from frack.pubsub import Bus
+from frack.persona import PersonaVerifier
+from frack.session import SessionStore
+from frack.metrics import Metrics, MetricsSite
+from frack.cache import CacheRegistry
+from frack.mirror import ReadOnlyResource
+from frack.index import TicketIndex
+from frack import analytics
+from frack.analytics import History
+from frack.similar import SimilarTickets
+from frack.spam import SpamFilter
 
 
 
@@ -24,11 +41,50 @@ class WebService(Service):
     """
     Service for plain web interface for tickets
 
-    @param port: An endpoint description, suitable for `serverToString`.
+    @param port: An endpoint description, suitable for `serverToString`, or
+        C{fd:N} to accept connections on an inherited listening socket.
+    @param verifier: The L{PersonaVerifier} used for logging in.
+    @param cache: The L{frack.cache.TieredCache} to keep tickets in, or
+        C{None}.
+    @param admission: The L{frack.admission.AdmissionController} database
+        work waits for, or C{None} to let it all start straight away.
+    @param cacheBudget: The most bytes this process's caches may use, or
+        C{None} for no limit.
+    @param readOnly: If C{True}, refuse anything but C{GET} and C{HEAD}
+        requests, as a L{frack.mirror.Mirror} does.
+    @param primaryUrl: Where changes can be made when C{readOnly}, or
+        C{None}.
+    @param ticketIndex: If C{True}, keep a L{TicketIndex} for the API's
+        C{/search}.
+    @param ticketStats: If C{True}, keep the counts of L{frack.stats} up to
+        date and show them at C{/tickets/stats}.
+    @param snapshots: If C{True}, use the snapshots of L{frack.history}
+        to show tickets' history.
+    @param similarTickets: If C{True}, keep a L{SimilarTickets} index for
+        the API's C{/similar}, which suggests duplicates of new tickets.
+    @param spamThreshold: The score from 0 to 1 at which a
+        L{SpamFilter} holds new tickets and comments for moderators, or
+        C{None} not to check them.
+    @param spamThreads: The most threads scoring submissions at once.
+
+    @ivar metrics: The L{Metrics} of this process.
+    @ivar caches: The L{CacheRegistry} of this process's caches.
     """
+
+    # Seconds open connections are given to finish when stopping.
+    drainTimeout = 10
+
     def __init__(self, port, mediaPath, runner, templateRoot, fileRoot, baseUrl,
-                 secureCookies=True, frackRootPath=''):
+                 secureCookies=True, frackRootPath='', ticketFreshness=0,
+                 verifier=None, cache=None, admission=None, cacheBudget=None,
+                 readOnly=False, primaryUrl=None, ticketIndex=False,
+                 ticketStats=False, snapshots=False, similarTickets=False,
+                 spamThreshold=None, spamThreads=2):
         self.port = port
+        self.runner = runner
+        self.cache = cache
+        self.listeningPort = None
+        self.metrics = Metrics()
 
         self.root = Resource()
         file_store = DiskFileStore(fileRoot)
@@ -36,28 +92,159 @@ class WebService(Service):
         loader = FileSystemLoader(templateRoot)
         jinja_env = Environment(loader=loader)
         jinja_env.globals['frack_root'] = frackRootPath
-        renderer = Renderer(jinja_env)
+        renderer = Renderer(jinja_env, loadManifest(mediaPath))
+        encoders = [CompressingEncoderFactory()]
+
+        self.admission = admission
+        auth_store = AuthStore(self.admitted('auth'))
+        self.sessions = sessions = SessionStore(runner)
+        sessions.secureCookies = secureCookies
+        self.bus = Bus()
+
+        self.spam = None
+        if spamThreshold is not None:
+            self.spam = SpamFilter(self.admitted('write'),
+                                   spamThreshold, spamThreads)
 
-        auth_store = AuthStore(runner)
-        
         # ticket app
         ticket_app = TicketApp(runner, renderer, file_store,
-                               frackRootPath=frackRootPath)
+                               frackRootPath=frackRootPath,
+                               ticket_freshness=ticketFreshness,
+                               bus=self.bus, cache=cache,
+                               admission=admission,
+                               ticket_stats=ticketStats,
+                               snapshots=snapshots,
+                               spam=self.spam)
+        self.ticket_app = ticket_app
         self.root.putChild('tickets',
-            TracAuthWrapper(auth_store, ticket_app.app.resource()))
+            TracAuthWrapper(auth_store, EncodingResourceWrapper(
+                ticket_app.app.resource(), encoders), sessions))
 
         # authentication/registration app
+        if verifier is None:
+            verifier = PersonaVerifier(baseUrl)
+        self.verifier = verifier
         auth_app = PersonaAuthApp(runner, renderer, audience=baseUrl,
-                                  frackRootPath=frackRootPath)
+                                  frackRootPath=frackRootPath,
+                                  verifier=verifier, admission=admission)
         auth_app.secure_cookie = secureCookies
         self.root.putChild('auth',
-            TracAuthWrapper(auth_store, auth_app.app.resource()))
+            TracAuthWrapper(auth_store, EncodingResourceWrapper(
+                auth_app.app.resource(), encoders), sessions))
+
+        self.index = None
+        if ticketIndex:
+            self.index = TicketIndex()
+            self.index.subscribe(self.bus)
 
-        self.root.putChild('static', static.File(mediaPath))
+        self.similar = None
+        if similarTickets:
+            self.similar = SimilarTickets(self.admitted('read'))
+            self.similar.subscribe(self.bus)
+
+        self.history = None
+        if analytics.available:
+            self.history = History(self.admitted('read'))
+
+        # JSON API
+        api = Resource()
+        api_app = TicketAPI(runner, admission, self.bus, index=self.index,
+                            history=self.history, snapshots=snapshots,
+                            similar=self.similar)
+        api.putChild('v1', TracAuthWrapper(auth_store,
+            EncodingResourceWrapper(api_app.resource(), encoders)))
+        self.root.putChild('api', api)
+
+        self.root.putChild('static', staticFiles(mediaPath))
         self.root.putChild('files', static.File(fileRoot))
-        self.site = Site(self.root)
+        root = self.root
+        if readOnly:
+            root = ReadOnlyResource(root, primaryUrl)
+        self.site = MetricsSite(root, self.metrics)
+        self.factory = WrappingFactory(self.site)
+        self.metrics.gauge('open_connections',
+                           lambda: len(self.factory.protocols))
+        self.metrics.gauge('event_watchers',
+                           lambda: len(ticket_app.events.subscribers))
+        self.caches = CacheRegistry(cacheBudget)
+        if cache is not None and hasattr(cache.local, 'victim'):
+            self.caches.register('tickets', cache.local)
+        self.caches.register('choices', ticket_app.choices)
+        if hasattr(verifier, 'verified'):
+            self.caches.register('persona', verifier.verified)
+        self.caches.register('sessions', sessions)
+        if self.index is not None:
+            self.caches.register('index', self.index)
+        if self.similar is not None:
+            self.caches.register('similar', self.similar)
+        if self.spam is not None:
+            self.caches.register('spam', self.spam.classifier)
+        if self.history is not None:
+            self.caches.register('history', self.history)
+            self.caches.register('analytics', self.history.series)
+        self.metrics.source(self.caches.metrics)
+        if admission is not None:
+            self.metrics.gauge('admission_waiting', admission.waiting)
+            for kind in admission.limits:
+                self.metrics.gauge('admission_active_' + kind,
+                                   lambda kind=kind: admission.active[kind])
+                self.metrics.gauge('admission_rejected_' + kind,
+                                   lambda kind=kind: admission.rejected[kind])
+
+
+    def admitted(self, kind):
+        """
+        Get my runner for work of class C{kind}, which waits for a turn if
+        I have an L{frack.admission.AdmissionController}.
+        """
+        if self.admission is None:
+            return self.runner
+        return self.admission.runner(self.runner, kind)
 
 
     def startService(self):
-        self.endpoint = serverFromString(reactor, self.port)
-        self.endpoint.listen(self.site)
+        Service.startService(self)
+        if self.port.startswith('fd:'):
+            fd = int(self.port[3:])
+            self.listeningPort = reactor.adoptStreamPort(fd, socket.AF_INET,
+                                                         self.factory)
+            os.close(fd)
+        else:
+            self.endpoint = serverFromString(reactor, self.port)
+            d = self.endpoint.listen(self.factory)
+            d.addCallback(lambda port: setattr(self, 'listeningPort', port))
+        self.sessions.start()
+        if self.cache is not None:
+            self.cache.start()
+        if self.index is not None:
+            self.index.start(self.admitted('read'))
+        if self.similar is not None:
+            self.similar.start()
+        if self.spam is not None:
+            self.spam.start()
+
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        """
+        Stop accepting connections, and give the open ones C{drainTimeout}
+        seconds to finish before stopping.
+        """
+        Service.stopService(self)
+        if self.index is not None:
+            self.index.stop()
+        if self.similar is not None:
+            self.similar.stop()
+        if self.spam is not None:
+            self.spam.stop()
+        if self.listeningPort is not None:
+            yield self.listeningPort.stopListening()
+        self.ticket_app.events.close()
+        waited = 0
+        while self.factory.protocols and waited < self.drainTimeout:
+            yield task.deferLater(reactor, 0.1, lambda: None)
+            waited += 0.1
+        stopped = [self.sessions.stop(), self.verifier.close()]
+        if self.cache is not None:
+            stopped.append(self.cache.stop())
+        yield defer.gatherResults(stopped)
@@ -0,0 +1,428 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+"""
+Serving with several processes.
+
+With C{--workers N}, the process started by C{twistd} becomes a
+L{Supervisor}: it opens the listening socket and runs N copies of
+C{python -m frack.workers} which inherit it, so the kernel shares incoming
+connections between them.  Workers which die are started again, and
+sending the supervisor C{SIGHUP} replaces the workers one at a time, each
+only after its replacement is serving.  Every second each worker reports its
+L{frack.metrics.Metrics} to the supervisor over a pipe, and the supervisor
+serves the totals on the admin endpoint.
+
+The supervisor sends workers commands, one JSON object per line, on their
+standard input, and they answer on the metrics pipe with
+C{{"reply": id, "result": ...}} or C{{"reply": id, "error": message}}.
+This is how the admin endpoint profiles a worker.
+"""
+
+import os
+import sys
+import json
+import signal
+import shutil
+import socket
+import itertools
+
+from twisted.application.service import Service
+from twisted.internet import defer, protocol, error, stdio
+from twisted.internet.endpoints import serverFromString
+from twisted.internet.task import LoopingCall
+from twisted.protocols.basic import LineReceiver
+from twisted.python import log
+from twisted.web.server import Site
+
+from frack.admin import AdminResource
+from frack.metrics import aggregate
+from frack.profiler import profileFor
+
+
+# File descriptors of the listening socket and the metrics pipe in workers.
+LISTEN_FD = 3
+METRICS_FD = 4
+
+# Options which only make sense for the supervisor.
+SUPERVISOR_OPTIONS = ('workers', 'web', 'admin', 'admin_token')
+
+
+
+def parseTCP(description):
+    """
+    Get the port and interface from a C{tcp:} endpoint description.
+
+    @raise ValueError: If it isn't one.
+    """
+    parts = description.split(':')
+    if parts[0] != 'tcp':
+        raise ValueError('Only tcp: endpoints can be shared by workers, not '
+                         '%r' % (description,))
+    port = None
+    interface = ''
+    for part in parts[1:]:
+        if '=' in part:
+            name, value = part.split('=', 1)
+            if name == 'port':
+                port = int(value)
+            elif name == 'interface':
+                interface = value
+        elif port is None:
+            port = int(part)
+    if port is None:
+        raise ValueError('No port in %r' % (description,))
+    return port, interface
+
+
+def listeningSocket(description, backlog=128):
+    """
+    Open a listening socket for workers to share.
+    """
+    port, interface = parseTCP(description)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((interface, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+def workerArguments(config):
+    """
+    Get the command line options to pass on from the supervisor's
+    configuration to its workers.
+    """
+    args = []
+    for flag in config.optFlags:
+        name = flag[0]
+        if name not in SUPERVISOR_OPTIONS and config[name]:
+            args.append('--%s' % (name,))
+    for param in config.optParameters:
+        name = param[0]
+        if name not in SUPERVISOR_OPTIONS and config[name] is not None:
+            args.append('--%s=%s' % (name, config[name]))
+    return args
+
+
+
+class WorkerProtocol(protocol.ProcessProtocol):
+    """
+    The supervisor's end of one worker process.
+
+    @ivar ready: A Deferred which fires when the worker first reports, which
+        it does once it's serving.
+    @ivar ended: A Deferred which fires when the process has exited.
+    @ivar retiring: C{True} if the worker was asked to stop, and so
+        shouldn't be replaced when it does.
+    """
+
+    def __init__(self, supervisor):
+        self.supervisor = supervisor
+        self.ready = defer.Deferred()
+        self.ended = defer.Deferred()
+        self.retiring = False
+        self.metrics = {}
+        self._buffer = ''
+        self._calls = {}
+        self._ids = itertools.count()
+
+
+    def call(self, command, **kwargs):
+        """
+        Send the worker a command.
+
+        @return: A Deferred which fires with its result, or fails with
+            C{ValueError} if the worker reports an error.
+        """
+        callID = next(self._ids)
+        message = dict(kwargs, id=callID, command=command)
+        d = self._calls[callID] = defer.Deferred()
+        self.transport.write(json.dumps(message) + '\n')
+        return d
+
+
+    def childDataReceived(self, childFD, data):
+        if childFD != METRICS_FD:
+            return
+        lines = (self._buffer + data).split('\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                log.msg('Bad message from worker: %r' % (line,))
+                continue
+            if 'reply' in message:
+                self._replied(message)
+                continue
+            self.metrics = message
+            if not self.ready.called:
+                self.ready.callback(self)
+
+
+    def _replied(self, message):
+        d = self._calls.pop(message['reply'], None)
+        if d is None:
+            return
+        if 'error' in message:
+            d.errback(ValueError(message['error']))
+        else:
+            d.callback(message['result'])
+
+
+    def stop(self, sig='TERM'):
+        self.retiring = True
+        try:
+            self.transport.signalProcess(sig)
+        except error.ProcessExitedAlready:
+            pass
+
+
+    def processEnded(self, reason):
+        calls, self._calls = self._calls, {}
+        for d in calls.values():
+            d.errback(reason)
+        self.supervisor.workerEnded(self, reason)
+        self.ended.callback(None)
+
+
+
+class Supervisor(Service):
+    """
+    I run C{count} worker processes sharing one listening socket.
+    """
+
+    # Seconds to wait before replacing a worker that died, doubled each
+    # time a replacement dies before it's ready, up to maxBackoff.
+    backoff = 1
+    maxBackoff = 30
+
+    # Seconds stopping workers are given before they're killed.
+    killTimeout = 30
+
+
+    def __init__(self, count, port, workerArgs, admin=None, adminToken=None,
+                 tempDirectory=None, reactor=None):
+        """
+        @param count: Number of workers.
+        @param port: A C{tcp:} endpoint description to serve on.
+        @param workerArgs: Extra command line arguments for the workers.
+        @param admin: An endpoint description for the admin resource, or
+            C{None}.
+        @param tempDirectory: A directory made for the workers, to be
+            removed once they've stopped, or C{None}.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.count = count
+        self.port = port
+        self.workerArgs = workerArgs
+        self.admin = admin
+        self.adminToken = adminToken
+        self.tempDirectory = tempDirectory
+        self.workers = []
+        self.restarts = 0
+        self._delay = self.backoff
+        self._stopping = False
+        self._restarting = None
+
+
+    def startService(self):
+        Service.startService(self)
+        self.socket = listeningSocket(self.port)
+        for i in range(self.count):
+            self.spawn()
+        signal.signal(signal.SIGHUP, lambda *args:
+                      self.reactor.callFromThread(self.rollingRestart))
+        if self.admin:
+            resource = AdminResource(self.metrics, self.adminToken,
+                                     self.profile)
+            serverFromString(self.reactor, self.admin).listen(Site(resource))
+
+
+    def spawn(self):
+        """
+        Start a worker.
+
+        @return: Its L{WorkerProtocol}.
+        """
+        worker = WorkerProtocol(self)
+        args = [sys.executable, '-m', 'frack.workers'] + self.workerArgs
+        self.reactor.spawnProcess(worker, sys.executable, args,
+                                  env=os.environ,
+                                  childFDs={0: 'w', 1: 1, 2: 2,
+                                            LISTEN_FD: self.socket.fileno(),
+                                            METRICS_FD: 'r'})
+        self.workers.append(worker)
+        worker.ready.addCallback(self._workerReady)
+        return worker
+
+
+    def _workerReady(self, worker):
+        self._delay = self.backoff
+        return worker
+
+
+    def workerEnded(self, worker, reason):
+        self.workers.remove(worker)
+        if self._stopping or worker.retiring:
+            return
+        log.msg('Worker exited unexpectedly: %s' % (reason.getErrorMessage(),))
+        self.restarts += 1
+        self.reactor.callLater(self._delay, self._replace)
+        if not worker.ready.called:
+            # It didn't get going; don't start them as fast as they die.
+            self._delay = min(self._delay * 2, self.maxBackoff)
+
+
+    def _replace(self):
+        if not self._stopping and len(self.workers) < self.count:
+            self.spawn()
+
+
+    def rollingRestart(self):
+        """
+        Replace each worker in turn, stopping it only once its replacement
+        is serving.
+
+        @return: A Deferred which fires when they've all been replaced.
+        """
+        if self._restarting is None:
+            self._restarting = self._rollingRestart()
+            def done(result):
+                self._restarting = None
+                return result
+            self._restarting.addBoth(done)
+        return self._restarting
+
+
+    @defer.inlineCallbacks
+    def _rollingRestart(self):
+        for old in list(self.workers):
+            if self._stopping:
+                break
+            new = self.spawn()
+            yield defer.DeferredList([new.ready, new.ended],
+                                     fireOnOneCallback=True)
+            if not new.ready.called:
+                log.msg('Replacement worker failed; stopping rolling restart')
+                break
+            yield self._stopWorker(old)
+
+
+    def _stopWorker(self, worker):
+        worker.stop()
+        kill = self.reactor.callLater(self.killTimeout, worker.stop, 'KILL')
+        def ended(result):
+            if kill.active():
+                kill.cancel()
+            return result
+        return worker.ended.addBoth(ended)
+
+
+    def stopService(self):
+        Service.stopService(self)
+        self._stopping = True
+        d = defer.gatherResults([self._stopWorker(w) for w in self.workers])
+        d.addCallback(lambda ignored: self.socket.close())
+        if self.tempDirectory is not None:
+            d.addCallback(lambda ignored: shutil.rmtree(self.tempDirectory,
+                                                        ignore_errors=True))
+        return d
+
+
+    def metrics(self):
+        """
+        Get the workers' metrics, added up.
+        """
+        totals = aggregate([w.metrics for w in self.workers if w.metrics])
+        totals['worker_count'] = len(self.workers)
+        totals['worker_restarts'] = self.restarts
+        return totals
+
+
+    def profile(self, seconds, format='collapsed', interval=0.005, pid=None):
+        """
+        Profile one worker: the one with process ID C{pid}, or any.
+
+        @return: A Deferred which fires with the profile, as from
+            L{profileFor}.
+        """
+        ready = [w for w in self.workers
+                 if w.ready.called and not w.retiring
+                 and (pid is None or w.metrics.get('pid') == pid)]
+        if not ready:
+            raise ValueError('No such worker')
+        return ready[0].call('profile', seconds=seconds, format=format,
+                             interval=interval)
+
+
+
+class WorkerControl(LineReceiver):
+    """
+    The worker's end of its pipes to the supervisor: I read commands from
+    standard input, and write replies and metrics to the metrics pipe.
+    """
+
+    delimiter = '\n'
+
+    def __init__(self, profile=profileFor):
+        self.commands = {'profile': profile}
+
+
+    def send(self, message):
+        self.sendLine(json.dumps(message))
+
+
+    def lineReceived(self, line):
+        try:
+            message = json.loads(line)
+            callID = message.pop('id')
+            command = self.commands[message.pop('command')]
+        except (ValueError, KeyError):
+            log.msg('Bad command from supervisor: %r' % (line,))
+            return
+        def done(result):
+            self.send({'reply': callID, 'result': result})
+        def failed(failure):
+            if not failure.check(ValueError):
+                log.err(failure, 'Error running %r' % (line,))
+            self.send({'reply': callID, 'error': failure.getErrorMessage()})
+        d = defer.maybeDeferred(command, **message)
+        d.addCallbacks(done, failed)
+
+
+    def reportMetrics(self, metrics):
+        """
+        Write a snapshot of C{metrics} to the supervisor.
+        """
+        self.send(metrics.snapshot())
+
+
+def main(argv=None):
+    """
+    Run a worker.
+    """
+    from twisted.internet import reactor
+    from frack.service import Options, makeService
+
+    config = Options()
+    config.parseOptions(sys.argv[1:] if argv is None else argv)
+    config['web'] = 'fd:%d' % (LISTEN_FD,)
+    service = makeService(config)
+
+    log.startLogging(sys.stderr)
+    control = WorkerControl()
+    stdio.StandardIO(control, stdin=0, stdout=METRICS_FD)
+    reporter = LoopingCall(control.reportMetrics, service.web.metrics)
+    def start():
+        service.startService()
+        reporter.start(1)
+    reactor.callWhenRunning(start)
+    reactor.addSystemEventTrigger('before', 'shutdown', service.stopService)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()